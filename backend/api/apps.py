@@ -1,6 +1,16 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self) -> None:
+        from backend.settings import GRAPHQL_METRICS
+        from api.cost import check_budget_cache
+        from api.metrics import instrument_connection
+
+        check_budget_cache()
+        if GRAPHQL_METRICS:
+            connection_created.connect(instrument_connection)
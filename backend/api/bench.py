@@ -0,0 +1,664 @@
+"""Scenarios benchmarking the API and the consumer against synthetic data, run by
+the benchmark_suite command."""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from decimal import Decimal
+import http.client
+import json
+import math
+import os
+import random
+import re
+import tempfile
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Avg, Min, Max
+from django.http import HttpRequest, HttpResponse
+from django.test import RequestFactory, override_settings
+from django.utils import timezone
+import websockets
+
+from api.caching import bump_data_version
+from api.documents import DocumentCache, query_hash
+from api.fake_feed import FakeFeed
+from api.fields import STORAGES, convert_storage
+from api.ingest import load_readings
+from api.management.commands.consume_feed import (
+    FeedPipeline,
+    FeedStatus,
+    PipelineMetrics,
+)
+from api.management.commands.convert_value_storage import current_storage
+from api.models import ReadConfig, Temperature, TemperatureRollup
+from api.pubsub import ReadingPublisher
+from api.schema import schema
+from api.views import CachedGraphQLView
+
+
+# interval between two readings of the default feed.
+FEED_PERIOD = timedelta(seconds=0.5)
+
+
+def synthetic_readings(
+    count: int, start: datetime, period: timedelta = FEED_PERIOD, seed: int = 0
+) -> Iterator[Temperature]:
+    """Generate temperature readings following a daily cycle, plus some noise.
+
+    Args:
+        count (int): number of readings
+        start (datetime): timestamp of the first reading
+        period (timedelta): interval between two readings
+        seed (int): seed of the noise, for reproducible data sets
+    """
+    noise = random.Random(seed)
+    day = timedelta(days=1).total_seconds()
+    for index in range(count):
+        timestamp = start + index * period
+        cycle = math.sin(2 * math.pi * (timestamp.timestamp() % day) / day)
+        value = 10 + 15 * cycle + noise.gauss(0, 2)
+        yield Temperature(timestamp=timestamp, value=Decimal(f"{value:.15f}"))
+
+
+def seed_readings(
+    count: int, period: timedelta = FEED_PERIOD, batch_size: int = 10000
+) -> datetime:
+    """Append `count` synthetic readings after the latest one in db, along with
+    their rollups, by batches of `batch_size` (copied on PostgreSQL).
+
+    Returns:
+        datetime: timestamp of the last inserted reading
+    """
+    latest = Temperature.objects.order_by("-timestamp").first()
+    start = latest.timestamp + period if latest else timezone.now() - count * period
+    batch: List[Temperature] = []
+    for reading in synthetic_readings(count, start, period, seed=count):
+        batch.append(reading)
+        if len(batch) >= batch_size:
+            load_readings(batch)
+            batch = []
+    load_readings(batch)
+    return start + (count - 1) * period
+
+
+def time_call(func: Callable[[], Any], repeat: int = 50) -> Dict[str, float]:
+    """Call `func` `repeat` times and return latency percentiles, in milliseconds."""
+    durations = []
+    for _ in range(max(repeat, 1)):
+        started = time.perf_counter()
+        func()
+        durations.append((time.perf_counter() - started) * 1000)
+    return percentiles(durations)
+
+
+def percentiles(durations: List[float]) -> Dict[str, float]:
+    """p50, p99 and max of a non-empty list of durations, sorted in place."""
+    durations.sort()
+    return {
+        "p50": percentile(durations, 50),
+        "p99": percentile(durations, 99),
+        "max": durations[-1],
+    }
+
+
+def percentile(ordered: List[float], rank: float) -> float:
+    """Nearest-rank percentile of an ordered list of values."""
+    index = max(math.ceil(rank / 100 * len(ordered)) - 1, 0)
+    return ordered[index]
+
+
+def current_temperature_query() -> Optional[Temperature]:
+    """Query run by currentTemperature on a cache miss."""
+    return Temperature.objects.order_by("-timestamp").first()
+
+
+def statistics_query(after: datetime, before: datetime) -> Dict[str, Any]:
+    """Raw-table query run by temperatureStatistics."""
+    return Temperature.objects.filter(
+        timestamp__gte=after, timestamp__lte=before
+    ).aggregate(Min("value"), Max("value"))
+
+
+# window sizes, as "30s", "15m", "1h", "7d" or "2w".
+WINDOW_UNITS = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days", "w": "weeks"}
+WINDOW_PATTERN = re.compile(r"^(\d+)([smhdw])$")
+# sensor of the readings ingested by the consumer benchmark, deleted afterwards.
+BENCH_SENSOR = "benchmark"
+
+
+def parse_window(window: str) -> timedelta:
+    """Duration of a window size such as "1h".
+
+    Raises:
+        ValueError: if the window size is invalid
+    """
+    match = WINDOW_PATTERN.match(window.strip())
+    if not match:
+        raise ValueError(f"invalid window {window!r}")
+    return timedelta(**{WINDOW_UNITS[match.group(2)]: int(match.group(1))})
+
+
+async def ingest_throughput(
+    count: int,
+    batch_size: int = 100,
+    writers: int = 1,
+    queue_size: int = 10000,
+    timeout: float = 600,
+) -> Dict[str, Any]:
+    """Consume `count` readings from a local fake feed, sent as fast as possible,
+    and measure how fast they are persisted.
+
+    The readings are tagged with BENCH_SENSOR, and deleted along with their rollups
+    afterwards. They are neither cached nor published, and spilled, if ever, to a
+    file of their own: a consumer running alongside is left alone.
+
+    Raises:
+        asyncio.TimeoutError: if the readings are not persisted within `timeout`
+    """
+    await ReadConfig.objects.aupdate_or_create(
+        config_key="status", defaults={"config_value": "on"}
+    )
+    feed = FakeFeed(count)
+    server = await feed.serve()
+    port = server.sockets[0].getsockname()[1]
+    spill_dir = tempfile.TemporaryDirectory()
+    pipeline = FeedPipeline(
+        writers=writers,
+        queue_size=queue_size,
+        batch_size=batch_size,
+        spill_path=os.path.join(spill_dir.name, "spill.jsonl"),
+        status=FeedStatus("on", interval=timeout),
+        log=lambda message: None,
+        live=False,
+    )
+    started = time.perf_counter()
+    consumer = asyncio.create_task(
+        pipeline.run({BENCH_SENSOR: f"ws://127.0.0.1:{port}/graphql"})
+    )
+    try:
+
+        async def persisted() -> None:
+            while pipeline.metrics.persisted < count:
+                await asyncio.sleep(0.01)
+
+        await asyncio.wait_for(persisted(), timeout)
+        seconds = time.perf_counter() - started
+    finally:
+        consumer.cancel()
+        await asyncio.gather(consumer, return_exceptions=True)
+        server.close()
+        await server.wait_closed()
+        await sync_to_async(delete_sensor)(BENCH_SENSOR)
+        spill_dir.cleanup()
+    return {
+        "readings": count,
+        "batch_size": batch_size,
+        "writers": writers,
+        "seconds": seconds,
+        "rate": count / seconds,
+        "max_lag": pipeline.metrics.max_lag,
+    }
+
+
+def delete_sensor(sensor: str) -> None:
+    """Delete the readings of a sensor and their rollups."""
+    Temperature.objects.filter(sensor=sensor).delete()
+    TemperatureRollup.objects.filter(sensor=sensor).delete()
+    bump_data_version()
+
+
+def latency_key(result: Dict[str, Any]) -> Tuple[Any, ...]:
+    """What a latency result measures."""
+    return result["query"], result["rows"], result.get("window")
+
+
+def compare_results(
+    baseline: Dict[str, Any], current: Dict[str, Any], tolerance: float = 0.2
+) -> List[str]:
+    """Regressions of the results of a benchmark suite from a baseline: latencies
+    (p50 and p99) higher, or an ingest rate lower, by more than `tolerance`.
+
+    Only the measures found in both results are compared.
+    """
+    regressions = []
+    latencies = {latency_key(result): result for result in baseline["latencies"]}
+    for result in current["latencies"]:
+        before = latencies.get(latency_key(result))
+        if before is None:
+            continue
+        for name in ("p50", "p99"):
+            if result[name] > before[name] * (1 + tolerance):
+                query, rows, window = latency_key(result)
+                label = f"{query} {window}" if window else query
+                regressions.append(
+                    f"{label} at {rows} rows: {name} "
+                    f"{before[name]:.3f} -> {result[name]:.3f} ms"
+                )
+    ingest, before = current.get("ingest"), baseline.get("ingest")
+    if ingest and before and ingest["rate"] < before["rate"] * (1 - tolerance):
+        regressions.append(
+            f"ingest rate: {before['rate']:.0f} -> {ingest['rate']:.0f} readings/s"
+        )
+    return regressions
+
+
+# a dashboard query, as sent by the clients every few seconds.
+DASHBOARD_QUERY = """
+query Dashboard($lastHour: DateTime, $lastDay: DateTime) {
+  currentTemperature {
+    timestamp
+    value
+  }
+  lastHour: temperatureStatistics(after: $lastHour) {
+    min
+    max
+    avg
+  }
+  lastDay: temperatureStatistics(after: $lastDay) {
+    min
+    max
+    avg
+    p95
+  }
+}
+"""
+# a query resolved without any db access, to measure the request overhead only.
+OVERHEAD_QUERY = """
+query Overhead {
+  __schema {
+    queryType {
+      name
+    }
+  }
+}
+"""
+# a page of the history: the most fields per request.
+HISTORY_QUERY = """
+query History {
+  temperatures(first: 500) {
+    edges {
+      node {
+        timestamp
+        value
+      }
+    }
+  }
+}
+"""
+SUBSCRIPTION = "subscription { temperature { timestamp value } }"
+
+View = Callable[[HttpRequest], HttpResponse]
+
+
+class UncachedGraphQLView(CachedGraphQLView):
+    """CachedGraphQLView parsing and validating each request, as the plain
+    GraphQLView does (which can't execute the async resolvers)."""
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.documents = DocumentCache(
+            self.schema.graphql_schema, self.validation_rules, size=0
+        )
+
+
+def graphql_request(body: str, view: Optional[View] = None) -> Callable[[], None]:
+    """POST of a /graphql request to `view` (by default the API's), as sent by the
+    clients."""
+    view = view or CachedGraphQLView.as_view(schema=schema)
+    factory = RequestFactory()
+
+    def post() -> None:
+        response = view(factory.post("/graphql", body, content_type="application/json"))
+        assert response.status_code == 200, response.content
+
+    return post
+
+
+def query_plans(latest: datetime, window: timedelta) -> Dict[str, str]:
+    """Plans of the raw-table queries of currentTemperature, and of
+    temperatureStatistics over `window` ending at `latest`."""
+    return {
+        "currentTemperature": Temperature.objects.order_by("-timestamp")[:1].explain(),
+        "temperatureStatistics": Temperature.objects.filter(
+            timestamp__gte=latest - window, timestamp__lte=latest
+        ).explain(),
+    }
+
+
+def document_latencies(repeat: int = 500) -> List[Dict[str, Any]]:
+    """Latencies and body sizes of the dashboard query and of a query without any
+    db access, served without the document cache (parsing and validating each
+    request), by the cached documents, and as persisted queries sent by their hash
+    only."""
+    views: Dict[str, View] = {
+        "no cache": UncachedGraphQLView.as_view(schema=schema),
+        "document cache": CachedGraphQLView.as_view(schema=schema),
+        "persisted query": CachedGraphQLView.as_view(schema=schema),
+    }
+    results = []
+    for name, query in (("dashboard", DASHBOARD_QUERY), ("overhead", OVERHEAD_QUERY)):
+        extensions = {"persistedQuery": {"version": 1, "sha256Hash": query_hash(query)}}
+        # registers the persisted query.
+        graphql_request(
+            json.dumps({"query": query, "extensions": extensions}),
+            views["persisted query"],
+        )()
+        for label, view in views.items():
+            if label == "persisted query":
+                body = json.dumps({"extensions": extensions})
+            else:
+                body = json.dumps({"query": query})
+            timings = time_call(graphql_request(body, view), repeat)
+            results.append(
+                {"query": name, "view": label, "body_bytes": len(body), **timings}
+            )
+    return results
+
+
+def metrics_overhead(repeat: int = 200, rounds: int = 5) -> Dict[str, Any]:
+    """Latencies of the dashboard query and of a page of the history with and
+    without the metrics (resolver middleware, SQL accounting, document and
+    execution timings), and cost of the consumer metrics per reading.
+
+    The views are measured `rounds` times in turn, for both to suffer the same
+    noise, and the best measure of each is kept.
+    """
+    views: Dict[str, View] = {
+        "off": CachedGraphQLView.as_view(schema=schema, metrics=False, middleware=[]),
+        "on": CachedGraphQLView.as_view(schema=schema, metrics=True, middleware=[]),
+    }
+    requests = []
+    for name, query in (("dashboard", DASHBOARD_QUERY), ("history", HISTORY_QUERY)):
+        body = json.dumps({"query": query})
+        timings: Dict[str, Dict[str, float]] = {}
+        for _ in range(max(rounds, 1)):
+            for label, view in views.items():
+                measured = time_call(graphql_request(body, view), repeat)
+                if label not in timings or measured["p50"] < timings[label]["p50"]:
+                    timings[label] = measured
+        off, on = timings["off"], timings["on"]
+        requests.append(
+            {
+                "query": name,
+                "off_p50": off["p50"],
+                "off_p99": off["p99"],
+                "on_p50": on["p50"],
+                "on_p99": on["p99"],
+                "overhead": (on["p50"] - off["p50"]) / off["p50"],
+            }
+        )
+    metrics = PipelineMetrics()
+    count = 100000
+    started = time.perf_counter()
+    for _ in range(count):
+        metrics.record_received(Temperature.DEFAULT_SENSOR)
+    received = (time.perf_counter() - started) / count * 1e6
+    return {"requests": requests, "consumer_us_per_reading": received}
+
+
+# settings of the default connection compared, the last ones on PostgreSQL only.
+CONNECTION_CONFIGURATIONS: Dict[str, Dict[str, Any]] = {
+    "per request": {"CONN_MAX_AGE": 0, "OPTIONS": {}},
+    "persistent": {"CONN_MAX_AGE": 600, "OPTIONS": {}},
+    "pool": {"CONN_MAX_AGE": 0, "OPTIONS": {"pool": {"min_size": 1, "max_size": 1}}},
+    "pool+prepared": {
+        "CONN_MAX_AGE": 0,
+        "OPTIONS": {
+            "pool": {"min_size": 1, "max_size": 1},
+            "server_side_binding": True,
+            "prepare_threshold": 1,
+        },
+    },
+}
+
+
+def configure_connection(settings: Dict[str, Any]) -> None:
+    """Apply connection settings, starting without any open connection."""
+    connection.close()
+    if connection.vendor == "postgresql":
+        connection.close_pool()  # type: ignore
+    connection.settings_dict.update(settings)
+
+
+def connection_latencies(
+    latest: Temperature, window: timedelta, repeat: int = 200
+) -> List[Dict[str, Any]]:
+    """Latencies of a request running the hot queries (latest reading, min/max over
+    `window`, insert of a reading, rolled back) with a connection per request,
+    persistent connections, a pool and a pool of connections preparing their
+    statements.
+
+    The settings of the default connection are restored afterwards.
+    """
+    after = latest.timestamp - window
+    original = {
+        key: connection.settings_dict[key] for key in CONNECTION_CONFIGURATIONS["pool"]
+    }
+
+    def request() -> None:
+        current_temperature_query()
+        statistics_query(after, latest.timestamp)
+        with transaction.atomic():
+            Temperature.objects.create(
+                timestamp=latest.timestamp + timedelta(days=365), value=latest.value
+            )
+            transaction.set_rollback(True)
+        # as at the end of each request.
+        close_old_connections()
+
+    results = []
+    try:
+        for name, settings in CONNECTION_CONFIGURATIONS.items():
+            if "pool" in settings["OPTIONS"] and connection.vendor != "postgresql":
+                continue
+            configure_connection(settings)
+            request()  # warm up
+            results.append({"connections": name, **time_call(request, repeat)})
+    finally:
+        configure_connection(original)
+    return results
+
+
+def table_size() -> int:
+    """Size of the Temperature table and its indexes, in bytes."""
+    table = Temperature._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute("SELECT pg_total_relation_size(%s)", [table])
+        else:
+            # requires sqlite to be compiled with SQLITE_ENABLE_DBSTAT_VTAB.
+            cursor.execute(
+                "SELECT SUM(pgsize) FROM dbstat WHERE name = %s OR name IN "
+                "(SELECT name FROM sqlite_master WHERE tbl_name = %s)",
+                [table, table],
+            )
+        return cursor.fetchone()[0]
+
+
+def storage_comparison(
+    latest: Temperature, ingest: int = 20000, repeat: int = 20
+) -> List[Dict[str, Any]]:
+    """Size per row, bulk insert rate of `ingest` readings (rolled back) and
+    aggregate latencies of the decimal, fixed and float value storages.
+
+    The value column is converted in place for each storage, then back to its
+    original storage.
+    """
+    rows = Temperature.objects.count()
+    window = Temperature.objects.filter(
+        timestamp__gte=latest.timestamp - timedelta(days=1)
+    )
+    original = previous = current_storage()
+    results = []
+    for storage in STORAGES:
+        with override_settings(TEMPERATURE_VALUE_STORAGE=storage):
+            with connection.schema_editor() as editor:
+                convert_storage(editor, Temperature, "value", previous, storage)
+            previous = storage
+            # measure the rewritten table without its dead rows.
+            with connection.cursor() as cursor:
+                cursor.execute("VACUUM")
+            size = table_size() / rows
+            readings = list(
+                synthetic_readings(ingest, latest.timestamp + timedelta(days=365))
+            )
+            with transaction.atomic():
+                started = time.perf_counter()
+                Temperature.objects.bulk_create(readings, batch_size=1000)
+                rate = len(readings) / (time.perf_counter() - started)
+                transaction.set_rollback(True)
+            extremes = time_call(
+                lambda: window.aggregate(Min("value"), Max("value")), repeat
+            )
+            average = time_call(
+                lambda: Temperature.objects.aggregate(
+                    Avg("value", output_field=Temperature._meta.get_field("value"))
+                ),
+                max(repeat // 4, 1),
+            )
+            results.append(
+                {
+                    "storage": storage,
+                    "bytes_per_row": size,
+                    "ingest_rate": rate,
+                    "min_max_1d_p50": extremes["p50"],
+                    "avg_all_p50": average["p50"],
+                }
+            )
+    with connection.schema_editor() as editor:
+        convert_storage(editor, Temperature, "value", previous, original)
+    return results
+
+
+def load_client(url: str, body: bytes, deadline: float) -> Tuple[List[float], int]:
+    """Send requests on a keep-alive connection until the deadline.
+
+    Returns:
+        Tuple[List[float], int]: latencies of the successful requests, in
+            milliseconds, and number of failed requests
+    """
+    parts = urlsplit(url)
+    client = http.client.HTTPConnection(parts.netloc, timeout=60)
+    headers = {"Content-Type": "application/json"}
+    durations, failures = [], 0
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        try:
+            client.request("POST", parts.path, body, headers)
+            response = client.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            failures += 1
+            client.close()
+            continue
+        if response.status == 200:
+            durations.append((time.perf_counter() - started) * 1000)
+        else:
+            failures += 1
+    client.close()
+    return durations, failures
+
+
+def load_throughput(
+    url: str, concurrency: List[int], duration: float = 10.0
+) -> List[Dict[str, Any]]:
+    """Throughput and latencies of a running API (e.g. WSGI vs ASGI workers) under
+    each number of concurrent clients, each sending the dashboard query in a loop
+    for `duration` seconds."""
+    body = json.dumps({"query": DASHBOARD_QUERY}).encode("utf-8")
+    results = []
+    for clients in sorted(concurrency):
+        deadline = time.perf_counter() + duration
+        with ThreadPoolExecutor(clients) as executor:
+            runs = list(
+                executor.map(lambda _: load_client(url, body, deadline), range(clients))
+            )
+        durations = [d for run in runs for d in run[0]]
+        result = {
+            "clients": clients,
+            "requests_per_second": len(durations) / duration,
+            "failures": sum(run[1] for run in runs),
+        }
+        if durations:
+            result.update(percentiles(durations))
+        results.append(result)
+    return results
+
+
+async def subscription_client(
+    url: str, readings: int, ready: asyncio.Event, latencies: List[float]
+) -> int:
+    """Subscribe to the readings, and record their delivery latencies.
+
+    Returns:
+        int: number of received readings
+    """
+    async with websockets.connect(
+        url, subprotocols=["graphql-transport-ws"], max_queue=None  # type: ignore
+    ) as websocket:
+        await websocket.send(json.dumps({"type": "connection_init"}))
+        await websocket.recv()
+        await websocket.send(
+            json.dumps(
+                {"type": "subscribe", "id": "1", "payload": {"query": SUBSCRIPTION}}
+            )
+        )
+        ready.set()
+        received = 0
+        while received < readings:
+            message = json.loads(await websocket.recv())
+            temperature = message["payload"]["data"]["temperature"]
+            sent = datetime.fromisoformat(temperature["timestamp"])
+            latencies.append((timezone.now() - sent).total_seconds() * 1000)
+            received += 1
+        return received
+
+
+async def subscription_latencies(
+    url: str, subscribers: int = 1000, readings: int = 20, rate: float = 2.0
+) -> Dict[str, Any]:
+    """Delivery latencies of `readings` synthetic readings, published at `rate` per
+    second, to `subscribers` subscriptions to a running API.
+
+    This acts as the consumer: it publishes on PUBSUB_PORT, to an API which must not
+    run along with a real consumer.
+    """
+    publisher = ReadingPublisher()
+    await publisher.start()
+    latencies: List[float] = []
+    readies = [asyncio.Event() for _ in range(subscribers)]
+    started = time.perf_counter()
+    tasks = [
+        asyncio.create_task(subscription_client(url, readings, ready, latencies))
+        for ready in readies
+    ]
+    await asyncio.wait_for(
+        asyncio.gather(*(ready.wait() for ready in readies)), timeout=120
+    )
+    connected = time.perf_counter() - started
+    # let the API processes relay the stream before publishing.
+    while not publisher.clients:
+        await asyncio.sleep(0.1)
+    await asyncio.sleep(1)
+    for reading in synthetic_readings(readings, timezone.now()):
+        reading.pk = 0
+        reading.timestamp = timezone.now()
+        publisher.publish([reading])
+        await asyncio.sleep(1 / rate)
+    done, pending = await asyncio.wait(tasks, timeout=10)
+    for task in pending:
+        task.cancel()
+    await publisher.stop()
+    result = {
+        "subscribers": subscribers,
+        "connect_seconds": connected,
+        "received": sum(task.result() for task in done if not task.exception()),
+        "expected": readings * subscribers,
+    }
+    if latencies:
+        result.update(percentiles(latencies))
+    return result
@@ -0,0 +1,379 @@
+"""Unit tests for bench.py"""
+import asyncio
+from datetime import datetime, timedelta
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+from unittest.mock import AsyncMock, MagicMock, patch
+import pytest
+from django.utils import timezone
+import websockets
+
+from api.bench import (
+    BENCH_SENSOR,
+    CONNECTION_CONFIGURATIONS,
+    compare_results,
+    configure_connection,
+    connection_latencies,
+    current_temperature_query,
+    document_latencies,
+    ingest_throughput,
+    load_client,
+    load_throughput,
+    metrics_overhead,
+    parse_window,
+    percentile,
+    query_plans,
+    seed_readings,
+    statistics_query,
+    storage_comparison,
+    subscription_client,
+    subscription_latencies,
+    synthetic_readings,
+    table_size,
+    time_call,
+)
+from api.fields import STORAGES
+from api.ingest import store_readings
+from api.management.commands.consume_feed import FEED_SPILL_PATH, FeedPipeline
+from api.management.commands.convert_value_storage import current_storage
+from api.models import Temperature, TemperatureRollup
+
+
+def test_synthetic_readings_reproducible():
+    start = timezone.datetime.fromisoformat("2022-02-15T12:00:00+00:00")
+    first = list(synthetic_readings(5, start, seed=1))
+    assert [tm.timestamp for tm in first] == [
+        start + index * timedelta(seconds=0.5) for index in range(5)
+    ]
+    assert [tm.value for tm in first] == [
+        tm.value for tm in synthetic_readings(5, start, seed=1)
+    ]
+
+
+def test_percentile():
+    ordered = [float(value) for value in range(1, 101)]
+    assert percentile(ordered, 50) == 50
+    assert percentile(ordered, 99) == 99
+    assert percentile([3.0], 99) == 3
+
+
+def test_time_call():
+    calls = []
+    result = time_call(lambda: calls.append(1), repeat=10)
+    assert len(calls) == 10
+    assert 0 <= result["p50"] <= result["p99"] <= result["max"]
+
+
+@pytest.mark.django_db
+def test_seed_readings():
+    """Test that readings are appended after the latest one."""
+    latest = seed_readings(25, batch_size=10)
+    assert Temperature.objects.count() == 25
+    assert current_temperature_query().timestamp == latest
+    assert seed_readings(5) == latest + 5 * timedelta(seconds=0.5)
+    assert Temperature.objects.count() == 30
+    stats = statistics_query(latest - timedelta(seconds=1), latest)
+    assert stats["value__min"] <= stats["value__max"]
+    # along with their rollups.
+    assert TemperatureRollup.objects.filter(resolution=TemperatureRollup.MINUTE)
+
+
+def test_parse_window():
+    assert parse_window("30s") == timedelta(seconds=30)
+    assert parse_window("15m") == timedelta(minutes=15)
+    assert parse_window(" 1h") == timedelta(hours=1)
+    assert parse_window("7d") == timedelta(days=7)
+    assert parse_window("2w") == timedelta(weeks=2)
+    for window in ("", "1y", "h", "1.5h"):
+        with pytest.raises(ValueError):
+            parse_window(window)
+
+
+def test_compare_results():
+    baseline = {
+        "latencies": [
+            {"query": "currentTemperature", "rows": 1000, "p50": 1.0, "p99": 2.0},
+            {
+                "query": "temperatureStatistics",
+                "rows": 1000,
+                "window": "1h",
+                "p50": 1.0,
+                "p99": 2.0,
+            },
+        ],
+        "ingest": {"rate": 1000.0},
+    }
+    current = {
+        "latencies": [
+            {"query": "currentTemperature", "rows": 1000, "p50": 1.1, "p99": 3.0},
+            {
+                "query": "temperatureStatistics",
+                "rows": 1000,
+                "window": "1h",
+                "p50": 1.5,
+                "p99": 2.0,
+            },
+            # not in the baseline.
+            {"query": "currentTemperature", "rows": 10000, "p50": 9.0, "p99": 9.0},
+        ],
+        "ingest": {"rate": 700.0},
+    }
+    assert compare_results(baseline, current) == [
+        "currentTemperature at 1000 rows: p99 2.000 -> 3.000 ms",
+        "temperatureStatistics 1h at 1000 rows: p50 1.000 -> 1.500 ms",
+        "ingest rate: 1000 -> 700 readings/s",
+    ]
+    assert compare_results(baseline, current, tolerance=0.6) == []
+    assert len(compare_results(baseline, dict(current, ingest=None))) == 2
+
+
+# the pipeline persists the readings from other threads.
+@pytest.mark.django_db(transaction=True, serialized_rollback=True)
+def test_ingest_throughput():
+    """Test that the readings of the fake feed are persisted, then deleted, without
+    being cached nor published"""
+    with patch("api.ingest.cache_current_temperatures") as cache, patch(
+        "api.ingest.publish_readings"
+    ) as publish, patch("api.bench.FeedPipeline", wraps=FeedPipeline) as pipeline:
+        result = asyncio.run(ingest_throughput(250, batch_size=50, timeout=30))
+    cache.assert_not_called()
+    publish.assert_not_called()
+    assert pipeline.call_args.kwargs["spill_path"] != FEED_SPILL_PATH
+    assert result["readings"] == 250
+    assert result["rate"] > 0
+    assert result["max_lag"] >= 0
+    assert not Temperature.objects.filter(sensor=BENCH_SENSOR).exists()
+    assert not TemperatureRollup.objects.filter(sensor=BENCH_SENSOR).exists()
+
+
+@pytest.mark.django_db
+def test_query_plans():
+    latest = seed_readings(2)
+    plans = query_plans(latest, timedelta(days=1))
+    assert list(plans) == ["currentTemperature", "temperatureStatistics"]
+    assert all(plans.values())
+
+
+@pytest.mark.django_db
+def test_document_latencies():
+    """Test that both queries are measured on the three views."""
+    results = document_latencies(repeat=2)
+    assert [(result["query"], result["view"]) for result in results] == [
+        (query, view)
+        for query in ("dashboard", "overhead")
+        for view in ("no cache", "document cache", "persisted query")
+    ]
+    # persisted queries are sent by their hash only.
+    assert results[2]["body_bytes"] < results[1]["body_bytes"]
+
+
+@pytest.mark.django_db
+def test_metrics_overhead():
+    seed_readings(3)
+    result = metrics_overhead(repeat=1, rounds=2)
+    assert [request["query"] for request in result["requests"]] == [
+        "dashboard",
+        "history",
+    ]
+    assert result["consumer_us_per_reading"] > 0
+
+
+@pytest.fixture
+def mock_connections():
+    """Keep the connection of the test, which runs in a transaction."""
+    with patch("api.bench.configure_connection") as mock_configure, patch(
+        "api.bench.close_old_connections"
+    ):
+        yield mock_configure
+
+
+@pytest.mark.django_db
+def test_connection_latencies(mock_connections):
+    store_readings([Temperature(timestamp=timezone.now(), value=19)])
+    results = connection_latencies(
+        current_temperature_query(), timedelta(hours=1), repeat=2
+    )
+    assert [result["connections"] for result in results] == [
+        "per request",
+        "persistent",
+    ]
+    # the original settings are restored.
+    assert mock_connections.call_count == 3
+    assert Temperature.objects.count() == 1
+
+
+def test_configure_connection():
+    """Test that the pool is closed along with the connection on PostgreSQL."""
+    mock_connection = MagicMock(vendor="postgresql", settings_dict={})
+    with patch("api.bench.connection", mock_connection):
+        configure_connection(CONNECTION_CONFIGURATIONS["pool"])
+    mock_connection.close.assert_called_once_with()
+    mock_connection.close_pool.assert_called_once_with()
+    assert mock_connection.settings_dict == CONNECTION_CONFIGURATIONS["pool"]
+
+
+# the sqlite schema editor cannot run in the atomic block of a test.
+@pytest.mark.django_db(transaction=True, serialized_rollback=True)
+def test_storage_comparison():
+    """Test that each storage is measured, then the original one restored."""
+    latest = Temperature.objects.create(
+        timestamp=datetime.fromisoformat("2000-02-15T12:00:00+00:00"),
+        value=Decimal("19.5"),
+    )
+    original = current_storage()
+    results = storage_comparison(latest, ingest=10, repeat=1)
+    assert [result["storage"] for result in results] == list(STORAGES)
+    assert current_storage() == original
+    assert list(Temperature.objects.values_list("value", flat=True)) == [
+        Decimal("19.5")
+    ]
+
+
+@pytest.mark.django_db
+def test_table_size():
+    assert table_size() > 0
+
+
+def test_table_size_postgresql():
+    mock_connection = MagicMock(vendor="postgresql")
+    cursor = mock_connection.cursor.return_value.__enter__.return_value
+    cursor.fetchone.return_value = (8192,)
+    with patch("api.bench.connection", mock_connection):
+        assert table_size() == 8192
+    assert "pg_total_relation_size" in cursor.execute.call_args[0][0]
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Answer the POST requests to /graphql only."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(200 if self.path == "/graphql" else 404)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def api_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, args=(0.01,))
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+@pytest.mark.parametrize("path, succeeded", [("/graphql", True), ("/nope", False)])
+def test_load_client(api_url, path, succeeded):
+    durations, failures = load_client(api_url + path, b"{}", time.perf_counter() + 0.05)
+    assert bool(durations) is succeeded
+    assert bool(failures) is not succeeded
+
+
+def test_load_client_refused():
+    """Test that the requests to a stopped API are failures."""
+    with patch("http.client.HTTPConnection.request", side_effect=OSError):
+        durations, failures = load_client(
+            "http://127.0.0.1:8000/graphql", b"{}", time.perf_counter() + 0.01
+        )
+    assert durations == []
+    assert failures > 0
+
+
+def test_load_throughput():
+    with patch(
+        "api.bench.load_client", side_effect=[([2.0, 1.0], 1), ([], 3), ([], 2)]
+    ) as mock_load_client:
+        results = load_throughput("http://127.0.0.1:8000/graphql", [2, 1], 0.5)
+    assert mock_load_client.call_count == 3
+    assert results[0] == {
+        "clients": 1,
+        "requests_per_second": 4.0,
+        "failures": 1,
+        "p50": 1.0,
+        "p99": 2.0,
+        "max": 2.0,
+    }
+    # without any successful request.
+    assert results[1] == {"clients": 2, "requests_per_second": 0.0, "failures": 5}
+
+
+def test_subscription_client():
+    """Test that a subscriber records the latency of each reading it receives."""
+
+    async def serve(websocket):
+        assert json.loads(await websocket.recv())["type"] == "connection_init"
+        await websocket.send(json.dumps({"type": "connection_ack"}))
+        assert json.loads(await websocket.recv())["type"] == "subscribe"
+        for _ in range(2):
+            payload = {
+                "data": {"temperature": {"timestamp": timezone.now().isoformat()}}
+            }
+            await websocket.send(
+                json.dumps({"type": "next", "id": "1", "payload": payload})
+            )
+
+    async def run():
+        server = await websockets.serve(serve, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        ready = asyncio.Event()
+        latencies = []
+        received = await subscription_client(
+            f"ws://127.0.0.1:{port}/graphql", 2, ready, latencies
+        )
+        server.close()
+        await server.wait_closed()
+        return received, ready, latencies
+
+    received, ready, latencies = asyncio.run(run())
+    assert received == 2
+    assert ready.is_set()
+    assert len(latencies) == 2
+
+
+@pytest.mark.parametrize("delivered", [True, False])
+def test_subscription_latencies(delivered):
+    """Test that the readings are published once all the subscribers are ready,
+    and that the failed and late subscribers are not counted."""
+    publisher = MagicMock(clients=set(), start=AsyncMock(), stop=AsyncMock())
+    behaviours = iter(["received", "failed", "late"])
+
+    async def fake_subscriber(url, readings, ready, latencies):
+        ready.set()
+        behaviour = next(behaviours)
+        if behaviour == "failed":
+            raise OSError("connection lost")
+        if behaviour == "late":
+            await asyncio.Event().wait()
+        if delivered:
+            latencies.extend([1.0] * readings)
+        return readings
+
+    wait = asyncio.wait
+    with patch("api.bench.ReadingPublisher", return_value=publisher), patch(
+        "api.bench.subscription_client", fake_subscriber
+    ), patch(
+        # the API relays the stream after a while.
+        "asyncio.sleep",
+        AsyncMock(side_effect=lambda delay: publisher.clients.add(1)),
+    ), patch(
+        "asyncio.wait", lambda tasks, timeout: wait(tasks, timeout=0.01)
+    ):
+        result = asyncio.run(
+            subscription_latencies("ws://127.0.0.1:8000/graphql", 3, 4)
+        )
+    assert publisher.publish.call_count == 4
+    publisher.stop.assert_awaited_once_with()
+    assert result["received"] == 4
+    assert result["expected"] == 12
+    assert ("p50" in result) is delivered
@@ -0,0 +1,138 @@
+"""Cache-aside helpers for the hottest queries."""
+import time
+from typing import Any, Dict, List, Optional
+from django.core.cache import cache
+from django.db import transaction
+
+from backend.settings import CURRENT_TEMPERATURE_CACHE_TIMEOUT
+from api.models import Temperature
+
+CURRENT_TEMPERATURE_KEY = "current_temperature"
+# cache key of the version of the readings and rollups.
+DATA_VERSION_KEY = "data_version"
+
+
+def current_temperature_key(sensor: Optional[str] = None) -> str:
+    """Cache key of the latest reading of a sensor, or of any sensor if None."""
+    if sensor is None:
+        return CURRENT_TEMPERATURE_KEY
+    return f"{CURRENT_TEMPERATURE_KEY}:{sensor}"
+
+
+def reading_item(reading: Temperature) -> Dict[str, Any]:
+    """Cached fields of a reading."""
+    return {
+        "id": reading.pk,
+        "sensor": reading.sensor,
+        "timestamp": reading.timestamp,
+        "value": reading.value,
+    }
+
+
+def cache_current_temperature(
+    reading: Temperature, overwrite: bool = True, sensor: Optional[str] = None
+) -> None:
+    """Store the latest temperature reading in the cache.
+
+    Args:
+        reading (Temperature): the latest reading
+        overwrite (bool): replace a newer cached reading, if any
+        sensor (str): sensor of the reading, None for the latest of any sensor
+    """
+    key = current_temperature_key(sensor)
+    item = reading_item(reading)
+    if overwrite:
+        # don't replace a newer reading cached by a concurrent writer.
+        cached = cache.get(key)
+        if cached is None or cached["timestamp"] <= reading.timestamp:
+            cache.set(key, item, CURRENT_TEMPERATURE_CACHE_TIMEOUT)
+    else:
+        cache.add(key, item, CURRENT_TEMPERATURE_CACHE_TIMEOUT)
+
+
+def cache_current_temperatures(readings: List[Temperature]) -> None:
+    """Store the latest of the readings, and the latest one of each of their
+    sensors, in the cache with a single read and a single write."""
+    latest: Dict[str, Temperature] = {}
+    for reading in readings:
+        for key in (current_temperature_key(), current_temperature_key(reading.sensor)):
+            if key not in latest or latest[key].timestamp <= reading.timestamp:
+                latest[key] = reading
+    cached = cache.get_many(list(latest))
+    # don't replace newer readings cached by a concurrent writer.
+    cache.set_many(
+        {
+            key: reading_item(reading)
+            for key, reading in latest.items()
+            if key not in cached or cached[key]["timestamp"] <= reading.timestamp
+        },
+        CURRENT_TEMPERATURE_CACHE_TIMEOUT,
+    )
+
+
+def cached_current_temperature(sensor: Optional[str] = None) -> Optional[Temperature]:
+    """Return the latest temperature reading of a sensor, or of any sensor, from the
+    cache, None on a cache miss."""
+    cached = cache.get(current_temperature_key(sensor))
+    if cached is None:
+        return None
+    return Temperature(**cached)
+
+
+async def acache_current_temperature(
+    reading: Temperature, overwrite: bool = True, sensor: Optional[str] = None
+) -> None:
+    """Async version of cache_current_temperature."""
+    key = current_temperature_key(sensor)
+    item = reading_item(reading)
+    if overwrite:
+        cached = await cache.aget(key)
+        if cached is None or cached["timestamp"] <= reading.timestamp:
+            await cache.aset(key, item, CURRENT_TEMPERATURE_CACHE_TIMEOUT)
+    else:
+        await cache.aadd(key, item, CURRENT_TEMPERATURE_CACHE_TIMEOUT)
+
+
+async def acached_current_temperature(
+    sensor: Optional[str] = None,
+) -> Optional[Temperature]:
+    """Async version of cached_current_temperature."""
+    cached = await cache.aget(current_temperature_key(sensor))
+    if cached is None:
+        return None
+    return Temperature(**cached)
+
+
+def bump_data_version() -> None:
+    """Record that the readings or the rollups have changed, in the transaction of
+    the change: inserted (ingest, backfill), deleted (retention) or rewritten.
+
+    The version is incremented in the cache once the change is committed, without
+    any lock serializing the writers.
+    """
+    transaction.on_commit(incr_data_version)
+
+
+def initial_data_version() -> int:
+    """Version of the data once its cached version is lost: the microseconds since
+    the epoch, more than the bumps of the lost version, which is not reused."""
+    return time.time_ns() // 1000
+
+
+def incr_data_version() -> None:
+    """Increment the cached data version, atomically with Redis or Memcached."""
+    try:
+        cache.incr(DATA_VERSION_KEY)
+    except ValueError:
+        # not cached yet, or evicted.
+        cache.add(DATA_VERSION_KEY, initial_data_version(), None)
+
+
+def data_version() -> Optional[int]:
+    """Return the version of the readings and of the rollups, None without a shared
+    cache to keep it."""
+    version = cache.get(DATA_VERSION_KEY)
+    if version is None:
+        cache.add(DATA_VERSION_KEY, initial_data_version(), None)
+        version = cache.get(DATA_VERSION_KEY)
+    return version
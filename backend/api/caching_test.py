@@ -0,0 +1,140 @@
+"""Unit tests for caching.py"""
+import asyncio
+from decimal import Decimal
+import pytest
+from unittest.mock import patch
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.utils import timezone
+
+from api.caching import (
+    CURRENT_TEMPERATURE_KEY,
+    acache_current_temperature,
+    acached_current_temperature,
+    bump_data_version,
+    cache_current_temperature,
+    cache_current_temperatures,
+    cached_current_temperature,
+    data_version,
+    incr_data_version,
+)
+from api.ingest import store_readings
+from api.models import Temperature
+
+
+OLDER = Temperature(
+    id=1,
+    value=Decimal("19.5"),
+    timestamp=timezone.datetime.fromisoformat("2022-02-15T12:00:00+00:00"),
+)
+NEWER = Temperature(
+    id=2,
+    value=Decimal("20.5"),
+    timestamp=timezone.datetime.fromisoformat("2022-02-15T12:00:01+00:00"),
+)
+
+
+@pytest.fixture
+def local_cache():
+    """Replace the shared cache with a local memory one."""
+    local = LocMemCache("test", {})
+    with patch("api.caching.cache", local):
+        yield local
+    local.clear()
+
+
+def test_cache_miss(local_cache):
+    assert cached_current_temperature() is None
+
+
+def test_cache_current_temperature(local_cache):
+    cache_current_temperature(OLDER)
+    cached = cached_current_temperature()
+    assert (cached.id, cached.timestamp, cached.value) == (
+        OLDER.id,
+        OLDER.timestamp,
+        OLDER.value,
+    )
+
+
+def test_cache_current_temperature_keeps_newer(local_cache):
+    """Test that an older reading doesn't replace a newer cached one."""
+    cache_current_temperature(NEWER)
+    cache_current_temperature(OLDER)
+    assert cached_current_temperature().id == NEWER.id
+    cache_current_temperature(NEWER)
+    assert cached_current_temperature().id == NEWER.id
+
+
+def test_cache_current_temperature_no_overwrite(local_cache):
+    """Test that a reading read from the db doesn't replace a cached one."""
+    cache_current_temperature(OLDER)
+    cache_current_temperature(NEWER, overwrite=False)
+    assert cached_current_temperature().id == OLDER.id
+    local_cache.delete(CURRENT_TEMPERATURE_KEY)
+    cache_current_temperature(NEWER, overwrite=False)
+    assert cached_current_temperature().id == NEWER.id
+
+
+def test_cache_current_temperatures(local_cache):
+    """Test that the latest reading of each sensor is cached, along with the latest
+    of all, without replacing newer ones."""
+    attic = Temperature(
+        id=3,
+        sensor="attic",
+        value=Decimal("12.5"),
+        timestamp=OLDER.timestamp,
+    )
+    cache_current_temperatures([NEWER, OLDER, attic])
+    assert cached_current_temperature().id == NEWER.id
+    assert cached_current_temperature(Temperature.DEFAULT_SENSOR).id == NEWER.id
+    assert cached_current_temperature("attic").sensor == "attic"
+    assert cached_current_temperature("cellar") is None
+    cache_current_temperatures([OLDER])
+    assert cached_current_temperature(Temperature.DEFAULT_SENSOR).id == NEWER.id
+
+
+def test_cache_timeout(local_cache):
+    """Test that the cached reading expires."""
+    with patch("api.caching.CURRENT_TEMPERATURE_CACHE_TIMEOUT", 0.01):
+        cache_current_temperature(OLDER)
+    with patch("django.core.cache.backends.locmem.time.time", return_value=2e9):
+        assert cached_current_temperature() is None
+
+
+@pytest.mark.django_db
+def test_data_version(local_cache, django_capture_on_commit_callbacks):
+    """Test that the version is bumped once the changes are committed, and that a
+    lost version is not reused"""
+    with patch("api.caching.time.time_ns", return_value=5_000_000):
+        assert data_version() == 5000
+    with django_capture_on_commit_callbacks(execute=False) as callbacks:
+        store_readings([Temperature(timestamp=OLDER.timestamp, value=OLDER.value)])
+    assert data_version() == 5000
+    callbacks[0]()
+    assert data_version() == 5001
+    local_cache.clear()
+    with django_capture_on_commit_callbacks(execute=True):
+        bump_data_version()
+    assert data_version() > 5001
+
+
+def test_data_version_without_cache():
+    """Test that there is no version without a shared cache"""
+    with patch("api.caching.cache", DummyCache("dummy", {})):
+        incr_data_version()
+        assert data_version() is None
+
+
+def test_async_cache_current_temperature(local_cache):
+    async def run():
+        await acache_current_temperature(NEWER)
+        await acache_current_temperature(OLDER)
+        await acache_current_temperature(OLDER, overwrite=False)
+        return await acached_current_temperature()
+
+    assert asyncio.run(run()).id == NEWER.id
+    local_cache.clear()
+    assert asyncio.run(acached_current_temperature()) is None
+    asyncio.run(acache_current_temperature(OLDER, overwrite=False))
+    assert cached_current_temperature().id == OLDER.id
@@ -0,0 +1,121 @@
+"""Conditional GET requests of the /graphql endpoint.
+
+The responses to the queries only change when the readings or their rollups do:
+they are tagged with the version of the data, bumped by every write (ingest,
+backfill, retention), and a request whose If-None-Match matches it is answered
+with a 304 without being executed.
+
+The queries of the feed gaps, which change without any reading being persisted,
+are not tagged.
+
+The queries of windows ended before now - IMMUTABLE_WINDOW_GRACE only read
+readings which are not expected to change anymore: their responses are marked as
+cacheable for IMMUTABLE_RESPONSE_MAX_AGE, to be served by the reverse proxy, a
+backfill or the retention showing once they expire.
+"""
+from datetime import datetime, timedelta
+import hashlib
+import json
+from typing import Any, Dict, Iterator, Optional, Sequence
+
+from django.utils import timezone
+from graphql import (
+    DocumentNode,
+    FieldNode,
+    GraphQLError,
+    GraphQLSchema,
+    Node,
+    OperationType,
+    get_operation_ast,
+)
+from graphql.execution.values import get_argument_values, get_variable_values
+
+from backend.settings import IMMUTABLE_WINDOW_GRACE
+from api.caching import data_version
+
+
+# fields whose result only depends on the readings of the window they are given.
+WINDOW_FIELDS = ("temperatures", "temperatureStatistics", "temperatureSeries")
+# fields whose result changes without any reading being persisted.
+UNTAGGED_FIELDS = ("feedGaps",)
+
+
+def _selections(node: Node) -> Iterator[Node]:
+    selection_set = getattr(node, "selection_set", None)
+    for selection in selection_set.selections if selection_set else ():
+        yield selection
+        yield from _selections(selection)
+
+
+def selects_fields(document: DocumentNode, names: Sequence[str]) -> bool:
+    """Whether a field of `names` is selected anywhere in a document, fragments
+    included."""
+    return any(
+        isinstance(selection, FieldNode) and selection.name.value in names
+        for definition in document.definitions
+        for selection in _selections(definition)
+    )
+
+
+def immutable_operation(
+    schema: GraphQLSchema,
+    document: DocumentNode,
+    operation_name: Optional[str],
+    variables: Optional[Dict[str, Any]],
+    now: Optional[datetime] = None,
+) -> bool:
+    """Whether the result of an operation is not expected to change anymore, i.e.
+    whether it only selects windows ended before now - IMMUTABLE_WINDOW_GRACE."""
+    operation = get_operation_ast(document, operation_name)
+    if operation is None or operation.operation != OperationType.QUERY:
+        return False
+    coerced = get_variable_values(
+        schema, operation.variable_definitions, variables or {}
+    )
+    if isinstance(coerced, list):
+        # invalid variables, reported by the execution.
+        return False
+    limit = (now or timezone.now()) - timedelta(seconds=IMMUTABLE_WINDOW_GRACE)
+    for selection in operation.selection_set.selections:
+        if not isinstance(selection, FieldNode):
+            # fragments at the top level are not inspected.
+            return False
+        name = selection.name.value
+        if name == "__typename":
+            continue
+        if name not in WINDOW_FIELDS:
+            return False
+        try:
+            arguments = get_argument_values(
+                schema.query_type.fields[name],  # type: ignore
+                selection,
+                coerced,
+            )
+        except GraphQLError:
+            return False
+        before = arguments.get("before")
+        if before is None or before > limit:
+            return False
+    return True
+
+
+def request_key(
+    query: str, variables: Optional[Dict[str, Any]], operation_name: Optional[str]
+) -> str:
+    """Digest of what the response to a request depends on, besides the readings."""
+    request = json.dumps([query, variables, operation_name], sort_keys=True)
+    return hashlib.sha256(request.encode("utf-8")).hexdigest()[:32]
+
+
+def response_etag(
+    query: str, variables: Optional[Dict[str, Any]], operation_name: Optional[str]
+) -> Optional[str]:
+    """ETag of the response to a request, None without a data version.
+
+    The ETag is a weak one: it identifies the data the response is computed from
+    rather than its bytes.
+    """
+    version = data_version()
+    if version is None:
+        return None
+    return f'W/"{request_key(query, variables, operation_name)}-{version}"'
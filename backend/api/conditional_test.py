@@ -0,0 +1,93 @@
+"""Unit tests for conditional.py"""
+from datetime import timedelta
+import pytest
+from unittest.mock import patch
+from django.utils import timezone
+from graphql import parse
+
+from api.conditional import (
+    immutable_operation,
+    request_key,
+    response_etag,
+    selects_fields,
+)
+from api.schema import schema
+
+
+NOW = timezone.datetime.fromisoformat("2022-02-15T12:00:00+00:00")
+PAST = "2022-02-15T11:00:00+00:00"
+RECENT = "2022-02-15T11:59:00+00:00"
+
+
+def _immutable(query, variables=None, operation_name=None):
+    return immutable_operation(
+        schema.graphql_schema, parse(query), operation_name, variables, NOW
+    )
+
+
+@pytest.mark.parametrize(
+    "query, immutable",
+    [
+        (f'{{ temperatureStatistics(before: "{PAST}") {{ min }} }}', True),
+        (
+            f'{{ a: temperatureStatistics(before: "{PAST}") {{ min }} '
+            f'b: temperatureSeries(bucket: HOUR, before: "{PAST}") {{ min }} '
+            f'c: temperatures(before: "{PAST}") {{ edges {{ cursor }} }} '
+            "__typename }",
+            True,
+        ),
+        # ended within the grace delay.
+        (f'{{ temperatureStatistics(before: "{RECENT}") {{ min }} }}', False),
+        ("{ temperatureStatistics { min } }", False),
+        (
+            f'{{ temperatureStatistics(before: "{PAST}") {{ min }} '
+            "currentTemperature { value } }",
+            False,
+        ),
+        # not validated.
+        ('{ temperatureStatistics(before: "oops") { min } }', False),
+        ("{ ...Fields } fragment Fields on Query { __typename }", False),
+        ('mutation { toggleFeed(input: {status: "on"}) { status } }', False),
+    ],
+)
+def test_immutable_operation(query, immutable):
+    assert _immutable(query) is immutable
+
+
+def test_immutable_operation_variables():
+    query = (
+        "query Q($before: DateTime) { temperatureStatistics(before: $before) { min } }"
+    )
+    assert _immutable(query, {"before": PAST}, "Q")
+    assert not _immutable(query, {"before": RECENT}, "Q")
+    assert not _immutable(query, {"before": "not a date"}, "Q")
+    assert not _immutable(query, {"before": PAST}, "Other")
+
+
+def test_immutable_operation_now():
+    query = f'{{ temperatureStatistics(before: "{PAST}") {{ min }} }}'
+    with patch("api.conditional.timezone.now", return_value=NOW - timedelta(days=1)):
+        assert not immutable_operation(schema.graphql_schema, parse(query), None, None)
+
+
+def test_selects_fields():
+    names = ("feedGaps",)
+    assert selects_fields(parse("{ feedGaps { started } }"), names)
+    fragments = "{ ... on Query { ...Gaps } } fragment Gaps on Query { feedGaps { a } }"
+    assert selects_fields(parse(fragments), names)
+    assert not selects_fields(parse("{ currentTemperature { value } }"), names)
+
+
+def test_request_key():
+    assert request_key("{ a }", {"x": 1, "y": 2}, None) == request_key(
+        "{ a }", {"y": 2, "x": 1}, None
+    )
+    assert request_key("{ a }", None, None) != request_key("{ a }", None, "A")
+
+
+def test_response_etag():
+    key = request_key("{ a }", None, None)
+    with patch("api.conditional.data_version", return_value=42):
+        assert response_etag("{ a }", None, None) == f'W/"{key}-42"'
+    with patch("api.conditional.data_version", return_value=None):
+        assert response_etag("{ a }", None, None) is None
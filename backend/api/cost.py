@@ -0,0 +1,209 @@
+"""Cost of the GraphQL queries, estimated before their execution.
+
+The cost of a query is the sum of the costs of its top level fields, each field
+being counted once per alias: the statistics and the series cost in proportion to
+the span of their window, the history in proportion to its page size. A document
+costing more than QUERY_MAX_COST is rejected, and the cost of the queries of a
+client is charged to its budget of QUERY_COST_BUDGET per QUERY_COST_BUDGET_PERIOD,
+counted in the "budget" cache, so that a heavy dashboard can't saturate the db for
+the others. The counters must be incremented atomically: the budget is refused on
+a cache which can't, where it would silently count nothing or race.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+import math
+import time
+from typing import Any, Dict, MutableMapping, Optional
+
+from django.core.cache import caches
+from django.core.cache.backends.base import BaseCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.cache.backends.memcached import BaseMemcachedCache
+from django.core.cache.backends.redis import RedisCache
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpRequest
+from django.utils.connection import ConnectionProxy
+from django.utils import timezone
+from graphql import (
+    DocumentNode,
+    FragmentDefinitionNode,
+    GraphQLError,
+    GraphQLSchema,
+    OperationType,
+    get_operation_ast,
+)
+from graphql.execution.collect_fields import collect_fields
+from graphql.execution.values import get_argument_values, get_variable_values
+
+from backend.settings import (
+    QUERY_BUDGET_PROXIES,
+    QUERY_COST_BUDGET,
+    QUERY_COST_BUDGET_PERIOD,
+    QUERY_COST_PER_DAY,
+    QUERY_COST_PER_READING,
+    QUERY_COST_UNBOUNDED_DAYS,
+    QUERY_MAX_COST,
+    TEMPERATURE_RETENTION_DAYS,
+    TEMPERATURES_MAX_PAGE_SIZE,
+)
+
+QUERY_BUDGET_KEY = "query_budget:{}:{}"
+QUERY_BUDGET_CACHE = "budget"
+# backends whose add and incr are atomic.
+ATOMIC_CACHES = (LocMemCache, RedisCache, BaseMemcachedCache)
+budget_cache: BaseCache = ConnectionProxy(caches, QUERY_BUDGET_CACHE)  # type: ignore
+# fields whose cost is the span of their window.
+WINDOW_FIELDS = ("temperatureStatistics", "temperatureSeries")
+
+
+def aware(value: datetime) -> datetime:
+    """Datetime in UTC if naive, as stored."""
+    if timezone.is_naive(value):
+        return timezone.make_aware(value, dt_timezone.utc)
+    return value
+
+
+def window_cost(
+    after: Optional[datetime], before: Optional[datetime], now: datetime
+) -> float:
+    """Cost of the aggregates over a window, at least 1."""
+    end = aware(before) if before else now
+    if after is None:
+        days = TEMPERATURE_RETENTION_DAYS or QUERY_COST_UNBOUNDED_DAYS
+        start = end - timedelta(days=days)
+    else:
+        start = aware(after)
+    span = max((end - start).total_seconds(), 0.0) / 86400
+    return max(span * QUERY_COST_PER_DAY, 1.0)
+
+
+def field_cost(name: str, arguments: Dict[str, Any], now: datetime) -> float:
+    """Cost of a top level field, given its arguments."""
+    if name.startswith("__"):
+        return 0.0
+    if name in WINDOW_FIELDS:
+        return window_cost(arguments.get("after"), arguments.get("before"), now)
+    if name == "temperatures":
+        first = arguments.get("first") or TEMPERATURES_MAX_PAGE_SIZE
+        size = min(first, TEMPERATURES_MAX_PAGE_SIZE)
+        return max(size * QUERY_COST_PER_READING, 1.0)
+    return 1.0
+
+
+def operation_cost(
+    schema: GraphQLSchema,
+    document: DocumentNode,
+    operation_name: Optional[str],
+    variables: Optional[Dict[str, Any]],
+    now: Optional[datetime] = None,
+) -> int:
+    """Estimated cost of the query operation of a validated document, 0 for the
+    other operations and for invalid variables, reported by the execution."""
+    operation = get_operation_ast(document, operation_name)
+    if operation is None or operation.operation != OperationType.QUERY:
+        return 0
+    coerced = get_variable_values(
+        schema, operation.variable_definitions, variables or {}
+    )
+    if isinstance(coerced, list):
+        return 0
+    fragments = {
+        definition.name.value: definition
+        for definition in document.definitions
+        if isinstance(definition, FragmentDefinitionNode)
+    }
+    query_type = schema.query_type
+    # fields selected under the same alias are resolved once, @skip applied.
+    fields = collect_fields(
+        schema, fragments, coerced, query_type, operation.selection_set  # type: ignore
+    )
+    now = now or timezone.now()
+    total = 0.0
+    for nodes in fields.values():
+        name = nodes[0].name.value
+        field = query_type.fields.get(name)  # type: ignore
+        if field is None:
+            continue
+        try:
+            arguments = get_argument_values(field, nodes[0], coerced)
+        except GraphQLError:
+            continue
+        total += field_cost(name, arguments, now)
+    return math.ceil(total)
+
+
+def cost_error(cost: int) -> Optional[GraphQLError]:
+    """Error rejecting a query costing more than QUERY_MAX_COST, None if it may run."""
+    if QUERY_MAX_COST and cost > QUERY_MAX_COST:
+        return GraphQLError(
+            f"Query cost {cost} exceeds the maximum of {QUERY_MAX_COST}."
+        )
+    return None
+
+
+def forwarded_address(forwarded_for: str, remote: str) -> str:
+    """Address of a client as seen by the farthest trusted proxy, given the
+    X-Forwarded-For header and the address of the peer."""
+    if QUERY_BUDGET_PROXIES:
+        forwarded = forwarded_for.split(",")
+        # the addresses before those appended by the proxies may be forged.
+        if len(forwarded) >= QUERY_BUDGET_PROXIES:
+            return forwarded[-QUERY_BUDGET_PROXIES].strip()
+    return remote
+
+
+def client_address(request: HttpRequest) -> str:
+    """Address of the client of a request, as seen by the farthest trusted proxy."""
+    return forwarded_address(
+        request.META.get("HTTP_X_FORWARDED_FOR", ""),
+        request.META.get("REMOTE_ADDR", ""),
+    )
+
+
+def scope_address(scope: MutableMapping[str, Any]) -> str:
+    """Address of the client of an ASGI connection, as client_address."""
+    headers = dict(scope.get("headers") or [])
+    client = scope.get("client") or ("",)
+    return forwarded_address(
+        headers.get(b"x-forwarded-for", b"").decode("latin-1"), client[0]
+    )
+
+
+def check_budget_cache(backend: Optional[BaseCache] = None) -> None:
+    """Make sure the budget counters are incremented atomically, if budgeted.
+
+    Raises:
+        ImproperlyConfigured: if the budget cache (by default) does not support it
+    """
+    backend = backend or caches[QUERY_BUDGET_CACHE]
+    if QUERY_COST_BUDGET and not isinstance(backend, ATOMIC_CACHES):
+        raise ImproperlyConfigured(
+            f"QUERY_COST_BUDGET needs an atomic cache, not {type(backend).__name__}: "
+            "set QUERY_BUDGET_CACHE_BACKEND to LocMemCache, RedisCache or Memcached."
+        )
+
+
+def spend_budget(client: str, cost: int, now: Optional[float] = None) -> float:
+    """Charge a cost to the budget of a client for the current period.
+
+    Returns:
+        float: 0 within the budget, else the number of seconds until the end of
+            the period, when the budget is renewed
+    """
+    if not QUERY_COST_BUDGET or not cost:
+        return 0.0
+    now = time.time() if now is None else now
+    period = int(now // QUERY_COST_BUDGET_PERIOD)
+    key = QUERY_BUDGET_KEY.format(client, period)
+    # a counter per period, incremented atomically (see check_budget_cache).
+    if budget_cache.add(key, cost, QUERY_COST_BUDGET_PERIOD):
+        spent = cost
+    else:
+        try:
+            spent = budget_cache.incr(key, cost)
+        except ValueError:
+            # expired meanwhile.
+            budget_cache.set(key, cost, QUERY_COST_BUDGET_PERIOD)
+            spent = cost
+    if spent <= QUERY_COST_BUDGET:
+        return 0.0
+    return (period + 1) * QUERY_COST_BUDGET_PERIOD - now
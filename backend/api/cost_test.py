@@ -0,0 +1,174 @@
+"""Unit tests for cost.py"""
+from datetime import timedelta
+from unittest.mock import patch
+import pytest
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.exceptions import ImproperlyConfigured
+from django.test import RequestFactory
+from django.utils import timezone
+from graphql import parse
+
+from api.cost import check_budget_cache, client_address, cost_error, field_cost
+from api.cost import operation_cost, scope_address, spend_budget, window_cost
+from api.schema import schema
+
+
+NOW = timezone.datetime.fromisoformat("2022-02-15T12:00:00+00:00")
+
+
+def _cost(query, variables=None, operation_name=None):
+    return operation_cost(
+        schema.graphql_schema, parse(query), operation_name, variables, NOW
+    )
+
+
+@pytest.fixture
+def local_cache():
+    """The configured budget cache, emptied afterwards."""
+    local = caches["budget"]
+    yield local
+    local.clear()
+
+
+def test_window_cost():
+    assert window_cost(NOW - timedelta(days=10), NOW, NOW) == 10
+    assert window_cost(NOW - timedelta(days=10), None, NOW) == 10
+    # naive datetimes are in UTC.
+    naive = timezone.datetime(2022, 2, 5, 12)
+    assert window_cost(naive, NOW.replace(tzinfo=None), NOW) == 10
+    # at least 1, even for an empty or reversed window.
+    assert window_cost(NOW, NOW - timedelta(hours=1), NOW) == 1
+    assert window_cost(NOW - timedelta(hours=1), NOW, NOW) == 1
+
+
+def test_window_cost_unbounded():
+    """Test that an unbounded window spans the retention period, if any."""
+    with patch("api.cost.TEMPERATURE_RETENTION_DAYS", 0), patch(
+        "api.cost.QUERY_COST_UNBOUNDED_DAYS", 100
+    ):
+        assert window_cost(None, NOW, NOW) == 100
+    with patch("api.cost.TEMPERATURE_RETENTION_DAYS", 30):
+        assert window_cost(None, None, NOW) == 30
+
+
+def test_field_cost():
+    assert field_cost("__typename", {}, NOW) == 0
+    assert field_cost("currentTemperature", {}, NOW) == 1
+    with patch("api.cost.TEMPERATURES_MAX_PAGE_SIZE", 1000), patch(
+        "api.cost.QUERY_COST_PER_READING", 0.01
+    ):
+        assert field_cost("temperatures", {}, NOW) == 10
+        assert field_cost("temperatures", {"first": 500}, NOW) == 5
+        assert field_cost("temperatures", {"first": 5000}, NOW) == 10
+        assert field_cost("temperatures", {"first": 10}, NOW) == 1
+
+
+def test_operation_cost():
+    window = 'after: "2022-02-05T12:00:00+00:00", before: "2022-02-15T12:00:00+00:00"'
+    assert _cost("{ currentTemperature { value } }") == 1
+    assert _cost(f"{{ temperatureStatistics({window}) {{ min }} }}") == 10
+    # each alias is resolved, the same alias once.
+    assert (
+        _cost(
+            f"""{{
+                a: temperatureStatistics({window}) {{ min }}
+                b: temperatureStatistics({window}) {{ max }}
+                b: temperatureStatistics({window}) {{ avg }}
+                __typename
+            }}"""
+        )
+        == 20
+    )
+
+
+def test_operation_cost_fragments_directives_variables():
+    query = """
+        query Window($after: DateTime, $skip: Boolean!) {
+            ...Statistics
+            currentTemperature @skip(if: $skip) { value }
+        }
+        fragment Statistics on Query {
+            temperatureSeries(bucket: DAY, after: $after) { count }
+        }
+    """
+    variables = {"after": "2022-02-10T12:00:00+00:00", "skip": True}
+    assert _cost(query, variables) == 5
+    assert _cost(query, dict(variables, skip=False), "Window") == 6
+    # reported by the execution.
+    assert _cost(query, {"after": "yesterday", "skip": True}) == 0
+
+
+def test_operation_cost_other_operations():
+    assert _cost('mutation { toggleFeed(input: {status: "on"}) { status } }') == 0
+    assert _cost("subscription { temperature { value } }") == 0
+    assert _cost("{ currentTemperature { value } }", operation_name="Other") == 0
+    # left to the validation.
+    assert _cost("{ unknown currentTemperature { value } }") == 1
+    assert _cost('{ temperatureStatistics(after: "yesterday") { min } }') == 0
+
+
+def test_client_address():
+    request = RequestFactory().get(
+        "/graphql", REMOTE_ADDR="10.0.0.1", HTTP_X_FORWARDED_FOR="1.2.3.4, 5.6.7.8"
+    )
+    assert client_address(request) == "10.0.0.1"
+    with patch("api.cost.QUERY_BUDGET_PROXIES", 1):
+        assert client_address(request) == "5.6.7.8"
+    with patch("api.cost.QUERY_BUDGET_PROXIES", 2):
+        assert client_address(request) == "1.2.3.4"
+    with patch("api.cost.QUERY_BUDGET_PROXIES", 3):
+        assert client_address(request) == "10.0.0.1"
+
+
+def test_scope_address():
+    scope = {
+        "client": ("10.0.0.1", 4000),
+        "headers": [(b"x-forwarded-for", b"1.2.3.4, 5.6.7.8")],
+    }
+    assert scope_address(scope) == "10.0.0.1"
+    with patch("api.cost.QUERY_BUDGET_PROXIES", 1):
+        assert scope_address(scope) == "5.6.7.8"
+        assert scope_address({}) == ""
+
+
+def test_cost_error():
+    with patch("api.cost.QUERY_MAX_COST", 10):
+        assert cost_error(10) is None
+        assert cost_error(11).message == "Query cost 11 exceeds the maximum of 10."
+    with patch("api.cost.QUERY_MAX_COST", 0):
+        assert cost_error(10**9) is None
+
+
+def test_spend_budget(local_cache):
+    with patch("api.cost.QUERY_COST_BUDGET", 10), patch(
+        "api.cost.QUERY_COST_BUDGET_PERIOD", 60
+    ):
+        assert spend_budget("a", 6, now=125.0) == 0
+        assert spend_budget("a", 4, now=130.0) == 0
+        assert spend_budget("b", 10, now=130.0) == 0
+        # until the end of the period.
+        assert spend_budget("a", 1, now=150.0) == 30
+        assert spend_budget("a", 0, now=150.0) == 0
+        assert spend_budget("a", 1, now=180.0) == 0
+        # expired between the add and the incr.
+        with patch.object(local_cache, "add", return_value=False):
+            assert spend_budget("c", 5, now=180.0) == 0
+        assert local_cache.get("query_budget:c:3") == 5
+
+
+def test_check_budget_cache(tmp_path):
+    """Test that the budget is refused on a cache which can't count it"""
+    check_budget_cache()
+    for backend in (DummyCache("", {}), FileBasedCache(str(tmp_path), {})):
+        with pytest.raises(ImproperlyConfigured, match=type(backend).__name__):
+            check_budget_cache(backend)
+        with patch("api.cost.QUERY_COST_BUDGET", 0):
+            check_budget_cache(backend)
+
+
+def test_spend_budget_disabled(local_cache):
+    with patch("api.cost.QUERY_COST_BUDGET", 0):
+        assert spend_budget("a", 100) == 0
+    assert not local_cache._cache
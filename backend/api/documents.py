@@ -0,0 +1,147 @@
+"""Parsed documents and persisted queries of the /graphql endpoint.
+
+The dashboards send the same few queries over and over: their documents are
+parsed and validated once, then kept in a LRU cache keyed by the query text.
+Clients may also send the sha256 hash of a query instead of its text, following
+the automatic persisted queries protocol: a hash unknown to the API is answered
+with a PersistedQueryNotFound error, upon which the client sends the query along
+with its hash, to be stored for the next requests.
+"""
+from collections import OrderedDict
+import hashlib
+from threading import Lock
+from typing import (
+    Any,
+    Dict,
+    Generic,
+    Hashable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
+
+from django.core.cache import cache
+from graphene_django.settings import graphene_settings
+from graphql import DocumentNode, GraphQLError, GraphQLSchema, parse, validate
+
+from backend.settings import (
+    GRAPHQL_DOCUMENT_CACHE_SIZE,
+    PERSISTED_QUERIES_CACHE_SIZE,
+    PERSISTED_QUERIES_TIMEOUT,
+)
+
+
+PERSISTED_QUERY_KEY = "persisted_query:{}"
+PERSISTED_QUERY_NOT_FOUND = "PersistedQueryNotFound"
+
+Key = TypeVar("Key", bound=Hashable)
+Item = TypeVar("Item")
+
+
+class LRUCache(Generic[Key, Item]):
+    """Mapping keeping its `size` most recently used items, safe across threads."""
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.items: "OrderedDict[Key, Item]" = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key: Key) -> Optional[Item]:
+        with self.lock:
+            item = self.items.get(key)
+            if item is not None:
+                self.items.move_to_end(key)
+            return item
+
+    def set(self, key: Key, item: Item) -> None:
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.items[key] = item
+            self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.items.clear()
+
+
+Validated = Tuple[Optional[DocumentNode], List[GraphQLError]]
+
+
+class DocumentCache:
+    """Documents of the queries against a schema, parsed and validated once."""
+
+    def __init__(
+        self,
+        schema: GraphQLSchema,
+        rules: Optional[Sequence[Any]] = None,
+        size: int = GRAPHQL_DOCUMENT_CACHE_SIZE,
+    ) -> None:
+        self.schema = schema
+        self.rules = rules
+        self.documents: LRUCache[str, DocumentNode] = LRUCache(size)
+
+    def document(self, query: str) -> Validated:
+        """Parse and validate a query, unless its document is cached.
+
+        Returns:
+            Validated: the document, None on a syntax error, and the errors
+        """
+        document = self.documents.get(query)
+        if document is not None:
+            return document, []
+        try:
+            document = parse(query)
+        except GraphQLError as error:
+            return None, [error]
+        errors = validate(
+            self.schema, document, self.rules, graphene_settings.MAX_VALIDATION_ERRORS
+        )
+        if not errors:
+            # invalid queries are not cached: they would evict the valid ones.
+            self.documents.set(query, document)
+        return document, errors
+
+
+document_caches: Dict[Tuple[GraphQLSchema, Tuple[Any, ...]], DocumentCache] = {}
+document_caches_lock = Lock()
+
+
+def document_cache(
+    schema: GraphQLSchema, rules: Optional[Sequence[Any]] = None
+) -> DocumentCache:
+    """Cache of the documents against a schema and validation rules, shared by
+    the views of the process: a view is instantiated for each request."""
+    key = (schema, tuple(rules or ()))
+    with document_caches_lock:
+        if key not in document_caches:
+            document_caches[key] = DocumentCache(schema, rules)
+        return document_caches[key]
+
+
+persisted_queries: LRUCache[str, str] = LRUCache(PERSISTED_QUERIES_CACHE_SIZE)
+
+
+def query_hash(query: str) -> str:
+    return hashlib.sha256(query.encode("utf-8")).hexdigest()
+
+
+def persist_query(sha256: str, query: str) -> None:
+    """Store a query under its hash, in the process and in the shared cache."""
+    persisted_queries.set(sha256, query)
+    cache.set(PERSISTED_QUERY_KEY.format(sha256), query, PERSISTED_QUERIES_TIMEOUT)
+
+
+def persisted_query(sha256: str) -> Optional[str]:
+    """Query stored under a hash, None if unknown."""
+    query = persisted_queries.get(sha256)
+    if query is None:
+        # persisted by another API process.
+        query = cache.get(PERSISTED_QUERY_KEY.format(sha256))
+        if query is not None:
+            persisted_queries.set(sha256, query)
+    return query
@@ -0,0 +1,93 @@
+"""Unit tests for documents.py"""
+import pytest
+from unittest.mock import patch
+from django.core.cache.backends.locmem import LocMemCache
+from graphql import parse
+
+from api.documents import (
+    DocumentCache,
+    LRUCache,
+    document_cache,
+    persist_query,
+    persisted_queries,
+    persisted_query,
+    query_hash,
+)
+from api.schema import schema
+
+
+QUERY = "{ currentTemperature { value } }"
+
+
+@pytest.fixture
+def local_cache():
+    """Replace the shared cache with a local memory one."""
+    local = LocMemCache("test", {})
+    with patch("api.documents.cache", local):
+        yield local
+    local.clear()
+    persisted_queries.clear()
+
+
+def test_lru_cache_evicts_least_recently_used():
+    lru = LRUCache(2)
+    lru.set("a", 1)
+    lru.set("b", 2)
+    assert lru.get("a") == 1
+    lru.set("c", 3)
+    assert (lru.get("a"), lru.get("b"), lru.get("c")) == (1, None, 3)
+
+
+def test_lru_cache_disabled():
+    lru = LRUCache(0)
+    lru.set("a", 1)
+    assert lru.get("a") is None
+
+
+def test_document_parsed_once():
+    documents = DocumentCache(schema.graphql_schema)
+    with patch("api.documents.parse", wraps=parse) as mock_parse:
+        first, errors = documents.document(QUERY)
+        second, _ = documents.document(QUERY)
+    assert errors == []
+    assert first is second
+    mock_parse.assert_called_once_with(QUERY)
+
+
+def test_invalid_documents_not_cached():
+    documents = DocumentCache(schema.graphql_schema)
+    document, errors = documents.document("{ unknownField }")
+    assert document is not None and len(errors) == 1
+    assert documents.documents.get("{ unknownField }") is None
+
+
+def test_document_cache_shared():
+    assert document_cache(schema.graphql_schema) is document_cache(
+        schema.graphql_schema, []
+    )
+    assert document_cache(schema.graphql_schema) is not document_cache(
+        schema.graphql_schema, [object]
+    )
+
+
+def test_syntax_error():
+    document, errors = DocumentCache(schema.graphql_schema).document("{ oops ")
+    assert document is None
+    assert "Syntax Error" in errors[0].message
+
+
+def test_persisted_query(local_cache):
+    sha256 = query_hash(QUERY)
+    assert persisted_query(sha256) is None
+    persist_query(sha256, QUERY)
+    assert persisted_query(sha256) == QUERY
+
+
+def test_persisted_query_from_shared_cache(local_cache):
+    """Test that a query persisted by another process is found in the cache."""
+    sha256 = query_hash(QUERY)
+    persist_query(sha256, QUERY)
+    persisted_queries.clear()
+    assert persisted_query(sha256) == QUERY
+    local_cache.clear()
+    assert persisted_query(sha256) == QUERY
@@ -0,0 +1,144 @@
+"""Fake temperature feed, speaking the graphql-ws protocol as the upstream feed does.
+
+Once they have started their subscription, the clients get readings following a
+cycle, plus some noise, as fast as they read them or at a given rate, in bursts or
+not. The feed can also drop the connections and send malformed frames, to soak-test
+the consumer without the upstream feed.
+"""
+import asyncio
+import json
+import math
+import random
+from typing import Any, Dict, List, Optional
+
+import websockets
+
+GRAPHQL_WS = "graphql-ws"
+# number of distinct frames, sent in a loop.
+CYCLE = 1000
+# frames the consumer must skip: truncated, not a reading, not a number.
+MALFORMED_FRAMES = (
+    '{"type": "data", "id": "1", "payload": {"data": {"temperature": 2',
+    json.dumps({"type": "data", "id": "1", "payload": {"data": {}}}),
+    json.dumps(
+        {"type": "data", "id": "1", "payload": {"data": {"temperature": "hot"}}}
+    ),
+)
+
+
+def reading_frame(value: float, operation_id: str = "1") -> str:
+    """Frame of a reading, as sent by the upstream feed."""
+    return json.dumps(
+        {
+            "type": "data",
+            "id": operation_id,
+            "payload": {"data": {"temperature": value}},
+        }
+    )
+
+
+class FakeFeed:
+    """graphql-ws server sending `count` readings to its clients, forever if None.
+
+    Each client gets `rate` frames per second, as many as it reads if None, sent
+    back to back by bursts of `burst` frames. Its connection is dropped, without a
+    close handshake, after every `disconnect_every` readings, and a `malformed`
+    fraction of its frames are not readings.
+
+    `sent` counts the readings sent to all the clients, `malformed_sent` the
+    malformed frames, and `disconnections` the dropped connections.
+    """
+
+    def __init__(
+        self,
+        count: Optional[int] = None,
+        seed: int = 0,
+        rate: Optional[float] = None,
+        burst: int = 1,
+        disconnect_every: Optional[int] = None,
+        malformed: float = 0.0,
+    ) -> None:
+        self.count = count
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.disconnect_every = disconnect_every
+        self.malformed = malformed
+        self.sent = 0
+        self.malformed_sent = 0
+        self.disconnections = 0
+        self.clients = 0
+        noise = random.Random(seed)
+        self.values: List[float] = [
+            round(
+                10 + 15 * math.sin(2 * math.pi * index / CYCLE) + noise.gauss(0, 2), 2
+            )
+            for index in range(CYCLE)
+        ]
+        # draws of the malformed frames, reproducible as well.
+        self.random = random.Random(seed)
+
+    def stats(self) -> Dict[str, Any]:
+        """Snapshot of the feed counters."""
+        return {
+            "clients": self.clients,
+            "sent": self.sent,
+            "malformed": self.malformed_sent,
+            "disconnections": self.disconnections,
+        }
+
+    async def started(self, websocket: Any) -> str:
+        """Wait for the start of the subscription, and return its id."""
+        while True:
+            message = json.loads(await websocket.recv())
+            if message.get("type") == "connection_init":
+                await websocket.send(json.dumps({"type": "connection_ack"}))
+            elif message.get("type") == "start":
+                return str(message.get("id") or "1")
+
+    async def emit(self, websocket: Any, operation_id: str) -> None:
+        """Send the frames to a client, until the count is reached or its
+        connection dropped."""
+        frames = [reading_frame(value, operation_id) for value in self.values]
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        emitted = 0
+        readings = 0
+        while self.count is None or self.sent < self.count:
+            if emitted % self.burst == 0:
+                # a burst is due once the previous ones are, on average, on time;
+                # without rate, yielding lets the connection read a close frame.
+                delay = started + emitted / self.rate - loop.time() if self.rate else 0
+                await asyncio.sleep(max(delay, 0))
+            emitted += 1
+            if self.malformed and self.random.random() < self.malformed:
+                await websocket.send(self.random.choice(MALFORMED_FRAMES))
+                self.malformed_sent += 1
+                continue
+            await websocket.send(frames[self.sent % CYCLE])
+            self.sent += 1
+            readings += 1
+            if self.disconnect_every and readings % self.disconnect_every == 0:
+                self.disconnections += 1
+                websocket.transport.abort()
+                return
+        await websocket.wait_closed()
+
+    async def handle(self, websocket: Any) -> None:
+        """Serve a client, until it disconnects or is disconnected."""
+        self.clients += 1
+        try:
+            await self.emit(websocket, await self.started(websocket))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.clients -= 1
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 0) -> Any:
+        """Start serving, on a free port by default.
+
+        Returns:
+            Server: the websockets server, whose `sockets` tell the port
+        """
+        return await websockets.serve(
+            self.handle, host, port, subprotocols=[GRAPHQL_WS]  # type: ignore
+        )
@@ -0,0 +1,137 @@
+"""Unit tests for fake_feed.py"""
+import asyncio
+import json
+import time
+import pytest
+import websockets
+
+from api.fake_feed import CYCLE, MALFORMED_FRAMES, FakeFeed, reading_frame
+
+
+def test_reading_frame():
+    assert json.loads(reading_frame(21.5, "7")) == {
+        "type": "data",
+        "id": "7",
+        "payload": {"data": {"temperature": 21.5}},
+    }
+
+
+def test_fake_feed_values():
+    """Test that the values are reproducible"""
+    values = FakeFeed(seed=1).values
+    assert len(values) == CYCLE
+    assert values == FakeFeed(seed=1).values
+    assert values != FakeFeed(seed=2).values
+
+
+def test_fake_feed_serve():
+    """Test that a client gets the readings once it has started its subscription"""
+
+    async def run():
+        feed = FakeFeed(count=CYCLE + 2)
+        server = await feed.serve()
+        port = server.sockets[0].getsockname()[1]
+        async with websockets.connect(
+            f"ws://127.0.0.1:{port}/graphql", subprotocols=["graphql-ws"]
+        ) as websocket:
+            await websocket.send(json.dumps({"type": "connection_init"}))
+            assert json.loads(await websocket.recv()) == {"type": "connection_ack"}
+            await websocket.send(json.dumps({"type": "start", "id": "5"}))
+            frames = [json.loads(await websocket.recv()) for _ in range(CYCLE + 2)]
+            # no more frames.
+            done, _ = await asyncio.wait(
+                [asyncio.create_task(websocket.recv())], timeout=0.05
+            )
+            assert not done
+        feed.count = None
+        # a client leaving midway, without reading the frames in flight.
+        async with websockets.connect(
+            f"ws://127.0.0.1:{port}/graphql",
+            subprotocols=["graphql-ws"],
+            close_timeout=0.1,
+        ) as websocket:
+            await websocket.send(json.dumps({"type": "start"}))
+            assert json.loads(await websocket.recv())["id"] == "1"
+        # a client leaving before its subscription.
+        async with websockets.connect(
+            f"ws://127.0.0.1:{port}/graphql", subprotocols=["graphql-ws"]
+        ):
+            pass
+        server.close()
+        await server.wait_closed()
+        return feed, frames
+
+    feed, frames = asyncio.run(run())
+    assert {frame["id"] for frame in frames} == {"5"}
+    values = [frame["payload"]["data"]["temperature"] for frame in frames]
+    assert values == feed.values + feed.values[:2]
+    assert feed.sent >= CYCLE + 3
+    assert feed.stats()["clients"] == 0
+
+
+async def _subscribe(port):
+    websocket = await websockets.connect(
+        f"ws://127.0.0.1:{port}/graphql", subprotocols=["graphql-ws"]
+    )
+    await websocket.send(json.dumps({"type": "start"}))
+    return websocket
+
+
+def test_fake_feed_rate():
+    """Test that the frames are sent by bursts, at the given rate on average"""
+
+    async def run():
+        feed = FakeFeed(count=100, rate=2000, burst=10)
+        server = await feed.serve()
+        websocket = await _subscribe(server.sockets[0].getsockname()[1])
+        started = time.perf_counter()
+        for _ in range(100):
+            await websocket.recv()
+        elapsed = time.perf_counter() - started
+        await websocket.close()
+        server.close()
+        await server.wait_closed()
+        return elapsed
+
+    # the last burst is due after 90 frames.
+    assert asyncio.run(run()) >= 0.045
+
+
+def test_fake_feed_disconnects_and_malformed():
+    """Test that the clients are dropped after every few readings, some of their
+    frames being malformed"""
+
+    async def run():
+        feed = FakeFeed(count=6, disconnect_every=3, malformed=0.3, seed=3)
+        server = await feed.serve()
+        port = server.sockets[0].getsockname()[1]
+        connections = []
+        while feed.sent < feed.count:
+            websocket = await _subscribe(port)
+            frames = []
+            with pytest.raises(websockets.ConnectionClosedError):
+                while True:
+                    frames.append(await websocket.recv())
+            connections.append(frames)
+        server.close()
+        await server.wait_closed()
+        return feed, connections
+
+    feed, connections = asyncio.run(run())
+    readings = [
+        [frame for frame in frames if frame not in MALFORMED_FRAMES]
+        for frames in connections
+    ]
+    assert [len(frames) for frames in readings] == [3, 3]
+    assert [
+        json.loads(frame)["payload"]["data"]["temperature"]
+        for frames in readings
+        for frame in frames
+    ] == feed.values[:6]
+    assert feed.malformed_sent == sum(map(len, connections)) - 6 > 0
+    assert feed.stats() == {
+        "clients": 0,
+        "sent": 6,
+        "malformed": feed.malformed_sent,
+        "disconnections": 2,
+    }
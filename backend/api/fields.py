@@ -0,0 +1,124 @@
+"""Custom model fields."""
+from decimal import Decimal
+from typing import Any, Optional
+
+from django.conf import settings
+from django.db import models
+from django.db.backends.base.base import BaseDatabaseWrapper
+from django.db.backends.base.schema import BaseDatabaseSchemaEditor
+
+
+# Storages of the temperature values.
+DECIMAL = "decimal"
+FIXED = "fixed"
+FLOAT = "float"
+STORAGES = (DECIMAL, FIXED, FLOAT)
+
+
+class TemperatureValueField(models.DecimalField):
+    """Decimal field which may be stored in a more compact column.
+
+    The TEMPERATURE_VALUE_STORAGE setting picks the column type:
+    - "decimal": numeric(max_digits, decimal_places), exact
+    - "fixed": bigint of the value scaled by 10**decimal_places, exact
+    - "float": double precision, rounded to about 15 significant digits
+    Values are always Decimal with `decimal_places` digits on the Python side, so
+    the storage does not change the API output.
+    """
+
+    def deconstruct(self) -> Any:
+        # the migrations see a plain numeric column, whatever the storage: it is
+        # converted by the convert_value_storage command.
+        name, _, args, kwargs = super().deconstruct()
+        return name, "django.db.models.DecimalField", args, kwargs
+
+    @property
+    def storage(self) -> str:
+        # read at runtime, so that the storage can be switched by the benchmarks.
+        return getattr(settings, "TEMPERATURE_VALUE_STORAGE", DECIMAL)
+
+    def get_internal_type(self) -> str:
+        # picks the db type, the db converters and the aggregates output.
+        return {FIXED: "BigIntegerField", FLOAT: "FloatField"}.get(
+            self.storage, "DecimalField"
+        )
+
+    def db_type(self, connection: BaseDatabaseWrapper) -> Optional[str]:
+        if self.storage == DECIMAL:
+            return super().db_type(connection)
+        return connection.data_types[self.get_internal_type()]
+
+    def normalize(self, value: Any) -> Decimal:
+        """Round a (non null) value the way it is persisted."""
+        value = self.to_python(value)
+        return value.quantize(Decimal(1).scaleb(-self.decimal_places))
+
+    def get_db_prep_value(
+        self, value: Any, connection: BaseDatabaseWrapper, prepared: bool = False
+    ) -> Any:
+        if self.storage == DECIMAL or value is None:
+            return super().get_db_prep_value(value, connection, prepared)
+        value = self.normalize(value)
+        if self.storage == FIXED:
+            return int(value.scaleb(self.decimal_places))
+        return float(value)
+
+    def from_db_value(
+        self, value: Any, expression: Any, connection: BaseDatabaseWrapper
+    ) -> Optional[Decimal]:
+        if value is None or self.storage == DECIMAL:
+            return value
+        if self.storage == FIXED:
+            return self.normalize(Decimal(value).scaleb(-self.decimal_places))
+        return self.normalize(repr(value))
+
+
+def convert_storage(
+    schema_editor: BaseDatabaseSchemaEditor,
+    model: Any,
+    field_name: str,
+    old: str,
+    new: str,
+) -> None:
+    """Convert the column of a TemperatureValueField from a storage to another."""
+    if old == new:
+        return
+    field: TemperatureValueField = model._meta.get_field(field_name)
+    table = schema_editor.quote_name(model._meta.db_table)
+    column = schema_editor.quote_name(str(field.column))
+    scale = 10**field.decimal_places
+    if new == FIXED:
+        expression = f"ROUND({column} * {scale})"
+    elif old == FIXED:
+        expression = f"{column} / {scale}.0"
+    else:
+        expression = column
+    connection = schema_editor.connection
+    if connection.vendor == "postgresql":
+        new_type = plain_field(field, new).db_type(connection)
+        schema_editor.execute(
+            f"ALTER TABLE {table} ALTER COLUMN {column} TYPE {new_type} "
+            f"USING ({expression})::{new_type}"
+        )
+    else:
+        # rewrite the values, then recreate the column with its new type.
+        schema_editor.execute(f"UPDATE {table} SET {column} = {expression}")
+        schema_editor.alter_field(
+            model, plain_field(field, old), plain_field(field, new)
+        )
+
+
+def plain_field(field: TemperatureValueField, storage: str) -> models.Field:
+    """Regular field matching the column of a TemperatureValueField in a storage."""
+    plain: models.Field = {
+        FIXED: models.BigIntegerField(),
+        FLOAT: models.FloatField(),
+    }.get(
+        storage,
+        models.DecimalField(
+            max_digits=field.max_digits, decimal_places=field.decimal_places
+        ),
+    )
+    plain.set_attributes_from_name(field.name)
+    plain.model = field.model
+    return plain
@@ -0,0 +1,132 @@
+"""Unit tests for fields.py"""
+from datetime import datetime, timedelta
+from decimal import Decimal
+import pytest
+from unittest.mock import MagicMock
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.models import Max, Min
+from django.test import override_settings
+
+from api.fields import (
+    DECIMAL,
+    FIXED,
+    FLOAT,
+    STORAGES,
+    TemperatureValueField,
+    convert_storage,
+)
+from api.models import ReadConfig, Temperature
+
+
+# values within the 15 significant digits kept by the float storage.
+VALUES = [Decimal("19.1234567890123"), Decimal("-3.5"), Decimal("0")]
+
+
+@pytest.fixture
+def field():
+    return TemperatureValueField(max_digits=18, decimal_places=15)
+
+
+def test_normalize(field):
+    assert field.normalize(19.1) == Decimal("19.100000000000001")
+    assert field.normalize("1.5") == Decimal("1.500000000000000")
+
+
+@pytest.mark.parametrize(
+    "storage,internal_type",
+    [(DECIMAL, "DecimalField"), (FIXED, "BigIntegerField"), (FLOAT, "FloatField")],
+)
+def test_db_type(field, storage, internal_type):
+    with override_settings(TEMPERATURE_VALUE_STORAGE=storage):
+        assert field.get_internal_type() == internal_type
+        assert field.db_type(connection) == connection.data_types[
+            internal_type
+        ] % {"max_digits": 18, "decimal_places": 15}
+
+
+@pytest.mark.parametrize("storage", [FIXED, FLOAT])
+def test_round_trip(field, storage):
+    with override_settings(TEMPERATURE_VALUE_STORAGE=storage):
+        for value in VALUES:
+            prepared = field.get_db_prep_value(value, connection)
+            assert field.from_db_value(prepared, None, connection) == value
+        assert field.get_db_prep_value(None, connection) is None
+        assert field.from_db_value(None, None, connection) is None
+
+
+def test_fixed_is_exact(field):
+    value = Decimal("19.123456789012345")
+    with override_settings(TEMPERATURE_VALUE_STORAGE=FIXED):
+        assert field.get_db_prep_value(value, connection) == 19123456789012345
+        assert field.from_db_value(19123456789012345, None, connection) == value
+
+
+def _convert():
+    call_command("convert_value_storage")
+
+
+# the sqlite schema editor cannot run in the atomic block of a test.
+@pytest.mark.django_db(transaction=True, serialized_rollback=True)
+def test_convert_value_storage():
+    """Test that the values survive conversions between all the storages."""
+    start = datetime.fromisoformat("2000-02-15T12:00:00+00:00")
+    Temperature.objects.bulk_create(
+        Temperature(timestamp=start + timedelta(seconds=index), value=value)
+        for index, value in enumerate(VALUES)
+    )
+    for storage in (FIXED, FLOAT, DECIMAL, FLOAT, FIXED, DECIMAL):
+        with override_settings(TEMPERATURE_VALUE_STORAGE=storage):
+            _convert()
+            assert ReadConfig.objects.get(pk="value_storage").config_value == storage
+            readings = Temperature.objects.filter(timestamp__lt=start + timedelta(1))
+            values = list(
+                readings.order_by("timestamp").values_list("value", flat=True)
+            )
+            assert values == VALUES, storage
+            assert readings.aggregate(Min("value"), Max("value")) == {
+                "value__min": Decimal("-3.5"),
+                "value__max": VALUES[0],
+            }
+            assert readings.filter(value__gt=0).count() == 1
+
+
+@pytest.mark.django_db(transaction=True, serialized_rollback=True)
+def test_value_storage_migration():
+    """Test that the migrated schema does not depend on the configured storage."""
+    with override_settings(TEMPERATURE_VALUE_STORAGE=FIXED):
+        call_command("migrate", "api", "0004", verbosity=0)
+        call_command("migrate", "api", verbosity=0)
+    assert not ReadConfig.objects.filter(pk="value_storage").exists()
+    with connection.cursor() as cursor:
+        columns = connection.introspection.get_table_description(
+            cursor, Temperature._meta.db_table
+        )
+    assert [
+        connection.introspection.get_field_type(column.type_code, column)
+        for column in columns
+        if column.name == "value"
+    ] == ["DecimalField"]
+    assert TemperatureValueField().deconstruct()[1] == "django.db.models.DecimalField"
+
+
+def test_convert_storage_same():
+    editor = MagicMock()
+    convert_storage(editor, Temperature, "value", FIXED, FIXED)
+    editor.execute.assert_not_called()
+
+
+@pytest.mark.django_db
+def test_convert_value_storage_noop(capsys):
+    _convert()
+    assert "already stored as decimal" in capsys.readouterr().out
+
+
+@pytest.mark.django_db
+def test_convert_value_storage_unknown():
+    with override_settings(TEMPERATURE_VALUE_STORAGE="text"), pytest.raises(
+        CommandError
+    ):
+        _convert()
+    assert STORAGES == (DECIMAL, FIXED, FLOAT)
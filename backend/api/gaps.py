@@ -0,0 +1,67 @@
+"""Outages of the feeds, recorded by the consumer.
+
+A gap is opened when the connection to the feed of a sensor is lost, and closed
+by the first reading received after the consumer reconnects, possibly in a later
+run of the consumer. While a gap is open, the sensor may still be emitting
+readings: the window is missing, rather than cold.
+"""
+from datetime import datetime
+from typing import List, Optional
+
+from django.db.models import Q
+
+from api.models import FeedGap, Temperature
+
+
+def open_gap(sensor: str, started: datetime) -> FeedGap:
+    """Record the start of an outage of the feed of a sensor."""
+    return FeedGap.objects.create(sensor=sensor, started=started)
+
+
+def close_gap(gap: FeedGap, ended: datetime) -> None:
+    """Record the end of an outage."""
+    gap.ended = ended
+    gap.save(update_fields=["ended"])
+
+
+def pending_gap(sensor: str) -> Optional[FeedGap]:
+    """Outage of the feed of a sensor left open by a previous run, if any."""
+    gaps = FeedGap.objects.filter(sensor=sensor, ended=None)
+    return gaps.order_by("-started").first()
+
+
+def startup_gap(sensor: str, before: Optional[datetime] = None) -> Optional[FeedGap]:
+    """Outage of the feed of a sensor while no consumer was reading it.
+
+    Args:
+        sensor (str): sensor of the feed
+        before (datetime): first reading of the current run, if any
+
+    Returns:
+        FeedGap: the gap left open by a previous run, or else a gap opened from the
+            last persisted reading of the sensor, None for a sensor never read
+    """
+    gap = pending_gap(sensor)
+    if gap is not None:
+        return gap
+    readings = Temperature.objects.filter(sensor=sensor).order_by("-timestamp")
+    if before is not None:
+        readings = readings.filter(timestamp__lt=before)
+    last = readings.values_list("timestamp", flat=True).first()
+    return open_gap(sensor, last) if last is not None else None
+
+
+def feed_gaps(
+    after: Optional[datetime] = None,
+    before: Optional[datetime] = None,
+    sensor: Optional[str] = None,
+) -> List[FeedGap]:
+    """Outages overlapping a window, of a sensor or of any sensor, oldest first."""
+    query = FeedGap.objects.all()
+    if sensor is not None:
+        query = query.filter(sensor=sensor)
+    if after:
+        query = query.filter(Q(ended__gte=after) | Q(ended=None))
+    if before:
+        query = query.filter(started__lte=before)
+    return list(query.order_by("started", "id"))
@@ -0,0 +1,57 @@
+"""Unit tests for gaps.py"""
+from datetime import timedelta
+import pytest
+from django.utils import timezone
+
+from api.gaps import close_gap, feed_gaps, open_gap, pending_gap, startup_gap
+from api.models import Temperature
+
+
+NOW = timezone.datetime.fromisoformat("2022-02-15T12:00:00+00:00")
+
+
+@pytest.mark.django_db
+def test_open_close_gap():
+    assert pending_gap("attic") is None
+    gap = open_gap("attic", NOW)
+    assert pending_gap("attic") == gap
+    assert pending_gap("cellar") is None
+    close_gap(gap, NOW + timedelta(minutes=5))
+    assert pending_gap("attic") is None
+    gap.refresh_from_db()
+    assert gap.ended == NOW + timedelta(minutes=5)
+
+
+@pytest.mark.django_db
+def test_startup_gap():
+    """Test that a restart opens a gap from the last reading, unless one is open"""
+    assert startup_gap("attic") is None
+    Temperature.objects.create(value=20, timestamp=NOW, sensor="attic")
+    Temperature.objects.create(value=21, timestamp=NOW - timedelta(minutes=1))
+    gap = startup_gap("attic")
+    assert gap.started == NOW and gap.ended is None
+    assert startup_gap("attic") == gap
+    assert startup_gap("cellar") is None
+
+
+@pytest.mark.django_db
+def test_startup_gap_before():
+    """Test that the readings of the current run are left out of the gap"""
+    Temperature.objects.create(value=20, timestamp=NOW, sensor="attic")
+    Temperature.objects.create(value=21, timestamp=NOW + timedelta(minutes=1))
+    gap = startup_gap("attic", before=NOW + timedelta(minutes=1))
+    assert gap.started == NOW
+
+
+@pytest.mark.django_db
+def test_feed_gaps_within_window():
+    """Test that the gaps overlapping the window are returned, open ones included"""
+    closed = open_gap("attic", NOW)
+    close_gap(closed, NOW + timedelta(hours=1))
+    ongoing = open_gap("cellar", NOW + timedelta(hours=2))
+    assert feed_gaps() == [closed, ongoing]
+    assert feed_gaps(sensor="attic") == [closed]
+    assert feed_gaps(after=NOW + timedelta(minutes=30)) == [closed, ongoing]
+    assert feed_gaps(after=NOW + timedelta(minutes=90)) == [ongoing]
+    assert feed_gaps(before=NOW + timedelta(minutes=90)) == [closed]
+    assert feed_gaps(before=NOW - timedelta(minutes=1)) == []
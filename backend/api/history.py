@@ -0,0 +1,81 @@
+"""Paginated history of the temperature readings.
+
+Pages are read by keyset on (timestamp, id): a cursor holds the position of the
+last reading of a page, and the next page is the readings following it in that
+order. Unlike an offset, the position is reached through the timestamp index, so
+that any page costs the same as the first one. The rows of a page are streamed
+from the db (with a server-side cursor on PostgreSQL) instead of being loaded into
+a queryset cache.
+"""
+import base64
+import binascii
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+from backend.settings import TEMPERATURES_MAX_PAGE_SIZE
+from api.models import Temperature
+
+
+# position of a reading in the history.
+Position = Tuple[datetime, int]
+
+
+def encode_cursor(reading: Temperature) -> str:
+    """Opaque cursor of the position of a reading."""
+    position = f"{reading.timestamp.isoformat()}|{reading.pk}"
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Position:
+    """Position of a cursor.
+
+    Raises:
+        ValidationError: if the cursor was not returned by encode_cursor
+    """
+    try:
+        timestamp, pk = base64.urlsafe_b64decode(cursor).decode().split("|")
+        position = datetime.fromisoformat(timestamp), int(pk)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValidationError("invalid cursor.")
+    if position[0].tzinfo is None:
+        raise ValidationError("invalid cursor.")
+    return position
+
+
+def readings_page(
+    after: Optional[datetime] = None,
+    before: Optional[datetime] = None,
+    first: int = TEMPERATURES_MAX_PAGE_SIZE,
+    cursor: Optional[str] = None,
+) -> Tuple[List[Temperature], bool]:
+    """Page of the readings of the [after, before] window, oldest first.
+
+    Args:
+        first: number of readings of the page, at most TEMPERATURES_MAX_PAGE_SIZE
+        cursor: cursor of the last reading of the previous page, if any
+
+    Returns:
+        Tuple[List[Temperature], bool]: readings of the page, whether more follow
+    """
+    if not 0 < first <= TEMPERATURES_MAX_PAGE_SIZE:
+        raise ValidationError(
+            f"first must be between 1 and {TEMPERATURES_MAX_PAGE_SIZE}."
+        )
+    query = Temperature.objects.all()
+    if after:
+        query = query.filter(timestamp__gte=after)
+    if before:
+        query = query.filter(timestamp__lte=before)
+    if cursor:
+        timestamp, pk = decode_cursor(cursor)
+        # the range condition on its own lets the seek use the timestamp index.
+        query = query.filter(
+            Q(timestamp__gte=timestamp), Q(timestamp__gt=timestamp) | Q(id__gt=pk)
+        )
+    # one more reading tells whether there is a next page.
+    rows = query.order_by("timestamp", "id")[: first + 1]
+    readings = list(rows.iterator(chunk_size=first + 1))
+    return readings[:first], len(readings) > first
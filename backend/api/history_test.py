@@ -0,0 +1,98 @@
+"""Unit tests for history.py"""
+from decimal import Decimal
+import pytest
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from api.history import decode_cursor, encode_cursor, readings_page
+from api.models import Temperature
+
+
+START = timezone.datetime.fromisoformat("2023-03-01T00:00:00+00:00")
+END = START + timezone.timedelta(seconds=9)
+
+
+@pytest.fixture
+def readings():
+    """Readings two per second, the latest ones inserted first."""
+    return Temperature.objects.bulk_create(
+        [
+            Temperature(
+                timestamp=START + timezone.timedelta(seconds=second),
+                value=Decimal(second * 2 + offset),
+            )
+            for second in reversed(range(10))
+            for offset in range(2)
+        ]
+    )
+
+
+@pytest.mark.django_db
+def test_pages_follow_keyset_order(readings):
+    """Test that paging through the window returns every reading once, in order."""
+    expected = sorted(readings, key=lambda tm: (tm.timestamp, tm.pk))
+    pages = []
+    cursor = None
+    while True:
+        page, has_next_page = readings_page(START, END, first=3, cursor=cursor)
+        pages.append(page)
+        if not has_next_page:
+            break
+        cursor = encode_cursor(page[-1])
+    assert [len(page) for page in pages] == [3] * 6 + [2]
+    assert [tm.pk for page in pages for tm in page] == [tm.pk for tm in expected]
+
+
+@pytest.mark.django_db
+def test_deep_page_single_query(readings):
+    """Test that a page is read with a single query, wherever it starts."""
+    expected = sorted(readings, key=lambda tm: (tm.timestamp, tm.pk))
+    cursor = encode_cursor(expected[14])
+    with CaptureQueriesContext(connection) as queries:
+        page, has_next_page = readings_page(START, END, first=10, cursor=cursor)
+    assert len(queries) == 1
+    assert "OFFSET" not in queries[0]["sql"]
+    assert [tm.pk for tm in page] == [tm.pk for tm in expected[15:]]
+    assert not has_next_page
+
+
+@pytest.mark.django_db
+def test_window_bounds(readings):
+    page, has_next_page = readings_page(
+        START + timezone.timedelta(seconds=2), START + timezone.timedelta(seconds=3)
+    )
+    assert [tm.value for tm in page] == [4, 5, 6, 7]
+    assert not has_next_page
+
+
+@pytest.mark.parametrize("first", [0, -1, 1001])
+def test_page_size_enforced(first):
+    with pytest.raises(ValidationError):
+        readings_page(first=first)
+
+
+def test_cursor_round_trip():
+    reading = Temperature(id=42, timestamp=START, value=Decimal(0))
+    assert decode_cursor(encode_cursor(reading)) == (START, 42)
+
+
+@pytest.mark.parametrize(
+    "cursor",
+    [
+        "",
+        "not a cursor",
+        # no padding.
+        "MjAyMy0wMy0wMVQwMDowMDowMHw0Mg",
+        # x|y
+        "eHx5",
+        # y
+        "eQ==",
+        # naive timestamp.
+        "MjAyMy0wMy0wMVQwMDowMDowMHwx",
+    ],
+)
+def test_invalid_cursor(cursor):
+    with pytest.raises(ValidationError):
+        decode_cursor(cursor)
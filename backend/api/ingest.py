@@ -0,0 +1,75 @@
+"""Persistence of the temperature readings."""
+from typing import List
+
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+
+from api.caching import bump_data_version, cache_current_temperatures
+from api.models import Temperature
+from api.pubsub import publish_readings
+from api.rollups import update_rollups
+
+
+VALUE_FIELD = Temperature._meta.get_field("value")
+# columns written by a COPY: the ids are generated by the db.
+COPY_FIELDS = [
+    field for field in Temperature._meta.concrete_fields if not field.primary_key
+]
+
+
+def store_readings(readings: List[Temperature], live: bool = True) -> None:
+    """Persist readings in bulk, along with their rollups, cache the latest ones and
+    publish them to the live subscribers, unless `live` is False.
+
+    Every write path must go through here, or load_readings, for the rollups to
+    stay exact.
+    """
+    if not readings:
+        return
+    # round the values as stored, for the rollups to match the raw readings.
+    for reading in readings:
+        reading.value = VALUE_FIELD.normalize(reading.value)
+    with transaction.atomic():
+        Temperature.objects.bulk_create(readings)
+        update_rollups(readings)
+        bump_data_version()
+    if live:
+        cache_current_temperatures(readings)
+        publish_readings(readings)
+
+
+def load_readings(readings: List[Temperature]) -> None:
+    """Persist a chunk of past readings along with their rollups, as store_readings
+    does but through a COPY on PostgreSQL, and without publishing them to the live
+    subscribers.
+    """
+    if not readings:
+        return
+    for reading in readings:
+        reading.value = VALUE_FIELD.normalize(reading.value)
+    with transaction.atomic():
+        if connection.vendor == "postgresql":
+            copy_readings(readings)
+        else:
+            Temperature.objects.bulk_create(readings)
+        update_rollups(readings)
+        bump_data_version()
+    cache_current_temperatures(readings)
+
+
+def copy_readings(readings: List[Temperature]) -> None:
+    """Write readings into the Temperature table with a single COPY."""
+    # the connection itself, rather than its proxy, for the per row conversions.
+    db = connections[DEFAULT_DB_ALIAS]
+    table = db.ops.quote_name(Temperature._meta.db_table)
+    columns = ", ".join(
+        db.ops.quote_name(field.column) for field in COPY_FIELDS  # type: ignore
+    )
+    with db.cursor() as cursor:
+        with cursor.copy(f"COPY {table} ({columns}) FROM STDIN") as copy:
+            for reading in readings:
+                copy.write_row(
+                    [
+                        field.get_db_prep_value(getattr(reading, field.attname), db)
+                        for field in COPY_FIELDS
+                    ]
+                )
@@ -0,0 +1,103 @@
+"""Unit tests for ingest.py"""
+from datetime import timedelta
+from decimal import Decimal
+import pytest
+from unittest.mock import patch
+from django.db import connection
+from django.utils import timezone
+
+from api.ingest import load_readings, store_readings
+from api.models import Temperature, TemperatureRollup
+
+
+@pytest.mark.django_db
+def test_store_readings():
+    """Test that readings are persisted with their rollups, the latest is cached and
+    all are published."""
+    now = timezone.now()
+    latest = Temperature(timestamp=now, value=Decimal("20.5"))
+    readings = [
+        Temperature(timestamp=now - timedelta(seconds=1), value=Decimal("19.5")),
+        latest,
+    ]
+    with patch("api.ingest.cache_current_temperatures") as mock_cache_current, patch(
+        "api.ingest.publish_readings"
+    ) as mock_publish:
+        store_readings(readings)
+        mock_cache_current.assert_called_once_with(readings)
+        mock_publish.assert_called_once_with(readings)
+    assert Temperature.objects.count() == 2
+    assert (
+        TemperatureRollup.objects.filter(resolution=TemperatureRollup.DAY)
+        .get(bucket=now.replace(hour=0, minute=0, second=0, microsecond=0))
+        .count
+        == 2
+    )
+
+
+@pytest.mark.django_db
+def test_store_no_readings():
+    with patch("api.ingest.cache_current_temperatures") as mock_cache_current:
+        store_readings([])
+        mock_cache_current.assert_not_called()
+    assert Temperature.objects.count() == 0
+
+
+@pytest.mark.django_db
+def test_load_readings():
+    """Test that loaded readings are persisted with their rollups, the latest is
+    cached but none is published."""
+    now = timezone.now()
+    readings = [
+        Temperature(timestamp=now - timedelta(days=1), value="19.5"),
+        Temperature(timestamp=now - timedelta(days=2), value="20.5"),
+    ]
+    with patch("api.ingest.cache_current_temperatures") as mock_cache_current, patch(
+        "api.ingest.publish_readings"
+    ) as mock_publish:
+        load_readings(readings)
+        load_readings([])
+        mock_cache_current.assert_called_once_with(readings)
+        mock_publish.assert_not_called()
+    assert sorted(Temperature.objects.values_list("value", flat=True)) == [
+        Decimal("19.5"),
+        Decimal("20.5"),
+    ]
+    assert (
+        TemperatureRollup.objects.filter(resolution=TemperatureRollup.DAY).count() == 2
+    )
+
+
+@pytest.mark.skipif(connection.vendor != "postgresql", reason="PostgreSQL only")
+@pytest.mark.django_db
+def test_load_readings_copy():
+    """Test that loaded readings are written with a COPY on PostgreSQL, their ids
+    generated by the db, along with their rollups."""
+    day = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    readings = [
+        Temperature(timestamp=day - timedelta(hours=2), value="19.5", sensor="attic"),
+        Temperature(timestamp=day - timedelta(hours=1), value="-4.25", sensor="attic"),
+        Temperature(timestamp=day - timedelta(hours=1), value="12", sensor="cellar"),
+    ]
+    with patch("api.ingest.cache_current_temperatures"), patch.object(
+        Temperature.objects, "bulk_create"
+    ) as mock_bulk_create:
+        load_readings(readings)
+    mock_bulk_create.assert_not_called()
+    assert list(
+        Temperature.objects.order_by("sensor", "timestamp").values_list(
+            "sensor", "timestamp", "value"
+        )
+    ) == [(tm.sensor, tm.timestamp, Decimal(tm.value)) for tm in readings]
+    assert len(set(Temperature.objects.values_list("id", flat=True))) == 3
+    rollup = TemperatureRollup.objects.get(
+        sensor="attic",
+        resolution=TemperatureRollup.DAY,
+        bucket=day - timedelta(days=1),
+    )
+    assert (rollup.count, rollup.sum, rollup.min, rollup.max) == (
+        2,
+        Decimal("15.25"),
+        Decimal("-4.25"),
+        Decimal("19.5"),
+    )
@@ -0,0 +1,431 @@
+"""Benchmark the API and the consumer, with machine-readable results to compare
+across commits."""
+import asyncio
+from datetime import timedelta
+import json
+import platform
+import subprocess
+import sys
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlsplit, urlunsplit
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from django.db import connection
+from django.utils import timezone
+
+from api.bench import (
+    compare_results,
+    connection_latencies,
+    current_temperature_query,
+    document_latencies,
+    graphql_request,
+    ingest_throughput,
+    load_throughput,
+    metrics_overhead,
+    parse_window,
+    query_plans,
+    seed_readings,
+    storage_comparison,
+    subscription_latencies,
+    time_call,
+)
+from api.models import Temperature
+from backend.settings import FEED_BATCH_SIZE, FEED_WRITERS
+
+
+# scenarios, in the order they are run: the in-process ones, the consumer, then
+# those loading a running API.
+SCENARIOS = (
+    "queries",
+    "graphql",
+    "metrics",
+    "connections",
+    "storage",
+    "ingest",
+    "load",
+    "subscriptions",
+)
+CURRENT_QUERY = "{ currentTemperature { timestamp value } }"
+STATISTICS_QUERY = """
+query Statistics($after: DateTime, $before: DateTime) {
+  temperatureStatistics(after: $after, before: $before) {
+    min
+    max
+    avg
+    count
+  }
+}
+"""
+# settings the results depend on, recorded along with them.
+RECORDED_SETTINGS = (
+    "TEMPERATURE_VALUE_STORAGE",
+    "TEMPERATURE_PARTITIONING",
+    "STATISTICS_FROM_ROLLUPS",
+    "RECENT_READINGS_HORIZON",
+    "SQL_POOL_MAX_SIZE",
+    "SQL_PREPARE_THRESHOLD",
+)
+
+
+def git_commit() -> Optional[str]:
+    """Commit of the working tree, if any."""
+    try:
+        completed = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=settings.BASE_DIR,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return completed.stdout.strip()
+
+
+def parse_windows(value: str) -> Dict[str, timedelta]:
+    """Windows of a comma separated list, by name.
+
+    Raises:
+        CommandError: if a window is invalid
+    """
+    try:
+        return {window.strip(): parse_window(window) for window in value.split(",")}
+    except ValueError as exc:
+        raise CommandError(str(exc))
+
+
+def parse_scenarios(value: str) -> List[str]:
+    """Scenarios of a comma separated list, in the order they are run.
+
+    Raises:
+        CommandError: if a scenario is unknown
+    """
+    names = {name.strip() for name in value.split(",")}
+    unknown = names.difference(SCENARIOS)
+    if unknown:
+        raise CommandError(f"unknown scenario(s): {', '.join(sorted(unknown))}")
+    return [name for name in SCENARIOS if name in names]
+
+
+def websocket_url(url: str) -> str:
+    """Websocket url of the same endpoint as an http(s) url."""
+    parts = urlsplit(url)
+    return urlunsplit(parts._replace(scheme=parts.scheme.replace("http", "ws")))
+
+
+def describe(result: Dict[str, Any]) -> str:
+    """One line summary of a result."""
+    return " | ".join(
+        f"{key} {value:.3f}" if isinstance(value, float) else f"{key} {value}"
+        for key, value in result.items()
+    )
+
+
+class Command(BaseCommand):
+    """Custom command to run the benchmark scenarios:
+
+    - queries: at each table size, the p50/p99 latencies of the currentTemperature
+      and temperatureStatistics (over each window, ending at the latest reading)
+      requests, and their query plans with --explain
+    - graphql: the requests without the document cache, with it, and as persisted
+      queries
+    - metrics: the requests with and without the metrics
+    - connections: the hot queries with each connection setting
+    - storage: the size, ingest rate and aggregates of each value storage
+    - ingest: the throughput of the consumer reading a local fake feed as fast as
+      it sends
+    - load: a running API under concurrent clients
+    - subscriptions: the fan-out of readings to the subscribers of a running API,
+      which must not run along with a real consumer
+
+    Synthetic readings are appended to the Temperature table up to each size, and
+    the storage scenario rewrites it: run it against a dedicated database. The
+    results are written as JSON, and compared to a baseline if given.
+    """
+
+    help = "Benchmark the API and the consumer, with JSON results"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--scenarios",
+            default="queries,ingest",
+            help=f"Comma separated scenarios among {', '.join(SCENARIOS)}",
+        )
+        parser.add_argument(
+            "--sizes",
+            default="1000000,10000000,100000000",
+            help="Comma separated table sizes at which queries are measured",
+        )
+        parser.add_argument(
+            "--windows",
+            default="1h,1d,7d,30d",
+            help="Comma separated windows of temperatureStatistics (s, m, h, d, w)",
+        )
+        parser.add_argument(
+            "--explain",
+            action="store_true",
+            help="Add the query plans at the largest size and window",
+        )
+        parser.add_argument(
+            "--repeat", type=int, default=50, help="Number of runs of each request"
+        )
+        parser.add_argument(
+            "--rounds",
+            type=int,
+            default=5,
+            help="Number of alternated measures with and without the metrics",
+        )
+        parser.add_argument(
+            "--storage-readings",
+            type=int,
+            default=20000,
+            help="Number of readings inserted with each value storage",
+        )
+        parser.add_argument(
+            "--ingest-readings",
+            type=int,
+            default=100000,
+            help="Number of readings consumed from the fake feed",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=FEED_BATCH_SIZE,
+            help="Batch size of the consumer",
+        )
+        parser.add_argument(
+            "--writers",
+            type=int,
+            default=FEED_WRITERS,
+            help="Number of db writers of the consumer",
+        )
+        parser.add_argument(
+            "--url",
+            default="http://127.0.0.1:8000/graphql",
+            help="Endpoint of the API loaded by the load and subscriptions scenarios",
+        )
+        parser.add_argument(
+            "--concurrency",
+            default="1,10,50",
+            help="Comma separated numbers of concurrent clients",
+        )
+        parser.add_argument(
+            "--duration", type=float, default=10.0, help="Seconds per load step"
+        )
+        parser.add_argument(
+            "--subscribers", type=int, default=1000, help="Number of subscribers"
+        )
+        parser.add_argument(
+            "--published-readings",
+            type=int,
+            default=20,
+            help="Number of readings published to the subscribers",
+        )
+        parser.add_argument(
+            "--publish-rate",
+            type=float,
+            default=2.0,
+            help="Readings published per second",
+        )
+        parser.add_argument(
+            "--output", help="File the JSON results are written to (default: stdout)"
+        )
+        parser.add_argument(
+            "--baseline", help="JSON results of a previous run to compare with"
+        )
+        parser.add_argument(
+            "--tolerance",
+            type=float,
+            default=0.2,
+            help="Relative degradation from the baseline deemed a regression",
+        )
+
+    def report(self, size: int, label: str, timings: Dict[str, float]) -> None:
+        """Print a latency result, the JSON results going to stdout."""
+        self.stderr.write(
+            f"{size:>10} rows | {label:<26} | "
+            f"p50 {timings['p50']:8.3f} ms | p99 {timings['p99']:8.3f} ms"
+        )
+
+    def handle(self, *args: tuple, **options: Any) -> None:
+        scenarios = parse_scenarios(options["scenarios"])
+        options["windows"] = parse_windows(options["windows"])
+        baseline = None
+        if options["baseline"]:
+            with open(options["baseline"]) as baseline_file:
+                baseline = json.load(baseline_file)
+        results: Dict[str, Any] = {
+            "commit": git_commit(),
+            "date": timezone.now().isoformat(),
+            "python": platform.python_version(),
+            "database": connection.vendor,
+            "settings": {name: getattr(settings, name) for name in RECORDED_SETTINGS},
+            "repeat": options["repeat"],
+            "latencies": [],
+            "ingest": None,
+        }
+        for scenario in scenarios:
+            results.update(getattr(self, f"measure_{scenario}")(options))
+        output = json.dumps(results, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as output_file:
+                output_file.write(output + "\n")
+        else:
+            sys.stdout.write(output + "\n")
+        if baseline is not None:
+            self.check_regressions(baseline, results, options["tolerance"])
+
+    def measure_queries(self, options: Any) -> Dict[str, Any]:
+        """Latencies of the requests at each table size, and their query plans at
+        the largest one if asked."""
+        latencies = []
+        for size in sorted(int(size) for size in options["sizes"].split(",")):
+            latencies += self.measure_latencies(
+                size, options["windows"], options["repeat"]
+            )
+        if not options["explain"]:
+            return {"latencies": latencies}
+        latest = current_temperature_query().timestamp  # type: ignore
+        plans = query_plans(latest, max(options["windows"].values()))
+        for query, plan in plans.items():
+            self.stderr.write(f"{query} plan:\n{plan}")
+        return {"latencies": latencies, "plans": plans}
+
+    def measure_latencies(
+        self, size: int, windows: Dict[str, timedelta], repeat: int
+    ) -> List[Dict[str, Any]]:
+        """Latencies of the requests once the table is grown to `size` readings."""
+        missing = size - Temperature.objects.count()
+        if missing > 0:
+            self.stderr.write(f"Seeding {missing} readings")
+            seed_readings(missing)
+        latest = current_temperature_query().timestamp  # type: ignore
+        timings = time_call(
+            graphql_request(json.dumps({"query": CURRENT_QUERY})), repeat
+        )
+        latencies = [{"query": "currentTemperature", "rows": size, **timings}]
+        self.report(size, "currentTemperature", timings)
+        for name, window in windows.items():
+            body = json.dumps(
+                {
+                    "query": STATISTICS_QUERY,
+                    "variables": {
+                        "after": (latest - window).isoformat(),
+                        "before": latest.isoformat(),
+                    },
+                }
+            )
+            timings = time_call(graphql_request(body), repeat)
+            latencies.append(
+                {
+                    "query": "temperatureStatistics",
+                    "rows": size,
+                    "window": name,
+                    **timings,
+                }
+            )
+            self.report(size, f"temperatureStatistics {name}", timings)
+        return latencies
+
+    def measure_graphql(self, options: Any) -> Dict[str, Any]:
+        """Latencies of the requests with and without the document cache."""
+        graphql = document_latencies(options["repeat"])
+        self.report_results("graphql", graphql)
+        return {"graphql": graphql}
+
+    def measure_metrics(self, options: Any) -> Dict[str, Any]:
+        """Latencies of the requests with and without the metrics."""
+        metrics = metrics_overhead(options["repeat"], options["rounds"])
+        self.report_results("metrics", metrics["requests"])
+        self.stderr.write(
+            f"metrics | consumer {metrics['consumer_us_per_reading']:.2f} us "
+            "per received reading"
+        )
+        return {"metrics": metrics}
+
+    def measure_connections(self, options: Any) -> Dict[str, Any]:
+        """Latencies of the hot queries, over the shortest window, with each
+        connection setting."""
+        connections = connection_latencies(
+            self.latest_reading(), min(options["windows"].values()), options["repeat"]
+        )
+        self.report_results("connections", connections)
+        return {"connections": connections}
+
+    def measure_storage(self, options: Any) -> Dict[str, Any]:
+        """Size, ingest rate and aggregate latencies of each value storage."""
+        storage = storage_comparison(
+            self.latest_reading(), options["storage_readings"], options["repeat"]
+        )
+        self.report_results("storage", storage)
+        return {"storage": storage}
+
+    def measure_ingest(self, options: Any) -> Dict[str, Any]:
+        """Ingest throughput of the consumer reading the local fake feed."""
+        ingest = asyncio.run(
+            ingest_throughput(
+                options["ingest_readings"],
+                batch_size=options["batch_size"],
+                writers=options["writers"],
+            )
+        )
+        self.stderr.write(
+            f"ingest | {ingest['rate']:.0f} readings/s | "
+            f"max lag {ingest['max_lag']:.3f} s"
+        )
+        return {"ingest": ingest}
+
+    def measure_load(self, options: Any) -> Dict[str, Any]:
+        """Throughput and latencies of the running API under concurrent clients."""
+        load = load_throughput(
+            options["url"],
+            [int(clients) for clients in options["concurrency"].split(",")],
+            options["duration"],
+        )
+        self.report_results("load", load)
+        return {"load": load}
+
+    def measure_subscriptions(self, options: Any) -> Dict[str, Any]:
+        """Delivery latencies of the readings to the subscribers of the running
+        API."""
+        subscriptions = asyncio.run(
+            subscription_latencies(
+                websocket_url(options["url"]),
+                options["subscribers"],
+                options["published_readings"],
+                options["publish_rate"],
+            )
+        )
+        self.report_results("subscriptions", [subscriptions])
+        return {"subscriptions": subscriptions}
+
+    def latest_reading(self) -> Temperature:
+        """Latest reading, which the scenarios on existing data start from.
+
+        Raises:
+            CommandError: if the db holds no reading
+        """
+        latest = current_temperature_query()
+        if latest is None:
+            raise CommandError("No reading in db, run the queries scenario first")
+        return latest
+
+    def report_results(self, scenario: str, results: List[Dict[str, Any]]) -> None:
+        """Print the results of a scenario, the JSON results going to stdout."""
+        for result in results:
+            self.stderr.write(f"{scenario} | {describe(result)}")
+
+    def check_regressions(
+        self, baseline: Dict[str, Any], results: Dict[str, Any], tolerance: float
+    ) -> None:
+        """Report the regressions from the baseline.
+
+        Raises:
+            CommandError: if there are any
+        """
+        regressions = compare_results(baseline, results, tolerance)
+        for regression in regressions:
+            self.stderr.write(f"Regression: {regression}")
+        if regressions:
+            raise CommandError(f"{len(regressions)} regression(s) from baseline")
@@ -0,0 +1,165 @@
+"""Unit tests for benchmark_suite.py"""
+from datetime import timedelta
+from io import StringIO
+import json
+import subprocess
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.utils import timezone
+
+from api.management.commands.benchmark_suite import git_commit
+from api.models import Temperature
+from backend.settings import FEED_BATCH_SIZE
+
+
+@pytest.mark.django_db
+def test_benchmark_suite(capsys):
+    """Test that the latencies at each size are written as JSON, along with the
+    query plans, without ingest."""
+    size = Temperature.objects.count() + 2
+    call_command(
+        "benchmark_suite",
+        "--scenarios",
+        "queries",
+        "--sizes",
+        str(size),
+        "--windows",
+        "1h, 1d",
+        "--repeat",
+        "1",
+        "--explain",
+    )
+    assert Temperature.objects.count() == size
+    results = json.loads(capsys.readouterr().out)
+    assert results["ingest"] is None
+    assert list(results["plans"]) == ["currentTemperature", "temperatureStatistics"]
+    assert [
+        (latency["query"], latency["rows"], latency.get("window"))
+        for latency in results["latencies"]
+    ] == [
+        ("currentTemperature", size, None),
+        ("temperatureStatistics", size, "1h"),
+        ("temperatureStatistics", size, "1d"),
+    ]
+
+
+@pytest.mark.django_db
+def test_benchmark_suite_regression(tmp_path):
+    """Test that the results are written to the output file, then compared to the
+    baseline."""
+    size = Temperature.objects.count() + 1
+    output, baseline = tmp_path / "results.json", tmp_path / "baseline.json"
+    baseline.write_text(json.dumps({"latencies": [], "ingest": {"rate": 1000.0}}))
+    err = StringIO()
+    with patch(
+        "api.management.commands.benchmark_suite.ingest_throughput",
+        AsyncMock(return_value={"rate": 100.0, "max_lag": 0.5}),
+    ) as mock_ingest, pytest.raises(CommandError, match="1 regression"):
+        call_command(
+            "benchmark_suite",
+            "--sizes",
+            str(size),
+            "--windows",
+            "1h",
+            "--repeat",
+            "1",
+            "--ingest-readings",
+            "10",
+            "--writers",
+            "2",
+            "--output",
+            str(output),
+            "--baseline",
+            str(baseline),
+            stderr=err,
+        )
+    mock_ingest.assert_awaited_once_with(10, batch_size=FEED_BATCH_SIZE, writers=2)
+    assert json.loads(output.read_text())["ingest"]["rate"] == 100.0
+    assert "Regression: ingest rate: 1000 -> 100 readings/s" in err.getvalue()
+
+
+@pytest.mark.django_db
+def test_benchmark_suite_scenarios(capsys):
+    """Test that the scenarios are run in order on the latest reading, their results
+    written as JSON and reported."""
+    latest = Temperature.objects.create(timestamp=timezone.now(), value=19)
+    calls = []
+
+    def scenario(name, result):
+        return MagicMock(side_effect=lambda *args: calls.append(name) or result)
+
+    with patch(
+        "api.management.commands.benchmark_suite.document_latencies",
+        scenario("graphql", [{"query": "dashboard", "p50": 1.0}]),
+    ), patch(
+        "api.management.commands.benchmark_suite.metrics_overhead",
+        scenario("metrics", {"requests": [], "consumer_us_per_reading": 0.5}),
+    ), patch(
+        "api.management.commands.benchmark_suite.connection_latencies",
+        scenario("connections", []),
+    ) as mock_connections, patch(
+        "api.management.commands.benchmark_suite.storage_comparison",
+        scenario("storage", []),
+    ) as mock_storage, patch(
+        "api.management.commands.benchmark_suite.load_throughput",
+        scenario("load", []),
+    ) as mock_load, patch(
+        "api.management.commands.benchmark_suite.subscription_latencies",
+        AsyncMock(return_value={"received": 4}),
+    ) as mock_subscriptions:
+        call_command(
+            "benchmark_suite",
+            "--scenarios",
+            "subscriptions,load,storage,connections,metrics,graphql",
+            "--windows",
+            "1d,1h",
+            "--url",
+            "https://api.example.com/graphql",
+            "--concurrency",
+            "1,5",
+            "--duration",
+            "2",
+            "--subscribers",
+            "3",
+        )
+    assert calls == ["graphql", "metrics", "connections", "storage", "load"]
+    mock_connections.assert_called_once_with(latest, timedelta(hours=1), 50)
+    mock_storage.assert_called_once_with(latest, 20000, 50)
+    mock_load.assert_called_once_with("https://api.example.com/graphql", [1, 5], 2.0)
+    mock_subscriptions.assert_awaited_once_with(
+        "wss://api.example.com/graphql", 3, 20, 2.0
+    )
+    out, err = capsys.readouterr()
+    results = json.loads(out)
+    assert results["latencies"] == []
+    assert results["graphql"] == [{"query": "dashboard", "p50": 1.0}]
+    assert results["subscriptions"] == {"received": 4}
+    assert "graphql | query dashboard | p50 1.000" in err
+    assert "metrics | consumer 0.50 us" in err
+
+
+@pytest.mark.django_db
+def test_benchmark_suite_without_reading():
+    with pytest.raises(CommandError, match="No reading in db"):
+        call_command("benchmark_suite", "--scenarios", "connections")
+
+
+def test_benchmark_suite_bad_window():
+    with pytest.raises(CommandError):
+        call_command("benchmark_suite", "--windows", "1h,1y")
+
+
+def test_benchmark_suite_bad_scenario():
+    with pytest.raises(CommandError, match="unknown scenario"):
+        call_command("benchmark_suite", "--scenarios", "queries,nope")
+
+
+def test_git_commit():
+    assert len(git_commit() or "0" * 40) == 40
+    with patch(
+        "api.management.commands.benchmark_suite.subprocess.run",
+        side_effect=subprocess.CalledProcessError(128, "git"),
+    ):
+        assert git_commit() is None
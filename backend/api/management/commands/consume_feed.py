@@ -1,58 +1,924 @@
-"""Consume the temperatures feed."""
-from typing import Any, Dict, Iterable, List
+"""Consume the temperatures feeds."""
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime
+from functools import partial
+import os
+import random
+import signal
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterator, List, Optional
 import websockets
 import asyncio
 import json
+import logging
+import math
+import time
 from django.utils import timezone
-from asgiref.sync import sync_to_async
+from asgiref.sync import ThreadSensitiveContext, sync_to_async
 
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandParser
+from prometheus_client import start_http_server
 from django.core.cache import cache
+from django.db import DatabaseError, close_old_connections, connections
 
-from backend.settings import FEED_URI
-from api.models import Temperature, ReadConfig
+from backend.settings import (
+    FEED_URI,
+    FEED_URIS,
+    FEED_BATCH_SIZE,
+    FEED_FLUSH_INTERVAL,
+    FEED_WRITERS,
+    FEED_QUEUE_SIZE,
+    FEED_QUEUE_POLICY,
+    FEED_SPILL_PATH,
+    FEED_STATS_INTERVAL,
+    FEED_STATUS_POLL_INTERVAL,
+    FEED_PING_INTERVAL,
+    FEED_PING_TIMEOUT,
+    FEED_RECONNECT_MIN_DELAY,
+    FEED_RECONNECT_MAX_DELAY,
+    FEED_SHUTDOWN_TIMEOUT,
+    FEED_METRICS_PORT,
+    PUBSUB_PORT,
+)
+from api.models import FeedGap, Temperature, ReadConfig
+from api.gaps import close_gap, open_gap, startup_gap
+from api.ingest import store_readings
+from api.metrics import (
+    INGEST_BATCH_SIZE,
+    INGEST_DISCONNECTIONS,
+    INGEST_DROPPED,
+    INGEST_LAG_SECONDS,
+    INGEST_MALFORMED,
+    INGEST_PERSISTED,
+    INGEST_QUEUE_DEPTH,
+    INGEST_RECEIVED,
+    INGEST_SPILLED,
+    INGEST_WRITE_ERRORS,
+    INGEST_WRITE_SECONDS,
+)
+from api.pubsub import start_publisher
+
+
+logger = logging.getLogger(__name__)
+
+# Policies applied when a reading is received while the queue is full.
+BLOCK = "block"
+DROP_OLDEST = "drop-oldest"
+SPILL = "spill"
+QUEUE_POLICIES = (BLOCK, DROP_OLDEST, SPILL)
+
+# subscription sent to a feed once connected.
+START = {"type": "start", "payload": {"query": "subscription { temperature }"}}
+# frames of the feed ending the subscription.
+SUBSCRIPTION_ENDS = ("error", "connection_error", "complete")
+
+
+class SubscriptionError(Exception):
+    """The feed ended the subscription."""
+
+
+# failures of a feed connection, after which it is reconnected.
+CONNECTION_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    websockets.WebSocketException,
+    SubscriptionError,
+)
+
+
+@dataclass
+class Frame:
+    """A frame received from the feed of a sensor, along with its reception time."""
+
+    received: Dict[str, Any]
+    timestamp: datetime
+    sensor: str = Temperature.DEFAULT_SENSOR
+
+
+class PipelineMetrics:
+    """Counters of the ingestion pipeline, also exported to Prometheus."""
+
+    def __init__(self) -> None:
+        self.received = 0
+        self.persisted = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.malformed = 0
+        self.disconnections = 0
+        self.write_errors = 0
+        # seconds between the reception and the persistence of the oldest reading
+        # of the last written batch.
+        self.lag = 0.0
+        self.max_lag = 0.0
+
+    def record_received(self, sensor: str) -> None:
+        self.received += 1
+        INGEST_RECEIVED.labels(sensor).inc()
+
+    def record_dropped(self) -> None:
+        self.dropped += 1
+        INGEST_DROPPED.inc()
+
+    def record_spilled(self) -> None:
+        self.spilled += 1
+        INGEST_SPILLED.inc()
+
+    def record_malformed(self, sensor: str) -> None:
+        self.malformed += 1
+        INGEST_MALFORMED.labels(sensor).inc()
+
+    def record_disconnection(self, sensor: str) -> None:
+        self.disconnections += 1
+        INGEST_DISCONNECTIONS.labels(sensor).inc()
+
+    def record_write_error(self) -> None:
+        self.write_errors += 1
+        INGEST_WRITE_ERRORS.inc()
+
+    def record_write(self, count: int, oldest: datetime, seconds: float = 0.0) -> None:
+        """Account for a batch of `count` readings, the oldest received at `oldest`,
+        written in `seconds`."""
+        self.persisted += count
+        self.lag = (timezone.now() - oldest).total_seconds()
+        self.max_lag = max(self.max_lag, self.lag)
+        INGEST_PERSISTED.inc(count)
+        INGEST_BATCH_SIZE.observe(count)
+        INGEST_WRITE_SECONDS.observe(seconds)
+        INGEST_LAG_SECONDS.observe(self.lag)
+
+
+class ReadingBuffer:
+    """In-memory buffer of temperature readings, persisted with one bulk insert.
+
+    The buffer is due for a flush when it holds `max_size` readings, or when its
+    oldest reading has been waiting for `max_delay` seconds. Flushes are accounted
+    in `metrics` if given, and pass `live` on to store_readings.
+    """
+
+    def __init__(
+        self,
+        max_size: int = FEED_BATCH_SIZE,
+        max_delay: float = FEED_FLUSH_INTERVAL,
+        metrics: Optional[PipelineMetrics] = None,
+        live: bool = True,
+    ) -> None:
+        self.max_size = max(max_size, 1)
+        self.max_delay = max_delay
+        self.metrics = metrics
+        self.live = live
+        self.readings: List[Temperature] = []
+        # monotonic time at which the oldest pending reading was buffered.
+        self.opened_at: Optional[float] = None
+
+    def __len__(self) -> int:
+        return len(self.readings)
+
+    def append(self, reading: Temperature, now: Optional[float] = None) -> None:
+        """Add a reading to the buffer."""
+        if not self.readings:
+            self.opened_at = time.monotonic() if now is None else now
+        self.readings.append(reading)
+
+    def time_left(self, now: Optional[float] = None) -> Optional[float]:
+        """Seconds until the time threshold is hit, None if the buffer is empty."""
+        if self.opened_at is None:
+            return None
+        now = time.monotonic() if now is None else now
+        return max(self.opened_at + self.max_delay - now, 0.0)
+
+    def is_due(self, now: Optional[float] = None) -> bool:
+        """Tell if the buffer has hit its size or time threshold."""
+        if len(self.readings) >= self.max_size:
+            return True
+        return self.time_left(now) == 0.0
+
+    def flush(self) -> int:
+        """Persist the pending readings in a single bulk insert.
+
+        The readings are kept until the insert is committed: a flush failing on a
+        db error can be retried.
+
+        Returns:
+            int: number of persisted readings
+        """
+        if not self.readings:
+            return 0
+        readings = self.readings
+        # a flush is the consumer's request: replace a broken connection, or one
+        # older than CONN_MAX_AGE, and give a pooled one back afterwards.
+        close_old_connections()
+        started = time.perf_counter()
+        try:
+            store_readings(readings, self.live)
+        except DatabaseError:
+            # the ids returned by the rolled back insert must not be reused.
+            for reading in readings:
+                reading.pk = None
+            raise
+        written = time.perf_counter() - started
+        self.readings, self.opened_at = [], None
+        close_old_connections()
+        if self.metrics:
+            self.metrics.record_write(len(readings), readings[0].timestamp, written)
+        return len(readings)
+
+
+class Backoff:
+    """Delays between the reconnections to a feed: the n-th delay is drawn between
+    half and the whole of min_delay * 2**n, capped at max_delay, so that consumers
+    disconnected together don't reconnect together."""
+
+    def __init__(
+        self,
+        min_delay: float = FEED_RECONNECT_MIN_DELAY,
+        max_delay: float = FEED_RECONNECT_MAX_DELAY,
+        rand: Callable[[], float] = random.random,
+    ) -> None:
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.rand = rand
+        self.attempts = 0
+
+    def next(self) -> float:
+        """Delay before the next reconnection."""
+        delay = min(self.min_delay * 2 ** min(self.attempts, 32), self.max_delay)
+        self.attempts += 1
+        return delay / 2 + self.rand() * delay / 2
+
+    def reset(self) -> None:
+        """Start over from min_delay, once reconnected."""
+        self.attempts = 0
+
+
+class SpillFile:
+    """Append-only file of frames which did not fit in the queue."""
+
+    def __init__(self, path: str = FEED_SPILL_PATH) -> None:
+        self.path = path
+
+    def write(self, frame: Frame) -> None:
+        """Append a frame to the file."""
+        with open(self.path, "a") as spill:
+            spill.write(
+                json.dumps(
+                    {
+                        "sensor": frame.sensor,
+                        "received": frame.received,
+                        "timestamp": frame.timestamp.isoformat(),
+                    }
+                )
+                + "\n"
+            )
+
+    def pop_all(self) -> Iterator[Frame]:
+        """Take all the spilled frames out of the file, oldest first, after those
+        of a replay interrupted by a crash."""
+        replayed = f"{self.path}.replay"
+        if os.path.exists(replayed):
+            yield from self.read(replayed)
+        if not os.path.exists(self.path):
+            return
+        # frames spilled while replaying go to a fresh file.
+        os.replace(self.path, replayed)
+        yield from self.read(replayed)
+
+    def read(self, path: str) -> Iterator[Frame]:
+        """Read the frames of a file, then remove it."""
+        with open(path) as spill:
+            for line in spill:
+                item = json.loads(line)
+                yield Frame(
+                    received=item["received"],
+                    timestamp=datetime.fromisoformat(item["timestamp"]),
+                    sensor=item.get("sensor", Temperature.DEFAULT_SENSOR),
+                )
+        os.remove(path)
+
+
+class FeedStatus:
+    """In-process copy of the feed status (on/off).
+
+    The status is published by the ToggleFeed mutation to the db and the cache. It
+    is polled every `interval` seconds instead of being read for every reading, the
+    last status read being kept while the db or the cache fails.
+    """
+
+    def __init__(
+        self,
+        value: str = "on",
+        interval: float = FEED_STATUS_POLL_INTERVAL,
+        log: Callable[[str], Any] = logger.warning,
+    ) -> None:
+        self.value = value
+        self.interval = interval
+        self.log = log
+
+    def is_on(self) -> bool:
+        return self.value == "on"
+
+    def refresh(self) -> str:
+        """Read the published status, from the cache or the db on a cache miss."""
+        value = cache.get("status")
+        if value is None:
+            value = ReadConfig.objects.get(pk="status").config_value
+        self.value = value
+        return value
+
+    async def watch(self) -> None:
+        """Refresh the status periodically, until cancelled."""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await sync_to_async(self.refresh)()
+            except Exception as exc:
+                self.log(f"Feed status not refreshed, still {self.value}: {exc!r}")
+
+
+class GapRecorder:
+    """Outages of the feed of a sensor, recorded as FeedGaps.
+
+    The records are deferred while the db fails, for the receiver to go on reading
+    the feed, and retried with a backoff. An outage whose end is not recorded yet
+    when the feed is lost again is merged with the next one.
+    """
+
+    def __init__(self, sensor: str, backoff: Backoff) -> None:
+        self.sensor = sensor
+        self.backoff = backoff
+        self.gap: Optional[FeedGap] = None
+        # the downtime of the consumer is still to be recorded.
+        self.startup = True
+        # start and end of the outage, not recorded yet.
+        self.started: Optional[datetime] = None
+        self.ended: Optional[datetime] = None
+        # monotonic time of the next attempt.
+        self.retry_at = 0.0
+
+    def lost(self, started: datetime) -> None:
+        """Start an outage, unless one is under way."""
+        if self.gap is None and self.started is None:
+            self.started = started
+        self.ended = None
+
+    def back(self, ended: datetime) -> None:
+        """End the outage under way, if any."""
+        if self.ended is None and (self.startup or self.gap or self.started):
+            self.ended = ended
+
+    def is_due(self, now: Optional[float] = None) -> bool:
+        """Tell if there is something to record, and it is time to try."""
+        if not (self.startup or self.started or self.ended):
+            return False
+        return (time.monotonic() if now is None else now) >= self.retry_at
+
+    def defer(self, now: Optional[float] = None) -> None:
+        """Put the next attempt off, after a failed one."""
+        now = time.monotonic() if now is None else now
+        self.retry_at = now + self.backoff.next()
+
+    def record(self) -> Optional[FeedGap]:
+        """Record what is known of the outage.
+
+        Returns:
+            FeedGap: the gap closed, if any
+
+        Raises:
+            DatabaseError: if the db fails, what is not recorded being kept
+        """
+        if self.startup:
+            self.gap = startup_gap(self.sensor, self.ended)
+            self.startup = False
+        if self.started is not None:
+            if self.gap is None:
+                self.gap = open_gap(self.sensor, self.started)
+            self.started = None
+        self.backoff.reset()
+        if self.ended is None or self.gap is None:
+            self.ended = None
+            return None
+        close_gap(self.gap, self.ended)
+        gap, self.gap, self.ended = self.gap, None, None
+        return gap
+
+
+def parse_frame(data: Any) -> Optional[Dict[str, Any]]:
+    """Parse a frame of a feed.
+
+    Returns:
+        Dict[str,Any]: the frame (json), None if it is not a reading
+
+    Raises:
+        SubscriptionError: if the frame ends the subscription
+    """
+    try:
+        received = json.loads(data)
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(received, dict):
+        return None
+    if received.get("type") in SUBSCRIPTION_ENDS:
+        raise SubscriptionError(f"{received['type']}: {received.get('payload')}")
+    try:
+        value = received["payload"]["data"]["temperature"]
+    except (TypeError, KeyError):
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return received if math.isfinite(value) else None
 
 
 # process_reading is isolated from capture_data in order to ease its testing.
 
 
-def process_reading(received: Dict[str, Any]) -> None:
-    """Process an incoming temperature reading and persist.
+def process_reading(
+    received: Dict[str, Any],
+    buffer: ReadingBuffer,
+    status: FeedStatus,
+    timestamp: Optional[datetime] = None,
+    sensor: str = Temperature.DEFAULT_SENSOR,
+) -> None:
+    """Process an incoming temperature reading and buffer it for persistence.
 
     Args:
         received (Dict[str,Any]): received reading (json)
+        buffer (ReadingBuffer): buffer the reading is added to
+        status (FeedStatus): current feed status
+        timestamp (datetime): reception time of the reading, defaults to now
+        sensor (str): sensor whose feed the reading was received from
     """
     # Check if reading is on before persisting
-    if cache.get("status", ReadConfig.objects.get(pk="status").config_value) == "on":
-        Temperature.objects.create(
-            timestamp=timezone.now(), value=received["payload"]["data"]["temperature"]
+    if status.is_on():
+        buffer.append(
+            Temperature(
+                sensor=sensor,
+                timestamp=timestamp or timezone.now(),
+                value=received["payload"]["data"]["temperature"],
+            )
         )
+        if buffer.is_due():
+            buffer.flush()
+    else:
+        # the feed was toggled off: persist what was read while it was on.
+        buffer.flush()
+
+
+class FeedPipeline:
+    """Producer/consumer pipeline between the feed websockets and the db.
+
+    A task per feed receives and parses the frames into a bounded queue, while
+    `writers` tasks drain the queue into their own ReadingBuffer, so that a slow db
+    does not stall the websocket reads. The writers are shared by all the feeds:
+    their batches mix the readings of every sensor.
+
+    A feed whose connection is lost is reconnected with a Backoff, and the outage
+    recorded as a FeedGap, while the other feeds and the writers go on. With `live`
+    False, the persisted readings are neither cached nor published.
+    """
+
+    def __init__(
+        self,
+        writers: int = FEED_WRITERS,
+        queue_size: int = FEED_QUEUE_SIZE,
+        policy: str = FEED_QUEUE_POLICY,
+        batch_size: int = FEED_BATCH_SIZE,
+        flush_interval: float = FEED_FLUSH_INTERVAL,
+        spill_path: str = FEED_SPILL_PATH,
+        status: Optional[FeedStatus] = None,
+        ping_interval: float = FEED_PING_INTERVAL,
+        ping_timeout: float = FEED_PING_TIMEOUT,
+        reconnect_min_delay: float = FEED_RECONNECT_MIN_DELAY,
+        reconnect_max_delay: float = FEED_RECONNECT_MAX_DELAY,
+        shutdown_timeout: float = FEED_SHUTDOWN_TIMEOUT,
+        log: Callable[[str], Any] = logger.warning,
+        live: bool = True,
+    ) -> None:
+        if policy not in QUEUE_POLICIES:
+            raise ValueError(f"queue policy must be one of {', '.join(QUEUE_POLICIES)}.")
+        self.writers = max(writers, 1)
+        self.policy = policy
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue: "asyncio.Queue[Frame]" = asyncio.Queue(maxsize=queue_size)
+        self.spill = SpillFile(spill_path)
+        self.status = status or FeedStatus()
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.reconnect_min_delay = reconnect_min_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self.shutdown_timeout = shutdown_timeout
+        self.log = log
+        self.live = live
+        self.metrics = PipelineMetrics()
+
+    def stats(self) -> Dict[str, Any]:
+        """Snapshot of the pipeline metrics."""
+        return {
+            "queue_depth": self.queue.qsize(),
+            "received": self.metrics.received,
+            "persisted": self.metrics.persisted,
+            "dropped": self.metrics.dropped,
+            "spilled": self.metrics.spilled,
+            "malformed": self.metrics.malformed,
+            "disconnections": self.metrics.disconnections,
+            "write_errors": self.metrics.write_errors,
+            "lag": self.metrics.lag,
+            "max_lag": self.metrics.max_lag,
+        }
+
+    async def put(self, frame: Frame) -> None:
+        """Queue a frame, applying the full queue policy if needed."""
+        self.metrics.record_received(frame.sensor)
+        if not self.queue.full():
+            self.queue.put_nowait(frame)
+        elif self.policy == DROP_OLDEST:
+            self.queue.get_nowait()
+            self.queue.task_done()
+            self.metrics.record_dropped()
+            self.queue.put_nowait(frame)
+        elif self.policy == SPILL:
+            self.spill.write(frame)
+            self.metrics.record_spilled()
+        else:
+            await self.queue.put(frame)
+
+    def process(self, frames: Deque[Frame], buffer: ReadingBuffer) -> None:
+        """Process a batch of frames in a single hop to the sync world.
+
+        On a db error, the frames left to process are still in `frames`, those
+        already processed in the buffer.
+        """
+        while frames:
+            frame = frames.popleft()
+            process_reading(
+                frame.received, buffer, self.status, frame.timestamp, frame.sensor
+            )
+
+    def buffer(self) -> ReadingBuffer:
+        """Create a writer buffer."""
+        return ReadingBuffer(
+            self.batch_size, self.flush_interval, self.metrics, self.live
+        )
+
+    def replay_spill(self, buffer: ReadingBuffer) -> None:
+        """Process the spilled frames, once the queue has drained."""
+        frames: Deque[Frame] = deque()
+        for frame in self.spill.pop_all():
+            frames.append(frame)
+            if len(frames) >= buffer.max_size:
+                self.process(frames, buffer)
+        self.process(frames, buffer)
+        buffer.flush()
+
+    def spill_buffer(self, buffer: ReadingBuffer) -> None:
+        """Spill the readings of a buffer which can't be written, to be replayed by
+        the next run."""
+        for reading in buffer.readings:
+            self.spill.write(
+                Frame(
+                    received={"payload": {"data": {"temperature": str(reading.value)}}},
+                    timestamp=reading.timestamp,
+                    sensor=reading.sensor,
+                )
+            )
+        buffer.readings, buffer.opened_at = [], None
+
+    def spill_frames(self, frames: Deque[Frame]) -> None:
+        """Spill frames which won't be processed, to be replayed by the next run."""
+        while frames:
+            self.spill.write(frames.popleft())
+
+    async def flush(
+        self, buffer: ReadingBuffer, error: Optional[DatabaseError] = None
+    ) -> None:
+        """Flush a buffer, retrying with a backoff as long as the db fails, from the
+        failure of a previous attempt if any."""
+        backoff = Backoff(self.reconnect_min_delay, self.reconnect_max_delay)
+        while True:
+            if error is not None:
+                self.metrics.record_write_error()
+                self.log(f"Write of {len(buffer)} readings failed: {error!r}")
+                await asyncio.sleep(backoff.next())
+            try:
+                await sync_to_async(buffer.flush)()
+                return
+            except DatabaseError as exc:
+                error = exc
 
+    async def write(self) -> None:
+        """Writer task: drain the queue into the db.
 
-async def capture_data() -> None:  # pragma: no cover
-    """Read from the feed."""
-    start = {"type": "start", "payload": {"query": "subscription { temperature }"}}
-    async with websockets.connect(FEED_URI, subprotocols=["graphql-ws"]) as websocket:  # type: ignore
-        await websocket.send(json.dumps(start))
+        The sync calls of a writer run in a thread of its own, with its own db
+        connection, for the writers to write concurrently.
+
+        A write failing on a db error is retried until it succeeds, the readings
+        being kept meanwhile, and the queue filling up: the full queue policy
+        applies. On shutdown, the readings which can't be written are spilled, as
+        the frames of a batch left unprocessed.
+        """
+        async with ThreadSensitiveContext():
+            buffer = self.buffer()
+            try:
+                while True:
+                    frames = await self.take(buffer)
+                    if not frames:
+                        continue
+                    await self.write_frames(frames, buffer)
+                    if self.policy == SPILL and self.queue.empty():
+                        await sync_to_async(self.replay_spill)(buffer)
+            finally:
+                # don't lose the pending readings on shutdown.
+                try:
+                    await sync_to_async(buffer.flush)()
+                except DatabaseError as exc:
+                    self.log(f"Spilling {len(buffer)} readings, not written: {exc!r}")
+                    self.spill_buffer(buffer)
+                await sync_to_async(connections.close_all)()
+
+    async def take(self, buffer: ReadingBuffer) -> List[Frame]:
+        """Wait for the next frames, up to a full batch, flushing the buffer if it
+        is due meanwhile.
+
+        Returns:
+            List[Frame]: the frames taken from the queue, none if the buffer was due
+        """
+        try:
+            frames = [
+                await asyncio.wait_for(self.queue.get(), timeout=buffer.time_left())
+            ]
+        except asyncio.TimeoutError:
+            await self.flush(buffer)
+            return []
+        # take whatever else is already queued, up to a full batch.
+        while len(frames) < buffer.max_size and not self.queue.empty():
+            frames.append(self.queue.get_nowait())
+        return frames
+
+    async def write_frames(self, frames: List[Frame], buffer: ReadingBuffer) -> None:
+        """Process frames taken from the queue into the buffer, retrying as long as
+        the db fails, the frames left unprocessed on shutdown being spilled."""
+        pending = deque(frames)
+        try:
+            while pending:
+                try:
+                    await sync_to_async(self.process)(pending, buffer)
+                except DatabaseError as exc:
+                    await self.flush(buffer, exc)
+        finally:
+            if pending:
+                # after a process still running, in the same thread.
+                await sync_to_async(self.spill_frames)(pending)
+            for _ in frames:
+                self.queue.task_done()
+
+    async def supervise(self, name: str, worker: Callable[[], Awaitable[None]]) -> None:
+        """Run a worker, restarting it with a backoff whenever it fails, until
+        cancelled."""
+        backoff = Backoff(self.reconnect_min_delay, self.reconnect_max_delay)
         while True:
-            data = await websocket.recv()
-            received = json.loads(data)
-            await sync_to_async(process_reading)(received)
+            try:
+                await worker()
+            except Exception as exc:
+                self.log(f"{name} failed, restarting it: {exc!r}")
+                await asyncio.sleep(backoff.next())
+
+    async def record_gaps(self, gaps: GapRecorder) -> Optional[FeedGap]:
+        """Record the outage of a feed if due, deferring it on a db error.
+
+        Returns:
+            FeedGap: the gap closed, if any
+        """
+        if not gaps.is_due():
+            return None
+        try:
+            return await sync_to_async(gaps.record)()
+        except DatabaseError as exc:
+            self.log(f"Outage of feed {gaps.sensor} not recorded yet: {exc!r}")
+            gaps.defer()
+            return None
+
+    async def consume(
+        self, sensor: str, uri: str, connect: Callable[..., Any] = websockets.connect
+    ) -> None:
+        """Receiver task of a sensor feed: read and parse its frames into the queue,
+        skipping those which are not readings, and reconnecting whenever the
+        connection is lost or the subscription ended by the feed, until cancelled.
+
+        An outage is recorded as a FeedGap from the last frame received, closed by
+        the first frame received after reconnecting. So is the downtime of the
+        consumer, from the last persisted reading.
+        """
+        backoff = Backoff(self.reconnect_min_delay, self.reconnect_max_delay)
+        gaps = GapRecorder(
+            sensor, Backoff(self.reconnect_min_delay, self.reconnect_max_delay)
+        )
+        await self.record_gaps(gaps)
+        last_received: Optional[datetime] = None
+        while True:
+            try:
+                async with connect(
+                    uri,
+                    subprotocols=["graphql-ws"],
+                    ping_interval=self.ping_interval,
+                    ping_timeout=self.ping_timeout,
+                ) as websocket:
+                    await websocket.send(json.dumps(START))
+                    while True:
+                        received = parse_frame(await websocket.recv())
+                        if received is None:
+                            # a bad frame is skipped, not worth a reconnection.
+                            self.metrics.record_malformed(sensor)
+                            continue
+                        frame = Frame(
+                            received=received,
+                            timestamp=timezone.now(),
+                            sensor=sensor,
+                        )
+                        await self.put(frame)
+                        last_received = frame.timestamp
+                        backoff.reset()
+                        gaps.back(frame.timestamp)
+                        gap = await self.record_gaps(gaps)
+                        if gap is not None:
+                            self.log(f"Feed {sensor} is back after {gap.started}")
+            except CONNECTION_ERRORS as exc:
+                self.metrics.record_disconnection(sensor)
+                self.log(f"Feed {sensor} lost: {exc!r}")
+                gaps.lost(last_received or timezone.now())
+                await self.record_gaps(gaps)
+            await asyncio.sleep(backoff.next())
+
+    async def report(self, interval: float, write: Any) -> None:
+        """Periodically write the pipeline metrics."""
+        while True:
+            await asyncio.sleep(interval)
+            write(
+                " ".join(f"{key}={value}" for key, value in self.stats().items())
+            )
+
+    async def run(
+        self, feeds: Dict[str, str], connect: Callable[..., Any] = websockets.connect
+    ) -> None:
+        """Run a receiver per sensor feed and the writers until cancelled, then
+        persist what was already received, or spill what the writers could not
+        persist within the shutdown timeout."""
+        INGEST_QUEUE_DEPTH.set_function(self.queue.qsize)
+        writers = [
+            asyncio.create_task(self.supervise("Writer", self.write))
+            for _ in range(self.writers)
+        ]
+        watcher = asyncio.create_task(self.status.watch())
+        # replay what was left over by a previous run, whatever its policy.
+        buffer = self.buffer()
+        await sync_to_async(self.replay_spill)(buffer)
+        # a receiver failing on a bug is restarted, the other feeds going on.
+        receivers = [
+            asyncio.create_task(
+                self.supervise(
+                    f"Receiver of feed {sensor}",
+                    partial(self.consume, sensor, uri, connect),
+                )
+            )
+            for sensor, uri in feeds.items()
+        ]
+        try:
+            await asyncio.gather(*receivers)
+        finally:
+            for task in receivers:
+                task.cancel()
+            await asyncio.gather(*receivers, return_exceptions=True)
+            # let the writers persist what was already received.
+            try:
+                await asyncio.wait_for(self.queue.join(), self.shutdown_timeout)
+            except asyncio.TimeoutError:
+                self.log(f"Writers stuck, spilling {self.queue.qsize()} readings")
+            for task in writers + [watcher]:
+                task.cancel()
+            await asyncio.gather(*writers, watcher, return_exceptions=True)
+            while not self.queue.empty():
+                self.spill.write(self.queue.get_nowait())
+                self.queue.task_done()
+
 
+def feed_uris() -> Dict[str, str]:
+    """URIs of the feeds to consume, by sensor."""
+    return FEED_URIS or {Temperature.DEFAULT_SENSOR: FEED_URI}
 
-class Command(BaseCommand):  # pragma: no cover
-    """Custom command to consume the temperatures feed and store read values in db."""
 
-    help = "Consume the temperatures feed and store read values in db"
+async def capture_data(
+    pipeline: FeedPipeline,
+    feeds: Dict[str, str],
+    stats_interval: float = 0,
+    write: Any = logger.info,
+) -> None:
+    """Read from the feeds of the sensors, in the same event loop, until cancelled."""
+    reporter = None
+    if stats_interval > 0:
+        reporter = asyncio.create_task(pipeline.report(stats_interval, write))
+    try:
+        await pipeline.run(feeds)
+    finally:
+        if reporter:
+            reporter.cancel()
 
-    def handle(self, *args: tuple, **options: int) -> None:
-        """Consume the feed in an infinite loop and persist data in db."""
-        self.stdout.write(f"Launch consumption of temperature feed at {FEED_URI}")
+
+class Command(BaseCommand):
+    """Custom command to consume the temperatures feeds of the sensors and store
+    read values in db."""
+
+    help = "Consume the temperatures feeds and store read values in db"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=FEED_BATCH_SIZE,
+            help="Number of buffered readings triggering a bulk insert",
+        )
+        parser.add_argument(
+            "--flush-interval",
+            type=float,
+            default=FEED_FLUSH_INTERVAL,
+            help="Max number of seconds a reading is buffered before being inserted",
+        )
+        parser.add_argument(
+            "--writers",
+            type=int,
+            default=FEED_WRITERS,
+            help="Number of concurrent db writers",
+        )
+        parser.add_argument(
+            "--queue-size",
+            type=int,
+            default=FEED_QUEUE_SIZE,
+            help="Max number of readings waiting for a db writer",
+        )
+        parser.add_argument(
+            "--queue-policy",
+            choices=QUEUE_POLICIES,
+            default=FEED_QUEUE_POLICY,
+            help="What to do with a reading received while the queue is full",
+        )
+        parser.add_argument(
+            "--status-poll-interval",
+            type=float,
+            default=FEED_STATUS_POLL_INTERVAL,
+            help="Number of seconds between two refreshes of the feed status",
+        )
+        parser.add_argument(
+            "--stats-interval",
+            type=float,
+            default=FEED_STATS_INTERVAL,
+            help="Number of seconds between two queue metrics reports, 0 to disable",
+        )
+
+    def handle(self, *args: tuple, **options: Any) -> None:
+        """Consume the feeds in an infinite loop and persist data in db."""
+        feeds = feed_uris()
+        for sensor, uri in feeds.items():
+            self.stdout.write(
+                f"Launch consumption of temperature feed {sensor} at {uri}"
+            )
         # setup initial reading status
         ReadConfig.objects.update_or_create(
             config_key="status", defaults={"config_value": "on"}
         )
         # set the cache
         cache.set("status", "on")
-        asyncio.run(capture_data())
+
+        if FEED_METRICS_PORT:
+            start_http_server(FEED_METRICS_PORT)
+            self.stdout.write(f"Serving metrics on port {FEED_METRICS_PORT}")
+
+        async def consume() -> None:
+            if PUBSUB_PORT:
+                # stream the persisted readings to the API subscribers.
+                publisher = await start_publisher()
+                self.stdout.write(f"Publishing readings on port {publisher.port}")
+            # the pipeline queue must be created within the running event loop.
+            pipeline = FeedPipeline(
+                writers=options["writers"],
+                queue_size=options["queue_size"],
+                policy=options["queue_policy"],
+                batch_size=options["batch_size"],
+                flush_interval=options["flush_interval"],
+                status=FeedStatus(
+                    "on", options["status_poll_interval"], log=self.stdout.write
+                ),
+                log=self.stdout.write,
+            )
+            capture = asyncio.create_task(
+                capture_data(
+                    pipeline, feeds, options["stats_interval"], self.stdout.write
+                )
+            )
+            # stop as when cancelled: the readings already received are persisted.
+            loop = asyncio.get_running_loop()
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                loop.add_signal_handler(signum, capture.cancel)
+            try:
+                await capture
+            except asyncio.CancelledError:
+                self.stdout.write("Consumption stopped, pending readings persisted")
+
+        asyncio.run(consume())
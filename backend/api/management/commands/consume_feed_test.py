@@ -1,36 +1,1005 @@
-from unittest.mock import MagicMock, patch
+import asyncio
+from datetime import timedelta
+from io import StringIO
+import json
+import os
+import signal
+import threading
+from unittest.mock import AsyncMock, MagicMock, patch
+import pytest
+from django.core.management import call_command
+from django.db import OperationalError
+from django.utils import timezone
+from prometheus_client import REGISTRY
 
-from api.management.commands.consume_feed import process_reading
-from api.models import ReadConfig
+from api.fake_feed import MALFORMED_FRAMES, FakeFeed as FakeFeedServer, reading_frame
+from api.management.commands.consume_feed import (
+    BLOCK,
+    DROP_OLDEST,
+    SPILL,
+    Backoff,
+    FeedPipeline,
+    FeedStatus,
+    Frame,
+    GapRecorder,
+    PipelineMetrics,
+    SubscriptionError,
+    parse_frame,
+    process_reading,
+    ReadingBuffer,
+    SpillFile,
+    capture_data,
+    feed_uris,
+)
+from api.models import ReadConfig, Temperature
+from backend.settings import FEED_URI
 
 
+@pytest.fixture(autouse=True)
+def mock_close_old_connections():
+    """Keep the connection of the test, which runs in a transaction."""
+    with patch(
+        "api.management.commands.consume_feed.close_old_connections"
+    ) as mock_close:
+        yield mock_close
+
 def test_process_reading_with_persist():
     """Test that process_reading call the persistence method when the batch is full"""
     # Given
     received = {"payload": {"data": {"temperature": 20.5}}}
+    buffer = ReadingBuffer(max_size=1, max_delay=60)
     # When
     with patch(
-        "api.management.commands.consume_feed.Temperature.objects.create"
-    ) as mock_create, patch(
-        "api.management.commands.consume_feed.ReadConfig.objects.get",
-        return_value=ReadConfig(config_key="status", config_value="on"),
-    ):
-        process_reading(received)
+        "api.management.commands.consume_feed.store_readings"
+    ) as mock_create:
+        process_reading(received, buffer, FeedStatus("on"))
         # Then
         mock_create.assert_called_once()
+        assert len(mock_create.call_args.args[0]) == 1
+        assert len(buffer) == 0
 
 
 def test_process_reading_without_persist():
     """Test that process_reading don't call the persistence method when the batch is not full"""
     # Given
     received = {"payload": {"data": {"temperature": 20.5}}}
+    buffer = ReadingBuffer(max_size=2, max_delay=60)
+    # When
+    with patch(
+        "api.management.commands.consume_feed.store_readings"
+    ) as mock_create:
+        process_reading(received, buffer, FeedStatus("on"))
+        # Then
+        mock_create.assert_not_called()
+        assert len(buffer) == 1
+
+
+def test_process_reading_feed_off():
+    """Test that process_reading don't buffer the reading and flushes pending ones when the feed is off"""
+    # Given
+    received = {"payload": {"data": {"temperature": 20.5}}}
+    buffer = ReadingBuffer(max_size=10, max_delay=60)
+    buffer.append(Temperature(value=19.5))
     # When
     with patch(
-        "api.management.commands.consume_feed.Temperature.objects.create"
-    ) as mock_create, patch(
+        "api.management.commands.consume_feed.store_readings"
+    ) as mock_create:
+        process_reading(received, buffer, FeedStatus("off"))
+        # Then
+        mock_create.assert_called_once()
+        assert [tm.value for tm in mock_create.call_args.args[0]] == [19.5]
+        assert len(buffer) == 0
+
+
+def test_buffer_time_threshold():
+    """Test that the buffer is due once its oldest reading has waited long enough"""
+    buffer = ReadingBuffer(max_size=10, max_delay=1.0)
+    assert buffer.time_left(now=0.0) is None
+    assert not buffer.is_due(now=0.0)
+    buffer.append(Temperature(value=19.5), now=10.0)
+    buffer.append(Temperature(value=20.5), now=10.6)
+    assert buffer.time_left(now=10.6) == pytest.approx(0.4)
+    assert not buffer.is_due(now=10.6)
+    assert buffer.is_due(now=11.0)
+
+
+def test_buffer_flush(mock_close_old_connections):
+    """Test that flushing writes all pending readings at once and resets the buffer"""
+    buffer = ReadingBuffer(max_size=10, max_delay=1.0)
+    with patch(
+        "api.management.commands.consume_feed.store_readings"
+    ) as mock_create:
+        assert buffer.flush() == 0
+        mock_create.assert_not_called()
+        buffer.append(Temperature(value=19.5))
+        buffer.append(Temperature(value=20.5))
+        assert buffer.flush() == 2
+        mock_create.assert_called_once()
+    # the connection is recycled around the write, as around a request.
+    assert mock_close_old_connections.call_count == 2
+    assert len(buffer) == 0
+    assert buffer.time_left() is None
+
+
+def test_buffer_flush_db_error():
+    """Test that the readings are kept until they are written"""
+    buffer = ReadingBuffer(max_size=10, max_delay=1.0)
+    buffer.append(Temperature(value=19.5))
+    buffer.readings[0].pk = 7
+    with patch(
+        "api.management.commands.consume_feed.store_readings",
+        side_effect=[OperationalError("gone"), None],
+    ) as mock_create:
+        with pytest.raises(OperationalError):
+            buffer.flush()
+        assert len(buffer) == 1 and buffer.readings[0].pk is None
+        assert buffer.flush() == 1
+    assert mock_create.call_count == 2
+    assert len(buffer) == 0
+
+
+def _frame(value, sensor=Temperature.DEFAULT_SENSOR):
+    return Frame(
+        received={"payload": {"data": {"temperature": value}}},
+        timestamp=timezone.now(),
+        sensor=sensor,
+    )
+
+
+def test_pipeline_bad_policy():
+    """Test that an unknown full queue policy is rejected"""
+    with pytest.raises(ValueError):
+        FeedPipeline(policy="ignore")
+
+
+@pytest.mark.parametrize(
+    "policy,expected_queue,dropped,spilled",
+    [
+        (DROP_OLDEST, [20.5, 21.5], 1, 0),
+        (SPILL, [19.5, 20.5], 0, 1),
+    ],
+)
+def test_pipeline_full_queue_policy(tmp_path, policy, expected_queue, dropped, spilled):
+    """Test what happens to a reading received while the queue is full"""
+
+    async def run():
+        pipeline = FeedPipeline(
+            queue_size=2, policy=policy, spill_path=str(tmp_path / "spill.jsonl")
+        )
+        for value in (19.5, 20.5, 21.5):
+            await pipeline.put(_frame(value))
+        return pipeline
+
+    pipeline = asyncio.run(run())
+    queued = [pipeline.queue.get_nowait() for _ in range(pipeline.queue.qsize())]
+    assert [frame.received["payload"]["data"]["temperature"] for frame in queued] == (
+        expected_queue
+    )
+    stats = pipeline.stats()
+    assert stats["received"] == 3
+    assert stats["dropped"] == dropped
+    assert stats["spilled"] == spilled
+    if policy == SPILL:
+        assert [
+            frame.received["payload"]["data"]["temperature"]
+            for frame in pipeline.spill.pop_all()
+        ] == [21.5]
+
+
+def test_pipeline_metrics_exported():
+    """Test that the pipeline metrics are exported to Prometheus"""
+
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    names = (
+        "feed_readings_dropped_total",
+        "feed_readings_spilled_total",
+        "feed_readings_persisted_total",
+        "feed_batch_size_sum",
+        "feed_write_seconds_sum",
+        "feed_lag_seconds_count",
+    )
+    before = {name: sample(name) for name in names}
+    received = sample("feed_readings_received_total", sensor="attic")
+    disconnections = sample("feed_disconnections_total", sensor="attic")
+    malformed = sample("feed_frames_malformed_total", sensor="attic")
+    metrics = PipelineMetrics()
+    metrics.record_received("attic")
+    metrics.record_dropped()
+    metrics.record_spilled()
+    metrics.record_malformed("attic")
+    metrics.record_disconnection("attic")
+    metrics.record_write(10, timezone.now() - timedelta(seconds=2), 0.5)
+    assert sample("feed_readings_received_total", sensor="attic") == received + 1
+    assert sample("feed_disconnections_total", sensor="attic") == disconnections + 1
+    assert sample("feed_frames_malformed_total", sensor="attic") == malformed + 1
+    assert {name: sample(name) - before[name] for name in names} == {
+        "feed_readings_dropped_total": 1,
+        "feed_readings_spilled_total": 1,
+        "feed_readings_persisted_total": 10,
+        "feed_batch_size_sum": 10,
+        "feed_write_seconds_sum": 0.5,
+        "feed_lag_seconds_count": 1,
+    }
+    assert metrics.lag >= 2
+
+
+def test_pipeline_block_policy():
+    """Test that the receiver waits for room when the queue is full"""
+
+    async def run():
+        pipeline = FeedPipeline(queue_size=1, policy=BLOCK)
+        await pipeline.put(_frame(19.5))
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(pipeline.put(_frame(20.5)), timeout=0.01)
+        return pipeline
+
+    assert asyncio.run(run()).queue.qsize() == 1
+
+
+def test_spill_file_empty(tmp_path):
+    """Test that popping a missing spill file yields nothing"""
+    assert list(SpillFile(str(tmp_path / "spill.jsonl")).pop_all()) == []
+
+
+def test_spill_file_interrupted_replay(tmp_path):
+    """Test that the frames of a replay interrupted by a crash are replayed first"""
+    spill = SpillFile(str(tmp_path / "spill.jsonl"))
+    spill.write(_frame(19.5))
+    # crashed while replaying it.
+    next(spill.pop_all())
+    spill.write(_frame(20.5))
+    assert [
+        frame.received["payload"]["data"]["temperature"] for frame in spill.pop_all()
+    ] == [19.5, 20.5]
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_pipeline_writer():
+    """Test that the writers persist the queued readings of all the feeds in batches
+    and report the lag"""
+
+    async def run():
+        pipeline = FeedPipeline(writers=1, batch_size=2, flush_interval=60)
+        for value, sensor in ((19.5, "attic"), (20.5, "cellar"), (21.5, "attic")):
+            await pipeline.put(_frame(value, sensor))
+        writer = asyncio.create_task(pipeline.write())
+        await pipeline.queue.join()
+        writer.cancel()
+        await asyncio.gather(writer, return_exceptions=True)
+        return pipeline
+
+    with patch(
+        "api.management.commands.consume_feed.store_readings"
+    ) as mock_create:
+        pipeline = asyncio.run(run())
+    # one full batch, then the leftover flushed on shutdown
+    assert [len(call.args[0]) for call in mock_create.call_args_list] == [2, 1]
+    assert [
+        tm.sensor for call in mock_create.call_args_list for tm in call.args[0]
+    ] == ["attic", "cellar", "attic"]
+    stats = pipeline.stats()
+    assert stats["persisted"] == 3
+    assert stats["queue_depth"] == 0
+    assert stats["lag"] >= 0
+    assert stats["max_lag"] >= stats["lag"]
+
+
+def test_pipeline_writers_overlap():
+    """Test that the writers flush concurrently, each in a thread of its own"""
+    barrier = threading.Barrier(2, timeout=5)
+    threads = []
+
+    def store(readings, live):
+        threads.append(threading.get_ident())
+        # both flushes must be under way for either to go on.
+        barrier.wait()
+
+    async def run():
+        pipeline = FeedPipeline(writers=2, batch_size=1)
+        for value in (19.5, 20.5):
+            await pipeline.put(_frame(value))
+        writers = [asyncio.create_task(pipeline.write()) for _ in range(2)]
+        await asyncio.wait_for(pipeline.queue.join(), 5)
+        for writer in writers:
+            writer.cancel()
+        await asyncio.gather(*writers, return_exceptions=True)
+        return pipeline
+
+    with patch("api.management.commands.consume_feed.store_readings", store):
+        pipeline = asyncio.run(run())
+    assert pipeline.stats()["persisted"] == 2
+    assert len(set(threads)) == 2
+
+
+def test_pipeline_writer_retries():
+    """Test that a write failing on a db error is retried, without losing or
+    duplicating readings"""
+
+    async def run():
+        pipeline = FeedPipeline(
+            batch_size=2,
+            flush_interval=60,
+            reconnect_min_delay=0,
+            reconnect_max_delay=0,
+            log=lambda message: None,
+        )
+        for value in (19.5, 20.5, 21.5):
+            await pipeline.put(_frame(value))
+        writer = asyncio.create_task(pipeline.write())
+        await pipeline.queue.join()
+        writer.cancel()
+        await asyncio.gather(writer, return_exceptions=True)
+        return pipeline
+
+    written = []
+
+    def store(readings, live):
+        if len(written) < 2:
+            written.append(None)
+            raise OperationalError("gone")
+        written.append([tm.value for tm in readings])
+
+    with patch(
+        "api.management.commands.consume_feed.store_readings", side_effect=store
+    ):
+        pipeline = asyncio.run(run())
+    assert written == [None, None, [19.5, 20.5], [21.5]]
+    assert pipeline.stats()["write_errors"] == 2
+    assert pipeline.stats()["persisted"] == 3
+
+
+def test_pipeline_writer_spills_on_shutdown(tmp_path):
+    """Test that the readings which can't be written are spilled on shutdown"""
+
+    async def run():
+        pipeline = FeedPipeline(
+            batch_size=1,
+            spill_path=str(tmp_path / "spill.jsonl"),
+            reconnect_min_delay=0.01,
+            reconnect_max_delay=0.01,
+            log=lambda message: None,
+        )
+        await pipeline.put(_frame(19.5, "attic"))
+        writer = asyncio.create_task(pipeline.write())
+        await _wait_for(lambda: pipeline.metrics.write_errors == 2)
+        writer.cancel()
+        await asyncio.gather(writer, return_exceptions=True)
+        return pipeline
+
+    with patch(
+        "api.management.commands.consume_feed.store_readings",
+        side_effect=OperationalError("gone"),
+    ):
+        pipeline = asyncio.run(run())
+    assert pipeline.queue.empty()
+    assert [
+        (frame.sensor, frame.received["payload"]["data"]["temperature"])
+        for frame in pipeline.spill.pop_all()
+    ] == [("attic", "19.5")]
+
+
+def test_pipeline_writer_spills_batch_on_shutdown(tmp_path):
+    """Test that the frames of a batch left unprocessed are spilled on shutdown"""
+
+    async def run():
+        pipeline = FeedPipeline(
+            batch_size=2,
+            flush_interval=60,
+            spill_path=str(tmp_path / "spill.jsonl"),
+            reconnect_min_delay=0.01,
+            reconnect_max_delay=0.01,
+            log=lambda message: None,
+        )
+        writer = asyncio.create_task(pipeline.write())
+        await pipeline.put(_frame(19.5))
+        await pipeline.queue.join()
+        # the buffer is full after the first frame of the batch.
+        pipeline.queue.put_nowait(_frame(20.5))
+        pipeline.queue.put_nowait(_frame(21.5))
+        await _wait_for(lambda: pipeline.metrics.write_errors == 2)
+        writer.cancel()
+        await asyncio.gather(writer, return_exceptions=True)
+        return pipeline
+
+    with patch(
+        "api.management.commands.consume_feed.store_readings",
+        side_effect=OperationalError("gone"),
+    ):
+        pipeline = asyncio.run(run())
+    assert sorted(
+        float(frame.received["payload"]["data"]["temperature"])
+        for frame in pipeline.spill.pop_all()
+    ) == [19.5, 20.5, 21.5]
+
+
+def test_pipeline_supervise():
+    """Test that a failed writer is restarted"""
+    calls = []
+
+    async def worker():
+        calls.append(None)
+        if len(calls) == 1:
+            raise RuntimeError("bug")
+        await asyncio.sleep(3600)
+
+    async def run():
+        pipeline = FeedPipeline(
+            reconnect_min_delay=0, reconnect_max_delay=0, log=lambda message: None
+        )
+        task = asyncio.create_task(pipeline.supervise("Writer", worker))
+        await _wait_for(lambda: len(calls) == 2)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(run())
+
+
+def test_pipeline_writer_flush_interval():
+    """Test that a writer flushes on time on a quiet feed"""
+
+    async def run():
+        pipeline = FeedPipeline(batch_size=10, flush_interval=0.01)
+        await pipeline.put(_frame(19.5))
+        writer = asyncio.create_task(pipeline.write())
+        await pipeline.queue.join()
+        await asyncio.sleep(0.05)
+        flushed = pipeline.stats()["persisted"]
+        writer.cancel()
+        await asyncio.gather(writer, return_exceptions=True)
+        return flushed
+
+    with patch(
+        "api.management.commands.consume_feed.store_readings"
+    ) as mock_create:
+        assert asyncio.run(run()) == 1
+    mock_create.assert_called_once()
+
+
+def test_pipeline_writer_replay_spill(tmp_path):
+    """Test that a writer replays the spilled readings once the queue has drained"""
+
+    async def run():
+        pipeline = FeedPipeline(
+            batch_size=2,
+            flush_interval=60,
+            policy=SPILL,
+            spill_path=str(tmp_path / "spill.jsonl"),
+        )
+        for value in (16.5, 17.5, 18.5):
+            pipeline.spill.write(_frame(value, "attic"))
+        await pipeline.put(_frame(19.5))
+        writer = asyncio.create_task(pipeline.write())
+        await pipeline.queue.join()
+        await asyncio.sleep(0.05)
+        writer.cancel()
+        await asyncio.gather(writer, return_exceptions=True)
+        return pipeline
+
+    with patch(
+        "api.management.commands.consume_feed.store_readings"
+    ) as mock_create:
+        pipeline = asyncio.run(run())
+    assert sorted(
+        tm.value for call in mock_create.call_args_list for tm in call.args[0]
+    ) == [16.5, 17.5, 18.5, 19.5]
+    assert [
+        tm.sensor for call in mock_create.call_args_list for tm in call.args[0]
+    ] == ["default", "attic", "attic", "attic"]
+    assert pipeline.stats()["persisted"] == 4
+    assert list(pipeline.spill.pop_all()) == []
+
+
+def test_backoff():
+    """Test that the delays double up to the max, jittered within their upper half"""
+    backoff = Backoff(1.0, 5.0, rand=lambda: 1.0)
+    assert [backoff.next() for _ in range(5)] == [1.0, 2.0, 4.0, 5.0, 5.0]
+    backoff.reset()
+    assert Backoff(1.0, 5.0, rand=lambda: 0.0).next() == backoff.next() / 2
+
+
+class FakeConnection:
+    """Connection to a feed, delivering its frames then failing, or refused if
+    None, or delivering nothing if it is the last one."""
+
+    def __init__(self, values, last):
+        self.values = values
+        self.last = last
+        self.sent = []
+
+    async def __aenter__(self):
+        if self.values is None:
+            raise OSError("refused")
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def send(self, data):
+        self.sent.append(json.loads(data))
+
+    async def recv(self):
+        if self.values:
+            value = self.values.pop(0)
+            if isinstance(value, str):
+                # a frame, sent as is.
+                return value
+            return json.dumps({"payload": {"data": {"temperature": value}}})
+        if self.last:
+            await asyncio.sleep(3600)
+        raise OSError("closed")
+
+
+class FakeFeed:
+    """websockets.connect to a feed accepting the given connections in turn."""
+
+    def __init__(self, *connections):
+        self.connections = list(connections)
+        self.calls = []
+
+    def __call__(self, uri, **kwargs):
+        self.calls.append((uri, kwargs))
+        self.connection = FakeConnection(
+            self.connections.pop(0), last=not self.connections
+        )
+        return self.connection
+
+
+async def _wait_for(condition):
+    while not condition():
+        await asyncio.sleep(0)
+
+
+def test_pipeline_consume_reconnects():
+    """Test that a lost feed is reconnected, its outages being recorded as gaps"""
+    feed = FakeFeed(None, [19.5, 20.5], [21.5])
+    gap = MagicMock()
+
+    async def run(closed):
+        pipeline = FeedPipeline(
+            ping_interval=5, reconnect_min_delay=0, reconnect_max_delay=0
+        )
+        receiver = asyncio.create_task(pipeline.consume("attic", "ws://attic", feed))
+        await asyncio.wait_for(_wait_for(lambda: closed.call_count == 2), timeout=5)
+        receiver.cancel()
+        await asyncio.gather(receiver, return_exceptions=True)
+        return pipeline
+
+    with patch(
+        "api.management.commands.consume_feed.startup_gap", return_value=None
+    ), patch(
+        "api.management.commands.consume_feed.open_gap", return_value=gap
+    ) as mock_open, patch(
+        "api.management.commands.consume_feed.close_gap"
+    ) as mock_close:
+        pipeline = asyncio.run(run(mock_close))
+    frames = [pipeline.queue.get_nowait() for _ in range(3)]
+    assert [frame.sensor for frame in frames] == ["attic"] * 3
+    assert len(feed.calls) == 3
+    assert feed.calls[0][1]["ping_interval"] == 5
+    assert feed.connection.sent[0]["type"] == "start"
+    assert pipeline.stats()["disconnections"] == 2
+    # refused at first, then lost after the second reading.
+    assert [call.args[0] for call in mock_open.call_args_list] == ["attic"] * 2
+    assert mock_open.call_args_list[1].args[1] == frames[1].timestamp
+    assert [call.args for call in mock_close.call_args_list] == [
+        (gap, frames[0].timestamp),
+        (gap, frames[2].timestamp),
+    ]
+
+
+def test_pipeline_consume_skips_malformed():
+    """Test that the frames which are not readings are skipped, and that the feed
+    is subscribed again when it ends the subscription"""
+    error = json.dumps({"type": "error", "id": "1", "payload": {"message": "down"}})
+    feed = FakeFeed(["{oops", 19.5, error], [20.5])
+
+    async def run():
+        pipeline = FeedPipeline(reconnect_min_delay=0, reconnect_max_delay=0)
+        receiver = asyncio.create_task(pipeline.consume("attic", "ws://attic", feed))
+        await asyncio.wait_for(_wait_for(lambda: pipeline.queue.qsize() == 2), 5)
+        receiver.cancel()
+        await asyncio.gather(receiver, return_exceptions=True)
+        return pipeline
+
+    with patch(
+        "api.management.commands.consume_feed.startup_gap", return_value=None
+    ), patch("api.management.commands.consume_feed.open_gap"), patch(
+        "api.management.commands.consume_feed.close_gap"
+    ):
+        pipeline = asyncio.run(run())
+    frames = [pipeline.queue.get_nowait() for _ in range(2)]
+    assert [frame.received["payload"]["data"]["temperature"] for frame in frames] == [
+        19.5,
+        20.5,
+    ]
+    assert len(feed.calls) == 2
+    assert pipeline.stats()["malformed"] == 1
+    assert pipeline.stats()["disconnections"] == 1
+
+
+def test_pipeline_consume_closes_pending_gap():
+    """Test that an outage left open by a previous run is closed on reconnection"""
+    gap = MagicMock()
+
+    async def run(closed):
+        pipeline = FeedPipeline()
+        receiver = asyncio.create_task(
+            pipeline.consume("attic", "ws://attic", FakeFeed([19.5]))
+        )
+        await asyncio.wait_for(_wait_for(lambda: closed.called), 5)
+        receiver.cancel()
+        await asyncio.gather(receiver, return_exceptions=True)
+        return pipeline.queue.get_nowait()
+
+    with patch(
+        "api.management.commands.consume_feed.startup_gap", return_value=gap
+    ), patch("api.management.commands.consume_feed.close_gap") as mock_close:
+        frame = asyncio.run(run(mock_close))
+    mock_close.assert_called_once_with(gap, frame.timestamp)
+
+
+def test_pipeline_consume_defers_gaps():
+    """Test that the outages are still recorded, later on, when the db fails, the
+    feed being read meanwhile"""
+    gap = MagicMock()
+
+    async def run(closed):
+        pipeline = FeedPipeline(
+            reconnect_min_delay=0, reconnect_max_delay=0, log=lambda message: None
+        )
+        receiver = asyncio.create_task(
+            pipeline.consume("attic", "ws://attic", FakeFeed([19.5, 20.5]))
+        )
+        await asyncio.wait_for(_wait_for(lambda: closed.call_count == 2), 5)
+        receiver.cancel()
+        await asyncio.gather(receiver, return_exceptions=True)
+        return pipeline
+
+    with patch(
+        "api.management.commands.consume_feed.startup_gap",
+        side_effect=[OperationalError("gone"), gap],
+    ) as mock_startup, patch(
+        "api.management.commands.consume_feed.close_gap",
+        side_effect=[OperationalError("gone"), None],
+    ) as mock_close:
+        pipeline = asyncio.run(run(mock_close))
+    frames = [pipeline.queue.get_nowait() for _ in range(2)]
+    assert [call.args for call in mock_startup.call_args_list] == [
+        ("attic", None),
+        ("attic", frames[0].timestamp),
+    ]
+    assert [call.args for call in mock_close.call_args_list] == [
+        (gap, frames[0].timestamp),
+        (gap, frames[0].timestamp),
+    ]
+
+
+def test_gap_recorder_merges_outages():
+    """Test that an outage whose end was not recorded is merged with the next one,
+    and that the attempts are put off after a failure"""
+    gaps = GapRecorder("attic", Backoff(1.0, 1.0, rand=lambda: 1.0))
+    gaps.startup = False
+    now = timezone.now()
+    gaps.lost(now)
+    gaps.back(now + timedelta(seconds=1))
+    gaps.defer(now=10.0)
+    assert not gaps.is_due(now=10.5)
+    gaps.lost(now + timedelta(seconds=2))
+    assert gaps.is_due(now=11.0)
+    assert (gaps.started, gaps.ended) == (now, None)
+    with patch(
+        "api.management.commands.consume_feed.open_gap", return_value=MagicMock()
+    ) as mock_open:
+        assert gaps.record() is None
+    mock_open.assert_called_once_with("attic", now)
+    assert not gaps.is_due()
+
+
+def test_pipeline_run_restarts_receivers(tmp_path):
+    """Test that a failed receiver is restarted, instead of stopping the pipeline"""
+    calls = []
+    logged = []
+
+    async def consume(sensor, uri, connect):
+        calls.append(sensor)
+        if len(calls) == 1:
+            raise OperationalError("gone")
+        await asyncio.sleep(3600)
+
+    async def run():
+        pipeline = FeedPipeline(
+            spill_path=str(tmp_path / "spill.jsonl"),
+            reconnect_min_delay=0,
+            reconnect_max_delay=0,
+            log=logged.append,
+        )
+        with patch.object(pipeline, "consume", consume):
+            runner = asyncio.create_task(pipeline.run({"attic": "ws://attic"}))
+            await asyncio.wait_for(_wait_for(lambda: len(calls) == 2), 5)
+            runner.cancel()
+            await asyncio.gather(runner, return_exceptions=True)
+
+    asyncio.run(run())
+    assert calls == ["attic", "attic"]
+    assert logged[0].startswith("Receiver of feed attic failed, restarting it")
+
+
+def test_pipeline_run_persists_on_stop(tmp_path):
+    """Test that the readings received from all the feeds, and those left over by a
+    previous run, are persisted when the pipeline is stopped"""
+
+    async def run():
+        pipeline = FeedPipeline(
+            batch_size=10,
+            flush_interval=60,
+            policy=SPILL,
+            spill_path=str(tmp_path / "spill.jsonl"),
+        )
+        pipeline.spill.write(_frame(18.5, "cellar"))
+        feeds = {"attic": "ws://attic", "cellar": "ws://cellar"}
+        connect = MagicMock(
+            side_effect=lambda uri, **kwargs: FakeConnection(
+                [19.5, 20.5] if uri == "ws://attic" else [4.5], last=True
+            )
+        )
+        runner = asyncio.create_task(pipeline.run(feeds, connect))
+        await asyncio.wait_for(_wait_for(lambda: pipeline.metrics.received == 3), 5)
+        runner.cancel()
+        await asyncio.gather(runner, return_exceptions=True)
+
+    with patch(
+        "api.management.commands.consume_feed.startup_gap", return_value=None
+    ), patch(
+        "api.management.commands.consume_feed.store_readings"
+    ) as mock_create:
+        asyncio.run(run())
+    readings = [tm for call in mock_create.call_args_list for tm in call.args[0]]
+    assert sorted((tm.sensor, tm.value) for tm in readings) == [
+        ("attic", 19.5),
+        ("attic", 20.5),
+        ("cellar", 4.5),
+        ("cellar", 18.5),
+    ]
+
+
+def test_pipeline_run_spills_when_writers_stuck(tmp_path):
+    """Test that the shutdown does not wait forever for writers failing to write,
+    the readings they could not write being spilled"""
+
+    async def run():
+        pipeline = FeedPipeline(
+            batch_size=1,
+            spill_path=str(tmp_path / "spill.jsonl"),
+            reconnect_min_delay=0.01,
+            reconnect_max_delay=0.01,
+            shutdown_timeout=0.05,
+            log=lambda message: None,
+        )
+        connect = MagicMock(return_value=FakeConnection([19.5, 20.5, 21.5], True))
+        runner = asyncio.create_task(pipeline.run({"attic": "ws://attic"}, connect))
+        await asyncio.wait_for(
+            _wait_for(
+                lambda: pipeline.metrics.received == 3
+                and pipeline.metrics.write_errors > 0
+            ),
+            5,
+        )
+        runner.cancel()
+        await asyncio.gather(runner, return_exceptions=True)
+        return pipeline
+
+    with patch(
+        "api.management.commands.consume_feed.startup_gap", return_value=None
+    ), patch(
+        "api.management.commands.consume_feed.store_readings",
+        side_effect=OperationalError("gone"),
+    ):
+        pipeline = asyncio.run(run())
+    assert pipeline.queue.empty()
+    assert sorted(
+        float(frame.received["payload"]["data"]["temperature"])
+        for frame in pipeline.spill.pop_all()
+    ) == [19.5, 20.5, 21.5]
+
+
+@pytest.mark.parametrize("data", MALFORMED_FRAMES + ("null", '{"payload": "x"}'))
+def test_parse_frame_malformed(data):
+    assert parse_frame(data) is None
+
+
+def test_parse_frame():
+    assert parse_frame(reading_frame(21.5)) == json.loads(reading_frame(21.5))
+    assert parse_frame(reading_frame(21)) is not None
+    assert parse_frame(reading_frame(True)) is None
+    assert parse_frame(reading_frame(float("nan"))) is None
+
+
+@pytest.mark.parametrize(
+    "frame",
+    [
+        {"type": "error", "id": "1", "payload": {"message": "feed error"}},
+        {"type": "connection_error", "payload": {"message": "refused"}},
+        {"type": "complete", "id": "1"},
+    ],
+)
+def test_parse_frame_subscription_ended(frame):
+    with pytest.raises(SubscriptionError, match=frame["type"]):
+        parse_frame(json.dumps(frame))
+
+
+def test_pipeline_soak():
+    """Test that the readings of a fast feed, dropping the connection and sending
+    malformed frames, are all persisted in order"""
+
+    async def run():
+        feed = FakeFeedServer(
+            count=3000, rate=30000, burst=100, disconnect_every=1000, malformed=0.01
+        )
+        server = await feed.serve()
+        port = server.sockets[0].getsockname()[1]
+        pipeline = FeedPipeline(
+            batch_size=200,
+            status=FeedStatus("on", interval=60),
+            reconnect_min_delay=0,
+            reconnect_max_delay=0,
+            log=lambda message: None,
+        )
+        runner = asyncio.create_task(
+            pipeline.run({"attic": f"ws://127.0.0.1:{port}/graphql"})
+        )
+        await asyncio.wait_for(
+            _wait_for(lambda: pipeline.metrics.persisted == feed.count), 10
+        )
+        runner.cancel()
+        await asyncio.gather(runner, return_exceptions=True)
+        server.close()
+        await server.wait_closed()
+        return feed, pipeline
+
+    with patch(
+        "api.management.commands.consume_feed.startup_gap", return_value=None
+    ), patch("api.management.commands.consume_feed.open_gap"), patch(
+        "api.management.commands.consume_feed.close_gap"
+    ), patch(
+        "api.management.commands.consume_feed.store_readings"
+    ) as mock_create:
+        feed, pipeline = asyncio.run(run())
+    readings = [tm for call in mock_create.call_args_list for tm in call.args[0]]
+    assert [tm.value for tm in readings] == feed.values * 3
+    stats = pipeline.stats()
+    assert stats["received"] == 3000
+    assert stats["malformed"] == feed.malformed_sent > 0
+    assert stats["disconnections"] == feed.disconnections == 3
+
+
+def test_feed_uris():
+    """Test that the single feed is the one of the default sensor"""
+    with patch("api.management.commands.consume_feed.FEED_URIS", {}):
+        assert feed_uris() == {Temperature.DEFAULT_SENSOR: FEED_URI}
+    feeds = {"attic": "ws://attic/graphql", "cellar": "ws://cellar/graphql"}
+    with patch("api.management.commands.consume_feed.FEED_URIS", feeds):
+        assert feed_uris() == feeds
+
+
+def test_feed_status_from_cache():
+    """Test that the feed status is read from the cache without querying the db"""
+    with patch(
+        "api.management.commands.consume_feed.cache.get", return_value="off"
+    ), patch(
+        "api.management.commands.consume_feed.ReadConfig.objects.get"
+    ) as mock_get:
+        status = FeedStatus("on")
+        assert status.refresh() == "off"
+        assert not status.is_on()
+        mock_get.assert_not_called()
+
+
+def test_feed_status_from_db():
+    """Test that the feed status is read from the db on a cache miss"""
+    with patch(
+        "api.management.commands.consume_feed.cache.get", return_value=None
+    ), patch(
         "api.management.commands.consume_feed.ReadConfig.objects.get",
         return_value=ReadConfig(config_key="status", config_value="off"),
+    ) as mock_get:
+        status = FeedStatus("on")
+        assert status.refresh() == "off"
+        mock_get.assert_called_once_with(pk="status")
+
+
+def test_feed_status_watch():
+    """Test that the feed status is refreshed periodically"""
+
+    async def run(status):
+        watcher = asyncio.create_task(status.watch())
+        await asyncio.sleep(0.05)
+        watcher.cancel()
+        await asyncio.gather(watcher, return_exceptions=True)
+
+    status = FeedStatus("on", interval=0.01)
+    with patch("api.management.commands.consume_feed.cache.get", return_value="off"):
+        asyncio.run(run(status))
+    assert not status.is_on()
+
+
+def test_feed_status_watch_errors():
+    """Test that the feed status is still polled after a failed refresh"""
+    logged = []
+
+    async def run(status):
+        watcher = asyncio.create_task(status.watch())
+        await asyncio.wait_for(_wait_for(lambda: not status.is_on()), 5)
+        watcher.cancel()
+        await asyncio.gather(watcher, return_exceptions=True)
+
+    def get(key):
+        if not logged:
+            raise ConnectionError("cache down")
+        return "off"
+
+    status = FeedStatus("on", interval=0.01, log=logged.append)
+    with patch("api.management.commands.consume_feed.cache.get", get):
+        asyncio.run(run(status))
+    assert logged == [
+        "Feed status not refreshed, still on: ConnectionError('cache down')"
+    ]
+
+
+def test_capture_data_report():
+    """Test that the pipeline metrics are reported while the feeds are read"""
+    written = []
+
+    async def run():
+        pipeline = FeedPipeline()
+
+        async def read_feeds(feeds):
+            while not written:
+                await asyncio.sleep(0.001)
+
+        with patch.object(pipeline, "run", read_feeds):
+            await capture_data(pipeline, {}, stats_interval=0.001, write=written.append)
+
+    asyncio.run(run())
+    assert written[0].startswith("queue_depth=0 received=0 persisted=0")
+
+
+@pytest.mark.django_db
+def test_consume_feed_command():
+    """Test that the command turns the feed on, serves the metrics, publishes the
+    readings, and stops the consumption on SIGTERM"""
+    captured = {}
+
+    async def capture(pipeline, feeds, stats_interval, write):
+        captured.update(pipeline=pipeline, feeds=feeds, stats_interval=stats_interval)
+        os.kill(os.getpid(), signal.SIGTERM)
+        await asyncio.Event().wait()
+
+    out = StringIO()
+    with patch("api.management.commands.consume_feed.capture_data", capture), patch(
+        "api.management.commands.consume_feed.FEED_METRICS_PORT", 9100
+    ), patch(
+        "api.management.commands.consume_feed.start_http_server"
+    ) as mock_http_server, patch(
+        "api.management.commands.consume_feed.PUBSUB_PORT", 4100
+    ), patch(
+        "api.management.commands.consume_feed.start_publisher",
+        AsyncMock(return_value=MagicMock(port=4100)),
     ):
-        process_reading(received)
-        # Then
-        mock_create.assert_not_called()
+        call_command(
+            "consume_feed", "--writers", "2", "--stats-interval", "0", stdout=out
+        )
+    mock_http_server.assert_called_once_with(9100)
+    assert ReadConfig.objects.get(pk="status").config_value == "on"
+    assert captured["pipeline"].writers == 2
+    assert captured["feeds"] == feed_uris()
+    assert captured["stats_interval"] == 0
+    assert out.getvalue().splitlines() == [
+        f"Launch consumption of temperature feed {sensor} at {uri}"
+        for sensor, uri in feed_uris().items()
+    ] + [
+        "Serving metrics on port 9100",
+        "Publishing readings on port 4100",
+        "Consumption stopped, pending readings persisted",
+    ]
@@ -0,0 +1,47 @@
+"""Convert the temperature values to the configured storage."""
+from typing import Any
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from api.caching import bump_data_version
+from api.fields import DECIMAL, STORAGES, convert_storage
+from api.models import ReadConfig, Temperature
+
+
+# ReadConfig key of the storage the values are currently in.
+STORAGE_KEY = "value_storage"
+
+
+def current_storage() -> str:
+    """Storage of the temperature values in db."""
+    config = ReadConfig.objects.filter(config_key=STORAGE_KEY).first()
+    return config.config_value if config else DECIMAL
+
+
+class Command(BaseCommand):
+    """Custom command to rewrite the value column after TEMPERATURE_VALUE_STORAGE
+    has been changed."""
+
+    help = "Convert the temperature values to TEMPERATURE_VALUE_STORAGE"
+
+    def handle(self, *args: tuple, **options: Any) -> None:
+        # read at runtime, like the field does.
+        target = settings.TEMPERATURE_VALUE_STORAGE
+        if target not in STORAGES:
+            raise CommandError(
+                f"TEMPERATURE_VALUE_STORAGE must be one of {', '.join(STORAGES)}"
+            )
+        current = current_storage()
+        if current == target:
+            self.stdout.write(f"Values already stored as {current}")
+            return
+        with connection.schema_editor() as editor:
+            convert_storage(editor, Temperature, "value", current, target)
+        ReadConfig.objects.update_or_create(
+            config_key=STORAGE_KEY, defaults={"config_value": target}
+        )
+        # the values may be rounded by the conversion.
+        bump_data_version()
+        self.stdout.write(f"Values converted from {current} to {target}")
@@ -0,0 +1,112 @@
+"""Serve a local fake temperature feed, to soak-test the consumer."""
+import asyncio
+import signal
+from typing import Any
+from urllib.parse import urlparse
+
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+
+from api.fake_feed import FakeFeed
+from backend.settings import FEED_URI
+
+
+class Command(BaseCommand):
+    """Custom command to serve a graphql-ws feed of fake readings, on the port of
+    FEED_URI by default, so that consume_feed reads it without network access.
+
+    The readings are sent to each client at --rate per second (as fast as it reads
+    them by default), by bursts of --burst frames. Its connection is dropped after
+    every --disconnect-every readings, and a --malformed fraction of its frames are
+    not readings. The counters of the feed are reported every --stats-interval
+    seconds.
+    """
+
+    help = "Serve a local fake temperature feed, to soak-test the consumer"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--host", default="127.0.0.1", help="Interface to bind")
+        parser.add_argument(
+            "--port",
+            type=int,
+            default=urlparse(FEED_URI).port or 80,
+            help="Port to listen on (default: the port of FEED_URI)",
+        )
+        parser.add_argument(
+            "--rate",
+            type=float,
+            default=0,
+            help="Frames per second sent to each client, 0 for as fast as it reads",
+        )
+        parser.add_argument(
+            "--burst",
+            type=int,
+            default=1,
+            help="Number of frames sent back to back, the rate being an average",
+        )
+        parser.add_argument(
+            "--disconnect-every",
+            type=int,
+            default=0,
+            help="Number of readings after which a client is dropped, 0 to never",
+        )
+        parser.add_argument(
+            "--malformed",
+            type=float,
+            default=0.0,
+            help="Fraction of the frames which are not readings, between 0 and 1",
+        )
+        parser.add_argument(
+            "--count",
+            type=int,
+            default=0,
+            help="Number of readings sent in all, 0 for no limit",
+        )
+        parser.add_argument(
+            "--seed", type=int, default=0, help="Seed of the values and the draws"
+        )
+        parser.add_argument(
+            "--stats-interval",
+            type=float,
+            default=5,
+            help="Number of seconds between two reports of the counters, 0 to disable",
+        )
+
+    def handle(self, *args: tuple, **options: Any) -> None:
+        if not 0 <= options["malformed"] <= 1:
+            raise CommandError("--malformed must be between 0 and 1.")
+        feed = FakeFeed(
+            count=options["count"] or None,
+            seed=options["seed"],
+            rate=options["rate"] or None,
+            burst=options["burst"],
+            disconnect_every=options["disconnect_every"] or None,
+            malformed=options["malformed"],
+        )
+
+        async def serve() -> None:
+            server = await feed.serve(options["host"], options["port"])
+            self.stdout.write(
+                f"Serving fake feed at ws://{options['host']}:{options['port']}/graphql"
+            )
+            stop = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                loop.add_signal_handler(signum, stop.set)
+            interval = options["stats_interval"]
+            sent = 0
+            while not stop.is_set():
+                try:
+                    await asyncio.wait_for(stop.wait(), interval or None)
+                except asyncio.TimeoutError:
+                    stats = feed.stats()
+                    rate = (stats["sent"] - sent) / interval
+                    sent = stats["sent"]
+                    self.stdout.write(
+                        " ".join(f"{key}={value}" for key, value in stats.items())
+                        + f" rate={rate:.0f}/s"
+                    )
+            server.close()
+            await server.wait_closed()
+            self.stdout.write("Fake feed stopped")
+
+        asyncio.run(serve())
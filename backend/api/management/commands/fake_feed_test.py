@@ -0,0 +1,35 @@
+"""Unit tests for fake_feed.py"""
+from io import StringIO
+import os
+import signal
+import pytest
+from unittest.mock import patch
+from django.core.management import CommandError, call_command
+
+from api.fake_feed import FakeFeed
+
+
+def test_fake_feed_bad_malformed():
+    """Test that the fraction of malformed frames is checked before serving"""
+    with pytest.raises(CommandError, match="--malformed"):
+        call_command("fake_feed", "--malformed", "1.5")
+
+
+def test_fake_feed():
+    """Test that the counters are reported until the feed is stopped by a signal"""
+    stats = FakeFeed.stats
+    reports = []
+
+    def stop_after_two(feed):
+        reports.append(stats(feed))
+        if len(reports) == 2:
+            os.kill(os.getpid(), signal.SIGTERM)
+        return reports[-1]
+
+    out = StringIO()
+    with patch.object(FakeFeed, "stats", stop_after_two):
+        call_command("fake_feed", "--port", "0", "--stats-interval", "0.01", stdout=out)
+    lines = out.getvalue().splitlines()
+    assert lines[0] == "Serving fake feed at ws://127.0.0.1:0/graphql"
+    assert lines[1:3] == ["clients=0 sent=0 malformed=0 disconnections=0 rate=0/s"] * 2
+    assert lines[-1] == "Fake feed stopped"
@@ -0,0 +1,181 @@
+"""Load past temperature readings from a file."""
+import csv
+from datetime import datetime, timezone
+from decimal import Decimal, InvalidOperation
+import json
+import sys
+import time
+from typing import Any, Callable, Iterable, Iterator, List, Optional, TextIO
+
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+
+from backend.settings import LOAD_CHUNK_SIZE
+from api.ingest import load_readings
+from api.models import Temperature
+
+
+JSONL = "jsonl"
+CSV = "csv"
+FORMATS = (JSONL, CSV)
+
+
+def parse_record(record: Any) -> Temperature:
+    """Build a reading from a record with a timestamp (UTC if naive), a value and
+    optionally a sensor.
+
+    The frames spilled by consume_feed, holding the received frame instead of a
+    value, are accepted as well.
+
+    Raises:
+        ValueError: if the record is not a valid reading
+    """
+    if not isinstance(record, dict):
+        raise ValueError(f"invalid reading {record!r}")
+    try:
+        if "value" in record:
+            value = Decimal(str(record["value"]))
+        else:
+            value = Decimal(str(record["received"]["payload"]["data"]["temperature"]))
+        timestamp = datetime.fromisoformat(record["timestamp"])
+    except (KeyError, TypeError, InvalidOperation) as exc:
+        raise ValueError(f"invalid reading {record!r}") from exc
+    if not value.is_finite():
+        raise ValueError(f"invalid reading {record!r}")
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    sensor = record.get("sensor") or Temperature.DEFAULT_SENSOR
+    if not isinstance(sensor, str):
+        raise ValueError(f"invalid reading {record!r}")
+    return Temperature(sensor=sensor, timestamp=timestamp, value=value)
+
+
+def read_records(stream: TextIO, record_format: str) -> Iterator[Any]:
+    """Read the records of a JSONL stream, or of a CSV one with a header.
+
+    The lines which are not valid JSON are returned as is, to be skipped.
+    """
+    if record_format == CSV:
+        yield from csv.DictReader(stream)
+        return
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError:
+            yield line
+
+
+class ReadingsLoader:
+    """Load readings in chunks of `chunk_size`, so that memory stays bounded
+    whatever the number of readings.
+
+    Invalid records are skipped and counted. `report` is called with the loader
+    every `report_interval` seconds.
+    """
+
+    def __init__(
+        self,
+        chunk_size: int = LOAD_CHUNK_SIZE,
+        report: Optional[Callable[["ReadingsLoader"], None]] = None,
+        report_interval: float = 5.0,
+    ) -> None:
+        self.chunk_size = max(chunk_size, 1)
+        self.report = report
+        self.report_interval = report_interval
+        self.loaded = 0
+        self.skipped = 0
+        self.started = time.monotonic()
+        self.reported = self.started
+
+    def rate(self) -> float:
+        """Readings loaded per second since the start."""
+        return self.loaded / max(time.monotonic() - self.started, 1e-9)
+
+    def load(self, records: Iterable[Any]) -> int:
+        """Load readings from records.
+
+        Returns:
+            int: number of loaded readings
+        """
+        chunk: List[Temperature] = []
+        for record in records:
+            try:
+                chunk.append(parse_record(record))
+            except ValueError:
+                self.skipped += 1
+                continue
+            if len(chunk) >= self.chunk_size:
+                self.flush(chunk)
+                chunk = []
+        self.flush(chunk)
+        return self.loaded
+
+    def flush(self, chunk: List[Temperature]) -> None:
+        """Persist a chunk of readings, and report the progress if due."""
+        load_readings(chunk)
+        self.loaded += len(chunk)
+        now = time.monotonic()
+        if self.report and now - self.reported >= self.report_interval:
+            self.reported = now
+            self.report(self)
+
+
+class Command(BaseCommand):
+    """Custom command to load past readings (backfills, replays of the consumer
+    spill file, migrations) from a JSONL or CSV file, or stdin.
+
+    The readings are persisted with their rollups, by chunks committed one after
+    the other: after a failure, the chunks already loaded stay in db.
+    """
+
+    help = "Load past temperature readings from a JSONL or CSV file, or stdin"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "path", nargs="?", default="-", help="File to load, - for stdin"
+        )
+        parser.add_argument(
+            "--format",
+            choices=FORMATS,
+            help="Format of the records, guessed from the file extension by default",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=LOAD_CHUNK_SIZE,
+            help="Number of readings persisted per transaction",
+        )
+        parser.add_argument(
+            "--report-interval",
+            type=float,
+            default=5.0,
+            help="Number of seconds between two progress reports",
+        )
+
+    def handle(self, *args: tuple, **options: Any) -> None:
+        path = options["path"]
+        record_format = options["format"] or (CSV if path.endswith(".csv") else JSONL)
+
+        def report(loader: ReadingsLoader) -> None:
+            self.stdout.write(
+                f"{loader.loaded} readings loaded ({loader.rate():.0f}/s), "
+                f"{loader.skipped} skipped"
+            )
+
+        loader = ReadingsLoader(
+            options["chunk_size"], report, options["report_interval"]
+        )
+        try:
+            if path == "-":
+                loader.load(read_records(sys.stdin, record_format))
+            else:
+                with open(path, newline="") as stream:
+                    loader.load(read_records(stream, record_format))
+        except (OSError, csv.Error) as exc:
+            raise CommandError(f"{exc} after {loader.loaded} readings") from exc
+        elapsed = time.monotonic() - loader.started
+        self.stdout.write(
+            f"{loader.loaded} readings loaded in {elapsed:.1f}s "
+            f"({loader.rate():.0f}/s), {loader.skipped} skipped"
+        )
@@ -0,0 +1,124 @@
+"""Unit tests for load_readings.py"""
+from datetime import datetime, timezone
+from decimal import Decimal
+import io
+import pytest
+from unittest.mock import MagicMock, patch
+from django.core.management import CommandError, call_command
+
+from api.management.commands.load_readings import (
+    CSV,
+    JSONL,
+    ReadingsLoader,
+    parse_record,
+    read_records,
+)
+from api.models import Temperature
+
+
+TIMESTAMP = "2022-02-15T11:00:00+00:00"
+
+
+@pytest.mark.parametrize(
+    "record",
+    [
+        {"timestamp": TIMESTAMP, "value": 19.5},
+        {"timestamp": TIMESTAMP, "value": "19.5"},
+        {"timestamp": "2022-02-15T11:00:00", "value": "19.5"},
+        {
+            "timestamp": TIMESTAMP,
+            "received": {"payload": {"data": {"temperature": 19.5}}},
+        },
+    ],
+)
+def test_parse_record(record):
+    """Test that records, including the spilled frames, are parsed in UTC"""
+    reading = parse_record(record)
+    assert reading.timestamp == datetime(2022, 2, 15, 11, tzinfo=timezone.utc)
+    assert reading.value == Decimal("19.5")
+    assert reading.sensor == Temperature.DEFAULT_SENSOR
+
+
+def test_parse_record_sensor():
+    reading = parse_record({"sensor": "attic", "timestamp": TIMESTAMP, "value": 1})
+    assert reading.sensor == "attic"
+
+
+@pytest.mark.parametrize(
+    "record",
+    [
+        "{not json",
+        {"timestamp": TIMESTAMP},
+        {"timestamp": TIMESTAMP, "value": "warm"},
+        {"timestamp": TIMESTAMP, "value": "NaN"},
+        {"timestamp": None, "value": "19.5"},
+        {"timestamp": "yesterday", "value": "19.5"},
+        {"sensor": 3, "timestamp": TIMESTAMP, "value": "19.5"},
+    ],
+)
+def test_parse_invalid_record(record):
+    with pytest.raises(ValueError):
+        parse_record(record)
+
+
+def test_read_records():
+    jsonl = io.StringIO(f'{{"timestamp": "{TIMESTAMP}", "value": 1}}\n\n{{oops\n')
+    assert list(read_records(jsonl, JSONL)) == [
+        {"timestamp": TIMESTAMP, "value": 1},
+        "{oops\n",
+    ]
+    csv = io.StringIO(f"timestamp,value\n{TIMESTAMP},1.5\n")
+    assert list(read_records(csv, CSV)) == [{"timestamp": TIMESTAMP, "value": "1.5"}]
+
+
+def test_loader_chunks():
+    """Test that the readings are persisted by chunks, skipping the invalid ones,
+    and that the progress is reported"""
+    records = [{"timestamp": TIMESTAMP, "value": value} for value in range(5)]
+    report = MagicMock()
+    loader = ReadingsLoader(chunk_size=2, report=report, report_interval=0)
+    with patch("api.management.commands.load_readings.load_readings") as mock_load:
+        assert loader.load(records + ["{oops"]) == 5
+    assert [len(call.args[0]) for call in mock_load.call_args_list] == [2, 2, 1]
+    assert isinstance(mock_load.call_args.args[0][0], Temperature)
+    assert loader.skipped == 1
+    assert report.call_count == 3
+    assert loader.rate() > 0
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("extension", [".csv", ".jsonl", "-"])
+def test_load_readings_command(tmp_path, extension):
+    """Test that a file, whose format is guessed from its extension, or stdin are
+    loaded"""
+    if extension == ".csv":
+        content = f"timestamp,value\n{TIMESTAMP},1.5\n{TIMESTAMP},oops\n"
+    else:
+        content = f'{{"timestamp": "{TIMESTAMP}", "value": 1.5}}\n{{oops\n'
+    out = io.StringIO()
+    if extension == "-":
+        with patch("sys.stdin", io.StringIO(content)):
+            call_command(
+                "load_readings",
+                "--chunk-size",
+                "1",
+                "--report-interval",
+                "0",
+                stdout=out,
+            )
+    else:
+        path = tmp_path / f"readings{extension}"
+        path.write_text(content)
+        call_command("load_readings", str(path), stdout=out)
+    assert "1 readings loaded in" in out.getvalue()
+    assert out.getvalue().endswith("1 skipped\n")
+    assert list(
+        Temperature.objects.filter(
+            timestamp=datetime(2022, 2, 15, 11, tzinfo=timezone.utc)
+        ).values_list("value", flat=True)
+    ) == [Decimal("1.5")]
+
+
+def test_load_readings_missing_file(tmp_path):
+    with pytest.raises(CommandError, match="after 0 readings"):
+        call_command("load_readings", str(tmp_path / "missing.jsonl"))
@@ -0,0 +1,93 @@
+"""Maintain the partitions of the Temperature table and apply the retention."""
+import time
+from typing import Any
+
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from django.db import connection
+from django.utils import timezone
+
+from backend.settings import (
+    TEMPERATURE_PARTITIONING,
+    TEMPERATURE_PARTITIONS_AHEAD,
+    TEMPERATURE_RETENTION_DAYS,
+    TEMPERATURE_RETENTION_DOWNSAMPLE,
+)
+from api.partitions import (
+    INTERVALS,
+    apply_retention,
+    create_partitions,
+    is_partitioned,
+    partition_start,
+    partition_table,
+    retention_cutoff,
+    upcoming_end,
+)
+
+
+class Command(BaseCommand):
+    """Custom command to partition the Temperature table (PostgreSQL only), create
+    its upcoming partitions and drop the expired readings."""
+
+    help = "Create the upcoming Temperature partitions and drop the expired ones"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--interval",
+            choices=INTERVALS,
+            default=TEMPERATURE_PARTITIONING or None,
+            help="Time span of a partition, the table is not partitioned if unset",
+        )
+        parser.add_argument(
+            "--ahead",
+            type=int,
+            default=TEMPERATURE_PARTITIONS_AHEAD,
+            help="Number of partitions created after the current one",
+        )
+        parser.add_argument(
+            "--retention-days",
+            type=int,
+            default=TEMPERATURE_RETENTION_DAYS,
+            help="Number of days of readings kept, 0 to keep them all",
+        )
+        parser.add_argument(
+            "--no-downsample",
+            dest="downsample",
+            action="store_false",
+            default=TEMPERATURE_RETENTION_DOWNSAMPLE,
+            help="Drop the rollups of the expired readings too",
+        )
+        parser.add_argument(
+            "--every",
+            type=float,
+            default=0,
+            help="Run again every given number of seconds, once if 0",
+        )
+
+    def handle(self, *args: tuple, **options: Any) -> None:
+        if options["interval"] and connection.vendor != "postgresql":
+            raise CommandError("Partitioning requires PostgreSQL")
+        while True:
+            self.maintain(options)
+            if not options["every"]:
+                return
+            time.sleep(options["every"])
+
+    def maintain(self, options: Any) -> None:
+        interval, ahead = options["interval"], options["ahead"]
+        if interval:
+            if not is_partitioned():
+                self.stdout.write(f"Partitioning the Temperature table by {interval}")
+                partition_table(interval, ahead)
+            for name in create_partitions(
+                partition_start(timezone.now(), interval),
+                upcoming_end(interval, ahead),
+                interval,
+            ):
+                self.stdout.write(f"Created partition {name}")
+        if options["retention_days"]:
+            cutoff = retention_cutoff(options["retention_days"])
+            if interval:
+                # only whole partitions expire.
+                cutoff = partition_start(cutoff, interval)
+            dropped = apply_retention(cutoff, options["downsample"])
+            self.stdout.write(f"Dropped {dropped} readings older than {cutoff}")
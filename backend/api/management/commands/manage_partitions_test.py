@@ -0,0 +1,89 @@
+"""Unit tests for manage_partitions.py"""
+from datetime import timedelta
+from io import StringIO
+import pytest
+from unittest.mock import patch
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.utils import timezone
+
+from api.ingest import store_readings
+from api.management.commands.manage_partitions import Command
+from api.models import Temperature
+
+
+@pytest.mark.django_db
+def test_retention(capsys):
+    now = timezone.now()
+    store_readings(
+        [
+            Temperature(timestamp=now - timedelta(days=10), value=1),
+            Temperature(timestamp=now, value=2),
+        ]
+    )
+    call_command("manage_partitions", "--retention-days", "7")
+    assert "Dropped 1 readings" in capsys.readouterr().out
+    assert list(Temperature.objects.values_list("value", flat=True)) == [2]
+
+
+@pytest.mark.django_db
+def test_no_retention(capsys):
+    call_command("manage_partitions", "--retention-days", "0")
+    assert capsys.readouterr().out == ""
+
+
+@pytest.mark.skipif(connection.vendor == "postgresql", reason="not on PostgreSQL")
+def test_partitioning_requires_postgresql():
+    with pytest.raises(CommandError):
+        call_command("manage_partitions", "--interval", "day")
+
+
+@pytest.mark.skipif(connection.vendor != "postgresql", reason="PostgreSQL only")
+@pytest.mark.django_db
+def test_partitioning(capsys):
+    call_command("manage_partitions", "--interval", "day", "--ahead", "1")
+    output = capsys.readouterr().out
+    assert "Partitioning the Temperature table by day" in output
+    call_command("manage_partitions", "--interval", "day", "--ahead", "2")
+    assert capsys.readouterr().out.startswith("Created partition api_temperature_p")
+
+
+@pytest.mark.django_db
+def test_every():
+    """Test that the maintenance runs again after the given number of seconds"""
+    with patch(
+        "api.management.commands.manage_partitions.time.sleep",
+        side_effect=[None, KeyboardInterrupt],
+    ) as mock_sleep, patch.object(Command, "maintain") as mock_maintain:
+        with pytest.raises(KeyboardInterrupt):
+            call_command("manage_partitions", "--every", "60")
+    assert mock_maintain.call_count == 2
+    mock_sleep.assert_called_with(60)
+
+
+@pytest.mark.parametrize("partitioned", [False, True])
+def test_maintain_partitions(partitioned):
+    """Test that the table is partitioned once, that the upcoming partitions are
+    created, and that only whole partitions expire"""
+    module = "api.management.commands.manage_partitions"
+    out = StringIO()
+    with patch(f"{module}.is_partitioned", return_value=partitioned), patch(
+        f"{module}.partition_table"
+    ) as mock_partition_table, patch(
+        f"{module}.create_partitions", return_value=["api_temperature_p20220216"]
+    ), patch(
+        f"{module}.apply_retention", return_value=3
+    ) as mock_retention:
+        Command(stdout=out).maintain(
+            {"interval": "day", "ahead": 2, "retention_days": 7, "downsample": True}
+        )
+    assert mock_partition_table.called is not partitioned
+    cutoff = mock_retention.call_args.args[0]
+    assert (cutoff.hour, cutoff.minute, cutoff.second) == (0, 0, 0)
+    lines = out.getvalue().splitlines()
+    assert lines[-2:] == [
+        "Created partition api_temperature_p20220216",
+        f"Dropped 3 readings older than {cutoff}",
+    ]
+    assert len(lines) == (2 if partitioned else 3)
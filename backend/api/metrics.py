@@ -0,0 +1,203 @@
+"""Prometheus metrics of the API and of the consumer.
+
+The API records how long it takes to get the validated document of a query and to
+execute it, how long its root fields take to resolve, and how many SQL queries the
+execution runs and for how long. Nested fields, read from the resolved objects, are
+not timed. The consumer records the readings it receives and persists, the frames it
+skips, the size of its batches, their write latency and their lag.
+"""
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from inspect import isawaitable
+import time
+from typing import Any, Awaitable, Callable, ContextManager, Iterator, Optional
+
+from django.db.backends.base.base import BaseDatabaseWrapper
+from graphql import GraphQLFieldResolver, GraphQLSchema, MiddlewareManager
+from prometheus_client import Counter, Gauge, Histogram
+
+# the requests last from a few milliseconds to a few seconds.
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+DOCUMENT_SECONDS = Histogram(
+    "graphql_document_seconds",
+    "Time to get the parsed and validated document of a query.",
+    buckets=LATENCY_BUCKETS,
+)
+EXECUTION_SECONDS = Histogram(
+    "graphql_execution_seconds",
+    "Time to execute a GraphQL operation.",
+    buckets=LATENCY_BUCKETS,
+)
+RESOLVER_SECONDS = Histogram(
+    "graphql_resolver_seconds",
+    "Time to resolve a root field.",
+    ["field"],
+    buckets=LATENCY_BUCKETS,
+)
+SQL_QUERIES = Histogram(
+    "graphql_sql_queries",
+    "Number of SQL queries run by the execution of a GraphQL operation.",
+    buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100),
+)
+SQL_SECONDS = Histogram(
+    "graphql_sql_seconds",
+    "Time spent in the SQL queries of the execution of a GraphQL operation.",
+    buckets=LATENCY_BUCKETS,
+)
+
+INGEST_RECEIVED = Counter(
+    "feed_readings_received", "Readings received from the feeds.", ["sensor"]
+)
+INGEST_PERSISTED = Counter("feed_readings_persisted", "Readings persisted.")
+INGEST_DROPPED = Counter("feed_readings_dropped", "Readings dropped, the queue full.")
+INGEST_SPILLED = Counter("feed_readings_spilled", "Readings spilled, the queue full.")
+INGEST_MALFORMED = Counter(
+    "feed_frames_malformed", "Frames of the feeds which are not readings.", ["sensor"]
+)
+INGEST_DISCONNECTIONS = Counter(
+    "feed_disconnections", "Lost connections to the feeds.", ["sensor"]
+)
+INGEST_QUEUE_DEPTH = Gauge("feed_queue_depth", "Readings waiting for a db writer.")
+INGEST_BATCH_SIZE = Histogram(
+    "feed_batch_size",
+    "Number of readings persisted by a bulk insert.",
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000),
+)
+INGEST_WRITE_ERRORS = Counter(
+    "feed_write_errors", "Writes of readings failed on a db error, then retried."
+)
+INGEST_WRITE_SECONDS = Histogram(
+    "feed_write_seconds",
+    "Time to persist a batch of readings.",
+    buckets=LATENCY_BUCKETS,
+)
+INGEST_LAG_SECONDS = Histogram(
+    "feed_lag_seconds",
+    "Time from the reception of the oldest reading of a batch to its persistence.",
+    buckets=LATENCY_BUCKETS + (30.0, 60.0),
+)
+
+
+class QueryStats:
+    """SQL queries run on behalf of a GraphQL request."""
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.seconds = 0.0
+
+
+# the queries of the request being executed, propagated to the threads running its
+# db queries along with the context.
+request_queries: ContextVar[Optional[QueryStats]] = ContextVar(
+    "request_queries", default=None
+)
+
+
+def record_query(
+    execute: Callable[..., Any], sql: str, params: Any, many: bool, context: Any
+) -> Any:
+    """Execute wrapper accounting the SQL queries of the current request, if any."""
+    stats = request_queries.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.count += 1
+        stats.seconds += time.perf_counter() - started
+
+
+def instrument_connection(
+    sender: Any, connection: BaseDatabaseWrapper, **kwargs: Any
+) -> None:
+    """connection_created receiver: account for the queries of the connection."""
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def measure(histogram: Histogram, enabled: bool = True) -> ContextManager[Any]:
+    """Context observing its duration in `histogram`, if enabled."""
+    return histogram.time() if enabled else nullcontext()
+
+
+@contextmanager
+def execution_metrics(enabled: bool = True) -> Iterator[None]:
+    """Context observing the duration of an execution and its SQL queries."""
+    if not enabled:
+        yield
+        return
+    stats = QueryStats()
+    token = request_queries.set(stats)
+    try:
+        with EXECUTION_SECONDS.time():
+            yield
+    finally:
+        request_queries.reset(token)
+        SQL_QUERIES.observe(stats.count)
+        SQL_SECONDS.observe(stats.seconds)
+
+
+async def observed(awaitable: Awaitable[Any], field: str, started: float) -> Any:
+    """Await the result of an async resolver, then observe its duration."""
+    try:
+        return await awaitable
+    finally:
+        RESOLVER_SECONDS.labels(field).observe(time.perf_counter() - started)
+
+
+class ResolverMetricsMiddleware:
+    """Graphene middleware timing the resolvers, applied to the root fields by
+    RootFieldsMiddleware."""
+
+    def resolve(
+        self, next: Callable[..., Any], root: Any, info: Any, **args: Any
+    ) -> Any:
+        field = f"{info.parent_type.name}.{info.field_name}"
+        started = time.perf_counter()
+        result = next(root, info, **args)
+        if isawaitable(result):
+            return observed(result, field, started)
+        RESOLVER_SECONDS.labels(field).observe(time.perf_counter() - started)
+        return result
+
+
+class RootFieldsMiddleware(MiddlewareManager):
+    """Middleware applying `root_middleware` to the resolvers of the root fields
+    only, on top of `middlewares`: calling a middleware for each field of each
+    resolved object would cost more than what it measures."""
+
+    def __init__(
+        self, schema: GraphQLSchema, root_middleware: Any, *middlewares: Any
+    ) -> None:
+        # the last middleware being the outermost, the resolvers only are timed.
+        super().__init__(root_middleware, *middlewares)
+        self.nested = MiddlewareManager(*middlewares)
+        self.root_resolvers = {
+            field.resolve
+            for root in (schema.query_type, schema.mutation_type)
+            if root is not None
+            for field in root.fields.values()
+        }
+
+    def get_field_resolver(
+        self, field_resolver: GraphQLFieldResolver
+    ) -> GraphQLFieldResolver:
+        if field_resolver in self.root_resolvers:
+            return super().get_field_resolver(field_resolver)
+        return self.nested.get_field_resolver(field_resolver)
@@ -0,0 +1,98 @@
+"""Unit tests for metrics.py"""
+import asyncio
+from unittest.mock import MagicMock
+import pytest
+from django.db import connection
+from graphql import build_schema, graphql_sync
+from prometheus_client import REGISTRY
+
+from api.metrics import (
+    ResolverMetricsMiddleware,
+    RootFieldsMiddleware,
+    execution_metrics,
+    instrument_connection,
+    record_query,
+    request_queries,
+)
+from api.models import Temperature
+
+
+def _sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def _info(field):
+    info = MagicMock()
+    info.parent_type.name = "Query"
+    info.field_name = field
+    return info
+
+
+def test_instrument_connection():
+    """Test that the wrapper is installed once per connection"""
+    wrapped = MagicMock(execute_wrappers=[])
+    instrument_connection(None, wrapped)
+    instrument_connection(None, wrapped)
+    assert wrapped.execute_wrappers == [record_query]
+
+
+@pytest.mark.django_db
+def test_execution_metrics():
+    """Test that the SQL queries are only accounted within an execution"""
+    connection.ensure_connection()
+    assert record_query in connection.execute_wrappers
+    count = _sample("graphql_sql_queries_count")
+    executions = _sample("graphql_execution_seconds_count")
+    queries = _sample("graphql_sql_queries_sum")
+    with execution_metrics():
+        stats = request_queries.get()
+        Temperature.objects.count()
+        Temperature.objects.exists()
+    assert request_queries.get() is None
+    assert stats.count == 2 and stats.seconds > 0
+    Temperature.objects.count()
+    assert _sample("graphql_sql_queries_count") == count + 1
+    assert _sample("graphql_sql_queries_sum") == queries + 2
+    assert _sample("graphql_execution_seconds_count") == executions + 1
+    with execution_metrics(enabled=False):
+        assert request_queries.get() is None
+    assert _sample("graphql_sql_queries_count") == count + 1
+
+
+def test_resolver_metrics_middleware():
+    middleware = ResolverMetricsMiddleware()
+    resolved = _sample("graphql_resolver_seconds_count", field="Query.sync")
+    assert middleware.resolve(lambda root, info: 1, None, _info("sync")) == 1
+    assert _sample("graphql_resolver_seconds_count", field="Query.sync") == resolved + 1
+
+    async def resolve(root, info, value):
+        await asyncio.sleep(0)
+        return value
+
+    result = middleware.resolve(resolve, None, _info("async"), value=2)
+    assert _sample("graphql_resolver_seconds_count", field="Query.async") == 0
+    assert asyncio.run(result) == 2
+    assert _sample("graphql_resolver_seconds_count", field="Query.async") == 1
+
+
+def test_root_fields_middleware():
+    """Test that the root middleware only applies to the root fields"""
+    calls = []
+
+    def recorder(name):
+        def middleware(next, root, info, **args):
+            calls.append((name, info.field_name))
+            return next(root, info, **args)
+
+        return middleware
+
+    graphql_schema = build_schema(
+        "type Query { reading: Reading } type Reading { value: Float }"
+    )
+    graphql_schema.query_type.fields["reading"].resolve = lambda root, info: {
+        "value": 1.5
+    }
+    manager = RootFieldsMiddleware(graphql_schema, recorder("root"), recorder("all"))
+    result = graphql_sync(graphql_schema, "{ reading { value } }", middleware=manager)
+    assert result.data == {"reading": {"value": 1.5}}
+    assert calls == [("all", "reading"), ("root", "reading"), ("all", "value")]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0002_readconfig"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="temperature",
+            name="timestamp",
+            field=models.DateTimeField(db_index=True),
+        ),
+        migrations.AddIndex(
+            model_name="temperature",
+            index=models.Index(
+                fields=["timestamp", "value"], name="api_temp_timestamp_value_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,80 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:27
+
+from datetime import timezone
+
+from django.db import migrations, models
+from django.db.models import Count, Max, Min, Sum
+from django.db.models.functions import Trunc
+
+
+def build_rollups(apps, schema_editor):
+    """Aggregate the existing readings into rollups."""
+    Temperature = apps.get_model("api", "Temperature")
+    TemperatureRollup = apps.get_model("api", "TemperatureRollup")
+    for resolution in ("minute", "hour", "day"):
+        buckets = (
+            Temperature.objects.annotate(
+                bucket=Trunc("timestamp", resolution, tzinfo=timezone.utc)
+            )
+            .values("bucket")
+            .annotate(
+                count=Count("id"), sum=Sum("value"), min=Min("value"), max=Max("value")
+            )
+            .order_by("bucket")
+        )
+        batch = []
+        for item in buckets.iterator():
+            batch.append(TemperatureRollup(resolution=resolution, **item))
+            if len(batch) >= 10000:
+                TemperatureRollup.objects.bulk_create(batch)
+                batch = []
+        TemperatureRollup.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0003_temperature_timestamp_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TemperatureRollup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "resolution",
+                    models.CharField(
+                        choices=[
+                            ("minute", "Minute"),
+                            ("hour", "Hour"),
+                            ("day", "Day"),
+                        ],
+                        max_length=8,
+                    ),
+                ),
+                ("bucket", models.DateTimeField()),
+                ("count", models.BigIntegerField()),
+                ("sum", models.DecimalField(decimal_places=15, max_digits=30)),
+                ("min", models.DecimalField(decimal_places=15, max_digits=18)),
+                ("max", models.DecimalField(decimal_places=15, max_digits=18)),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("resolution", "bucket"),
+                        name="api_rollup_resolution_bucket",
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(build_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,70 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:57
+
+from datetime import timezone
+from decimal import ROUND_FLOOR, Decimal
+
+from django.db import migrations, models
+
+
+SKETCH_BIN = Decimal("0.1")
+
+
+def bucket(timestamp, resolution):
+    timestamp = timestamp.astimezone(timezone.utc).replace(second=0, microsecond=0)
+    if resolution in ("hour", "day"):
+        timestamp = timestamp.replace(minute=0)
+    if resolution == "day":
+        timestamp = timestamp.replace(hour=0)
+    return timestamp
+
+
+def build_sketches(apps, schema_editor):
+    """Aggregate the squares and sketches of the existing readings into rollups."""
+    Temperature = apps.get_model("api", "Temperature")
+    TemperatureRollup = apps.get_model("api", "TemperatureRollup")
+    # aggregates of the current bucket of each resolution.
+    current = {}
+
+    def flush(resolution):
+        start, sum_squares, sketch = current.pop(resolution)
+        TemperatureRollup.objects.filter(resolution=resolution, bucket=start).update(
+            sum_squares=sum_squares, sketch=sketch
+        )
+
+    readings = Temperature.objects.order_by("timestamp").values_list(
+        "timestamp", "value"
+    )
+    for timestamp, value in readings.iterator(chunk_size=10000):
+        key = str((value / SKETCH_BIN).to_integral_value(rounding=ROUND_FLOOR))
+        for resolution in ("minute", "hour", "day"):
+            start = bucket(timestamp, resolution)
+            if resolution in current and current[resolution][0] != start:
+                flush(resolution)
+            if resolution not in current:
+                current[resolution] = [start, Decimal(0), {}]
+            aggregates = current[resolution]
+            aggregates[1] += value * value
+            aggregates[2][key] = aggregates[2].get(key, 0) + 1
+    for resolution in list(current):
+        flush(resolution)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0004_temperaturerollup"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="temperaturerollup",
+            name="sketch",
+            field=models.JSONField(default=dict),
+        ),
+        migrations.AddField(
+            model_name="temperaturerollup",
+            name="sum_squares",
+            field=models.DecimalField(decimal_places=15, default=0, max_digits=36),
+        ),
+        migrations.RunPython(build_sketches, migrations.RunPython.noop),
+    ]
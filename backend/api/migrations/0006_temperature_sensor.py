@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0005_rollup_sketches"),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name="temperaturerollup",
+            name="api_rollup_resolution_bucket",
+        ),
+        migrations.AddField(
+            model_name="temperature",
+            name="sensor",
+            field=models.CharField(default="default", max_length=64),
+        ),
+        migrations.AddField(
+            model_name="temperaturerollup",
+            name="sensor",
+            field=models.CharField(default="default", max_length=64),
+        ),
+        migrations.AddIndex(
+            model_name="temperature",
+            index=models.Index(
+                fields=["sensor", "timestamp", "value"],
+                name="api_temp_sensor_ts_value_idx",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="temperaturerollup",
+            constraint=models.UniqueConstraint(
+                fields=("sensor", "resolution", "bucket"),
+                name="api_rollup_sensor_resolution_bucket",
+            ),
+        ),
+    ]
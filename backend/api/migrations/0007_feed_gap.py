@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0006_temperature_sensor"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="FeedGap",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("sensor", models.CharField(default="default", max_length=64)),
+                ("started", models.DateTimeField()),
+                ("ended", models.DateTimeField(null=True)),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["sensor", "started"], name="api_gap_sensor_start_idx"
+                    )
+                ],
+            },
+        ),
+    ]
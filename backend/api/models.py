@@ -1,13 +1,52 @@
 from django.db import models
 
+from api.fields import TemperatureValueField
+
 
 class Temperature(models.Model):
     """Model for temperature readings."""
 
+    # sensor of the readings of a single feed, or loaded without one.
+    DEFAULT_SENSOR = "default"
+
+    # name of the sensor (feed) the reading comes from.
+    sensor = models.CharField(max_length=64, default=DEFAULT_SENSOR)
     # timestamp of the reading, set by the consumer at consume time.
-    timestamp = models.DateTimeField()
-    # read temperature value.
-    value = models.DecimalField(max_digits=18, decimal_places=15)
+    timestamp = models.DateTimeField(db_index=True)
+    # read temperature value, stored as configured by TEMPERATURE_VALUE_STORAGE.
+    value = TemperatureValueField(max_digits=18, decimal_places=15)
+
+    class Meta:
+        indexes = [
+            # covers the min/max aggregates over a time range (index-only scans).
+            models.Index(
+                fields=["timestamp", "value"], name="api_temp_timestamp_value_idx"
+            ),
+            # the same, and the latest reading, over the readings of a sensor.
+            models.Index(
+                fields=["sensor", "timestamp", "value"],
+                name="api_temp_sensor_ts_value_idx",
+            ),
+        ]
+
+
+class FeedGap(models.Model):
+    """Model for an outage of the feed of a sensor: no reading was received between
+    `started` and `ended`, though some may have been emitted.
+
+    It tells a missing window apart from a cold period of the sensor.
+    """
+
+    sensor = models.CharField(max_length=64, default=Temperature.DEFAULT_SENSOR)
+    # reception time of the last reading before the outage, or its detection time.
+    started = models.DateTimeField()
+    # reception time of the first reading after the outage, None while it lasts.
+    ended = models.DateTimeField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["sensor", "started"], name="api_gap_sensor_start_idx")
+        ]
 
 
 class ReadConfig(models.Model):
@@ -15,3 +54,37 @@ class ReadConfig(models.Model):
 
     config_key = models.CharField(primary_key=True, max_length=24)
     config_value = models.CharField(max_length=256)
+
+
+class TemperatureRollup(models.Model):
+    """Model for the temperature readings of a sensor aggregated over a time bucket.
+
+    Rollups are maintained along with the readings, at minute, hour and day
+    resolutions, to answer statistics over long windows without scanning them.
+    """
+
+    MINUTE = "minute"
+    HOUR = "hour"
+    DAY = "day"
+    RESOLUTIONS = [(MINUTE, "Minute"), (HOUR, "Hour"), (DAY, "Day")]
+
+    sensor = models.CharField(max_length=64, default=Temperature.DEFAULT_SENSOR)
+    resolution = models.CharField(max_length=8, choices=RESOLUTIONS)
+    # start of the bucket, truncated in UTC.
+    bucket = models.DateTimeField()
+    # aggregates of the readings within the bucket.
+    count = models.BigIntegerField()
+    sum = models.DecimalField(max_digits=30, decimal_places=15)
+    min = models.DecimalField(max_digits=18, decimal_places=15)
+    max = models.DecimalField(max_digits=18, decimal_places=15)
+    sum_squares = models.DecimalField(max_digits=36, decimal_places=15, default=0)
+    # histogram of the values: count of readings per bin of SKETCH_BIN degrees.
+    sketch = models.JSONField(default=dict)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["sensor", "resolution", "bucket"],
+                name="api_rollup_sensor_resolution_bucket",
+            ),
+        ]
@@ -0,0 +1,273 @@
+"""Time partitioning and retention of the temperature readings.
+
+On PostgreSQL, the Temperature table can be turned into a table partitioned by
+range of timestamps, one partition per day or month. Queries filtering on the
+timestamp then only scan the matching partitions, and expired readings are
+dropped with their partitions instead of being deleted row by row. On other
+databases, and for the readings outside of any partition, retention falls back
+to deleting the rows in batches.
+"""
+from datetime import datetime, timedelta, timezone
+import re
+from typing import List, Optional, Tuple
+
+from django.db import connection, transaction
+from django.utils import timezone as django_timezone
+
+from api.caching import bump_data_version
+from api.models import Temperature, TemperatureRollup
+from api.rollups import floor
+
+
+DAY = "day"
+MONTH = "month"
+INTERVALS = (DAY, MONTH)
+TABLE = Temperature._meta.db_table
+# readings outside of the created partitions land in the default one.
+DEFAULT_PARTITION = f"{TABLE}_default"
+# the partitions are named after their start, in UTC.
+NAME_FORMATS = {DAY: "%Y%m%d", MONTH: "%Y%m"}
+# number of rows deleted per statement when the readings are not partitioned.
+DELETE_BATCH_SIZE = 10000
+# (name, start, end) of a partition, over [start, end).
+Partition = Tuple[str, datetime, datetime]
+
+
+def partition_start(timestamp: datetime, interval: str) -> datetime:
+    """Start of the partition holding a timestamp."""
+    start = floor(timestamp, TemperatureRollup.DAY)
+    if interval == MONTH:
+        start = start.replace(day=1)
+    return start
+
+
+def next_start(start: datetime, interval: str) -> datetime:
+    """Start of the partition following the one starting at `start`."""
+    if interval == DAY:
+        return start + timedelta(days=1)
+    return (start + timedelta(days=32)).replace(day=1)
+
+
+def partition_name(start: datetime, interval: str) -> str:
+    return f"{TABLE}_p{start.strftime(NAME_FORMATS[interval])}"
+
+
+def parse_partition_name(name: str) -> Optional[Partition]:
+    """Time range of a partition, from its name.
+
+    Returns:
+        Optional[Partition]: None if the name is not one of a time partition
+    """
+    prefix = f"{TABLE}_p"
+    if not name.startswith(prefix):
+        return None
+    suffix = name[len(prefix):]
+    for interval, name_format in NAME_FORMATS.items():
+        try:
+            start = datetime.strptime(suffix, name_format)
+        except ValueError:
+            continue
+        if start.strftime(name_format) != suffix:
+            # e.g. the name of a month read as the one of a day.
+            continue
+        start = start.replace(tzinfo=timezone.utc)
+        return name, start, next_start(start, interval)
+    return None
+
+
+def is_partitioned() -> bool:
+    """Whether the Temperature table is a partitioned one."""
+    if connection.vendor != "postgresql":
+        return False
+    with connection.cursor() as cursor:  # pragma: no cover
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass",
+            [TABLE],
+        )
+        return cursor.fetchone() is not None
+
+
+def list_partitions() -> List[Partition]:  # pragma: no cover
+    """Time partitions of the Temperature table, ordered by start."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE pg_inherits.inhparent = %s::regclass",
+            [TABLE],
+        )
+        names = [row[0] for row in cursor.fetchall()]
+    partitions = [parse_partition_name(name) for name in names]
+    return sorted(partition for partition in partitions if partition)
+
+
+def create_partitions(
+    start: datetime, end: datetime, interval: str
+) -> List[str]:  # pragma: no cover
+    """Create the missing partitions covering the [start, end) window.
+
+    The readings of their ranges which landed in the default partition are moved
+    into them.
+
+    Returns:
+        List[str]: names of the created partitions
+    """
+    existing = {name for name, _, _ in list_partitions()}
+    created = []
+    start = partition_start(start, interval)
+    while start < end:
+        name = partition_name(start, interval)
+        following = next_start(start, interval)
+        if name not in existing:
+            create_partition(name, start, following)
+            created.append(name)
+        start = following
+    return created
+
+
+def create_partition(
+    name: str, start: datetime, end: datetime
+) -> None:  # pragma: no cover
+    """Create the partition of the [start, end) range, out of the default one.
+
+    A partition overlapping rows of the default partition can't be created: they
+    are moved into a new table first, which is then attached as the partition.
+    """
+    bounds = f"FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+    where = 'WHERE "timestamp" >= %s AND "timestamp" < %s'
+    with transaction.atomic(), connection.cursor() as cursor:
+        # the writes into the default partition wait for the partition.
+        cursor.execute(f"LOCK TABLE {DEFAULT_PARTITION} IN EXCLUSIVE MODE")
+        cursor.execute(
+            f"SELECT 1 FROM {DEFAULT_PARTITION} {where} LIMIT 1", [start, end]
+        )
+        if cursor.fetchone() is None:
+            cursor.execute(
+                f"CREATE TABLE {name} PARTITION OF {TABLE} FOR VALUES {bounds}"
+            )
+            return
+        cursor.execute(f"CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS)")
+        cursor.execute(
+            f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} {where} RETURNING *) "
+            f"INSERT INTO {name} SELECT * FROM moved",
+            [start, end],
+        )
+        cursor.execute(
+            f"ALTER TABLE {TABLE} ATTACH PARTITION {name} FOR VALUES {bounds}"
+        )
+
+
+def partition_table(interval: str, ahead: int) -> None:  # pragma: no cover
+    """Turn the Temperature table into a table partitioned by `interval`.
+
+    The readings are copied into a new partitioned table, with partitions from the
+    oldest reading up to `ahead` intervals from now, which replaces the original
+    table. The table is locked meanwhile: the concurrent reads and writes wait for
+    the copy, then fail and are retried (as the writes of the feed consumer are).
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"LOCK TABLE {TABLE} IN ACCESS EXCLUSIVE MODE")
+        old = f"{TABLE}_unpartitioned"
+        cursor.execute(f"ALTER TABLE {TABLE} RENAME TO {old}")
+        cursor.execute(
+            f"ALTER TABLE {old} RENAME CONSTRAINT {TABLE}_pkey TO {old}_pkey"
+        )
+        # recreate the indexes on the new table, with the same names.
+        cursor.execute(
+            "SELECT indexname, indexdef FROM pg_indexes "
+            "WHERE tablename = %s AND indexname != %s",
+            [old, f"{old}_pkey"],
+        )
+        indexes = cursor.fetchall()
+        for name, _ in indexes:
+            cursor.execute(f"DROP INDEX {name}")
+        # partitioned tables cannot have identity columns before PostgreSQL 17:
+        # ids are taken from a sequence instead, which replaces the original one.
+        cursor.execute(f"ALTER TABLE {old} ALTER COLUMN id DROP IDENTITY IF EXISTS")
+        cursor.execute(f"ALTER TABLE {old} ALTER COLUMN id DROP DEFAULT")
+        cursor.execute(f"DROP SEQUENCE IF EXISTS {TABLE}_id_seq")
+        cursor.execute(
+            f"CREATE TABLE {TABLE} (LIKE {old} INCLUDING DEFAULTS) "
+            'PARTITION BY RANGE ("timestamp")'
+        )
+        # the partition key must be part of the primary key.
+        cursor.execute(f'ALTER TABLE {TABLE} ADD PRIMARY KEY ("id", "timestamp")')
+        cursor.execute(f"CREATE SEQUENCE {TABLE}_id_seq OWNED BY {TABLE}.id")
+        cursor.execute(
+            f"ALTER TABLE {TABLE} ALTER COLUMN id SET DEFAULT "
+            f"nextval('{TABLE}_id_seq')"
+        )
+        for _, definition in indexes:
+            definition = re.sub(rf" ON (\S+\.)?{old} ", f" ON {TABLE} ", definition)
+            cursor.execute(definition)
+        cursor.execute(
+            f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {TABLE} DEFAULT"
+        )
+        cursor.execute(f'SELECT MIN("timestamp") FROM {old}')
+        oldest = cursor.fetchone()[0] or django_timezone.now()
+        create_partitions(oldest, upcoming_end(interval, ahead), interval)
+        cursor.execute(f"INSERT INTO {TABLE} SELECT * FROM {old}")
+        cursor.execute(
+            f"SELECT setval('{TABLE}_id_seq', COALESCE(MAX(id), 0) + 1, false) "
+            f"FROM {TABLE}"
+        )
+        cursor.execute(f"DROP TABLE {old}")
+
+
+def upcoming_end(interval: str, ahead: int) -> datetime:
+    """End of the partition `ahead` intervals after the current one."""
+    end = next_start(partition_start(django_timezone.now(), interval), interval)
+    for _ in range(ahead):
+        end = next_start(end, interval)
+    return end
+
+
+def retention_cutoff(days: int) -> datetime:
+    """Start of the first day whose readings are kept."""
+    return floor(django_timezone.now() - timedelta(days=days), TemperatureRollup.DAY)
+
+
+def apply_retention(cutoff: datetime, downsample: bool = True) -> int:
+    """Drop the readings older than `cutoff`, a day start.
+
+    The readings are already aggregated into the rollups as they are persisted:
+    when `downsample` is set, these rollups are kept so that statistics over the
+    expired windows are still available. Otherwise they are dropped as well.
+
+    Returns:
+        int: number of dropped readings
+    """
+    rollups = 0
+    if not downsample:
+        rollups = TemperatureRollup.objects.filter(bucket__lt=cutoff).delete()[0]
+    dropped = 0
+    if is_partitioned():  # pragma: no cover
+        dropped += drop_partitions(cutoff)
+    # readings which are not in an expired partition.
+    oldest = Temperature.objects.filter(timestamp__lt=cutoff).order_by("timestamp")
+    while True:
+        ids = list(oldest.values_list("id", flat=True)[:DELETE_BATCH_SIZE])
+        if not ids:
+            break
+        dropped += Temperature.objects.filter(id__in=ids).delete()[0]
+    if dropped or rollups:
+        bump_data_version()
+    return dropped
+
+
+def drop_partitions(cutoff: datetime) -> int:  # pragma: no cover
+    """Drop the partitions ending before `cutoff`.
+
+    Returns:
+        int: number of dropped readings
+    """
+    dropped = 0
+    with connection.cursor() as cursor:
+        for name, _, end in list_partitions():
+            if end > cutoff:
+                break
+            cursor.execute(f"SELECT COUNT(*) FROM {name}")
+            dropped += cursor.fetchone()[0]
+            cursor.execute(f"ALTER TABLE {TABLE} DETACH PARTITION {name}")
+            cursor.execute(f"DROP TABLE {name}")
+    return dropped
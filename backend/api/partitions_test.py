@@ -0,0 +1,173 @@
+"""Unit tests for partitions.py"""
+from datetime import datetime, timedelta
+from decimal import Decimal
+import pytest
+from unittest.mock import patch
+from django.db import connection
+
+from api.ingest import store_readings
+from api.models import Temperature, TemperatureRollup
+from api.partitions import (
+    DAY,
+    DEFAULT_PARTITION,
+    MONTH,
+    apply_retention,
+    create_partitions,
+    is_partitioned,
+    list_partitions,
+    next_start,
+    parse_partition_name,
+    partition_name,
+    partition_start,
+    partition_table,
+    retention_cutoff,
+    upcoming_end,
+)
+
+
+# the partitioning runs on PostgreSQL only, as in the postgres job of the CI.
+postgresql = pytest.mark.skipif(
+    connection.vendor != "postgresql", reason="partitioning requires PostgreSQL"
+)
+
+
+def _dt(value):
+    return datetime.fromisoformat(value)
+
+
+@pytest.mark.parametrize(
+    "interval,timestamp,start,following,name",
+    [
+        (
+            DAY,
+            "2022-02-28T12:34:56+02:00",
+            "2022-02-28T00:00:00+00:00",
+            "2022-03-01T00:00:00+00:00",
+            "api_temperature_p20220228",
+        ),
+        (
+            MONTH,
+            "2022-01-31T23:59:59+00:00",
+            "2022-01-01T00:00:00+00:00",
+            "2022-02-01T00:00:00+00:00",
+            "api_temperature_p202201",
+        ),
+        (
+            MONTH,
+            "2022-12-15T00:00:00+00:00",
+            "2022-12-01T00:00:00+00:00",
+            "2023-01-01T00:00:00+00:00",
+            "api_temperature_p202212",
+        ),
+    ],
+)
+def test_partition_bounds(interval, timestamp, start, following, name):
+    assert partition_start(_dt(timestamp), interval) == _dt(start)
+    assert next_start(_dt(start), interval) == _dt(following)
+    assert partition_name(_dt(start), interval) == name
+    assert parse_partition_name(name) == (name, _dt(start), _dt(following))
+
+
+@pytest.mark.parametrize(
+    "name", ["api_temperature_default", "api_temperature_p2022", "other_p20220228"]
+)
+def test_parse_partition_name_other(name):
+    assert parse_partition_name(name) is None
+
+
+@patch("api.partitions.django_timezone.now")
+def test_upcoming_end(mock_now):
+    mock_now.return_value = _dt("2022-02-15T12:00:00+00:00")
+    assert upcoming_end(DAY, 3) == _dt("2022-02-19T00:00:00+00:00")
+    assert upcoming_end(MONTH, 1) == _dt("2022-04-01T00:00:00+00:00")
+
+
+@patch("api.partitions.django_timezone.now")
+def test_retention_cutoff(mock_now):
+    mock_now.return_value = _dt("2022-02-15T12:00:00+00:00")
+    assert retention_cutoff(30) == _dt("2022-01-16T00:00:00+00:00")
+
+
+@pytest.mark.django_db
+def test_is_partitioned():
+    """Test that the table is not partitioned by default."""
+    assert not is_partitioned()
+
+
+@pytest.fixture
+def readings():
+    start = _dt("2022-02-14T23:00:00+00:00")
+    store_readings(
+        [
+            Temperature(timestamp=start + timedelta(minutes=20 * i), value=Decimal(i))
+            for i in range(6)
+        ]
+    )
+
+
+@pytest.mark.django_db
+@patch("api.partitions.DELETE_BATCH_SIZE", 2)
+def test_apply_retention_downsample(readings):
+    """Test that the expired readings are dropped, and their rollups kept."""
+    cutoff = _dt("2022-02-15T00:00:00+00:00")
+    rollups = TemperatureRollup.objects.count()
+    assert apply_retention(cutoff) == 3
+    assert list(Temperature.objects.values_list("value", flat=True)) == [3, 4, 5]
+    assert TemperatureRollup.objects.count() == rollups
+    assert apply_retention(cutoff) == 0
+
+
+@pytest.mark.django_db
+def test_apply_retention_no_downsample(readings):
+    """Test that the rollups of the expired readings are dropped too."""
+    cutoff = _dt("2022-02-15T00:00:00+00:00")
+    assert apply_retention(cutoff, downsample=False) == 3
+    assert not TemperatureRollup.objects.filter(bucket__lt=cutoff).exists()
+    assert TemperatureRollup.objects.get(resolution="day").count == 3
+
+
+def _count(table):
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT COUNT(*) FROM {table}")
+        return cursor.fetchone()[0]
+
+
+@postgresql
+@pytest.mark.django_db
+@patch("api.partitions.django_timezone.now")
+def test_partition_table(mock_now, readings):
+    """Test that the readings are moved into daily partitions, ids going on."""
+    mock_now.return_value = _dt("2022-02-15T12:00:00+00:00")
+    latest = Temperature.objects.latest("id").id
+    partition_table(DAY, 1)
+    assert is_partitioned()
+    assert [name for name, _, _ in list_partitions()] == [
+        "api_temperature_p20220214",
+        "api_temperature_p20220215",
+        "api_temperature_p20220216",
+    ]
+    assert _count("api_temperature_p20220214") == 3
+    assert _count("api_temperature_p20220215") == 3
+    store_readings([Temperature(timestamp=mock_now.return_value, value=6)])
+    assert Temperature.objects.latest("id").id > latest
+    assert Temperature.objects.count() == 7
+
+
+@postgresql
+@pytest.mark.django_db
+@patch("api.partitions.django_timezone.now")
+def test_create_partitions_out_of_default(mock_now, readings):
+    """Test that a partition is created over readings of the default partition,
+    and that the expired partitions are dropped."""
+    mock_now.return_value = _dt("2022-02-15T12:00:00+00:00")
+    partition_table(DAY, 0)
+    later = _dt("2022-02-20T12:00:00+00:00")
+    store_readings([Temperature(timestamp=later, value=6)])
+    assert _count(DEFAULT_PARTITION) == 1
+    assert create_partitions(later, later, DAY) == ["api_temperature_p20220220"]
+    assert _count(DEFAULT_PARTITION) == 0
+    assert _count("api_temperature_p20220220") == 1
+    assert create_partitions(later, later, DAY) == []
+    assert apply_retention(_dt("2022-02-16T00:00:00+00:00")) == 6
+    assert [name for name, _, _ in list_partitions()] == ["api_temperature_p20220220"]
+    assert list(Temperature.objects.values_list("value", flat=True)) == [6]
@@ -0,0 +1,203 @@
+"""Fan-out of the persisted readings to the live subscribers.
+
+The consumer runs a ReadingPublisher: a local TCP server streaming every reading
+it persists, as one JSON line, to the connected API processes. Each API process
+relays that stream to its ReadingHub, which hands every reading to all of its
+subscribers, without any db query. Slow subscribers only get the latest readings
+(their queues drop the oldest ones), and an API process which does not keep up
+with the stream is disconnected by the publisher, then reconnects.
+"""
+import asyncio
+from datetime import datetime
+from decimal import Decimal
+import json
+from typing import AsyncIterator, List, Optional, Set
+
+from backend.settings import (
+    PUBSUB_BUFFER_LIMIT,
+    PUBSUB_HOST,
+    PUBSUB_PORT,
+    PUBSUB_RETRY_DELAY,
+    SUBSCRIPTION_QUEUE_SIZE,
+)
+from api.models import Temperature
+
+
+def encode_readings(readings: List[Temperature]) -> bytes:
+    """Stream lines of a batch of readings, oldest first."""
+    return b"".join(
+        json.dumps(
+            {
+                "id": reading.pk,
+                "sensor": reading.sensor,
+                "timestamp": reading.timestamp.isoformat(),
+                "value": str(reading.value),
+            }
+        ).encode()
+        + b"\n"
+        for reading in sorted(readings, key=lambda tm: tm.timestamp)
+    )
+
+
+def decode_reading(line: bytes) -> Temperature:
+    """Reading of a stream line."""
+    item = json.loads(line)
+    return Temperature(
+        id=item["id"],
+        sensor=item.get("sensor", Temperature.DEFAULT_SENSOR),
+        timestamp=datetime.fromisoformat(item["timestamp"]),
+        value=Decimal(item["value"]),
+    )
+
+
+class ReadingPublisher:
+    """Server streaming the persisted readings to the API processes.
+
+    A connection whose unsent data exceeds `buffer_limit` bytes is closed, so that
+    a stuck API process does not make the consumer buffer without bound.
+    """
+
+    def __init__(
+        self,
+        host: str = PUBSUB_HOST,
+        port: int = PUBSUB_PORT,
+        buffer_limit: int = PUBSUB_BUFFER_LIMIT,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.buffer_limit = buffer_limit
+        self.clients: Set[asyncio.StreamWriter] = set()
+        self.disconnected = 0
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def start(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self.connect, self.host, self.port)
+        # the actual port, when bound to any free one.
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self.server:
+            self.server.close()
+            clients = list(self.clients)
+            for client in clients:
+                client.close()
+            await asyncio.gather(
+                *(client.wait_closed() for client in clients), return_exceptions=True
+            )
+            # let the connections see the end of their streams.
+            await asyncio.sleep(0)
+            await self.server.wait_closed()
+
+    async def connect(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """Keep a client connection until it is closed."""
+        self.clients.add(writer)
+        try:
+            # clients don't send anything: wait for the end of the stream.
+            await reader.read()
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+
+    def publish(self, readings: List[Temperature]) -> None:
+        """Stream readings to the clients, from any thread."""
+        if readings and self.loop and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.send, encode_readings(readings))
+
+    def send(self, data: bytes) -> None:
+        for client in list(self.clients):
+            if client.transport.get_write_buffer_size() > self.buffer_limit:
+                self.clients.discard(client)
+                self.disconnected += 1
+                client.close()
+            else:
+                client.write(data)
+
+
+# publisher of the current process, started by the consumer.
+publisher: Optional[ReadingPublisher] = None
+
+
+async def start_publisher() -> ReadingPublisher:
+    """Start the publisher of the current process."""
+    global publisher
+    publisher = ReadingPublisher()
+    await publisher.start()
+    return publisher
+
+
+def publish_readings(readings: List[Temperature]) -> None:
+    """Stream persisted readings to the subscribers, if this process publishes."""
+    if publisher:
+        publisher.publish(readings)
+
+
+class ReadingHub:
+    """Fan-out of the published readings to the subscribers of an API process.
+
+    The hub relays the publisher stream as long as the process runs, starting with
+    its first subscriber. Each subscriber has a queue of `queue_size` readings,
+    which drops its oldest reading when full.
+    """
+
+    def __init__(
+        self,
+        host: str = PUBSUB_HOST,
+        port: int = PUBSUB_PORT,
+        queue_size: int = SUBSCRIPTION_QUEUE_SIZE,
+        retry_delay: float = PUBSUB_RETRY_DELAY,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.queue_size = max(queue_size, 1)
+        self.retry_delay = retry_delay
+        self.queues: Set["asyncio.Queue[Temperature]"] = set()
+        self.dropped = 0
+        self.relay_task: Optional["asyncio.Task[None]"] = None
+
+    def publish(self, reading: Temperature) -> None:
+        """Hand a reading to every subscriber."""
+        for queue in self.queues:
+            if queue.full():
+                queue.get_nowait()
+                self.dropped += 1
+            queue.put_nowait(reading)
+
+    async def subscribe(self) -> AsyncIterator[Temperature]:
+        """Iterate over the readings published from now on."""
+        # the relay is bound to the event loop of the subscribers.
+        if self.relay_task is None or self.relay_task.done():
+            self.relay_task = asyncio.create_task(self.relay())
+        queue: "asyncio.Queue[Temperature]" = asyncio.Queue(maxsize=self.queue_size)
+        self.queues.add(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self.queues.discard(queue)
+
+    async def relay(self) -> None:
+        """Relay the publisher stream to the subscribers, reconnecting on failure."""
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+            except OSError:
+                await asyncio.sleep(self.retry_delay)
+                continue
+            try:
+                async for line in reader:
+                    self.publish(decode_reading(line))
+            except ConnectionError:
+                pass
+            finally:
+                writer.close()
+            await asyncio.sleep(self.retry_delay)
+
+
+# hub of the current API process.
+reading_hub = ReadingHub()
@@ -0,0 +1,188 @@
+"""Unit tests for pubsub.py"""
+import asyncio
+from decimal import Decimal
+from unittest.mock import MagicMock, patch
+from django.utils import timezone
+
+from api import pubsub
+from api.models import Temperature
+from api.pubsub import (
+    ReadingHub,
+    ReadingPublisher,
+    decode_reading,
+    encode_readings,
+    publish_readings,
+    start_publisher,
+)
+
+
+NOW = timezone.datetime.fromisoformat("2022-02-15T12:00:00+00:00")
+OLDER = Temperature(id=1, timestamp=NOW, value=Decimal("19.5"))
+NEWER = Temperature(
+    id=2,
+    sensor="attic",
+    timestamp=NOW + timezone.timedelta(seconds=1),
+    value=Decimal("-0.25"),
+)
+
+
+def _fields(reading):
+    return reading.pk, reading.sensor, reading.timestamp, reading.value
+
+
+def test_encode_decode():
+    """Test that readings are streamed oldest first, and read back identical."""
+    lines = encode_readings([NEWER, OLDER]).splitlines()
+    assert [_fields(decode_reading(line)) for line in lines] == [
+        _fields(OLDER),
+        _fields(NEWER),
+    ]
+    # lines streamed before the sensors.
+    line = b'{"id": 1, "timestamp": "2022-02-15T12:00:00+00:00", "value": "19.5"}'
+    assert _fields(decode_reading(line)) == _fields(OLDER)
+
+
+def _hub(**kwargs):
+    hub = ReadingHub(**kwargs)
+    # don't relay any publisher.
+    hub.relay_task = MagicMock(**{"done.return_value": False})
+    return hub
+
+
+async def _wait_for(condition):
+    while not condition():
+        await asyncio.sleep(0.001)
+
+
+def test_hub_drops_oldest():
+    """Test that a slow subscriber only gets the latest readings."""
+
+    async def run():
+        hub = _hub(queue_size=1)
+        subscription = hub.subscribe()
+        first = asyncio.ensure_future(subscription.__anext__())
+        await _wait_for(lambda: hub.queues)
+        hub.publish(OLDER)
+        assert (await first) is OLDER
+        hub.publish(OLDER)
+        hub.publish(NEWER)
+        assert (await subscription.__anext__()) is NEWER
+        await subscription.aclose()
+        return hub
+
+    hub = asyncio.run(run())
+    assert hub.dropped == 1
+    assert not hub.queues
+
+
+def test_publisher_to_hub():
+    """Test that readings published from another thread reach the subscribers."""
+
+    async def run():
+        publisher = ReadingPublisher(port=0)
+        await publisher.start()
+        hub = ReadingHub(port=publisher.port, retry_delay=0.01)
+        subscription = hub.subscribe()
+        received = asyncio.ensure_future(subscription.__anext__())
+        await _wait_for(lambda: publisher.clients)
+        await asyncio.get_running_loop().run_in_executor(
+            None, publisher.publish, [OLDER]
+        )
+        reading = await received
+        # the relay reconnects once the publisher is back.
+        await publisher.stop()
+        publisher = ReadingPublisher(port=publisher.port)
+        await publisher.start()
+        await _wait_for(lambda: publisher.clients)
+        received = asyncio.ensure_future(subscription.__anext__())
+        publisher.publish([NEWER])
+        reading_after_restart = await received
+        await subscription.aclose()
+        hub.relay_task.cancel()
+        await publisher.stop()
+        return reading, reading_after_restart
+
+    reading, reading_after_restart = asyncio.run(run())
+    assert _fields(reading) == _fields(OLDER)
+    assert _fields(reading_after_restart) == _fields(NEWER)
+
+
+def test_relay_connection_error():
+    """Test that the relay reconnects after a connection error."""
+
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.set_exception(ConnectionResetError())
+        writer = MagicMock()
+        hub = ReadingHub(retry_delay=0)
+        connected = asyncio.Event()
+        attempts = []
+
+        async def open_connection(host, port):
+            attempts.append(port)
+            if len(attempts) == 1:
+                raise ConnectionRefusedError()
+            if connected.is_set():
+                await asyncio.sleep(3600)
+            connected.set()
+            return reader, writer
+
+        with patch("api.pubsub.asyncio.open_connection", open_connection):
+            task = asyncio.ensure_future(hub.relay())
+            await connected.wait()
+            await _wait_for(lambda: writer.close.called)
+            task.cancel()
+
+    asyncio.run(run())
+
+
+def test_publisher_client_reset():
+    async def run():
+        publisher = ReadingPublisher()
+        reader = asyncio.StreamReader()
+        reader.set_exception(ConnectionResetError())
+        writer = MagicMock()
+        await publisher.connect(reader, writer)
+        writer.close.assert_called_once()
+        assert not publisher.clients
+
+    asyncio.run(run())
+
+
+def test_publisher_drops_slow_client():
+    """Test that a client lagging by more than the buffer limit is disconnected."""
+    publisher = ReadingPublisher(buffer_limit=10)
+    slow, fast = MagicMock(), MagicMock()
+    slow.transport.get_write_buffer_size.return_value = 11
+    fast.transport.get_write_buffer_size.return_value = 10
+    publisher.clients = {slow, fast}
+    publisher.send(b"data")
+    slow.close.assert_called_once()
+    slow.write.assert_not_called()
+    fast.write.assert_called_once_with(b"data")
+    assert publisher.clients == {fast}
+    assert publisher.disconnected == 1
+
+
+def test_publisher_not_started():
+    publisher = ReadingPublisher()
+    publisher.publish([OLDER])
+    asyncio.run(publisher.stop())
+
+
+def test_publish_readings():
+    """Test that readings are only published by a process running a publisher."""
+    with patch("api.pubsub.publisher", None):
+        publish_readings([OLDER])
+
+    async def run():
+        with patch("api.pubsub.ReadingPublisher.start"):
+            started = await start_publisher()
+        with patch.object(started, "publish") as mock_publish:
+            publish_readings([OLDER])
+            mock_publish.assert_called_once_with([OLDER])
+        return started
+
+    with patch("api.pubsub.publisher", None):
+        started = asyncio.run(run())
+        assert pubsub.publisher is started
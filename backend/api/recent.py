@@ -0,0 +1,315 @@
+"""In-memory index of the recent temperature readings.
+
+The API process keeps the readings of the last RECENT_READINGS_HORIZON seconds in
+compact arrays, along with segment trees answering range min/max queries in
+O(log n). It is fed incrementally with the readings persisted since its last sync.
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from django.utils import timezone as django_timezone
+
+from django.db.models import Q
+from backend.settings import (
+    RECENT_READINGS_HORIZON,
+    RECENT_READINGS_SYNC_INTERVAL,
+    RECENT_READINGS_SYNC_OVERLAP,
+)
+from api.models import Temperature
+
+
+# values are stored as integers, scaled to the decimal places of the field.
+VALUE_FIELD = Temperature._meta.get_field("value")
+DECIMAL_PLACES: int = VALUE_FIELD.decimal_places  # type: ignore
+INT64_MAX = 2**63 - 1
+INT64_MIN = -(2**63)
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def to_micros(timestamp: datetime) -> int:
+    """Microseconds since the epoch of a timestamp."""
+    return (timestamp - EPOCH) // timedelta(microseconds=1)
+
+
+def to_scaled(value: Decimal) -> int:
+    """Fixed-point integer of a reading value."""
+    return int(Decimal(value).scaleb(DECIMAL_PLACES))
+
+
+def from_scaled(value: int) -> Decimal:
+    """Reading value of a fixed-point integer."""
+    return Decimal(value).scaleb(-DECIMAL_PLACES)
+
+
+class RecentIndex:
+    """Time-ordered readings, with segment trees of their min and max values.
+
+    Readings are evicted from the start of the arrays by moving `head` forward:
+    queries never reach the evicted positions, which are dropped once they make up
+    half of the arrays.
+
+    A late reading within the indexed range is folded, in O(log n), into the leaf
+    of the reading it follows, and kept in `late` by the position of that reading:
+    the queries check those of their boundary leaves one by one. They are merged
+    into the arrays on the next rebuild.
+    """
+
+    def __init__(self) -> None:
+        self.timestamps = array("q")
+        self.values = array("q")
+        self.head = 0
+        self.late: Dict[int, List[Tuple[int, int]]] = {}
+        self._build()
+
+    def __len__(self) -> int:
+        late = sum(len(self.late[position]) for position in self._late_positions())
+        return len(self.values) - self.head + late
+
+    def _late_positions(self) -> List[int]:
+        """Positions of the indexed readings followed by late ones, in order."""
+        return sorted(position for position in self.late if position >= self.head)
+
+    def _merge(self) -> None:
+        """Drop the evicted readings and merge the late ones into the arrays."""
+        timestamps, values, start = array("q"), array("q"), self.head
+        for position in self._late_positions():
+            timestamps.extend(self.timestamps[start:position + 1])
+            values.extend(self.values[start:position + 1])
+            for timestamp, value in sorted(self.late[position]):
+                timestamps.append(timestamp)
+                values.append(value)
+            start = position + 1
+        timestamps.extend(self.timestamps[start:])
+        values.extend(self.values[start:])
+        self.timestamps, self.values, self.head, self.late = timestamps, values, 0, {}
+
+    def _build(self) -> None:
+        """Drop the evicted readings, merge the late ones and rebuild the trees, in
+        O(n)."""
+        self._merge()
+        self.size = 1
+        while self.size < len(self.values):
+            self.size *= 2
+        self.mins = array("q", [INT64_MAX]) * (2 * self.size)
+        self.maxs = array("q", [INT64_MIN]) * (2 * self.size)
+        self.mins[self.size:self.size + len(self.values)] = self.values
+        self.maxs[self.size:self.size + len(self.values)] = self.values
+        for node in range(self.size - 1, 0, -1):
+            self._pull(node)
+
+    def _pull(self, node: int) -> None:
+        self.mins[node] = min(self.mins[2 * node], self.mins[2 * node + 1])
+        self.maxs[node] = max(self.maxs[2 * node], self.maxs[2 * node + 1])
+
+    def _set(self, position: int, lowest: int, highest: int) -> None:
+        """Set the min and max of a leaf and update its ancestors, in O(log n)."""
+        node = self.size + position
+        self.mins[node], self.maxs[node] = lowest, highest
+        node //= 2
+        while node:
+            self._pull(node)
+            node //= 2
+
+    def add(self, timestamp: int, value: int) -> None:
+        """Add a reading, in O(log n) amortized unless it is older than all the
+        indexed ones."""
+        if self.timestamps and timestamp < self.timestamps[-1]:
+            position = bisect_right(self.timestamps, timestamp, self.head) - 1
+            if position < self.head:
+                # the indexed range grows: keep the arrays sorted by timestamp.
+                self._merge()
+                self.timestamps.insert(0, timestamp)
+                self.values.insert(0, value)
+                self._build()
+                return
+            self.late.setdefault(position, []).append((timestamp, value))
+            node = self.size + position
+            self._set(
+                position, min(self.mins[node], value), max(self.maxs[node], value)
+            )
+            return
+        self.timestamps.append(timestamp)
+        self.values.append(value)
+        if len(self.values) > self.size:
+            self._build()
+            return
+        self._set(len(self.values) - 1, value, value)
+
+    def extend(self, readings: List[Tuple[int, int]]) -> None:
+        """Add a batch of (timestamp, value) readings.
+
+        Large batches are appended to the arrays before rebuilding the trees once.
+        """
+        if len(readings) * 16 < len(self):
+            for timestamp, value in readings:
+                self.add(timestamp, value)
+            return
+        readings.sort()
+        if self.timestamps and readings and readings[0][0] < self.timestamps[-1]:
+            # late readings: merge them with the current ones.
+            self._merge()
+            readings = sorted(list(zip(self.timestamps, self.values)) + readings)
+            self.timestamps, self.values = array("q"), array("q")
+        self.timestamps.extend(timestamp for timestamp, _ in readings)
+        self.values.extend(value for _, value in readings)
+        self._build()
+
+    def evict(self, before: int) -> None:
+        """Evict the readings older than the `before` timestamp."""
+        head = bisect_left(self.timestamps, before, self.head)
+        if head > self.head:
+            kept = sorted(
+                reading
+                for reading in self.late.pop(head - 1, [])
+                if reading[0] >= before
+            )
+            if kept:
+                # the first late reading kept takes the place of the evicted one.
+                head -= 1
+                self.timestamps[head], self.values[head] = kept.pop(0)
+                self.late[head] = kept
+                values = [self.values[head]] + [value for _, value in kept]
+                self._set(head, min(values), max(values))
+        self.head = head
+        if self.head * 2 > len(self.values):
+            self._build()
+
+    def _late_extremes(self, position: int, start: int, end: int) -> Tuple[int, int]:
+        """Min and max of the late readings following the reading at `position`,
+        between timestamps `start` and `end` included."""
+        values = [
+            value
+            for timestamp, value in self.late.get(position, [])
+            if start <= timestamp <= end
+        ]
+        return min(values, default=INT64_MAX), max(values, default=INT64_MIN)
+
+    def query(self, start: int, end: int) -> Optional[Tuple[int, int]]:
+        """Min and max of the readings between timestamps `start` and `end` included.
+
+        Returns:
+            Optional[Tuple[int, int]]: None if there is no reading in the range
+        """
+        low = bisect_left(self.timestamps, start, self.head)
+        high = bisect_right(self.timestamps, end, self.head)
+        lowest, highest = INT64_MAX, INT64_MIN
+        # the late readings of the leaves at the bounds may be out of the range.
+        if low > self.head:
+            lowest, highest = self._late_extremes(low - 1, start, end)
+        if high > low:
+            high -= 1
+            late_lowest, late_highest = self._late_extremes(high, start, end)
+            lowest = min(lowest, late_lowest, self.values[high])
+            highest = max(highest, late_highest, self.values[high])
+        low, high = low + self.size, high + self.size
+        while low < high:
+            if low & 1:
+                lowest = min(lowest, self.mins[low])
+                highest = max(highest, self.maxs[low])
+                low += 1
+            if high & 1:
+                high -= 1
+                lowest = min(lowest, self.mins[high])
+                highest = max(highest, self.maxs[high])
+            low //= 2
+            high //= 2
+        if lowest > highest:
+            return None
+        return lowest, highest
+
+
+class RecentReadings:
+    """Readings of the last `horizon`, synced from the db every `sync_interval` seconds.
+
+    A sync fetches the readings of the last `overlap` seconds again, as the writers
+    of the feed consumer commit them a while after their timestamp and not in id
+    order, plus those of a higher id than any loaded (backfills). The readings
+    already loaded are skipped by id.
+    """
+
+    def __init__(
+        self,
+        horizon: float = RECENT_READINGS_HORIZON,
+        sync_interval: float = RECENT_READINGS_SYNC_INTERVAL,
+        overlap: float = RECENT_READINGS_SYNC_OVERLAP,
+    ) -> None:
+        self.horizon = timedelta(seconds=horizon)
+        self.sync_interval = sync_interval
+        self.overlap = timedelta(seconds=overlap)
+        self.index = RecentIndex()
+        # readings are all loaded from that time on, None until the first sync.
+        self.covered_from: Optional[datetime] = None
+        self.last_id = 0
+        # timestamps by id of the loaded readings the next sync fetches again.
+        self.seen: Dict[int, int] = {}
+        self.synced_to: Optional[datetime] = None
+        self.synced_at = 0.0
+        self.lock = threading.Lock()
+
+    def sync(self) -> None:
+        """Load the readings persisted since the last sync, and evict the old ones."""
+        now = django_timezone.now()
+        start = now - self.horizon
+        # the timestamp bound lets a partitioned table scan its last partitions.
+        readings = Temperature.objects.filter(timestamp__gte=start)
+        if self.covered_from is None or self.synced_to is None:
+            self.covered_from = start
+        else:
+            readings = readings.filter(
+                Q(timestamp__gte=self.synced_to - self.overlap)
+                | Q(id__gt=self.last_id)
+            )
+        batch = []
+        for pk, timestamp, value in readings.values_list(
+            "id", "timestamp", "value"
+        ).iterator():
+            if pk in self.seen:
+                continue
+            self.seen[pk] = to_micros(timestamp)
+            batch.append((self.seen[pk], to_scaled(value)))
+            self.last_id = max(self.last_id, pk)
+        self.index.extend(batch)
+        self.index.evict(to_micros(start))
+        refetched_from = to_micros(now - self.overlap)
+        self.seen = {
+            pk: timestamp
+            for pk, timestamp in self.seen.items()
+            if timestamp >= refetched_from
+        }
+        self.covered_from = max(self.covered_from, start)
+        self.synced_to = now
+        self.synced_at = time.monotonic()
+
+    def statistics(
+        self, after: Optional[datetime], before: Optional[datetime]
+    ) -> Optional[Dict[str, Optional[Decimal]]]:
+        """Min and max of the readings between `after` and `before` (both included).
+
+        Returns:
+            Optional[Dict[str, Optional[Decimal]]]: "value__min" and "value__max",
+                like the raw aggregate, or None if the window is beyond the horizon
+        """
+        if after is None or after < django_timezone.now() - self.horizon:
+            return None
+        with self.lock:
+            if time.monotonic() - self.synced_at >= self.sync_interval:
+                self.sync()
+            if self.covered_from is None or after < self.covered_from:
+                return None
+            result = self.index.query(
+                to_micros(after), to_micros(before) if before else INT64_MAX
+            )
+        if result is None:
+            return {"value__min": None, "value__max": None}
+        return {
+            "value__min": from_scaled(result[0]),
+            "value__max": from_scaled(result[1]),
+        }
+
+
+recent_readings = RecentReadings()
@@ -0,0 +1,205 @@
+"""Unit tests for recent.py"""
+from datetime import timedelta
+from decimal import Decimal
+import random
+import pytest
+from unittest.mock import patch
+from django.db.models import Min, Max
+from django.utils import timezone
+
+from api.ingest import store_readings
+from api.models import Temperature
+from api.recent import (
+    RecentIndex,
+    RecentReadings,
+    from_scaled,
+    to_micros,
+    to_scaled,
+)
+
+
+def _brute_force(readings, start, end):
+    values = [value for timestamp, value in readings if start <= timestamp <= end]
+    return (min(values), max(values)) if values else None
+
+
+def test_scaled_values():
+    assert to_scaled(Decimal("-5.5")) == -5_500_000_000_000_000
+    assert str(from_scaled(to_scaled(Decimal("-5.5")))) == "-5.500000000000000"
+
+
+def test_to_micros():
+    timestamp = timezone.datetime.fromisoformat("1970-01-01T00:00:01.000002+00:00")
+    assert to_micros(timestamp) == 1_000_002
+
+
+def test_index_matches_brute_force():
+    """Test range queries while readings are added, late or not, and evicted."""
+    noise = random.Random(7)
+    index = RecentIndex()
+    readings = []
+    timestamp = 0
+    for step in range(2000):
+        timestamp += noise.randint(0, 3)
+        late = timestamp - noise.randint(0, 50) if step % 97 == 0 else timestamp
+        value = noise.randint(-10**6, 10**6)
+        index.add(late, value)
+        readings.append((late, value))
+        if step % 300 == 299:
+            oldest = timestamp - noise.randint(100, 1500)
+            index.evict(oldest)
+            readings = [reading for reading in readings if reading[0] >= oldest]
+        start = timestamp - noise.randint(0, 1000)
+        end = start + noise.randint(0, 1000)
+        assert index.query(start, end) == _brute_force(readings, start, end)
+    assert len(index) == len(readings)
+
+
+def test_index_late_readings():
+    """Test range queries while many late readings are folded into the leaves, and
+    evicted along with them or kept."""
+    noise = random.Random(13)
+    index = RecentIndex()
+    index.extend([(timestamp * 10, 0) for timestamp in range(100)])
+    readings = [(timestamp * 10, 0) for timestamp in range(100)]
+    for step in range(3000):
+        latest = readings[-1][0] if step % 3 else max(r[0] for r in readings) + 5
+        timestamp = noise.randint(latest - 300, latest)
+        value = noise.randint(-10**6, 10**6)
+        index.add(timestamp, value)
+        readings.append((timestamp, value))
+        if step % 50 == 49:
+            oldest = min(r[0] for r in readings) + noise.randint(0, 200)
+            index.evict(oldest)
+            readings = [reading for reading in readings if reading[0] >= oldest]
+        start = noise.randint(latest - 400, latest + 10)
+        end = start + noise.randint(0, 200)
+        assert index.query(start, end) == _brute_force(readings, start, end)
+        assert len(index) == len(readings)
+
+
+def test_index_late_reading_in_place():
+    """Test that a late reading within the indexed range does not rebuild the
+    trees, unlike one older than all the indexed readings."""
+    index = RecentIndex()
+    index.extend([(timestamp * 10, timestamp) for timestamp in range(1, 65)])
+    with patch.object(index, "_build", wraps=index._build) as mock_build:
+        index.add(15, -5)
+        index.add(15, 500)
+        mock_build.assert_not_called()
+        assert index.query(11, 19) == (-5, 500)
+        assert index.query(10, 14) == (1, 1)
+        assert index.query(16, 20) == (2, 2)
+        assert index.query(0, 1000) == (-5, 500)
+        index.add(5, 1000)
+        mock_build.assert_called_once_with()
+    assert index.late == {}
+    assert index.query(0, 1000) == (-5, 1000)
+
+
+def test_index_extend():
+    """Test that batches are added in bulk, late readings included."""
+    noise = random.Random(11)
+    index = RecentIndex()
+    readings = [(timestamp, noise.randint(-100, 100)) for timestamp in range(100)]
+    index.extend(list(readings))
+    late = [(50, 1000), (150, -1000)]
+    index.extend(list(late))
+    index.extend([(timestamp, 0) for timestamp in range(100, 300)] + [(20, 5)])
+    readings += late + [(timestamp, 0) for timestamp in range(100, 300)] + [(20, 5)]
+    assert len(index) == len(readings)
+    for start, end in [(0, 400), (40, 60), (20, 20), (120, 180), (149, 151)]:
+        assert index.query(start, end) == _brute_force(readings, start, end)
+
+
+def test_index_empty():
+    assert RecentIndex().query(0, 10) is None
+
+
+def _store(start, count):
+    store_readings(
+        [
+            Temperature(
+                timestamp=start + timedelta(seconds=index),
+                value=Decimal(f"{(index * 7919) % 101 - 50}.25"),
+            )
+            for index in range(count)
+        ]
+    )
+
+
+@pytest.mark.django_db
+def test_recent_statistics_match_raw():
+    """Test that windows within the horizon are answered like the raw aggregate."""
+    now = timezone.now()
+    _store(now - timedelta(seconds=600), 300)
+    recent = RecentReadings(horizon=900, sync_interval=0)
+    for after, before in [
+        (now - timedelta(seconds=500), now - timedelta(seconds=400)),
+        (now - timedelta(seconds=800), None),
+        (now - timedelta(seconds=200), now),
+    ]:
+        query = Temperature.objects.filter(timestamp__gte=after)
+        if before:
+            query = query.filter(timestamp__lte=before)
+        assert recent.statistics(after, before) == query.aggregate(
+            Min("value"), Max("value")
+        )
+    # new readings are fetched on the next sync
+    _store(now - timedelta(seconds=299), 10)
+    after = now - timedelta(seconds=300)
+    assert recent.statistics(after, None) == Temperature.objects.filter(
+        timestamp__gte=after
+    ).aggregate(Min("value"), Max("value"))
+
+
+@pytest.mark.django_db
+def test_recent_statistics_beyond_horizon():
+    recent = RecentReadings(horizon=900, sync_interval=0)
+    assert recent.statistics(None, timezone.now()) is None
+    assert recent.statistics(timezone.now() - timedelta(seconds=1000), None) is None
+    with patch.object(recent, "sync") as mock_sync:
+        recent.statistics(timezone.now() - timedelta(seconds=10), None)
+        # the first sync defines what the index covers
+        mock_sync.assert_called_once()
+
+
+@pytest.mark.django_db
+def test_recent_statistics_empty_window():
+    recent = RecentReadings(horizon=900, sync_interval=0)
+    assert recent.statistics(timezone.now() - timedelta(seconds=10), None) == {
+        "value__min": None,
+        "value__max": None,
+    }
+
+
+@pytest.mark.django_db
+def test_recent_statistics_sync_interval():
+    """Test that the db is not queried again before the sync interval."""
+    recent = RecentReadings(horizon=900, sync_interval=3600)
+    after = timezone.now() - timedelta(seconds=10)
+    recent.statistics(after, None)
+    with patch.object(recent, "sync") as mock_sync:
+        recent.statistics(after, None)
+        mock_sync.assert_not_called()
+
+
+@pytest.mark.django_db
+def test_recent_sync_late_commits():
+    """Test that readings committed out of id order or late are loaded, once."""
+    now = timezone.now()
+    Temperature.objects.create(id=10, value=20, timestamp=now - timedelta(seconds=5))
+    recent = RecentReadings(horizon=900, sync_interval=0, overlap=60)
+    recent.sync()
+    # committed after a reading of a higher id, by another writer.
+    Temperature.objects.create(id=5, value=30, timestamp=now - timedelta(seconds=4))
+    # backfilled, older than the overlap.
+    Temperature.objects.create(id=11, value=10, timestamp=now - timedelta(seconds=500))
+    recent.sync()
+    recent.sync()
+    assert len(recent.index) == 3
+    assert recent.statistics(now - timedelta(seconds=600), None) == {
+        "value__min": Decimal(10),
+        "value__max": Decimal(30),
+    }
+    assert set(recent.seen) == {5, 10}
@@ -0,0 +1,431 @@
+"""Pre-aggregated rollups of the temperature readings.
+
+Readings are aggregated per sensor and minute, hour and day bucket (in UTC) as
+they are persisted. Statistics over a window are then computed from the coarsest buckets
+which fit in the window, and from the raw readings only at its partial edges.
+"""
+from datetime import datetime, timedelta, timezone
+from decimal import ROUND_FLOOR, Decimal
+from functools import reduce
+from operator import or_
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from django.db import IntegrityError, OperationalError, transaction
+from django.db.models import Max, Min, Q
+
+from api.models import Temperature, TemperatureRollup
+
+# resolutions, from the finest to the coarsest.
+RESOLUTIONS = (
+    TemperatureRollup.MINUTE,
+    TemperatureRollup.HOUR,
+    TemperatureRollup.DAY,
+)
+RAW = "raw"
+# [start, end) time range over the raw readings or the buckets of a resolution.
+Range = Tuple[str, datetime, datetime]
+# smallest time increment of a stored timestamp.
+TICK = timedelta(microseconds=1)
+# (after, before) window of readings, both included, unbounded when None.
+Window = Tuple[Optional[datetime], Optional[datetime]]
+# attempts of a rollups update conflicting with a concurrent writer.
+UPDATE_ATTEMPTS = 3
+# (sensor, resolution, bucket) identifying a rollup.
+RollupKey = Tuple[str, str, datetime]
+# width of the bins of the value histograms kept by the rollups, in degrees:
+# percentiles computed from the rollups are approximated within half of it.
+SKETCH_BIN = Decimal("0.1")
+# statistics of a window, and the rollup columns they are computed from.
+STATISTICS = {
+    "min": ("min",),
+    "max": ("max",),
+    "count": ("count",),
+    "avg": ("count", "sum"),
+    "stddev": ("count", "sum", "sum_squares"),
+    "p50": ("count", "min", "max", "sketch"),
+    "p95": ("count", "min", "max", "sketch"),
+}
+MIN_MAX = ("min", "max")
+PERCENTILES = {"p50": Decimal("0.5"), "p95": Decimal("0.95")}
+VALUE_FIELD = Temperature._meta.get_field("value")
+
+
+def floor(timestamp: datetime, resolution: str) -> datetime:
+    """Truncate a timestamp to the start of its bucket."""
+    timestamp = timestamp.astimezone(timezone.utc).replace(second=0, microsecond=0)
+    if resolution in (TemperatureRollup.HOUR, TemperatureRollup.DAY):
+        timestamp = timestamp.replace(minute=0)
+    if resolution == TemperatureRollup.DAY:
+        timestamp = timestamp.replace(hour=0)
+    return timestamp
+
+
+def ceil(timestamp: datetime, resolution: str) -> datetime:
+    """Round a timestamp up to the start of a bucket."""
+    floored = floor(timestamp, resolution)
+    if floored == timestamp:
+        return floored
+    return floored + bucket_length(resolution)
+
+
+def bucket_length(resolution: str) -> timedelta:
+    """Time span of the buckets of a resolution."""
+    return {
+        TemperatureRollup.MINUTE: timedelta(minutes=1),
+        TemperatureRollup.HOUR: timedelta(hours=1),
+        TemperatureRollup.DAY: timedelta(days=1),
+    }[resolution]
+
+
+def split_window(start: datetime, end: datetime) -> List[Range]:
+    """Cover the [start, end) window with the fewest buckets and raw ranges.
+
+    Each resolution covers what is left between the full buckets of the next
+    coarser resolution, and the raw readings cover the partial minutes at the
+    edges of the window.
+    """
+    ranges: List[Range] = []
+
+    def add(resolution: str, low: datetime, high: datetime) -> None:
+        if low < high:
+            ranges.append((resolution, low, high))
+
+    finer = RAW
+    for resolution in RESOLUTIONS:
+        low, high = ceil(start, resolution), floor(end, resolution)
+        if low >= high:
+            break
+        add(finer, start, low)
+        add(finer, high, end)
+        start, end, finer = low, high, resolution
+    add(finer, start, end)
+    return ranges
+
+
+def sketch_bin(value: Decimal) -> str:
+    """Key of the sketch bin of a value."""
+    return str((value / SKETCH_BIN).to_integral_value(rounding=ROUND_FLOOR))
+
+
+def aggregate_readings(
+    readings: Iterable[Temperature],
+) -> Dict[RollupKey, TemperatureRollup]:
+    """Aggregate readings into rollups of their sensor, in memory.
+
+    The readings are aggregated per minute, then the minutes per hour and day.
+    """
+    minutes: Dict[Tuple[str, datetime], TemperatureRollup] = {}
+    for reading in readings:
+        value = Decimal(reading.value)
+        key = (reading.sensor, floor(reading.timestamp, TemperatureRollup.MINUTE))
+        rollup = minutes.get(key)
+        if rollup is None:
+            rollup = minutes[key] = empty_rollup(
+                key[0], TemperatureRollup.MINUTE, key[1]
+            )
+        rollup.count += 1
+        rollup.sum += value
+        rollup.sum_squares += value * value
+        if rollup.min is None or value < rollup.min:
+            rollup.min = value
+        if rollup.max is None or value > rollup.max:
+            rollup.max = value
+        sketch_key = sketch_bin(value)
+        rollup.sketch[sketch_key] = rollup.sketch.get(sketch_key, 0) + 1
+    rollups = {
+        (sensor, TemperatureRollup.MINUTE, bucket): rollup
+        for (sensor, bucket), rollup in minutes.items()
+    }
+    for resolution in RESOLUTIONS[1:]:
+        for minute in minutes.values():
+            rollup_key = (minute.sensor, resolution, floor(minute.bucket, resolution))
+            if rollup_key not in rollups:
+                rollups[rollup_key] = empty_rollup(*rollup_key)
+            merge(rollups[rollup_key], minute)
+    return rollups
+
+
+def empty_rollup(sensor: str, resolution: str, bucket: datetime) -> TemperatureRollup:
+    """Rollup of a bucket without any reading yet."""
+    return TemperatureRollup(
+        sensor=sensor,
+        resolution=resolution,
+        bucket=bucket,
+        count=0,
+        sum=Decimal(0),
+        sum_squares=Decimal(0),
+        sketch={},
+    )
+
+
+def rollup_key(rollup: TemperatureRollup) -> RollupKey:
+    return rollup.sensor, rollup.resolution, rollup.bucket
+
+
+def merge(rollup: TemperatureRollup, other: TemperatureRollup) -> None:
+    """Merge the aggregates of another rollup of the same bucket into a rollup."""
+    rollup.count += other.count
+    rollup.sum += other.sum
+    rollup.sum_squares = Decimal(rollup.sum_squares) + other.sum_squares
+    if rollup.min is None or other.min < rollup.min:
+        rollup.min = other.min
+    if rollup.max is None or other.max > rollup.max:
+        rollup.max = other.max
+    for key, count in other.sketch.items():
+        rollup.sketch[key] = rollup.sketch.get(key, 0) + count
+
+
+def update_rollups(readings: Iterable[Temperature]) -> None:
+    """Merge persisted readings into the stored rollups.
+
+    Meant to be called in the transaction inserting the readings.
+    """
+    partials = aggregate_readings(readings)
+    if not partials:
+        return
+    starts: Dict[Tuple[str, str], List[datetime]] = {}
+    for sensor, resolution, bucket in partials:
+        starts.setdefault((sensor, resolution), []).append(bucket)
+    keys = reduce(
+        or_,
+        (
+            Q(sensor=sensor, resolution=resolution, bucket__in=buckets)
+            for (sensor, resolution), buckets in starts.items()
+        ),
+    )
+    # a concurrent writer may create the same new buckets, or deadlock with this
+    # one: retry on conflict.
+    for attempt in range(UPDATE_ATTEMPTS):
+        try:
+            with transaction.atomic():
+                # locked in the same order by all the writers, against deadlocks.
+                stored = (
+                    TemperatureRollup.objects.select_for_update()
+                    .filter(keys)
+                    .order_by("sensor", "resolution", "bucket")
+                )
+                updated = []
+                for rollup in stored:
+                    merge(rollup, partials[rollup_key(rollup)])
+                    updated.append(rollup)
+                TemperatureRollup.objects.bulk_update(
+                    updated, ["count", "sum", "min", "max", "sum_squares", "sketch"]
+                )
+                known = {rollup_key(rollup) for rollup in updated}
+                TemperatureRollup.objects.bulk_create(
+                    [rollup for key, rollup in partials.items() if key not in known]
+                )
+            return
+        except (IntegrityError, OperationalError):
+            if attempt == UPDATE_ATTEMPTS - 1:
+                raise
+
+
+class Summary:
+    """Mergeable aggregates of the readings of a window.
+
+    The statistics of the window are derived from them: the average and standard
+    deviation from the sums, the percentiles from the merged sketches.
+    """
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.sum = Decimal(0)
+        self.sum_squares = Decimal(0)
+        self.min: Optional[Decimal] = None
+        self.max: Optional[Decimal] = None
+        self.sketch: Dict[str, int] = {}
+
+    def add(self, value: Decimal) -> None:
+        """Add a reading value."""
+        self.merge(
+            {
+                "count": 1,
+                "sum": value,
+                "sum_squares": value * value,
+                "min": value,
+                "max": value,
+                "sketch": {sketch_bin(value): 1},
+            }
+        )
+
+    def merge(self, aggregates: Dict[str, Any]) -> None:
+        """Merge the aggregates of a rollup, of which only some may be given."""
+        self.count += aggregates.get("count", 0)
+        self.sum += Decimal(aggregates.get("sum", 0))
+        self.sum_squares += Decimal(aggregates.get("sum_squares", 0))
+        low, high = aggregates.get("min"), aggregates.get("max")
+        if low is not None and (self.min is None or low < self.min):
+            self.min = low
+        if high is not None and (self.max is None or high > self.max):
+            self.max = high
+        for key, count in aggregates.get("sketch", {}).items():
+            self.sketch[key] = self.sketch.get(key, 0) + count
+
+    def statistic(self, name: str) -> Any:
+        """A statistic of STATISTICS, None if there are no readings."""
+        if name in ("min", "max"):
+            return getattr(self, name)
+        if name == "count":
+            return self.count
+        if not self.count:
+            return None
+        mean = self.sum / self.count
+        if name == "avg":
+            return VALUE_FIELD.normalize(mean)
+        if name == "stddev":
+            variance = self.sum_squares / self.count - mean * mean
+            return VALUE_FIELD.normalize(max(variance, Decimal(0)).sqrt())
+        return self.percentile(PERCENTILES[name])
+
+    def percentile(self, fraction: Decimal) -> Decimal:
+        """Percentile of the values, interpolated between the two closest ranks.
+
+        The value of a rank is approximated by the middle of its sketch bin.
+        """
+        rank = fraction * (self.count - 1)
+        low = int(rank)
+        values = self.ranked_values([low, min(low + 1, self.count - 1)])
+        return VALUE_FIELD.normalize(
+            values[0] + (rank - low) * (values[1] - values[0])
+        )
+
+    def ranked_values(self, ranks: List[int]) -> List[Decimal]:
+        """Approximate values of the given (increasing) ranks."""
+        values: List[Decimal] = []
+        seen = 0
+        for key in sorted(self.sketch, key=int):
+            seen += self.sketch[key]
+            while len(values) < len(ranks) and seen > ranks[len(values)]:
+                middle = (Decimal(key) + Decimal("0.5")) * SKETCH_BIN
+                # the extreme bins are only partially filled.
+                values.append(min(max(middle, self.min), self.max))  # type: ignore
+        return values
+
+    def statistics(self, names: Iterable[str]) -> Dict[str, Any]:
+        """Statistics of the window, like the raw aggregates ("value__<name>")."""
+        return {f"value__{name}": self.statistic(name) for name in names}
+
+
+def window_statistics(
+    after: Optional[datetime],
+    before: Optional[datetime],
+    sensor: Optional[str] = None,
+) -> Dict[str, Optional[Decimal]]:
+    """Min and max of the readings between `after` and `before` (both included), of
+    a sensor or of all of them.
+
+    Returns:
+        Dict[str, Optional[Decimal]]: "value__min" and "value__max", like the raw
+            aggregate
+    """
+    return windows_statistics([(after, before)], sensor=sensor)[0]
+
+
+def windows_ranges(windows: Sequence[Window], scope: Q) -> Optional[List[List[Range]]]:
+    """Ranges of each window, the unbounded ones bounded by the minute rollups.
+
+    Returns:
+        List[List[Range]]: the ranges per window, None if a window is unbounded
+            and there are no rollups
+    """
+    bounds: Dict[str, Any] = {}
+    if any(after is None or before is None for after, before in windows):
+        # bound the windows to the stored buckets.
+        bounds = TemperatureRollup.objects.filter(
+            scope, resolution=TemperatureRollup.MINUTE
+        ).aggregate(first=Min("bucket"), last=Max("bucket"))
+        if bounds["first"] is None:
+            return None
+    ranges = []
+    for after, before in windows:
+        start = after or bounds["first"]
+        if before:
+            end = before + TICK
+        else:
+            end = bounds["last"] + bucket_length(TemperatureRollup.MINUTE)
+        ranges.append(split_window(start, end))
+    return ranges
+
+
+def ranges_rows(
+    ranges: List[List[Range]], scope: Q, columns: List[str]
+) -> Tuple[List[Tuple[datetime, Decimal]], List[Dict[str, Any]]]:
+    """Raw readings and rollups covered by the ranges of all the windows, read
+    by a query each.
+
+    Returns:
+        Tuple: the (timestamp, value) of the readings, and the resolution, bucket
+            and `columns` of the rollups
+    """
+    raw = [
+        Q(timestamp__gte=low, timestamp__lt=high)
+        for window_ranges in ranges
+        for r, low, high in window_ranges
+        if r == RAW
+    ]
+    buckets = [
+        Q(resolution=r, bucket__gte=low, bucket__lt=high)
+        for window_ranges in ranges
+        for r, low, high in window_ranges
+        if r != RAW
+    ]
+    readings = []
+    if raw:
+        readings = list(
+            Temperature.objects.filter(scope, reduce(or_, raw)).values_list(
+                "timestamp", "value"
+            )
+        )
+    rollups: List[Dict[str, Any]] = []
+    if buckets:
+        rollups = list(
+            TemperatureRollup.objects.filter(scope, reduce(or_, buckets)).values(
+                "resolution", "bucket", *columns
+            )
+        )
+    return readings, rollups
+
+
+def ranges_summary(
+    window_ranges: List[Range],
+    readings: List[Tuple[datetime, Decimal]],
+    rollups: List[Dict[str, Any]],
+) -> Summary:
+    """Summary of the readings and rollups within the ranges of a window."""
+    summary = Summary()
+    for timestamp, value in readings:
+        if any(r == RAW and low <= timestamp < high for r, low, high in window_ranges):
+            summary.add(value)
+    for rollup in rollups:
+        if any(
+            r == rollup["resolution"] and low <= rollup["bucket"] < high
+            for r, low, high in window_ranges
+        ):
+            summary.merge(rollup)
+    return summary
+
+
+def windows_statistics(
+    windows: Sequence[Window],
+    names: Iterable[str] = MIN_MAX,
+    sensor: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """Statistics of several (after, before) windows, like window_statistics.
+
+    All the windows are answered by a single query over the rollups and a single
+    one over the raw readings at their edges, which only read the columns needed
+    by the requested statistics. Without a sensor, the rollups of all the sensors
+    are merged.
+    """
+    scope = Q() if sensor is None else Q(sensor=sensor)
+    names = list(names)
+    columns = sorted({column for name in names for column in STATISTICS[name]})
+    ranges = windows_ranges(windows, scope)
+    if ranges is None:
+        return [Summary().statistics(names) for _ in windows]
+    readings, rollups = ranges_rows(ranges, scope, columns)
+    return [
+        ranges_summary(window_ranges, readings, rollups).statistics(names)
+        for window_ranges in ranges
+    ]
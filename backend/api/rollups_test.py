@@ -0,0 +1,239 @@
+"""Unit tests for rollups.py"""
+from datetime import datetime, timedelta
+from decimal import Decimal
+import random
+import pytest
+from unittest.mock import patch
+from django.db import IntegrityError, OperationalError
+from django.db.models import Min, Max
+
+from api.ingest import store_readings
+from api.models import Temperature, TemperatureRollup
+from api.rollups import (
+    RAW,
+    UPDATE_ATTEMPTS,
+    ceil,
+    floor,
+    split_window,
+    update_rollups,
+    window_statistics,
+)
+
+
+def _dt(value):
+    return datetime.fromisoformat(value)
+
+
+@pytest.mark.parametrize(
+    "timestamp,resolution,floored,ceiled",
+    [
+        (
+            "2022-02-01T12:34:56.5+00:00",
+            "minute",
+            "2022-02-01T12:34:00+00:00",
+            "2022-02-01T12:35:00+00:00",
+        ),
+        (
+            "2022-02-01T12:34:56+00:00",
+            "hour",
+            "2022-02-01T12:00:00+00:00",
+            "2022-02-01T13:00:00+00:00",
+        ),
+        (
+            "2022-02-01T12:34:56+00:00",
+            "day",
+            "2022-02-01T00:00:00+00:00",
+            "2022-02-02T00:00:00+00:00",
+        ),
+        (
+            "2022-02-01T12:00:00+00:00",
+            "hour",
+            "2022-02-01T12:00:00+00:00",
+            "2022-02-01T12:00:00+00:00",
+        ),
+        (
+            "2022-02-01T12:34:56+02:00",
+            "hour",
+            "2022-02-01T10:00:00+00:00",
+            "2022-02-01T11:00:00+00:00",
+        ),
+    ],
+)
+def test_floor_ceil(timestamp, resolution, floored, ceiled):
+    assert floor(_dt(timestamp), resolution) == _dt(floored)
+    assert ceil(_dt(timestamp), resolution) == _dt(ceiled)
+
+
+def test_split_window():
+    """Test that a window is covered by the coarsest buckets, and raw edges."""
+    ranges = split_window(
+        _dt("2022-02-01T22:58:30+00:00"), _dt("2022-02-04T01:02:10+00:00")
+    )
+    assert ranges == [
+        (RAW, _dt("2022-02-01T22:58:30+00:00"), _dt("2022-02-01T22:59:00+00:00")),
+        (RAW, _dt("2022-02-04T01:02:00+00:00"), _dt("2022-02-04T01:02:10+00:00")),
+        ("minute", _dt("2022-02-01T22:59:00+00:00"), _dt("2022-02-01T23:00:00+00:00")),
+        ("minute", _dt("2022-02-04T01:00:00+00:00"), _dt("2022-02-04T01:02:00+00:00")),
+        ("hour", _dt("2022-02-01T23:00:00+00:00"), _dt("2022-02-02T00:00:00+00:00")),
+        ("hour", _dt("2022-02-04T00:00:00+00:00"), _dt("2022-02-04T01:00:00+00:00")),
+        ("day", _dt("2022-02-02T00:00:00+00:00"), _dt("2022-02-04T00:00:00+00:00")),
+    ]
+
+
+def test_split_window_within_a_minute():
+    start, end = _dt("2022-02-01T12:00:10+00:00"), _dt("2022-02-01T12:00:20+00:00")
+    assert split_window(start, end) == [(RAW, start, end)]
+
+
+def test_split_window_empty():
+    start = _dt("2022-02-01T12:00:10+00:00")
+    assert split_window(start, start) == []
+
+
+@pytest.mark.django_db
+def test_update_rollups_merges():
+    """Test that readings are merged into the existing buckets."""
+    start = _dt("2022-02-01T12:00:10+00:00")
+    store_readings([Temperature(timestamp=start, value=Decimal("10"))])
+    store_readings(
+        [
+            Temperature(timestamp=start + timedelta(seconds=5), value=Decimal("12")),
+            Temperature(timestamp=start + timedelta(minutes=1), value=Decimal("8")),
+        ]
+    )
+    minutes = TemperatureRollup.objects.filter(resolution="minute").order_by("bucket")
+    assert [(r.count, r.sum, r.min, r.max) for r in minutes] == [
+        (2, Decimal(22), Decimal(10), Decimal(12)),
+        (1, Decimal(8), Decimal(8), Decimal(8)),
+    ]
+    hour = TemperatureRollup.objects.get(resolution="hour")
+    assert (hour.count, hour.sum, hour.min, hour.max) == (
+        3,
+        Decimal(30),
+        Decimal(8),
+        Decimal(12),
+    )
+    assert hour.sum_squares == Decimal(308)
+    assert hour.sketch == {"100": 1, "120": 1, "80": 1}
+
+
+@pytest.mark.django_db
+def test_update_rollups_per_sensor():
+    """Test that the readings of each sensor are rolled up in their own buckets."""
+    start = _dt("2022-02-01T12:00:10+00:00")
+    store_readings(
+        [
+            Temperature(sensor="attic", timestamp=start, value=Decimal("10")),
+            Temperature(sensor="cellar", timestamp=start, value=Decimal("4")),
+        ]
+    )
+    store_readings([Temperature(sensor="attic", timestamp=start, value=Decimal("12"))])
+    hours = TemperatureRollup.objects.filter(resolution="hour").order_by("sensor")
+    assert [(r.sensor, r.count, r.min, r.max) for r in hours] == [
+        ("attic", 2, Decimal(10), Decimal(12)),
+        ("cellar", 1, Decimal(4), Decimal(4)),
+    ]
+
+
+@pytest.mark.django_db
+def test_update_rollups_retry_on_conflict():
+    """Test that buckets created concurrently are merged on retry."""
+    reading = Temperature(timestamp=_dt("2022-02-01T12:00:10+00:00"), value=10)
+    update_rollups([reading])
+    select_for_update = TemperatureRollup.objects.select_for_update
+    # the buckets are not there yet when first selected, as if another writer
+    # created them in the meantime.
+    with patch.object(
+        TemperatureRollup.objects,
+        "select_for_update",
+        side_effect=[TemperatureRollup.objects.none(), select_for_update()],
+    ):
+        update_rollups([reading])
+    assert [r.count for r in TemperatureRollup.objects.all()] == [2, 2, 2]
+
+
+@pytest.mark.django_db
+def test_update_rollups_retry_on_deadlock():
+    """Test that an update chosen as a deadlock victim is retried."""
+    reading = Temperature(timestamp=_dt("2022-02-01T12:00:10+00:00"), value=10)
+    update_rollups([reading])
+    bulk_update = TemperatureRollup.objects.bulk_update
+    errors = [OperationalError("deadlock detected")]
+
+    def deadlock(*args, **kwargs):
+        if errors:
+            raise errors.pop()
+        return bulk_update(*args, **kwargs)
+
+    with patch.object(TemperatureRollup.objects, "bulk_update", side_effect=deadlock):
+        update_rollups([reading])
+    assert [r.count for r in TemperatureRollup.objects.all()] == [2, 2, 2]
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("error", [IntegrityError, OperationalError])
+def test_update_rollups_conflict_persists(error):
+    """Test that a persistent conflict is raised."""
+    with patch.object(
+        TemperatureRollup.objects, "bulk_create", side_effect=error()
+    ) as mock_create, pytest.raises(error):
+        update_rollups(
+            [Temperature(timestamp=_dt("2022-02-01T12:00:10+00:00"), value=1)]
+        )
+    assert mock_create.call_count == UPDATE_ATTEMPTS
+
+
+def test_update_rollups_nothing():
+    with patch.object(TemperatureRollup.objects, "bulk_create") as mock_create:
+        update_rollups([])
+        mock_create.assert_not_called()
+
+
+@pytest.mark.django_db
+def test_window_statistics_no_data():
+    assert window_statistics(None, None) == {"value__min": None, "value__max": None}
+
+
+@pytest.mark.django_db
+def test_window_statistics_match_raw():
+    """Test that the statistics match the raw aggregate, for random windows of all
+    the sensors or one of them."""
+    noise = random.Random(42)
+    start = _dt("2022-02-01T22:30:00+00:00")
+    readings = []
+    timestamp = start
+    while timestamp < start + timedelta(days=3):
+        readings.append(
+            Temperature(
+                sensor=noise.choice(["attic", "cellar"]),
+                timestamp=timestamp,
+                value=Decimal(f"{noise.uniform(-30, 30):.15f}"),
+            )
+        )
+        timestamp += timedelta(
+            seconds=noise.randint(1, 600), microseconds=noise.randint(0, 999999)
+        )
+    store_readings(readings)
+    timestamps = [reading.timestamp for reading in readings]
+    windows = [(None, None), (start, None), (None, start + timedelta(days=1))]
+    for _ in range(50):
+        after = start + timedelta(seconds=noise.randint(-3600, 3 * 86400))
+        before = after + timedelta(seconds=noise.randint(0, 2 * 86400))
+        windows.append((after, before))
+    # bounds matching readings exactly
+    windows.append((timestamps[10], timestamps[200]))
+    for after, before in windows:
+        for sensor in (None, "attic"):
+            query = Temperature.objects.all()
+            if sensor:
+                query = query.filter(sensor=sensor)
+            if after:
+                query = query.filter(timestamp__gte=after)
+            if before:
+                query = query.filter(timestamp__lte=before)
+            expected = query.aggregate(Min("value"), Max("value"))
+            assert window_statistics(after, before, sensor) == expected, (
+                after,
+                before,
+                sensor,
+            )
@@ -1,10 +1,18 @@
 """GraphQL schema."""
-from typing import Any, Optional
+from typing import Any, AsyncIterator, Dict, List, Optional
+from asgiref.sync import sync_to_async
 import graphene
 from graphene_django import DjangoObjectType
-from django.db.models import Min, Max
 from datetime import datetime
-from api.models import Temperature, ReadConfig
+from api.models import FeedGap, Temperature, TemperatureRollup, ReadConfig
+from api.caching import acache_current_temperature, acached_current_temperature
+from api.gaps import feed_gaps
+from api.history import encode_cursor, readings_page
+from api.pubsub import reading_hub
+from api.rollups import STATISTICS
+from api.series import temperature_series
+from api.statistics import statistics_loader
+from backend.settings import TEMPERATURES_MAX_PAGE_SIZE
 from django.core.exceptions import ValidationError
 from django.core.cache import cache
 
@@ -13,41 +21,184 @@ class TemperatureType(DjangoObjectType):
     class Meta:
         model = Temperature
         fields = (
+            "sensor",
             "timestamp",
             "value",
         )
 
 
 class TemperatureStatisticsNode(graphene.ObjectType):
+    """Statistics of the readings of a window, only computed when selected."""
+
+    min = graphene.Decimal()
+    max = graphene.Decimal()
+    count = graphene.Int()
+    avg = graphene.Decimal()
+    stddev = graphene.Decimal(description="Population standard deviation.")
+    p50 = graphene.Decimal(description="Median.")
+    p95 = graphene.Decimal(description="95th percentile.")
+
+
+class TemperatureBucket(graphene.Enum):
+    MINUTE = TemperatureRollup.MINUTE
+    HOUR = TemperatureRollup.HOUR
+    DAY = TemperatureRollup.DAY
+
+
+class TemperatureSeriesPoint(graphene.ObjectType):
+    """Aggregates of the readings within a bucket."""
+
+    bucket = graphene.DateTime()
+    count = graphene.Int()
     min = graphene.Decimal()
     max = graphene.Decimal()
+    avg = graphene.Decimal()
+
+
+class FeedGapType(DjangoObjectType):
+    """Outage of the feed of a sensor: readings may be missing from `started` to
+    `ended`, null while it lasts."""
+
+    class Meta:
+        model = FeedGap
+        fields = (
+            "sensor",
+            "started",
+            "ended",
+        )
+
+
+class TemperatureConnection(graphene.relay.Connection):
+    """Page of the temperature history, oldest first."""
+
+    class Meta:
+        node = TemperatureType
 
 
 class Query(graphene.ObjectType):
-    current_temperature = graphene.Field(TemperatureType)
+    """Queries, with async resolvers: single queries use the async ORM, the
+    helpers running several queries are called in the thread of the request."""
+
+    current_temperature = graphene.Field(
+        TemperatureType,
+        sensor=graphene.String(
+            required=False, description="Latest reading of any sensor if omitted."
+        ),
+    )
+    temperatures = graphene.Field(
+        TemperatureConnection,
+        after=graphene.DateTime(required=False),
+        before=graphene.DateTime(required=False),
+        first=graphene.Int(required=False),
+        cursor=graphene.String(required=False),
+    )
     temperature_statistics = graphene.Field(
         TemperatureStatisticsNode,
         after=graphene.DateTime(required=False),
         before=graphene.DateTime(required=False),
+        sensor=graphene.String(
+            required=False, description="Readings of all the sensors if omitted."
+        ),
+    )
+    temperature_series = graphene.List(
+        graphene.NonNull(TemperatureSeriesPoint),
+        bucket=TemperatureBucket(required=True),
+        after=graphene.DateTime(required=False),
+        before=graphene.DateTime(required=False),
+        sensor=graphene.String(
+            required=False, description="Readings of all the sensors if omitted."
+        ),
+    )
+
+    feed_gaps = graphene.List(
+        graphene.NonNull(FeedGapType),
+        after=graphene.DateTime(required=False),
+        before=graphene.DateTime(required=False),
+        sensor=graphene.String(
+            required=False, description="Outages of all the feeds if omitted."
+        ),
     )
 
-    def resolve_current_temperature(root, info: Any) -> Optional[Temperature]:
-        """Return the last registered temperature in db."""
-        return Temperature.objects.order_by("-timestamp").first()
+    async def resolve_current_temperature(
+        root, info: Any, sensor: Optional[str] = None
+    ) -> Optional[Temperature]:
+        """Return the last registered temperature of a sensor, or of any sensor, from
+        the cache or the db."""
+        current = await acached_current_temperature(sensor)
+        if current is None:
+            readings = Temperature.objects.all()
+            if sensor is not None:
+                readings = readings.filter(sensor=sensor)
+            current = await readings.order_by("-timestamp").afirst()
+            if current:
+                await acache_current_temperature(
+                    current, overwrite=False, sensor=sensor
+                )
+        return current
+
+    async def resolve_temperatures(
+        root,
+        info: Any,
+        after: Optional[datetime] = None,
+        before: Optional[datetime] = None,
+        first: int = TEMPERATURES_MAX_PAGE_SIZE,
+        cursor: Optional[str] = None,
+    ) -> TemperatureConnection:
+        """Return the readings following `cursor` within the window."""
+        readings, has_next_page = await sync_to_async(readings_page)(
+            after, before, first, cursor
+        )
+        edges = [
+            TemperatureConnection.Edge(node=reading, cursor=encode_cursor(reading))
+            for reading in readings
+        ]
+        return TemperatureConnection(
+            edges=edges,
+            page_info=graphene.relay.PageInfo(
+                has_next_page=has_next_page,
+                has_previous_page=cursor is not None,
+                start_cursor=edges[0].cursor if edges else None,
+                end_cursor=edges[-1].cursor if edges else None,
+            ),
+        )
 
-    def resolve_temperature_statistics(
-        root, info: Any, after: datetime = None, before: datetime = None
+    async def resolve_temperature_statistics(
+        root,
+        info: Any,
+        after: Optional[datetime] = None,
+        before: Optional[datetime] = None,
+        sensor: Optional[str] = None,
     ) -> TemperatureStatisticsNode:
-        query = Temperature.objects.all()
-        if after:
-            query = query.filter(timestamp__gte=after)
-        if before:
-            query = query.filter(timestamp__lte=before)
-        result = query.aggregate(Min("value"), Max("value"))
+        # computed along with the other windows requested by the operation.
+        loader = statistics_loader(info.context)
+        result = await sync_to_async(loader.load)(info, (after, before), sensor)
         return TemperatureStatisticsNode(
-            min=result.get("value__min"), max=result.get("value__max")
+            **{name: result.get(f"value__{name}") for name in STATISTICS}
+        )
+
+    async def resolve_temperature_series(
+        root,
+        info: Any,
+        bucket: TemperatureBucket,
+        after: Optional[datetime] = None,
+        before: Optional[datetime] = None,
+        sensor: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """Return a point per bucket of the window with readings."""
+        return await sync_to_async(temperature_series)(
+            bucket.value, after, before, sensor
         )
 
+    async def resolve_feed_gaps(
+        root,
+        info: Any,
+        after: Optional[datetime] = None,
+        before: Optional[datetime] = None,
+        sensor: Optional[str] = None,
+    ) -> List[FeedGap]:
+        """Return the outages of the feeds overlapping the window, oldest first."""
+        return await sync_to_async(feed_gaps)(after, before, sensor)
+
 
 class ToggleFeedInput(graphene.InputObjectType):
     """Input for ToggleFeed mutation."""
@@ -64,16 +215,16 @@ class ToggleFeed(graphene.Mutation):
 
     status = graphene.String()
 
-    def mutate(root, info: Any, input: ToggleFeedInput) -> "ToggleFeed":
+    async def mutate(root, info: Any, input: ToggleFeedInput) -> "ToggleFeed":
         cleaninput = input.get("status", "").lower()
         if cleaninput not in ("on", "off"):
             raise ValidationError("status must be 'on' or 'off'.")
         # update the db
-        val, _ = ReadConfig.objects.update_or_create(
+        val, _ = await ReadConfig.objects.aupdate_or_create(
             config_key="status", defaults={"config_value": cleaninput}
         )
         # update the cache
-        cache.set("status", cleaninput)
+        await cache.aset("status", cleaninput)
         return ToggleFeed(status=val.config_value)
 
 
@@ -81,4 +232,13 @@ class Mutation(graphene.ObjectType):
     toggle_feed = ToggleFeed.Field()
 
 
-schema = graphene.Schema(query=Query, mutation=Mutation)
+class Subscription(graphene.ObjectType):
+    temperature = graphene.Field(TemperatureType)
+
+    async def subscribe_temperature(root, info: Any) -> AsyncIterator[Temperature]:
+        """Stream the readings as they are persisted, without querying the db."""
+        async for reading in reading_hub.subscribe():
+            yield reading
+
+
+schema = graphene.Schema(query=Query, mutation=Mutation, subscription=Subscription)
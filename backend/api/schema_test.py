@@ -3,11 +3,11 @@ from decimal import Decimal
 import json
 from django.forms import ValidationError
 import pytest
-from unittest.mock import MagicMock, patch
+from unittest.mock import AsyncMock, MagicMock, patch
 from graphene_django.utils.testing import graphql_query
 from django.utils import timezone
 
-from api.models import Temperature, ReadConfig
+from api.models import FeedGap, Temperature, ReadConfig
 
 
 # Constant test data
@@ -40,7 +40,7 @@ def mock_manager():
     # emulate required functions in order to return constant test data
     # current temperature
     mock.order_by.return_value = mock
-    mock.first.return_value = CURRENT_TEMPERATURE
+    mock.afirst = AsyncMock(return_value=CURRENT_TEMPERATURE)
     # statistics
     mock.filter.return_value = mock
     mock.aggregate.return_value = STATS_OUTPUT
@@ -51,14 +51,14 @@ def mock_manager():
 def mock_config_manager():
     """Mock the ReadConfig db manager."""
     mock = MagicMock(spec=ReadConfig.objects)
-    mock.update_or_create.return_value = STATUS_CONFIG, False
+    mock.aupdate_or_create = AsyncMock(return_value=(STATUS_CONFIG, False))
     yield mock
 
 
 @pytest.fixture
 def mock_cache():
     """Mock the cache."""
-    mock = MagicMock()
+    mock = AsyncMock()
     yield mock
 
 
@@ -93,6 +93,89 @@ def test_current_temperature(client_query, mock_manager):
         )
 
 
+def test_current_temperature_from_cache(client_query, mock_manager):
+    """Test that a cached reading is served without querying the db."""
+    with patch(
+        "api.schema.Temperature.objects",
+        mock_manager,
+    ), patch(
+        "api.schema.acached_current_temperature", return_value=CURRENT_TEMPERATURE
+    ):
+        response = client_query(
+            """
+            query {
+                currentTemperature {
+                    timestamp
+                    value
+                }
+            }
+            """
+        )
+
+        content = json.loads(response.content)
+        assert "errors" not in content
+        assert content["data"]["currentTemperature"]["value"] == str(
+            CURRENT_TEMPERATURE.value
+        )
+        mock_manager.order_by.assert_not_called()
+
+
+def test_current_temperature_cache_fill(client_query, mock_manager):
+    """Test that a reading read from the db on a cache miss is cached."""
+    with patch(
+        "api.schema.Temperature.objects",
+        mock_manager,
+    ), patch(
+        "api.schema.acached_current_temperature", return_value=None
+    ), patch(
+        "api.schema.acache_current_temperature"
+    ) as mock_cache_current:
+        response = client_query(
+            """
+            query {
+                currentTemperature {
+                    value
+                }
+            }
+            """
+        )
+
+        content = json.loads(response.content)
+        assert "errors" not in content
+        mock_cache_current.assert_called_once_with(
+            CURRENT_TEMPERATURE, overwrite=False, sensor=None
+        )
+
+
+def test_current_temperature_of_sensor(client_query, mock_manager):
+    """Test that the latest reading of a sensor is read and cached on its own."""
+    with patch(
+        "api.schema.Temperature.objects",
+        mock_manager,
+    ), patch(
+        "api.schema.acached_current_temperature", return_value=None
+    ) as mock_cached_current, patch(
+        "api.schema.acache_current_temperature"
+    ) as mock_cache_current:
+        response = client_query(
+            """
+            query {
+                currentTemperature(sensor: "attic") {
+                    value
+                }
+            }
+            """
+        )
+
+        content = json.loads(response.content)
+        assert "errors" not in content
+        mock_cached_current.assert_called_once_with("attic")
+        mock_manager.filter.assert_called_once_with(sensor="attic")
+        mock_cache_current.assert_called_once_with(
+            CURRENT_TEMPERATURE, overwrite=False, sensor="attic"
+        )
+
+
 @pytest.mark.parametrize(
     "after,before",
     [
@@ -102,11 +185,10 @@ def test_current_temperature(client_query, mock_manager):
         (None, None),
     ],
 )
-def test_temperature_statistics(client_query, mock_manager, after, before):
+def test_temperature_statistics(client_query, after, before):
     with patch(
-        "api.schema.Temperature.objects",
-        mock_manager,
-    ):
+        "api.statistics.compute_statistics", return_value=[STATS_OUTPUT]
+    ) as mock_compute:
         response = client_query(
             """
             query($after:DateTime, $before:DateTime) {
@@ -129,6 +211,256 @@ def test_temperature_statistics(client_query, mock_manager, after, before):
         assert content["data"]["temperatureStatistics"]["max"] == str(
             STATS_OUTPUT["value__max"]
         )
+        mock_compute.assert_called_once_with(
+            [
+                (
+                    after and timezone.datetime.fromisoformat(after),
+                    before and timezone.datetime.fromisoformat(before),
+                )
+            ],
+            ["max", "min"],
+            None,
+        )
+
+
+def test_temperature_statistics_batched(client_query):
+    """Test that the windows of all the aliased fields are computed at once."""
+    day = {"value__min": Decimal(1), "value__max": Decimal(2)}
+    week = {"value__min": Decimal(3), "value__max": Decimal(4)}
+    with patch(
+        "api.statistics.compute_statistics", return_value=[day, week]
+    ) as mock_compute:
+        response = client_query(
+            """
+            query($day:DateTime) {
+                day: temperatureStatistics(after:$day) {
+                    min
+                }
+                sameDay: temperatureStatistics(after:$day) {
+                    max
+                }
+                ...week
+            }
+            fragment week on Query {
+                week: temperatureStatistics(after:"2020-12-01T12:00:00+00:00") {
+                    min
+                    max
+                }
+            }
+            """,
+            variables={"day": "2020-12-07T12:00:00+00:00"},
+        )
+
+        content = json.loads(response.content)
+        assert "errors" not in content
+        assert content["data"] == {
+            "day": {"min": "1"},
+            "sameDay": {"max": "2"},
+            "week": {"min": "3", "max": "4"},
+        }
+        mock_compute.assert_called_once_with(
+            [
+                (timezone.datetime.fromisoformat("2020-12-07T12:00:00+00:00"), None),
+                (timezone.datetime.fromisoformat("2020-12-01T12:00:00+00:00"), None),
+            ],
+            ["max", "min"],
+            None,
+        )
+
+
+def test_temperature_statistics_selected(client_query):
+    """Test that only the selected statistics are computed."""
+    with patch(
+        "api.statistics.compute_statistics",
+        return_value=[{"value__count": 3, "value__p95": Decimal("1.5")}],
+    ) as mock_compute:
+        response = client_query(
+            """
+            query {
+                __typename
+                temperatureStatistics {
+                    count
+                    ... on TemperatureStatisticsNode {
+                        p95
+                    }
+                }
+            }
+            """
+        )
+
+        content = json.loads(response.content)
+        assert "errors" not in content
+        assert content["data"]["temperatureStatistics"] == {
+            "count": 3,
+            "p95": "1.5",
+        }
+        mock_compute.assert_called_once_with([(None, None)], ["count", "p95"], None)
+
+
+def test_temperature_statistics_of_sensors(client_query):
+    """Test that the windows are computed in a pass per sensor."""
+    attic = {"value__min": Decimal(1), "value__max": Decimal(2)}
+    cellar = {"value__min": Decimal(3), "value__max": Decimal(4)}
+    with patch(
+        "api.statistics.compute_statistics", side_effect=[[attic], [cellar]]
+    ) as mock_compute:
+        response = client_query(
+            """
+            query {
+                attic: temperatureStatistics(sensor: "attic") {
+                    min
+                }
+                cellar: temperatureStatistics(sensor: "cellar") {
+                    max
+                }
+            }
+            """
+        )
+
+        content = json.loads(response.content)
+        assert "errors" not in content
+        assert content["data"] == {"attic": {"min": "1"}, "cellar": {"max": "4"}}
+        assert [call.args[2] for call in mock_compute.call_args_list] == [
+            "attic",
+            "cellar",
+        ]
+
+
+def test_temperatures(client_query):
+    """Test that a page of readings is returned with its cursors."""
+    with patch(
+        "api.schema.readings_page", return_value=([CURRENT_TEMPERATURE], True)
+    ) as mock_page, patch("api.schema.encode_cursor", return_value="cursor"):
+        response = client_query(
+            """
+            query($after:DateTime) {
+                temperatures(after:$after, first:1, cursor:"previous") {
+                    edges {
+                        cursor
+                        node {
+                            value
+                        }
+                    }
+                    pageInfo {
+                        hasNextPage
+                        hasPreviousPage
+                        endCursor
+                    }
+                }
+            }
+            """,
+            variables={"after": "2020-12-06T12:00:00+00:00"},
+        )
+
+        content = json.loads(response.content)
+        assert "errors" not in content
+        assert content["data"]["temperatures"] == {
+            "edges": [
+                {
+                    "cursor": "cursor",
+                    "node": {"value": str(CURRENT_TEMPERATURE.value)},
+                }
+            ],
+            "pageInfo": {
+                "hasNextPage": True,
+                "hasPreviousPage": True,
+                "endCursor": "cursor",
+            },
+        }
+        mock_page.assert_called_once_with(
+            timezone.datetime.fromisoformat("2020-12-06T12:00:00+00:00"),
+            None,
+            1,
+            "previous",
+        )
+
+
+def test_temperatures_empty(client_query):
+    with patch("api.schema.readings_page", return_value=([], False)):
+        response = client_query(
+            """
+            query {
+                temperatures {
+                    pageInfo {
+                        hasNextPage
+                        hasPreviousPage
+                        startCursor
+                    }
+                }
+            }
+            """
+        )
+
+        content = json.loads(response.content)
+        assert content["data"]["temperatures"]["pageInfo"] == {
+            "hasNextPage": False,
+            "hasPreviousPage": False,
+            "startCursor": None,
+        }
+
+
+def test_temperature_series(client_query):
+    """Test that the points of the series are returned."""
+    point = {
+        "bucket": CURRENT_TEMPERATURE.timestamp,
+        "count": 2,
+        "min": STATS_OUTPUT["value__min"],
+        "max": STATS_OUTPUT["value__max"],
+        "avg": CURRENT_TEMPERATURE.value,
+    }
+    with patch(
+        "api.schema.temperature_series", return_value=[point]
+    ) as mock_series:
+        response = client_query(
+            """
+            query {
+                temperatureSeries(bucket: HOUR) {
+                    bucket
+                    count
+                    min
+                    max
+                    avg
+                }
+            }
+            """
+        )
+
+        content = json.loads(response.content)
+        assert "errors" not in content
+        assert content["data"]["temperatureSeries"] == [
+            {
+                "bucket": "2022-02-15T12:00:00+00:00",
+                "count": 2,
+                "min": str(point["min"]),
+                "max": str(point["max"]),
+                "avg": str(point["avg"]),
+            }
+        ]
+        mock_series.assert_called_once_with("hour", None, None, None)
+
+
+def test_feed_gaps(client_query):
+    """Test that the outages of the feeds are returned, ongoing ones without end."""
+    gap = FeedGap(sensor="attic", started=CURRENT_TEMPERATURE.timestamp)
+    with patch("api.schema.feed_gaps", return_value=[gap]) as mock_gaps:
+        response = client_query(
+            """
+            query {
+                feedGaps(sensor: "attic") {
+                    sensor
+                    started
+                    ended
+                }
+            }
+            """
+        )
+
+        content = json.loads(response.content)
+        assert "errors" not in content
+        assert content["data"]["feedGaps"] == [
+            {"sensor": "attic", "started": "2022-02-15T12:00:00+00:00", "ended": None}
+        ]
+        mock_gaps.assert_called_once_with(None, None, "attic")
 
 
 def test_toggle_feed_on(client_query, mock_config_manager, mock_cache):
@@ -150,10 +482,10 @@ def test_toggle_feed_on(client_query, mock_config_manager, mock_cache):
         assert "errors" not in content
         assert "status" in content["data"]["toggleFeed"]
         assert content["data"]["toggleFeed"]["status"] == "on"
-        config_manager.update_or_create.assert_called_once_with(
+        config_manager.aupdate_or_create.assert_called_once_with(
             config_key="status", defaults={"config_value": "on"}
         )
-        cache.set.assert_called_once_with("status", "on")
+        cache.aset.assert_called_once_with("status", "on")
 
 
 def test_toggle_feed_bad_input(client_query, mock_config_manager, mock_cache):
@@ -173,5 +505,5 @@ def test_toggle_feed_bad_input(client_query, mock_config_manager, mock_cache):
         )
         content = json.loads(response.content)
         assert "errors" in content
-        config_manager.update_or_create.assert_not_called()
-        cache.set.assert_not_called()
+        config_manager.aupdate_or_create.assert_not_called()
+        cache.aset.assert_not_called()
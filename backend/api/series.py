@@ -0,0 +1,197 @@
+"""Time series of the temperature readings, aggregated per bucket.
+
+A series has one point per minute, hour or day bucket (in UTC) holding the count,
+min, max and average of the readings within the bucket, so that its size depends
+on the number of buckets only. The full buckets of the window are read from the
+rollups of the same resolution, and the partial buckets at its edges are merged
+from the rollups of the finer resolutions and the raw readings of their partial
+minutes. Without rollups, the raw readings are grouped per bucket by the db.
+"""
+from datetime import datetime, timezone
+from decimal import Decimal
+from functools import reduce
+from operator import or_
+from typing import Any, Dict, List, Optional, Tuple
+
+from django.core.exceptions import ValidationError
+from django.db.models import Avg, Count, Max, Min, Q, Sum
+from django.db.models.functions import Trunc
+
+from backend.settings import STATISTICS_FROM_ROLLUPS, TEMPERATURE_SERIES_MAX_BUCKETS
+from api.models import Temperature, TemperatureRollup
+from api.rollups import RAW, TICK, bucket_length, ceil, floor, split_window
+
+VALUE_FIELD = Temperature._meta.get_field("value")
+# point of a series: bucket (start), count, min, max and avg.
+Point = Dict[str, Any]
+
+
+def sensor_scope(sensor: Optional[str]) -> Q:
+    """Filter of the readings or rollups of a sensor, of all of them when None."""
+    return Q() if sensor is None else Q(sensor=sensor)
+
+
+def raw_points(resolution: str, window: Q) -> Dict[datetime, Point]:
+    """Points of the readings matching `window`, grouped by the db."""
+    rows = (
+        Temperature.objects.filter(window)
+        .annotate(bucket=Trunc("timestamp", resolution, tzinfo=timezone.utc))
+        .values("bucket")
+        .annotate(
+            count=Count("id"),
+            min=Min("value"),
+            max=Max("value"),
+            # the average of scaled values must be scaled back by the field.
+            avg=Avg("value", output_field=VALUE_FIELD),
+        )
+        .order_by("bucket")
+    )
+    return {
+        row["bucket"]: {**row, "avg": VALUE_FIELD.normalize(row["avg"])} for row in rows
+    }
+
+
+def rollup_points(
+    resolution: str, start: datetime, end: datetime, sensor: Optional[str] = None
+) -> List[Point]:
+    """Points of the buckets of `resolution` starting within [start, end), merging
+    the rollups of all the sensors when `sensor` is None."""
+    rows = (
+        TemperatureRollup.objects.filter(
+            sensor_scope(sensor),
+            resolution=resolution,
+            bucket__gte=start,
+            bucket__lt=end,
+        )
+        .values("bucket")
+        .annotate(count=Sum("count"), sum=Sum("sum"), min=Min("min"), max=Max("max"))
+        .order_by("bucket")
+    )
+    return [
+        {
+            "bucket": row["bucket"],
+            "count": row["count"],
+            "min": row["min"],
+            "max": row["max"],
+            "avg": VALUE_FIELD.normalize(Decimal(row["sum"]) / row["count"]),
+        }
+        for row in rows
+    ]
+
+
+def stored_bounds(sensor: Optional[str] = None) -> Optional[Tuple[datetime, datetime]]:
+    """Start and (excluded) end of the stored readings, None if there are none.
+
+    With rollups, these are the bounds of the minute rollups, which are kept after
+    the raw readings are dropped by the retention.
+    """
+    if STATISTICS_FROM_ROLLUPS:
+        bounds = TemperatureRollup.objects.filter(
+            sensor_scope(sensor), resolution=TemperatureRollup.MINUTE
+        ).aggregate(first=Min("bucket"), last=Max("bucket"))
+        length = bucket_length(TemperatureRollup.MINUTE)
+    else:
+        bounds = Temperature.objects.filter(sensor_scope(sensor)).aggregate(
+            first=Min("timestamp"), last=Max("timestamp")
+        )
+        length = TICK
+    if bounds["first"] is None:
+        return None
+    return bounds["first"], bounds["last"] + length
+
+
+def edge_point(
+    resolution: str, start: datetime, end: datetime, sensor: Optional[str] = None
+) -> Optional[Point]:
+    """Point of the readings of [start, end), a part of a single bucket.
+
+    The part is covered by the rollups of the finer resolutions, and by the raw
+    readings of its partial minutes only, as for window_statistics.
+    """
+    ranges = split_window(start, end)
+    raw = [
+        Q(timestamp__gte=low, timestamp__lt=high) for r, low, high in ranges if r == RAW
+    ]
+    buckets = [
+        Q(resolution=r, bucket__gte=low, bucket__lt=high)
+        for r, low, high in ranges
+        if r != RAW
+    ]
+    results = []
+    if raw:
+        result = Temperature.objects.filter(
+            sensor_scope(sensor), reduce(or_, raw)
+        ).aggregate(
+            count=Count("id"),
+            min=Min("value"),
+            max=Max("value"),
+            # the sum of scaled values must be scaled back by the field.
+            sum=Sum("value", output_field=VALUE_FIELD),
+        )
+        if result["count"]:
+            results.append(result)
+    if buckets:
+        result = TemperatureRollup.objects.filter(
+            sensor_scope(sensor), reduce(or_, buckets)
+        ).aggregate(count=Sum("count"), sum=Sum("sum"), min=Min("min"), max=Max("max"))
+        if result["count"]:
+            results.append(result)
+    if not results:
+        return None
+    count = sum(result["count"] for result in results)
+    return {
+        "bucket": floor(start, resolution),
+        "count": count,
+        "min": min(result["min"] for result in results),
+        "max": max(result["max"] for result in results),
+        "avg": VALUE_FIELD.normalize(
+            sum(Decimal(result["sum"]) for result in results) / count
+        ),
+    }
+
+
+def temperature_series(
+    resolution: str,
+    after: Optional[datetime] = None,
+    before: Optional[datetime] = None,
+    sensor: Optional[str] = None,
+) -> List[Point]:
+    """Points of the readings between `after` and `before` (both included), of a
+    sensor or of all of them.
+
+    Buckets without readings have no point. At most TEMPERATURE_SERIES_MAX_BUCKETS
+    buckets may be covered by the window.
+    """
+    if after is None or before is None:
+        # bound the window to the stored readings.
+        bounds = stored_bounds(sensor)
+        if bounds is None:
+            return []
+        start = after or bounds[0]
+        end = before + TICK if before else bounds[1]
+    else:
+        start, end = after, before + TICK
+    if start >= end:
+        return []
+    length = bucket_length(resolution)
+    buckets = (floor(end - TICK, resolution) - floor(start, resolution)) // length + 1
+    if buckets > TEMPERATURE_SERIES_MAX_BUCKETS:
+        raise ValidationError(
+            f"the window spans {buckets} buckets, "
+            f"at most {TEMPERATURE_SERIES_MAX_BUCKETS} are allowed."
+        )
+    if not STATISTICS_FROM_ROLLUPS:
+        window = Q(timestamp__gte=start, timestamp__lt=end) & sensor_scope(sensor)
+        return list(raw_points(resolution, window).values())
+    low, high = ceil(start, resolution), floor(end, resolution)
+    if low > high:
+        # the window is within a single bucket.
+        edges = [(start, end)]
+    else:
+        edges = [(start, low), (high, end)]
+    points = rollup_points(resolution, low, high, sensor) if low < high else []
+    for edge_start, edge_end in edges:
+        point = edge_point(resolution, edge_start, edge_end, sensor)
+        if point:
+            points.append(point)
+    return sorted(points, key=lambda point: point["bucket"])
@@ -0,0 +1,150 @@
+"""Unit tests for series.py"""
+from datetime import timedelta, timezone as dt_timezone
+from decimal import Decimal
+import random
+import pytest
+from unittest.mock import patch
+from django.core.exceptions import ValidationError
+from django.utils import timezone
+
+from api.fields import FIXED
+from api.ingest import store_readings
+from api.models import Temperature
+from api.series import temperature_series
+
+
+START = timezone.datetime.fromisoformat("2022-02-01T22:58:30+00:00")
+
+
+def _brute_force(readings, resolution, start, end, sensor=None):
+    lengths = {"minute": 60, "hour": 3600, "day": 86400}
+    points = {}
+    for reading in readings:
+        if not start <= reading.timestamp <= end:
+            continue
+        if sensor is not None and reading.sensor != sensor:
+            continue
+        seconds = reading.timestamp.timestamp() // lengths[resolution]
+        points.setdefault(seconds * lengths[resolution], []).append(reading.value)
+    return [
+        (
+            timezone.datetime.fromtimestamp(bucket, dt_timezone.utc),
+            len(values),
+            min(values),
+            max(values),
+            sum(values) / len(values),
+        )
+        for bucket, values in sorted(points.items())
+    ]
+
+
+def _assert_points(points, expected):
+    assert [
+        (point["bucket"], point["count"], point["min"], point["max"])
+        for point in points
+    ] == [item[:4] for item in expected]
+    # averages are rounded by the db (as floats on sqlite).
+    for point, item in zip(points, expected):
+        assert abs(point["avg"] - item[4]) < Decimal("1e-9")
+
+
+@pytest.fixture
+def readings():
+    """Readings every 10 minutes over 3 days of two sensors, with values exact in
+    binary."""
+    noise = random.Random(12)
+    readings = [
+        Temperature(
+            sensor=("attic", "cellar")[step % 3 == 0],
+            timestamp=START + timedelta(minutes=10 * step, seconds=noise.randrange(60)),
+            value=Decimal(noise.randrange(-160, 160)) / 4,
+        )
+        for step in range(6 * 24 * 3)
+    ]
+    store_readings(readings)
+    return readings
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("resolution", ["minute", "hour", "day"])
+@pytest.mark.parametrize("from_rollups", [True, False])
+@pytest.mark.parametrize("sensor", [None, "cellar"])
+@pytest.mark.parametrize(
+    "after, before",
+    [
+        (timedelta(hours=5, seconds=17), timedelta(days=2, hours=3, seconds=43)),
+        # across a bucket boundary, without any full bucket.
+        (timedelta(minutes=20), timedelta(hours=1, minutes=10)),
+    ],
+)
+def test_series_matches_brute_force(
+    readings, resolution, from_rollups, sensor, after, before
+):
+    """Test that the points from the rollups and the raw readings are the same, for
+    all the sensors or one of them."""
+    after, before = START + after, START + before
+    with patch("api.series.STATISTICS_FROM_ROLLUPS", from_rollups):
+        points = temperature_series(resolution, after, before, sensor)
+    _assert_points(points, _brute_force(readings, resolution, after, before, sensor))
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("resolution", ["minute", "hour", "day"])
+def test_series_whole_history(readings, resolution):
+    points = temperature_series(resolution)
+    _assert_points(
+        points,
+        _brute_force(
+            readings, resolution, readings[0].timestamp, readings[-1].timestamp
+        ),
+    )
+
+
+@pytest.mark.django_db
+def test_series_within_a_bucket(readings):
+    points = temperature_series(
+        "day", START + timedelta(hours=1), START + timedelta(minutes=61)
+    )
+    assert [point["count"] for point in points] == [1]
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("from_rollups", [True, False])
+def test_series_whole_history_dropped(readings, from_rollups):
+    """Test that the unbounded windows are bounded by the rollups, which outlive
+    the raw readings."""
+    Temperature.objects.all().delete()
+    with patch("api.series.STATISTICS_FROM_ROLLUPS", from_rollups):
+        points = temperature_series("day")
+    assert sum(point["count"] for point in points) == (
+        len(readings) if from_rollups else 0
+    )
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("from_rollups", [True, False])
+def test_series_fixed_storage_avg(settings, from_rollups):
+    """Test that the sums and averages of scaled values are scaled back."""
+    settings.TEMPERATURE_VALUE_STORAGE = FIXED
+    store_readings(
+        [
+            Temperature(timestamp=START, value=Decimal("1.5")),
+            Temperature(timestamp=START + timedelta(seconds=1), value=Decimal("2.25")),
+        ]
+    )
+    with patch("api.series.STATISTICS_FROM_ROLLUPS", from_rollups):
+        (point,) = temperature_series("minute", START, START + timedelta(seconds=1))
+    assert point["avg"] == Decimal("1.875")
+
+
+@pytest.mark.django_db
+def test_series_empty():
+    assert temperature_series("hour") == []
+    assert temperature_series("hour", START, START - timedelta(seconds=1)) == []
+
+
+def test_series_too_many_buckets():
+    with patch("api.series.TEMPERATURE_SERIES_MAX_BUCKETS", 60), pytest.raises(
+        ValidationError
+    ):
+        temperature_series("minute", START, START + timedelta(hours=1))
@@ -0,0 +1,228 @@
+"""Batched temperature statistics.
+
+A GraphQL request may ask for the statistics of several windows at once, as
+aliased temperatureStatistics fields. The first of these fields to be resolved
+gathers the windows of all of them from the operation, and they are computed
+together: from memory for the windows within the recent horizon, then with a
+single pass over the rollups, or a single statement over the raw readings when
+the rollups are not used. The other fields then get their results from the
+loader of the request, without any query.
+"""
+from decimal import ROUND_CEILING, ROUND_FLOOR, Decimal
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from django.db.models import Avg, Count, Max, Min, QuerySet, StdDev, Value
+from graphql import GraphQLResolveInfo, get_named_type
+from graphql.execution.collect_fields import collect_fields
+from graphql.execution.values import get_argument_values
+
+from backend.settings import RECENT_READINGS_HORIZON, STATISTICS_FROM_ROLLUPS
+from api.models import Temperature
+from api.recent import recent_readings
+from api.rollups import (
+    MIN_MAX,
+    PERCENTILES,
+    STATISTICS,
+    VALUE_FIELD,
+    Window,
+    windows_statistics,
+)
+
+Statistics = Dict[str, Any]
+# window of the readings of a sensor, or of all of them when None.
+SensorWindow = Tuple[Optional[str], Window]
+
+
+# aggregates of the readings computing the statistics other than percentiles.
+AGGREGATES = {
+    "min": lambda: Min("value"),
+    "max": lambda: Max("value"),
+    "count": lambda: Count("id"),
+    # the scaled values of the fixed storage are scaled back by the field.
+    "avg": lambda: Avg("value", output_field=VALUE_FIELD),
+    "stddev": lambda: StdDev("value", output_field=VALUE_FIELD),
+}
+
+
+def window_readings(window: Window, sensor: Optional[str] = None) -> QuerySet:
+    after, before = window
+    query = Temperature.objects.all()
+    if sensor is not None:
+        query = query.filter(sensor=sensor)
+    if after:
+        query = query.filter(timestamp__gte=after)
+    if before:
+        query = query.filter(timestamp__lte=before)
+    return query
+
+
+def raw_percentiles(
+    query: QuerySet, count: int, fractions: Sequence[Decimal]
+) -> List[Optional[Decimal]]:
+    """Percentiles of the values of `count` readings, interpolated between ranks.
+
+    The values are streamed in order, up to the highest rank needed.
+    """
+    if not count:
+        return [None for _ in fractions]
+    ranks = [fraction * (count - 1) for fraction in fractions]
+    last = int(max(ranks).to_integral_value(rounding=ROUND_CEILING))
+    values = []
+    for value in query.order_by("value").values_list("value", flat=True).iterator():
+        values.append(value)
+        if len(values) > last:
+            break
+    percentiles: List[Optional[Decimal]] = []
+    for rank in ranks:
+        low = int(rank.to_integral_value(rounding=ROUND_FLOOR))
+        high = int(rank.to_integral_value(rounding=ROUND_CEILING))
+        value = values[low] + (rank - low) * (values[high] - values[low])
+        percentiles.append(VALUE_FIELD.normalize(value))
+    return percentiles
+
+
+def raw_statistics(
+    windows: Sequence[Window],
+    names: Iterable[str] = MIN_MAX,
+    sensor: Optional[str] = None,
+) -> List[Statistics]:
+    """Statistics of several windows, with a single statement over the readings.
+
+    The aggregates of the windows are combined with UNION ALL rather than computed
+    as conditional aggregates over their union: each of them is then a range scan
+    of the covering index, as when computed on its own. Percentiles need another
+    pass over the readings of each window, sorted by value.
+    """
+    names = list(names)
+    percentiles = [name for name in names if name in PERCENTILES]
+    aggregated = [name for name in names if name in AGGREGATES]
+    if percentiles and "count" not in aggregated:
+        aggregated.append("count")
+    queries = [
+        window_readings(window, sensor)
+        .annotate(window=Value(i))
+        .values("window")
+        .annotate(**{name: AGGREGATES[name]() for name in aggregated})
+        .values_list("window", *aggregated)
+        for i, window in enumerate(windows)
+    ]
+    rows = queries[0].union(*queries[1:], all=True)
+    results = {row[0]: dict(zip(aggregated, row[1:])) for row in rows}
+    statistics = []
+    for i, window in enumerate(windows):
+        result = results[i]
+        for name in ("avg", "stddev"):
+            if result.get(name) is not None:
+                result[name] = VALUE_FIELD.normalize(result[name])
+        if percentiles:
+            values = raw_percentiles(
+                window_readings(window, sensor),
+                result["count"],
+                [PERCENTILES[name] for name in percentiles],
+            )
+            result.update(zip(percentiles, values))
+        statistics.append({f"value__{name}": result[name] for name in names})
+    return statistics
+
+
+def compute_statistics(
+    windows: Sequence[Window],
+    names: Iterable[str] = MIN_MAX,
+    sensor: Optional[str] = None,
+) -> List[Statistics]:
+    """Statistics of several windows of a sensor, or of all of them, each like the
+    raw aggregate."""
+    names = list(names)
+    results: List[Optional[Statistics]] = [None] * len(windows)
+    if RECENT_READINGS_HORIZON and sensor is None and set(names) <= set(MIN_MAX):
+        # windows within the recent horizon are answered from memory.
+        results = [recent_readings.statistics(*window) for window in windows]
+    pending = [i for i, result in enumerate(results) if result is None]
+    if pending:
+        compute = windows_statistics if STATISTICS_FROM_ROLLUPS else raw_statistics
+        computed = compute([windows[i] for i in pending], names, sensor)
+        for i, result in zip(pending, computed):
+            results[i] = result
+    return [result or {} for result in results]
+
+
+def requested_statistics(
+    info: GraphQLResolveInfo,
+) -> Tuple[List[SensorWindow], List[str]]:
+    """Windows of the fields of the operation resolved like the current one, and
+    the statistics selected by any of them."""
+    fields = collect_fields(
+        info.schema,
+        info.fragments,
+        info.variable_values,
+        info.parent_type,
+        info.operation.selection_set,
+    )
+    definition = info.parent_type.fields[info.field_name]
+    windows = []
+    names: Set[str] = set()
+    for nodes in fields.values():
+        for node in nodes:
+            if node.name.value != info.field_name:
+                continue
+            arguments = get_argument_values(definition, node, info.variable_values)
+            windows.append(
+                (
+                    arguments.get("sensor"),
+                    (arguments.get("after"), arguments.get("before")),
+                )
+            )
+            selected = collect_fields(
+                info.schema,
+                info.fragments,
+                info.variable_values,
+                get_named_type(definition.type),
+                node.selection_set,  # type: ignore
+            )
+            names.update(
+                selection.name.value
+                for selections in selected.values()
+                for selection in selections
+            )
+    return windows, sorted(names & set(STATISTICS))
+
+
+class StatisticsLoader:
+    """Statistics of the windows of a request, computed at once."""
+
+    def __init__(self) -> None:
+        self.results: Dict[SensorWindow, Statistics] = {}
+
+    def load(
+        self, info: GraphQLResolveInfo, window: Window, sensor: Optional[str] = None
+    ) -> Statistics:
+        """Statistics of a window of a sensor, or of all of them, computed along
+        with the requested ones.
+
+        Only the statistics selected by the requested fields are computed, with a
+        pass per requested sensor.
+        """
+        if (sensor, window) not in self.results:
+            windows, names = requested_statistics(info)
+            missing: Dict[Optional[str], Dict[Window, None]] = {}
+            for key in [(sensor, window)] + windows:
+                if key not in self.results:
+                    missing.setdefault(key[0], {})[key[1]] = None
+            for scope, scoped in missing.items():
+                self.results.update(
+                    ((scope, w), result)
+                    for w, result in zip(
+                        scoped, compute_statistics(list(scoped), names, scope)
+                    )
+                )
+        return self.results[(sensor, window)]
+
+
+def statistics_loader(context: Any) -> StatisticsLoader:
+    """Loader of the request of a context, kept along with it."""
+    loader = getattr(context, "statistics_loader", None)
+    if loader is None:
+        loader = StatisticsLoader()
+        if context is not None:
+            context.statistics_loader = loader
+    return loader
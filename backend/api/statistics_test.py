@@ -0,0 +1,228 @@
+"""Unit tests for statistics.py"""
+from datetime import timedelta
+from decimal import Decimal
+import random
+from types import SimpleNamespace
+import pytest
+from unittest.mock import patch
+from django.db import connection
+from django.db.models import Max, Min
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from api.fields import FIXED
+from api.ingest import store_readings
+from api.models import Temperature
+from api.rollups import PERCENTILES, STATISTICS
+from api.statistics import compute_statistics, raw_statistics, statistics_loader
+
+
+START = timezone.datetime.fromisoformat("2022-02-01T22:58:30+00:00")
+WINDOWS = [
+    (START + timedelta(hours=1, seconds=5), START + timedelta(hours=2, seconds=7)),
+    (START + timedelta(minutes=3), START + timedelta(days=1, minutes=17)),
+    (START + timedelta(days=2), None),
+    (None, START + timedelta(hours=5, seconds=40)),
+    (None, None),
+    # no readings.
+    (START - timedelta(days=3), START - timedelta(days=2)),
+]
+
+
+@pytest.fixture
+def readings():
+    noise = random.Random(13)
+    readings = [
+        Temperature(
+            sensor=("north", "south")[step % 2],
+            timestamp=START + timedelta(minutes=7 * step, seconds=noise.randrange(60)),
+            value=Decimal(noise.randrange(-400, 400)) / 100,
+        )
+        for step in range(8 * 24 * 3)
+    ]
+    store_readings(readings)
+    return readings
+
+
+def _brute_force(readings, after, before):
+    values = sorted(
+        reading.value
+        for reading in readings
+        if (after is None or reading.timestamp >= after)
+        and (before is None or reading.timestamp <= before)
+    )
+    if not values:
+        return {"count": 0}
+    count = len(values)
+    mean = sum(values) / count
+    percentiles = {}
+    for name, fraction in PERCENTILES.items():
+        rank = fraction * (count - 1)
+        low = int(rank)
+        high = min(low + 1, count - 1)
+        percentiles[name] = values[low] + (rank - low) * (values[high] - values[low])
+    return {
+        "min": values[0],
+        "max": values[-1],
+        "count": count,
+        "avg": mean,
+        "stddev": (sum((value - mean) ** 2 for value in values) / count).sqrt(),
+        **percentiles,
+    }
+
+
+def _per_window(after, before):
+    query = Temperature.objects.all()
+    if after:
+        query = query.filter(timestamp__gte=after)
+    if before:
+        query = query.filter(timestamp__lte=before)
+    return query.aggregate(Min("value"), Max("value"))
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "from_rollups, windows, queries",
+    [
+        (True, WINDOWS, 3),
+        (True, WINDOWS[:2], 2),
+        (False, WINDOWS, 1),
+        (False, WINDOWS[:2], 1),
+    ],
+)
+def test_batched_match_per_window(readings, from_rollups, windows, queries):
+    """Test that the windows computed at once match the per-window aggregates."""
+    with patch("api.statistics.RECENT_READINGS_HORIZON", 0), patch(
+        "api.statistics.STATISTICS_FROM_ROLLUPS", from_rollups
+    ), CaptureQueriesContext(connection) as captured:
+        results = compute_statistics(windows)
+    assert len(captured) == queries
+    assert results == [_per_window(*window) for window in windows]
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("from_rollups", [True, False])
+def test_sensor_statistics(readings, from_rollups):
+    """Test that the statistics of a sensor only cover its own readings."""
+    with patch("api.statistics.STATISTICS_FROM_ROLLUPS", from_rollups):
+        results = compute_statistics(WINDOWS, ["count", "min", "max"], "north")
+    north = [reading for reading in readings if reading.sensor == "north"]
+    for window, result in zip(WINDOWS, results):
+        expected = _brute_force(north, *window)
+        assert result["value__count"] == expected["count"]
+        assert result["value__min"] == expected.get("min")
+        assert result["value__max"] == expected.get("max")
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "from_rollups, tolerances",
+    [
+        (True, {"avg": "1e-12", "stddev": "1e-12", "p50": "0.1", "p95": "0.1"}),
+        (False, {"avg": "1e-9", "stddev": "1e-9", "p50": "1e-9", "p95": "1e-9"}),
+    ],
+)
+def test_all_statistics(readings, from_rollups, tolerances):
+    """Test the statistics against the brute force ones, percentiles from the
+    rollups being approximated within a sketch bin."""
+    with patch("api.statistics.STATISTICS_FROM_ROLLUPS", from_rollups):
+        results = compute_statistics(WINDOWS, list(STATISTICS))
+    for window, result in zip(WINDOWS, results):
+        expected = _brute_force(readings, *window)
+        assert result["value__count"] == expected["count"]
+        if not expected["count"]:
+            assert result["value__min"] is result["value__p50"] is None
+            continue
+        assert result["value__min"] == expected["min"]
+        assert result["value__max"] == expected["max"]
+        for name, tolerance in tolerances.items():
+            assert abs(result[f"value__{name}"] - expected[name]) <= Decimal(
+                tolerance
+            ), (window, name)
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "names, read, unread",
+    [
+        (["min", "max"], ['"min"', '"max"'], ['"sum"', '"sum_squares"', '"sketch"']),
+        (["avg"], ['"count"', '"sum"'], ['"min"', '"sum_squares"', '"sketch"']),
+        (["p95"], ['"count"', '"sketch"'], ['"sum"', '"sum_squares"']),
+    ],
+)
+def test_only_selected_statistics_read(readings, names, read, unread):
+    """Test that only the rollup columns of the requested statistics are read."""
+    with CaptureQueriesContext(connection) as captured:
+        compute_statistics(WINDOWS[:2], names)
+    sql = captured[-1]["sql"]
+    assert "api_temperaturerollup" in sql
+    assert all(column in sql for column in read)
+    assert not any(column in sql for column in unread)
+
+
+@pytest.mark.django_db
+def test_raw_percentile_only(readings):
+    (result,) = raw_statistics(WINDOWS[:1], ["p50"])
+    assert abs(
+        result["value__p50"] - _brute_force(readings, *WINDOWS[0])["p50"]
+    ) <= Decimal("1e-9")
+
+
+def test_recent_index_only_for_min_max():
+    with patch("api.statistics.recent_readings.statistics") as mock_recent, patch(
+        "api.statistics.windows_statistics", return_value=[{}]
+    ):
+        compute_statistics(WINDOWS[:1], ["min", "avg"])
+    mock_recent.assert_not_called()
+
+
+@pytest.mark.django_db
+def test_raw_statistics_fixed_storage(settings):
+    """Test that the scaled values are scaled back through the union."""
+    settings.TEMPERATURE_VALUE_STORAGE = FIXED
+    store_readings(
+        [
+            Temperature(timestamp=START, value=Decimal("1.5")),
+            Temperature(timestamp=START + timedelta(hours=1), value=Decimal("-2.25")),
+        ]
+    )
+    assert raw_statistics([(START, START), (None, None)]) == [
+        {"value__min": Decimal("1.5"), "value__max": Decimal("1.5")},
+        {"value__min": Decimal("-2.25"), "value__max": Decimal("1.5")},
+    ]
+
+
+@pytest.mark.django_db
+def test_batched_no_rollups():
+    with patch("api.statistics.RECENT_READINGS_HORIZON", 0):
+        assert (
+            compute_statistics(WINDOWS[:3])
+            == [{"value__min": None, "value__max": None}] * 3
+        )
+
+
+def test_recent_windows_from_memory():
+    """Test that only the windows beyond the recent horizon are computed."""
+    recent = {"value__min": Decimal(1), "value__max": Decimal(2)}
+    older = {"value__min": Decimal(3), "value__max": Decimal(4)}
+    with patch(
+        "api.statistics.recent_readings.statistics", side_effect=[None, recent]
+    ), patch("api.statistics.windows_statistics", return_value=[older]) as mock_windows:
+        assert compute_statistics(WINDOWS[:2]) == [older, recent]
+    mock_windows.assert_called_once_with(WINDOWS[:1], ["min", "max"], None)
+
+
+def test_sensor_windows_not_from_memory():
+    """Test that the recent readings of all the sensors don't answer for one."""
+    with patch("api.statistics.recent_readings.statistics") as mock_recent, patch(
+        "api.statistics.windows_statistics", return_value=[{}]
+    ) as mock_windows:
+        compute_statistics(WINDOWS[:1], sensor="north")
+    mock_recent.assert_not_called()
+    mock_windows.assert_called_once_with(WINDOWS[:1], ["min", "max"], "north")
+
+
+def test_statistics_loader_per_context():
+    context = SimpleNamespace()
+    assert statistics_loader(context) is statistics_loader(context)
+    assert statistics_loader(None) is not statistics_loader(None)
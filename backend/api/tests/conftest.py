@@ -5,6 +5,7 @@ import pytest
 from django.utils import timezone
 from graphene_django.utils.testing import graphql_query
 
+from api.ingest import store_readings
 from api.models import Temperature
 
 
@@ -40,4 +41,4 @@ def client_query(client):
 @pytest.fixture(scope="session")
 def django_db_setup(django_db_setup, django_db_blocker):
     with django_db_blocker.unblock():
-        Temperature.objects.bulk_create(SAMPLE)
+        store_readings(SAMPLE)
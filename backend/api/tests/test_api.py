@@ -1,8 +1,11 @@
 """API tests."""
 
+import hashlib
 import pytest
 import json
 from decimal import Decimal
+from unittest.mock import patch
+from django.core.cache.backends.locmem import LocMemCache
 from django.utils import timezone
 
 
@@ -98,3 +101,144 @@ def test_toggle_badstatus(client_query, badstatusvalue):
     )
     content = json.loads(response.content)
     assert "errors" in content
+
+
+@pytest.mark.django_db
+def test_temperatures_pages(client_query):
+    query = """
+        query($first:Int, $cursor:String) {
+            temperatures(first:$first, cursor:$cursor) {
+                edges {
+                    node {
+                        value
+                    }
+                }
+                pageInfo {
+                    hasNextPage
+                    endCursor
+                }
+            }
+        }
+        """
+    values = []
+    cursor = None
+    while True:
+        response = client_query(query, variables={"first": 3, "cursor": cursor})
+        content = json.loads(response.content)
+        assert "errors" not in content
+        page = content["data"]["temperatures"]
+        values.extend(Decimal(edge["node"]["value"]) for edge in page["edges"])
+        if not page["pageInfo"]["hasNextPage"]:
+            break
+        cursor = page["pageInfo"]["endCursor"]
+    assert values == [Decimal(20), Decimal(18.5), Decimal(10), Decimal(-5.5)]
+
+
+@pytest.mark.django_db
+def test_temperatures_page_too_large(client_query):
+    response = client_query(
+        """
+        query {
+            temperatures(first: 100000) {
+                edges {
+                    cursor
+                }
+            }
+        }
+        """
+    )
+    content = json.loads(response.content)
+    assert "errors" in content
+
+
+@pytest.mark.django_db
+def test_temperature_series(client_query):
+    response = client_query(
+        """
+        query {
+            temperatureSeries(bucket: HOUR, after: "2022-02-01T12:30:00+00:00") {
+                bucket
+                count
+                avg
+            }
+        }
+        """
+    )
+    content = json.loads(response.content)
+    assert "errors" not in content
+    assert [
+        (point["bucket"], point["count"], Decimal(point["avg"]))
+        for point in content["data"]["temperatureSeries"]
+    ] == [
+        ("2022-02-01T13:00:00+00:00", 1, Decimal(18.5)),
+        ("2022-02-01T14:00:00+00:00", 1, Decimal(10)),
+        ("2022-02-01T15:00:00+00:00", 1, Decimal(-5.5)),
+    ]
+
+
+@pytest.mark.django_db
+def test_temperature_statistics_moments(client_query):
+    response = client_query(
+        """
+        query {
+            temperatureStatistics(after: "2022-02-01T12:30:00+00:00") {
+                count
+                avg
+                stddev
+                p50
+            }
+        }
+        """
+    )
+    content = json.loads(response.content)
+    assert "errors" not in content
+    statistics = content["data"]["temperatureStatistics"]
+    assert statistics["count"] == 3
+    assert Decimal(statistics["avg"]) == Decimal("7.666666666666667")
+    assert Decimal(statistics["stddev"]) == Decimal("9.935905707192587")
+    # approximated by the middle of the sketch bin of 10.
+    assert Decimal(statistics["p50"]) == Decimal("10.05")
+
+
+@pytest.mark.django_db
+def test_persisted_query(client):
+    query = "query { currentTemperature { value } }"
+    extensions = {
+        "persistedQuery": {
+            "version": 1,
+            "sha256Hash": hashlib.sha256(query.encode()).hexdigest(),
+        }
+    }
+    response = client.get(
+        "http://localhost/graphql", {"extensions": json.dumps(extensions)}
+    )
+    assert json.loads(response.content)["errors"][0]["message"] == (
+        "PersistedQueryNotFound"
+    )
+    response = client.post(
+        "http://localhost/graphql",
+        json.dumps({"query": query, "extensions": extensions}),
+        content_type="application/json",
+    )
+    assert "errors" not in json.loads(response.content)
+    response = client.get(
+        "http://localhost/graphql", {"extensions": json.dumps(extensions)}
+    )
+    content = json.loads(response.content)
+    assert Decimal(content["data"]["currentTemperature"]["value"]) == Decimal(-5.5)
+
+
+@pytest.mark.django_db
+def test_conditional_get(client):
+    params = {
+        "query": 'query { temperatureStatistics(before: "2022-02-01T14:00:00+00:00")'
+        " { min max } }"
+    }
+    with patch("api.caching.cache", LocMemCache("test", {})):
+        response = client.get("http://localhost/graphql", params)
+        assert response.status_code == 200
+        assert "immutable" in response["Cache-Control"]
+        response = client.get(
+            "http://localhost/graphql", params, HTTP_IF_NONE_MATCH=response["ETag"]
+        )
+    assert response.status_code == 304
@@ -0,0 +1,455 @@
+"""Views of the /graphql and /metrics endpoints."""
+import json
+import math
+from inspect import isawaitable
+from typing import Any, Awaitable, Dict, List, Optional, Tuple, TypeVar, Union
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.db import connection, transaction
+from django.http import (
+    HttpRequest,
+    HttpResponse,
+    HttpResponseBadRequest,
+    HttpResponseNotAllowed,
+)
+from django.utils.cache import get_conditional_response, patch_cache_control
+from graphene_django.constants import MUTATION_ERRORS_FLAG
+from graphene_django.settings import graphene_settings
+from graphene_django.views import GraphQLView, HttpError
+from graphql import (
+    DocumentNode,
+    ExecutionResult,
+    OperationType,
+    execute,
+    get_operation_ast,
+    validate_schema,
+)
+from graphql.pyutils import AwaitableOrValue
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+from backend.settings import GRAPHQL_METRICS, IMMUTABLE_RESPONSE_MAX_AGE
+from api.conditional import (
+    UNTAGGED_FIELDS,
+    immutable_operation,
+    response_etag,
+    selects_fields,
+)
+from api.cost import client_address, cost_error, operation_cost, spend_budget
+from api.documents import (
+    PERSISTED_QUERY_NOT_FOUND,
+    document_cache,
+    persist_query,
+    persisted_query,
+    query_hash,
+)
+from api.metrics import (
+    DOCUMENT_SECONDS,
+    ResolverMetricsMiddleware,
+    RootFieldsMiddleware,
+    execution_metrics,
+    measure,
+)
+
+# set on the requests whose execution reported errors.
+EXECUTION_ERRORS_FLAG = "graphql_execution_errors"
+
+Validators = Tuple[Optional[str], bool]
+
+T = TypeVar("T")
+
+
+class CachedGraphQLView(GraphQLView):
+    """GraphQL view serving persisted queries, from cached documents.
+
+    Executes the requests as GraphQLView does, except that the documents are
+    parsed and validated once per query text, and that GET queries are answered
+    with a 304 when their response is unchanged.
+
+    Unless `metrics` is False, the durations of the documents, of the executions
+    and of the root field resolvers are recorded, along with the SQL queries.
+    """
+
+    metrics = GRAPHQL_METRICS
+
+    def __init__(
+        self, *args: Any, metrics: bool = GRAPHQL_METRICS, **kwargs: Any
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self.metrics = metrics
+        if metrics:
+            middleware: List[Any] = getattr(self, "middleware", None) or []
+            self.middleware = RootFieldsMiddleware(
+                self.schema.graphql_schema, ResolverMetricsMiddleware(), *middleware
+            )
+        self.documents = document_cache(
+            self.schema.graphql_schema, self.validation_rules
+        )
+
+    def dispatch(self, request: HttpRequest, *args: Any, **kwargs: Any) -> HttpResponse:
+        validators = self.get_validators(request)
+        response = conditional_response(request, validators)
+        if response is None:
+            response = super().dispatch(request, *args, **kwargs)
+        return tag_response(request, response, validators)
+
+    def get_validators(self, request: HttpRequest) -> Optional[Validators]:
+        """ETag and immutability of the response to a GET query, None if the
+        response is not to be cached."""
+        if request.method != "GET":
+            return None
+        try:
+            data = self.parse_body(request)
+            if self.graphiql and self.can_display_graphiql(request, data):
+                return None
+            query, variables, operation_name, _ = self.get_graphql_params(request, data)
+        except HttpError:
+            # reported by the execution.
+            return None
+        if not query:
+            return None
+        document, errors = self.documents.document(query)
+        if document is None or errors:
+            return None
+        operation = get_operation_ast(document, operation_name)
+        if operation is None or operation.operation != OperationType.QUERY:
+            return None
+        if selects_fields(document, UNTAGGED_FIELDS):
+            return None
+        immutable = immutable_operation(
+            self.schema.graphql_schema, document, operation_name, variables
+        )
+        etag = response_etag(query, variables, operation_name)
+        if etag is None and not immutable:
+            return None
+        return etag, immutable
+
+    def get_graphql_params(  # type: ignore[override]
+        self, request: HttpRequest, data: Dict[str, Any]
+    ) -> Tuple[Optional[str], Any, Optional[str], Any]:
+        """Parameters of the request, the query being looked up by its hash if it
+        is persisted, or persisted along with its hash otherwise."""
+        query, variables, operation_name, id = super().get_graphql_params(request, data)
+        extensions = request.GET.get("extensions") or data.get("extensions")
+        if extensions and isinstance(extensions, str):
+            try:
+                extensions = json.loads(extensions)
+            except ValueError:
+                raise HttpError(HttpResponseBadRequest("Extensions are invalid JSON."))
+        persisted = (extensions or {}).get("persistedQuery")
+        if not persisted:
+            return query, variables, operation_name, id
+        sha256 = persisted.get("sha256Hash")
+        if persisted.get("version") != 1 or not sha256:
+            raise HttpError(HttpResponseBadRequest("Unsupported persisted query."))
+        if query:
+            if query_hash(query) != sha256:
+                raise HttpError(
+                    HttpResponseBadRequest("Provided sha does not match query.")
+                )
+            persist_query(sha256, query)
+        else:
+            query = persisted_query(sha256)
+            if query is None:
+                # asks the client to send the query along with its hash.
+                raise HttpError(HttpResponseBadRequest(PERSISTED_QUERY_NOT_FOUND))
+        return query, variables, operation_name, id
+
+    def get_document(
+        self, request: HttpRequest, query: Optional[str], operation_name: Optional[str]
+    ) -> Union[DocumentNode, ExecutionResult]:
+        """Validated document of a query, or the result reporting its errors."""
+        # GraphiQL is rendered by dispatch, without executing the query.
+        if not query:
+            raise HttpError(HttpResponseBadRequest("Must provide query string."))
+
+        schema_validation_errors = validate_schema(self.schema.graphql_schema)
+        if schema_validation_errors:
+            return ExecutionResult(data=None, errors=schema_validation_errors)
+
+        document, errors = self.documents.document(query)
+        if document is None:
+            return ExecutionResult(errors=errors)
+
+        operation_ast = get_operation_ast(document, operation_name)
+        if (
+            request.method.lower() == "get"  # type: ignore
+            and operation_ast is not None
+            and operation_ast.operation != OperationType.QUERY
+        ):
+            raise HttpError(
+                HttpResponseNotAllowed(
+                    ["POST"],
+                    "Can only perform a {} operation from a POST request.".format(
+                        operation_ast.operation.value
+                    ),
+                )
+            )
+        if errors:
+            return ExecutionResult(data=None, errors=errors)
+        return document
+
+    def check_cost(
+        self,
+        request: HttpRequest,
+        document: DocumentNode,
+        variables: Any,
+        operation_name: Optional[str],
+    ) -> Optional[ExecutionResult]:
+        """Result rejecting a query costing more than QUERY_MAX_COST, None if it is
+        to be executed.
+
+        Raises:
+            HttpError: a 429 if the client has exceeded its budget
+        """
+        cost = operation_cost(
+            self.schema.graphql_schema, document, operation_name, variables
+        )
+        error = cost_error(cost)
+        if error is not None:
+            return ExecutionResult(errors=[error])
+        retry_after = spend_budget(client_address(request), cost)
+        if retry_after:
+            response = HttpResponse(status=429)
+            response["Retry-After"] = str(math.ceil(retry_after))
+            raise HttpError(response, "Query budget exceeded, retry later.")
+        return None
+
+    def is_atomic(self, document: DocumentNode, operation_name: Optional[str]) -> bool:
+        """Whether the operation is a mutation to run in a transaction."""
+        operation_ast = get_operation_ast(document, operation_name)
+        return (
+            operation_ast is not None
+            and operation_ast.operation == OperationType.MUTATION
+            and (
+                graphene_settings.ATOMIC_MUTATIONS is True
+                or connection.settings_dict.get("ATOMIC_MUTATIONS", False) is True
+            )
+        )
+
+    def execute_document(
+        self,
+        request: HttpRequest,
+        document: DocumentNode,
+        variables: Any,
+        operation_name: Optional[str],
+    ) -> AwaitableOrValue[ExecutionResult]:
+        execute_options: Dict[str, Any] = {
+            "root_value": self.get_root_value(request),
+            "context_value": self.get_context(request),
+            "variable_values": variables,
+            "operation_name": operation_name,
+            "middleware": self.get_middleware(request),
+        }
+        if self.execution_context_class:
+            execute_options["execution_context_class"] = self.execution_context_class
+        return execute(self.schema.graphql_schema, document, **execute_options)
+
+    def execute_sync(
+        self,
+        request: HttpRequest,
+        document: DocumentNode,
+        variables: Any,
+        operation_name: Optional[str],
+    ) -> ExecutionResult:
+        """Execute a document from a sync context, the async resolvers in an event
+        loop, the db queries in the current thread."""
+        result = self.execute_document(request, document, variables, operation_name)
+        if isawaitable(result):
+            result = async_to_sync(awaited)(result)
+        return result  # type: ignore
+
+    def execute_atomic(
+        self,
+        request: HttpRequest,
+        document: DocumentNode,
+        variables: Any,
+        operation_name: Optional[str],
+    ) -> ExecutionResult:
+        with transaction.atomic():
+            result = self.execute_sync(request, document, variables, operation_name)
+            if getattr(request, MUTATION_ERRORS_FLAG, False) is True:
+                transaction.set_rollback(True)
+        return result
+
+    def execute_graphql_request(
+        self,
+        request: HttpRequest,
+        data: Dict[str, Any],
+        query: Optional[str],
+        variables: Any,
+        operation_name: Optional[str],
+        show_graphiql: bool = False,
+    ) -> Optional[ExecutionResult]:
+        with measure(DOCUMENT_SECONDS, self.metrics):
+            document = self.get_document(request, query, operation_name)
+        if isinstance(document, ExecutionResult):
+            return document
+        rejected = self.check_cost(request, document, variables, operation_name)
+        if rejected is not None:
+            return rejected
+        try:
+            with execution_metrics(self.metrics):
+                if self.is_atomic(document, operation_name):
+                    result = self.execute_atomic(
+                        request, document, variables, operation_name
+                    )
+                else:
+                    result = self.execute_sync(
+                        request, document, variables, operation_name
+                    )
+        except Exception as e:
+            result = ExecutionResult(errors=[e])  # type: ignore
+        return flag_errors(request, result)
+
+
+class AsyncGraphQLView(CachedGraphQLView):
+    """CachedGraphQLView executing the queries in the event loop, when served by
+    ASGI: a request only holds a thread while it runs db queries, or reads the
+    persisted queries, parses its document and spends its budget in the caches.
+
+    Batches, GraphiQL and the requests which can't be parsed are served by the
+    sync view, as well as the mutations run in a transaction, which is bound to
+    a thread.
+    """
+
+    view_is_async = True
+
+    async def dispatch(  # type: ignore[override]
+        self, request: HttpRequest, *args: Any, **kwargs: Any
+    ) -> HttpResponse:
+        try:
+            data = self.parse_body(request)
+        except HttpError:
+            data = None
+        if (
+            data is None
+            or request.method not in ("GET", "POST")
+            or self.batch
+            or (self.graphiql and self.can_display_graphiql(request, data))
+        ):
+            return await sync_to_async(super().dispatch)(request, *args, **kwargs)
+        validators = None
+        if request.method == "GET":
+            validators = await sync_to_async(self.get_validators)(request)
+        response = conditional_response(request, validators)
+        if response is None:
+            try:
+                content, status_code = await self.get_response_async(request, data)
+            except HttpError as e:
+                response = e.response
+                response["Content-Type"] = "application/json"
+                response.content = self.json_encode(
+                    request, {"errors": [self.format_error(e)]}
+                )
+                return response
+            response = HttpResponse(
+                status=status_code, content=content, content_type="application/json"
+            )
+        return tag_response(request, response, validators)
+
+    async def get_response_async(
+        self, request: HttpRequest, data: Dict[str, Any]
+    ) -> Tuple[str, int]:
+        """Response content and status of a request, as GraphQLView.get_response
+        (ATOMIC_REQUESTS does not apply to async views)."""
+        query, variables, operation_name, _ = await sync_to_async(
+            self.get_graphql_params, thread_sensitive=False
+        )(request, data)
+        result = await self.execute_graphql_request_async(
+            request, query, variables, operation_name
+        )
+        status_code = 200
+        response: Dict[str, Any] = {}
+        if result.errors:
+            response["errors"] = [self.format_error(e) for e in result.errors]
+        if result.errors and any(not getattr(e, "path", None) for e in result.errors):
+            status_code = 400
+        else:
+            response["data"] = result.data
+        return self.json_encode(request, response), status_code
+
+    async def execute_graphql_request_async(
+        self,
+        request: HttpRequest,
+        query: Optional[str],
+        variables: Any,
+        operation_name: Optional[str],
+    ) -> ExecutionResult:
+        # neither the caches nor the parsing touch the db: off the ORM thread.
+        with measure(DOCUMENT_SECONDS, self.metrics):
+            document = await sync_to_async(self.get_document, thread_sensitive=False)(
+                request, query, operation_name
+            )
+        if isinstance(document, ExecutionResult):
+            return document
+        rejected = await sync_to_async(self.check_cost, thread_sensitive=False)(
+            request, document, variables, operation_name
+        )
+        if rejected is not None:
+            return rejected
+        try:
+            with execution_metrics(self.metrics):
+                if self.is_atomic(document, operation_name):
+                    result = await sync_to_async(self.execute_atomic)(
+                        request, document, variables, operation_name
+                    )
+                else:
+                    executed = self.execute_document(
+                        request, document, variables, operation_name
+                    )
+                    result = await executed if isawaitable(executed) else executed
+        except Exception as e:
+            result = ExecutionResult(errors=[e])  # type: ignore
+        return flag_errors(request, result)
+
+
+async def awaited(awaitable: Awaitable[T]) -> T:
+    return await awaitable
+
+
+def flag_errors(request: HttpRequest, result: ExecutionResult) -> ExecutionResult:
+    if result and result.errors:
+        setattr(request, EXECUTION_ERRORS_FLAG, True)
+    return result
+
+
+def conditional_response(
+    request: HttpRequest, validators: Optional[Validators]
+) -> Optional[HttpResponse]:
+    """304 response to a request whose response is unchanged, if any."""
+    if validators is None or validators[0] is None:
+        return None
+    return get_conditional_response(request, etag=validators[0])
+
+
+def tag_response(
+    request: HttpRequest, response: HttpResponse, validators: Optional[Validators]
+) -> HttpResponse:
+    """Set the validators and the cache policy of a successful response."""
+    if validators is None:
+        return response
+    if response.status_code != 304 and (
+        response.status_code != 200 or getattr(request, EXECUTION_ERRORS_FLAG, False)
+    ):
+        return response
+    etag, immutable = validators
+    if etag is not None:
+        response["ETag"] = etag
+    if immutable:
+        patch_cache_control(
+            response, public=True, max_age=IMMUTABLE_RESPONSE_MAX_AGE, immutable=True
+        )
+    else:
+        # may be stored, provided it is revalidated.
+        patch_cache_control(response, no_cache=True)
+    # the response only depends on the URL and on the Accept header (GraphiQL):
+    # drop the CSRF cookie, for the response to be shared by the proxy.
+    response.cookies.pop(settings.CSRF_COOKIE_NAME, None)
+    response["Vary"] = "Accept"
+    return response
+
+
+def metrics(request: HttpRequest) -> HttpResponse:
+    """Metrics of the process, in the Prometheus text format."""
+    return HttpResponse(generate_latest(), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,394 @@
+"""Unit tests for views.py"""
+import asyncio
+from datetime import timedelta
+from decimal import Decimal
+import json
+import pytest
+from unittest.mock import patch
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.urls import path
+from django.views.decorators.csrf import csrf_exempt
+from django.utils import timezone
+from graphene_django.constants import MUTATION_ERRORS_FLAG
+from graphql import ExecutionResult, parse
+from prometheus_client import REGISTRY
+
+from api.cost import spend_budget
+from api.documents import (
+    DocumentCache,
+    document_caches,
+    persist_query,
+    persisted_queries,
+    persisted_query,
+    query_hash,
+)
+from api.ingest import load_readings, store_readings
+from api.models import Temperature
+from api.partitions import apply_retention
+from api.schema import schema
+from api.views import AsyncGraphQLView, CachedGraphQLView, metrics
+
+
+QUERY = "{ feedStatus: __typename }"
+MUTATION = 'mutation { toggleFeed(input: {status: "on"}) { status } }'
+PAST = timezone.datetime.fromisoformat("2022-02-15T11:00:00+00:00")
+
+urlpatterns = [
+    path(
+        "graphql", csrf_exempt(AsyncGraphQLView.as_view(graphiql=True, schema=schema))
+    ),
+    path(
+        "sync/graphql",
+        csrf_exempt(CachedGraphQLView.as_view(graphiql=True, schema=schema)),
+    ),
+    path("metrics", metrics),
+]
+pytestmark = pytest.mark.urls("api.views_test")
+
+
+@pytest.fixture(params=["/graphql", "/sync/graphql"])
+def graphql_url(request):
+    """URL of the async and sync views."""
+    return request.param
+
+
+@pytest.fixture(autouse=True)
+def local_cache():
+    """Replace the shared cache with a local memory one, starting without any
+    cached document or persisted query."""
+    local = LocMemCache("test", {})
+    with patch("api.documents.cache", local), patch("api.caching.cache", local):
+        yield local
+    local.clear()
+    caches["budget"].clear()
+    persisted_queries.clear()
+    document_caches.clear()
+
+
+def _post(client, graphql_url, **body):
+    response = client.post(
+        graphql_url, json.dumps(body), content_type="application/json"
+    )
+    return response.status_code, json.loads(response.content)
+
+
+def _persisted(query):
+    return {"persistedQuery": {"version": 1, "sha256Hash": query_hash(query)}}
+
+
+def test_query_parsed_once(client, graphql_url):
+    """Test that the document is cached across requests, served by distinct views."""
+    with patch("api.documents.parse", wraps=parse) as mock_parse:
+        for _ in range(2):
+            assert _post(client, graphql_url, query=QUERY) == (
+                200,
+                {"data": {"feedStatus": "Query"}},
+            )
+    mock_parse.assert_called_once_with(QUERY)
+
+
+@pytest.mark.django_db
+def test_persisted_query(client, graphql_url):
+    """Test the automatic persisted queries flow: an unknown hash is reported, then
+    registered along with its query, then served by its hash alone."""
+    status, content = _post(client, graphql_url, extensions=_persisted(QUERY))
+    assert status == 400
+    assert content["errors"][0]["message"] == "PersistedQueryNotFound"
+    assert _post(client, graphql_url, query=QUERY, extensions=_persisted(QUERY)) == (
+        200,
+        {"data": {"feedStatus": "Query"}},
+    )
+    assert _post(client, graphql_url, extensions=_persisted(QUERY)) == (
+        200,
+        {"data": {"feedStatus": "Query"}},
+    )
+    response = client.get(graphql_url, {"extensions": json.dumps(_persisted(QUERY))})
+    assert json.loads(response.content) == {"data": {"feedStatus": "Query"}}
+
+
+@pytest.mark.django_db
+def test_async_view_cache_off_loop(client):
+    """Test that the async view reads and writes the caches outside the event loop."""
+    in_loop = []
+    extensions = _persisted(QUERY)
+
+    def off_loop(function):
+        def wrapper(*args, **kwargs):
+            try:
+                asyncio.get_running_loop()
+                in_loop.append(function.__name__)
+            except RuntimeError:
+                pass
+            return function(*args, **kwargs)
+
+        wrapper.__name__ = function.__name__
+        return wrapper
+
+    with patch("api.views.persist_query", off_loop(persist_query)), patch(
+        "api.views.persisted_query", off_loop(persisted_query)
+    ), patch("api.views.spend_budget", off_loop(spend_budget)), patch.object(
+        DocumentCache, "document", off_loop(DocumentCache.document)
+    ):
+        for query in (QUERY, None):
+            status, _ = _post(client, "/graphql", query=query, extensions=extensions)
+            assert status == 200
+    assert in_loop == []
+
+
+@pytest.mark.parametrize(
+    "extensions, message",
+    [
+        ({"persistedQuery": {"version": 1, "sha256Hash": "0" * 64}}, "Provided sha"),
+        ({"persistedQuery": {"version": 2, "sha256Hash": "0" * 64}}, "Unsupported"),
+        ("{not json", "Extensions are invalid JSON"),
+    ],
+)
+def test_persisted_query_invalid(client, graphql_url, extensions, message):
+    status, content = _post(client, graphql_url, query=QUERY, extensions=extensions)
+    assert status == 400
+    assert content["errors"][0]["message"].startswith(message)
+
+
+def test_invalid_queries(client, graphql_url):
+    status, content = _post(client, graphql_url, query="{ oops ")
+    assert status == 400 and "Syntax Error" in content["errors"][0]["message"]
+    status, content = _post(client, graphql_url, query="{ unknownField }")
+    assert status == 400 and "unknownField" in content["errors"][0]["message"]
+    status, content = _post(client, graphql_url)
+    assert status == 400 and content["errors"][0]["message"] == (
+        "Must provide query string."
+    )
+
+
+def test_graphiql(client, graphql_url):
+    response = client.get(graphql_url, HTTP_ACCEPT="text/html")
+    assert response.status_code == 200 and b"graphiql" in response.content.lower()
+
+
+def test_mutation_from_get(client, graphql_url):
+    response = client.get(graphql_url, {"query": MUTATION})
+    assert response.status_code == 405
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("atomic", [False, True])
+def test_mutation(client, graphql_url, atomic):
+    with patch("api.views.graphene_settings.ATOMIC_MUTATIONS", atomic):
+        assert _post(client, graphql_url, query=MUTATION) == (
+            200,
+            {"data": {"toggleFeed": {"status": "on"}}},
+        )
+
+
+@pytest.mark.django_db
+def test_mutation_errors_rolled_back(client, graphql_url):
+    def execute(schema, document, **options):
+        setattr(options["context_value"], MUTATION_ERRORS_FLAG, True)
+        return ExecutionResult(data={"toggleFeed": None})
+
+    with patch("api.views.graphene_settings.ATOMIC_MUTATIONS", True), patch(
+        "api.views.execute", side_effect=execute
+    ), patch("api.views.transaction.set_rollback") as mock_rollback:
+        client.post(graphql_url, {"query": MUTATION})
+    mock_rollback.assert_called_once_with(True)
+
+
+def test_schema_validation_errors(client, graphql_url):
+    with patch("api.views.validate_schema", return_value=["invalid"]), patch(
+        "api.views.CachedGraphQLView.format_error", return_value="invalid"
+    ):
+        assert _post(client, graphql_url, query=QUERY) == (400, {"errors": ["invalid"]})
+
+
+def test_execution_error(client, graphql_url):
+    with patch("api.views.execute", side_effect=Exception("boom")):
+        assert _post(client, graphql_url, query=QUERY) == (
+            400,
+            {"errors": [{"message": "boom"}]},
+        )
+
+
+def test_execution_context_class(client, graphql_url):
+    with patch("api.views.CachedGraphQLView.execution_context_class", "context"), patch(
+        "api.views.execute", return_value=ExecutionResult(data={})
+    ) as mock_execute:
+        client.post(graphql_url, {"query": QUERY})
+    assert mock_execute.call_args.kwargs["execution_context_class"] == "context"
+
+
+@pytest.mark.django_db
+def test_conditional_get(
+    client, graphql_url, local_cache, django_capture_on_commit_callbacks
+):
+    """Test that a GET query is answered with a 304 until a reading is persisted."""
+    query = {"query": "{ currentTemperature { value } }"}
+    response = client.get(graphql_url, query)
+    etag = response["ETag"]
+    assert etag.startswith('W/"')
+    assert response["Cache-Control"] == "no-cache"
+    assert response["Vary"] == "Accept"
+    assert "csrftoken" not in response.cookies
+    response = client.get(graphql_url, query, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304 and response["ETag"] == etag
+    with django_capture_on_commit_callbacks(execute=True):
+        store_readings([Temperature(timestamp=PAST, value=Decimal("1.5"))])
+    response = client.get(graphql_url, query, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200 and response["ETag"] != etag
+    content = json.loads(response.content)
+    assert Decimal(content["data"]["currentTemperature"]["value"]) == Decimal("1.5")
+    assert "Last-Modified" not in response
+
+
+@pytest.mark.django_db
+def test_conditional_get_past_window(
+    client, graphql_url, local_cache, django_capture_on_commit_callbacks
+):
+    """Test that the response to a past window is cacheable by the proxy, and that
+    it is revalidated once expired, as it changes with a backfill, then with the
+    retention."""
+    window = f'after: "{PAST - timedelta(hours=1)}", before: "{PAST}"'
+    query = {"query": f"{{ temperatureStatistics({window}) {{ max }} }}"}
+    response = client.get(graphql_url, query)
+    assert response["Cache-Control"] == "public, max-age=86400, immutable"
+    etag = response["ETag"]
+    with patch("api.views.execute") as mock_execute:
+        response = client.get(graphql_url, query, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+    mock_execute.assert_not_called()
+    with django_capture_on_commit_callbacks(execute=True):
+        load_readings([Temperature(timestamp=PAST, value=Decimal("1.5"))])
+    response = client.get(graphql_url, query, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200 and response["ETag"] != etag
+    content = json.loads(response.content)
+    assert Decimal(content["data"]["temperatureStatistics"]["max"]) == Decimal("1.5")
+    etag = response["ETag"]
+    with django_capture_on_commit_callbacks(execute=True):
+        apply_retention(PAST + timedelta(days=1))
+    response = client.get(graphql_url, query, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200 and response["ETag"] != etag
+
+
+@pytest.mark.django_db
+def test_conditional_get_without_cache(client, graphql_url):
+    """Test that the responses are not tagged without a shared cache to keep the
+    data version, those to the past windows being still cacheable."""
+    with patch("api.caching.cache", DummyCache("dummy", {})):
+        query = {"query": "{ currentTemperature { value } }"}
+        response = client.get(graphql_url, query)
+        assert "ETag" not in response and "Cache-Control" not in response
+        window = f'before: "{PAST}"'
+        query = {"query": f"{{ temperatureStatistics({window}) {{ max }} }}"}
+        response = client.get(graphql_url, query)
+    assert "ETag" not in response
+    assert response["Cache-Control"] == "public, max-age=86400, immutable"
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "params",
+    [
+        {
+            "query": "{ temperatureSeries(bucket: MINUTE, "
+            f'after: "{PAST.isoformat()}", before: "{timezone.now().isoformat()}") '
+            "{ min } }"
+        },
+        {"query": "{ unknownField }"},
+        {"query": "{ oops "},
+        {"query": MUTATION},
+        {"query": QUERY, "variables": "{not json"},
+        {},
+    ],
+)
+def test_conditional_get_errors_not_tagged(client, graphql_url, params):
+    """Test that responses with errors, even partial ones, are not cacheable."""
+    with patch("api.series.TEMPERATURE_SERIES_MAX_BUCKETS", 1):
+        response = client.get(graphql_url, params)
+    assert "ETag" not in response and "Cache-Control" not in response
+
+
+def test_conditional_post_not_tagged(client, graphql_url):
+    response = client.post(graphql_url, {"query": QUERY})
+    assert response.status_code == 200 and "ETag" not in response
+
+
+@pytest.mark.django_db
+def test_feed_gaps_not_tagged(client, graphql_url):
+    """Test that the outages, which change without any new reading, are not
+    cacheable."""
+    query = "{ ...Gaps } fragment Gaps on Query { feedGaps { started ended } }"
+    response = client.get(graphql_url, {"query": query})
+    assert response.json() == {"data": {"feedGaps": []}}
+    assert "ETag" not in response
+
+
+def test_query_over_max_cost(client, graphql_url):
+    """Test that a document costing too much is rejected before its execution."""
+    query = "{ a: currentTemperature { value } b: currentTemperature { value } }"
+    with patch("api.cost.QUERY_MAX_COST", 1), patch(
+        "api.schema.Query.resolve_current_temperature"
+    ) as mock_resolve:
+        assert _post(client, graphql_url, query=query) == (
+            400,
+            {"errors": [{"message": "Query cost 2 exceeds the maximum of 1."}]},
+        )
+    mock_resolve.assert_not_called()
+
+
+@pytest.mark.django_db
+def test_query_over_budget(client, graphql_url):
+    """Test that a client over its budget is throttled, but not the others."""
+    query = "{ currentTemperature { value } }"
+    with patch("api.cost.QUERY_COST_BUDGET", 2):
+        # introspection is free.
+        assert _post(client, graphql_url, query=QUERY)[0] == 200
+        for _ in range(2):
+            assert _post(client, graphql_url, query=query)[0] == 200
+        response = client.post(
+            graphql_url,
+            json.dumps({"query": query}),
+            content_type="application/json",
+        )
+        assert response.status_code == 429
+        assert 0 < int(response["Retry-After"]) <= 60
+        assert json.loads(response.content) == {
+            "errors": [{"message": "Query budget exceeded, retry later."}]
+        }
+        response = client.post(
+            graphql_url,
+            json.dumps({"query": query}),
+            content_type="application/json",
+            REMOTE_ADDR="10.0.0.2",
+        )
+        assert response.status_code == 200
+
+
+@pytest.mark.django_db
+def test_graphql_metrics(client, graphql_url):
+    """Test that the resolvers and the SQL queries of a request are measured"""
+    query = "{ currentTemperature { value } }"
+    queries = REGISTRY.get_sample_value("graphql_sql_queries_sum")
+    assert _post(client, graphql_url, query=query)[0] == 200
+    # the latest reading, read from the db in the thread of the ORM.
+    assert REGISTRY.get_sample_value("graphql_sql_queries_sum") == queries + 1
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response["Content-Type"].startswith("text/plain")
+    content = response.content.decode()
+    assert 'graphql_resolver_seconds_count{field="Query.currentTemperature"}' in content
+    assert "graphql_document_seconds_count" in content
+    assert "graphql_sql_queries_count" in content
+
+
+def test_graphiql_not_tagged(client, graphql_url):
+    response = client.get(graphql_url, {"query": QUERY}, HTTP_ACCEPT="text/html")
+    assert "ETag" not in response
+
+
+def test_invalid_body(client, graphql_url):
+    response = client.post(graphql_url, "{not json", content_type="application/json")
+    assert response.status_code == 400
+    assert json.loads(response.content)["errors"][0]["message"] == (
+        "POST body sent invalid JSON."
+    )
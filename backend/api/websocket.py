@@ -0,0 +1,407 @@
+"""GraphQL over websockets, as an ASGI application.
+
+Both the graphql-transport-ws protocol and the legacy graphql-ws one (from
+subscriptions-transport-ws) are supported. Subscriptions stream their results
+until completed by either side, queries and mutations get a single result.
+Clients running the same subscription share its execution: each result is
+computed and serialized once, whatever the number of clients. A subscription whose
+source fails ends with an error message to each of its clients. Queries are checked
+against their maximum cost and charged to the budget of the client, as over HTTP.
+"""
+import asyncio
+from inspect import isawaitable
+import json
+import math
+from types import SimpleNamespace
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    MutableMapping,
+    Optional,
+    Set,
+    Union,
+)
+
+from asgiref.sync import sync_to_async
+from graphene import Schema
+from graphql import (
+    DocumentNode,
+    ExecutionResult,
+    GraphQLError,
+    OperationType,
+    execute,
+    located_error,
+)
+from graphql.utilities import get_operation_ast
+
+from backend.settings import GRAPHQL_METRICS, SUBSCRIPTION_QUEUE_SIZE
+from api.cost import cost_error, operation_cost, scope_address, spend_budget
+from api.documents import document_cache
+from api.metrics import (
+    DOCUMENT_SECONDS,
+    ResolverMetricsMiddleware,
+    RootFieldsMiddleware,
+    execution_metrics,
+    measure,
+)
+
+Scope = MutableMapping[str, Any]
+Receive = Callable[[], Awaitable[Dict[str, Any]]]
+Send = Callable[[Dict[str, Any]], Awaitable[None]]
+
+GRAPHQL_TRANSPORT_WS = "graphql-transport-ws"
+GRAPHQL_WS = "graphql-ws"
+# server message types, per protocol.
+MESSAGES = {
+    GRAPHQL_TRANSPORT_WS: {"result": "next", "error": "error"},
+    GRAPHQL_WS: {"result": "data", "error": "error"},
+}
+# close codes of graphql-transport-ws.
+UNAUTHORIZED = 4401
+SUBSCRIBER_EXISTS = 4409
+
+
+class SharedSubscription:
+    """Subscription operation executed once for all the clients which run it.
+
+    Each result is serialized once and handed to the queue of every client, which
+    holds at most `queue_size` results and drops the oldest one when full: slow
+    clients skip results instead of holding the others back. If the results fail,
+    `errors` holds the serialized errors once the queues are ended, and `done` is
+    set as they are.
+    """
+
+    def __init__(
+        self, results: AsyncIterator[ExecutionResult], queue_size: int
+    ) -> None:
+        self.queue_size = max(queue_size, 1)
+        self.queues: Set["asyncio.Queue[Optional[str]]"] = set()
+        self.dropped = 0
+        self.errors: Optional[str] = None
+        self.done = False
+        self.task = asyncio.create_task(self.broadcast(results))
+
+    def join(self) -> "asyncio.Queue[Optional[str]]":
+        """Queue of the serialized results, None once there are no more."""
+        queue: "asyncio.Queue[Optional[str]]" = asyncio.Queue(maxsize=self.queue_size)
+        if self.done:
+            # the queues are already ended.
+            queue.put_nowait(None)
+        else:
+            self.queues.add(queue)
+        return queue
+
+    def leave(self, queue: "asyncio.Queue[Optional[str]]") -> bool:
+        """Remove a queue, and stop the operation if it was the last one.
+
+        Returns:
+            bool: True if the operation is stopped
+        """
+        self.queues.discard(queue)
+        if not self.queues:
+            self.task.cancel()
+        return not self.queues
+
+    def put(self, payload: Optional[str]) -> None:
+        for queue in self.queues:
+            if queue.full():
+                queue.get_nowait()
+                self.dropped += 1
+            queue.put_nowait(payload)
+
+    async def broadcast(self, results: AsyncIterator[ExecutionResult]) -> None:
+        try:
+            async for result in results:
+                self.put(json.dumps(result.formatted))
+        except Exception as error:
+            self.errors = json.dumps([located_error(error).formatted])
+        finally:
+            self.done = True
+            self.put(None)
+            await results.aclose()  # type: ignore
+
+
+class SharedSubscriptions:
+    """Running subscription operations, by document and variables."""
+
+    def __init__(
+        self, schema: Schema, queue_size: int = SUBSCRIPTION_QUEUE_SIZE
+    ) -> None:
+        self.schema = schema
+        self.queue_size = queue_size
+        self.operations: Dict[str, SharedSubscription] = {}
+
+    async def join(
+        self, payload: Dict[str, Any], context: Any
+    ) -> Union[SharedSubscription, ExecutionResult]:
+        """Running operation of a subscribe payload, or the result of its failure.
+
+        The operation is started with the context of its first client: resolvers of
+        subscriptions must not depend on the client. An operation whose results are
+        over is replaced by a fresh one, as its queues are already ended.
+        """
+        key = json.dumps(
+            [
+                payload.get("query"),
+                payload.get("variables"),
+                payload.get("operationName"),
+            ],
+            sort_keys=True,
+        )
+        operation = self.operations.get(key)
+        if operation is None or operation.done:
+            results = await self.schema.subscribe(
+                payload.get("query") or "",
+                variable_values=payload.get("variables"),
+                operation_name=payload.get("operationName"),
+                context_value=context,
+            )
+            if isinstance(results, ExecutionResult):
+                return results
+            operation = self.operations.get(key)
+            if operation is not None and not operation.done:
+                # started concurrently by another client.
+                await results.aclose()  # type: ignore
+            else:
+                operation = SharedSubscription(results, self.queue_size)
+                self.operations[key] = operation
+        return operation
+
+    def leave(
+        self, operation: SharedSubscription, queue: "asyncio.Queue[Optional[str]]"
+    ) -> None:
+        if operation.leave(queue):
+            for key, running in list(self.operations.items()):
+                if running is operation:
+                    del self.operations[key]
+
+
+class GraphQLWebSocket:
+    """Connection of a websocket client, running its operations concurrently."""
+
+    def __init__(
+        self,
+        subscriptions: SharedSubscriptions,
+        scope: Scope,
+        send: Send,
+        metrics: bool = GRAPHQL_METRICS,
+    ) -> None:
+        self.subscriptions = subscriptions
+        self.schema = subscriptions.schema
+        self.documents = document_cache(self.schema.graphql_schema)
+        self.metrics = metrics
+        self.middleware = (
+            RootFieldsMiddleware(
+                self.schema.graphql_schema, ResolverMetricsMiddleware()
+            )
+            if metrics
+            else None
+        )
+        self.scope = scope
+        self._send = send
+        self.protocol = GRAPHQL_WS
+        self.initialized = False
+        self.operations: Dict[str, "asyncio.Task[None]"] = {}
+        self.lock = asyncio.Lock()
+
+    async def send(self, message: Union[Dict[str, Any], str]) -> None:
+        """Send a message, or an already serialized one."""
+        if not isinstance(message, str):
+            message = json.dumps(message)
+        # the operations of a connection send concurrently.
+        async with self.lock:
+            await self._send({"type": "websocket.send", "text": message})
+
+    async def accept(self) -> bool:
+        """Accept the connection, if it uses a supported protocol."""
+        subprotocols = self.scope.get("subprotocols", [])
+        for protocol in (GRAPHQL_TRANSPORT_WS, GRAPHQL_WS):
+            if protocol in subprotocols:
+                self.protocol = protocol
+                await self._send({"type": "websocket.accept", "subprotocol": protocol})
+                return True
+        await self._send({"type": "websocket.close", "code": 4406})
+        return False
+
+    async def handle(self, message: Dict[str, Any]) -> Optional[int]:
+        """Handle a client message.
+
+        graphql-transport-ws clients must send connection_init before subscribing,
+        and no client can reuse the id of one of its running operations.
+
+        Returns:
+            int: code to close the connection with, None to keep it open
+        """
+        kind, operation_id = message.get("type"), message.get("id")
+        if kind == "connection_init":
+            self.initialized = True
+            await self.send({"type": "connection_ack"})
+        elif kind == "ping":
+            await self.send({"type": "pong"})
+        elif kind in ("subscribe", "start") and isinstance(operation_id, str):
+            if self.protocol == GRAPHQL_TRANSPORT_WS and not self.initialized:
+                return UNAUTHORIZED
+            if operation_id in self.operations:
+                return SUBSCRIBER_EXISTS
+            self.operations[operation_id] = asyncio.create_task(
+                self.run(operation_id, message.get("payload") or {})
+            )
+        elif kind in ("complete", "stop") and isinstance(operation_id, str):
+            self.stop(operation_id)
+        elif kind == "connection_terminate":
+            return 1000
+        return None
+
+    def stop(self, operation_id: str) -> None:
+        task = self.operations.pop(operation_id, None)
+        if task:
+            task.cancel()
+
+    def close(self) -> None:
+        for operation_id in list(self.operations):
+            self.stop(operation_id)
+
+    async def run(self, operation_id: str, payload: Dict[str, Any]) -> None:
+        """Execute an operation and send its results."""
+        try:
+            result = await self.execute(payload)
+            if isinstance(result, SharedSubscription):
+                errors = await self.stream(operation_id, result)
+                if errors is not None:
+                    await self.send_error(operation_id, errors)
+                    return
+            elif result.data is None and result.errors:
+                # the operation could not be executed at all.
+                await self.send_error(
+                    operation_id, json.dumps(result.formatted["errors"])
+                )
+                return
+            else:
+                await self.send_result(operation_id, json.dumps(result.formatted))
+            await self.send({"type": "complete", "id": operation_id})
+        finally:
+            self.operations.pop(operation_id, None)
+
+    async def stream(
+        self, operation_id: str, operation: SharedSubscription
+    ) -> Optional[str]:
+        """Send the results of a subscription, until there are no more.
+
+        Returns:
+            str: the serialized errors of the subscription if it failed
+        """
+        queue = operation.join()
+        try:
+            while True:
+                payload = await queue.get()
+                if payload is None:
+                    return operation.errors
+                await self.send_result(operation_id, payload)
+        finally:
+            self.subscriptions.leave(operation, queue)
+
+    async def send_result(self, operation_id: str, payload: str) -> None:
+        await self.send(
+            f'{{"type": "{MESSAGES[self.protocol]["result"]}", '
+            f'"id": {json.dumps(operation_id)}, "payload": {payload}}}'
+        )
+
+    async def send_error(self, operation_id: str, errors: str) -> None:
+        await self.send(
+            f'{{"type": "{MESSAGES[self.protocol]["error"]}", '
+            f'"id": {json.dumps(operation_id)}, "payload": {errors}}}'
+        )
+
+    async def check_cost(
+        self, document: DocumentNode, variables: Any, operation_name: Optional[str]
+    ) -> Optional[ExecutionResult]:
+        """Result rejecting a query costing more than QUERY_MAX_COST, or exceeding
+        the budget of the client, None if it is to be executed."""
+        cost = operation_cost(
+            self.schema.graphql_schema, document, operation_name, variables
+        )
+        error = cost_error(cost)
+        if error is None:
+            retry_after = await sync_to_async(spend_budget)(
+                scope_address(self.scope), cost
+            )
+            if retry_after:
+                seconds = math.ceil(retry_after)
+                error = GraphQLError(
+                    f"Query budget exceeded, retry in {seconds} s.",
+                    extensions={"retryAfter": seconds},
+                )
+        return None if error is None else ExecutionResult(data=None, errors=[error])
+
+    async def execute(
+        self, payload: Dict[str, Any]
+    ) -> Union[SharedSubscription, ExecutionResult]:
+        """Result of a query or mutation, or the running subscription."""
+        query = payload.get("query") or ""
+        variables = payload.get("variables")
+        operation_name = payload.get("operationName")
+        context = SimpleNamespace(scope=self.scope)
+        with measure(DOCUMENT_SECONDS, self.metrics):
+            document, errors = self.documents.document(query)
+        if document is None or errors:
+            return ExecutionResult(data=None, errors=errors)
+        operation = get_operation_ast(document, operation_name)
+        if operation and operation.operation == OperationType.SUBSCRIPTION:
+            return await self.subscriptions.join(payload, context)
+        rejected = await self.check_cost(document, variables, operation_name)
+        if rejected is not None:
+            return rejected
+        with execution_metrics(self.metrics):
+            result = execute(
+                self.schema.graphql_schema,
+                document,
+                variable_values=variables,
+                operation_name=operation_name,
+                context_value=context,
+                middleware=self.middleware,
+            )
+            if isawaitable(result):
+                result = await result
+        return result  # type: ignore
+
+
+def decode(message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """JSON object of a websocket message, None if it is not one."""
+    try:
+        content = json.loads(message.get("text") or message.get("bytes") or "")
+    except ValueError:
+        return None
+    return content if isinstance(content, dict) else None
+
+
+class GraphQLWebSocketApplication:
+    """ASGI application serving a GraphQL schema over websockets."""
+
+    def __init__(self, schema: Schema) -> None:
+        self.subscriptions = SharedSubscriptions(schema)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        message = await receive()
+        if message["type"] != "websocket.connect":
+            return
+        connection = GraphQLWebSocket(self.subscriptions, scope, send)
+        if not await connection.accept():
+            return
+        try:
+            while True:
+                message = await receive()
+                if message["type"] == "websocket.disconnect":
+                    return
+                content = decode(message)
+                if content is None:
+                    await send({"type": "websocket.close", "code": 4400})
+                    return
+                code = await connection.handle(content)
+                if code is not None:
+                    await send({"type": "websocket.close", "code": code})
+                    return
+        finally:
+            connection.close()
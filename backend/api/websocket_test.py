@@ -0,0 +1,400 @@
+"""Unit tests for websocket.py"""
+import asyncio
+import json
+from unittest.mock import MagicMock, patch
+import graphene
+import pytest
+from django.core.cache import caches
+from django.utils import timezone
+
+from api.models import Temperature
+from api.pubsub import ReadingHub
+from api.schema import schema
+from api.websocket import (
+    GRAPHQL_TRANSPORT_WS,
+    GRAPHQL_WS,
+    SUBSCRIBER_EXISTS,
+    UNAUTHORIZED,
+    GraphQLWebSocketApplication,
+    SharedSubscription,
+)
+
+
+class Query(graphene.ObjectType):
+    hello = graphene.String()
+    later = graphene.String()
+
+    def resolve_hello(root, info):
+        return "world"
+
+    async def resolve_later(root, info):
+        return "soon"
+
+
+class Subscription(graphene.ObjectType):
+    count = graphene.Int(until=graphene.Int())
+
+    async def subscribe_count(root, info, until=2):
+        for value in range(until):
+            yield value
+        if until < 0:
+            raise ValueError("source failed")
+
+
+COUNT_SCHEMA = graphene.Schema(query=Query, subscription=Subscription)
+
+
+class Client:
+    """In-memory websocket client of an ASGI application."""
+
+    def __init__(self, app, subprotocols=(GRAPHQL_TRANSPORT_WS,)):
+        self.received = asyncio.Queue()
+        self.sent = asyncio.Queue()
+        scope = {"type": "websocket", "subprotocols": list(subprotocols)}
+        self.received.put_nowait({"type": "websocket.connect"})
+        self.task = asyncio.ensure_future(app(scope, self.received.get, self.sent.put))
+
+    def send(self, **message):
+        self.received.put_nowait(
+            {"type": "websocket.receive", "text": json.dumps(message)}
+        )
+
+    async def recv(self):
+        event = await asyncio.wait_for(self.sent.get(), timeout=5)
+        if event["type"] == "websocket.send":
+            return json.loads(event["text"])
+        return event
+
+    async def disconnect(self):
+        self.received.put_nowait({"type": "websocket.disconnect"})
+        await self.task
+
+
+def _run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_transport_ws_protocol():
+    """Test the connection, ping, queries and errors of graphql-transport-ws."""
+
+    async def run():
+        client = Client(GraphQLWebSocketApplication(COUNT_SCHEMA))
+        assert (await client.recv())["subprotocol"] == GRAPHQL_TRANSPORT_WS
+        client.send(type="connection_init")
+        assert await client.recv() == {"type": "connection_ack"}
+        client.send(type="ping")
+        assert await client.recv() == {"type": "pong"}
+        client.send(type="subscribe", id="1", payload={"query": "{ hello }"})
+        assert await client.recv() == {
+            "type": "next",
+            "id": "1",
+            "payload": {"data": {"hello": "world"}},
+        }
+        assert await client.recv() == {"type": "complete", "id": "1"}
+        client.send(type="subscribe", id="2", payload={"query": "{ nope }"})
+        error = await client.recv()
+        assert (error["type"], error["id"]) == ("error", "2")
+        client.send(type="subscribe", id="3", payload={"query": "{"})
+        assert (await client.recv())["type"] == "error"
+        client.send(type="subscribe", id="4", payload={"query": "subscription { no }"})
+        assert (await client.recv())["type"] == "error"
+        query = "subscription ($until: Int) { count(until: $until) }"
+        payload = {"query": query, "variables": {"until": "x"}}
+        client.send(type="subscribe", id="5", payload=payload)
+        assert (await client.recv())["type"] == "error"
+        client.send(type="subscribe", id="6", payload={"query": "{ later }"})
+        assert await client.recv() == {
+            "type": "next",
+            "id": "6",
+            "payload": {"data": {"later": "soon"}},
+        }
+        await client.disconnect()
+
+    _run(run())
+
+
+def test_query_cost_and_budget():
+    """Test that the queries are checked against their maximum cost and charged to
+    the budget of the client, as over HTTP."""
+
+    async def run():
+        client = Client(GraphQLWebSocketApplication(COUNT_SCHEMA))
+        await client.recv()
+        client.send(type="connection_init")
+        await client.recv()
+        client.send(
+            type="subscribe", id="1", payload={"query": "{ a: hello b: hello }"}
+        )
+        assert await client.recv() == {
+            "type": "error",
+            "id": "1",
+            "payload": [{"message": "Query cost 2 exceeds the maximum of 1."}],
+        }
+        for operation_id in ("2", "3"):
+            client.send(
+                type="subscribe", id=operation_id, payload={"query": "{ hello }"}
+            )
+            assert (await client.recv())["type"] == "next"
+            assert await client.recv() == {"type": "complete", "id": operation_id}
+        client.send(type="subscribe", id="4", payload={"query": "{ hello }"})
+        error = await client.recv()
+        assert (error["type"], error["id"]) == ("error", "4")
+        assert error["payload"][0]["message"].startswith("Query budget exceeded")
+        assert 0 < error["payload"][0]["extensions"]["retryAfter"] <= 60
+        await client.disconnect()
+
+    with patch("api.cost.QUERY_MAX_COST", 1), patch("api.cost.QUERY_COST_BUDGET", 2):
+        caches["budget"].clear()
+        try:
+            _run(run())
+        finally:
+            caches["budget"].clear()
+
+
+def test_subscription_until_completed():
+    """Test that a subscription streams its results, then completes."""
+
+    async def run():
+        app = GraphQLWebSocketApplication(COUNT_SCHEMA)
+        client = Client(app, subprotocols=(GRAPHQL_WS,))
+        assert (await client.recv())["subprotocol"] == GRAPHQL_WS
+        client.send(type="start", id="1", payload={"query": "subscription { count }"})
+        for value in range(2):
+            assert await client.recv() == {
+                "type": "data",
+                "id": "1",
+                "payload": {"data": {"count": value}},
+            }
+        assert await client.recv() == {"type": "complete", "id": "1"}
+        await client.disconnect()
+        return app
+
+    app = _run(run())
+    assert app.subscriptions.operations == {}
+
+
+def test_temperature_subscription_shared():
+    """Test that clients of the same subscription share its execution."""
+    hub = ReadingHub()
+    # don't relay any publisher.
+    hub.relay_task = MagicMock(**{"done.return_value": False})
+    reading = Temperature(
+        id=1,
+        timestamp=timezone.datetime.fromisoformat("2022-02-15T12:00:00+00:00"),
+        value="19.5",
+    )
+    query = "subscription { temperature { timestamp value } }"
+
+    async def run():
+        app = GraphQLWebSocketApplication(schema)
+        clients = [Client(app), Client(app)]
+        for client in clients:
+            await client.recv()
+            client.send(type="connection_init")
+            await client.recv()
+            client.send(type="subscribe", id="1", payload={"query": query})
+        while len(hub.queues) < 1 or len(app.subscriptions.operations) < 1:
+            await asyncio.sleep(0.001)
+        operation = list(app.subscriptions.operations.values())[0]
+        while len(operation.queues) < 2:
+            await asyncio.sleep(0.001)
+        hub.publish(reading)
+        for client in clients:
+            assert await client.recv() == {
+                "type": "next",
+                "id": "1",
+                "payload": {
+                    "data": {
+                        "temperature": {
+                            "timestamp": "2022-02-15T12:00:00+00:00",
+                            "value": "19.5",
+                        }
+                    }
+                },
+            }
+        assert len(hub.queues) == 1
+        # the operation stops with its last client.
+        clients[0].send(type="complete", id="1")
+        await clients[1].disconnect()
+        await clients[0].disconnect()
+        while app.subscriptions.operations:
+            await asyncio.sleep(0.001)
+        while hub.queues:
+            await asyncio.sleep(0.001)
+
+    with patch("api.schema.reading_hub", hub):
+        _run(run())
+
+
+def test_shared_subscription_concurrent_start():
+    """Test that an operation started concurrently by two clients runs once."""
+    subscribe = COUNT_SCHEMA.subscribe
+
+    async def slow_subscribe(*args, **kwargs):
+        await asyncio.sleep(0)
+        return await subscribe(*args, **kwargs)
+
+    async def run():
+        app = GraphQLWebSocketApplication(COUNT_SCHEMA)
+        payload = {"query": "subscription { count(until: 1000000) }"}
+        with patch.object(COUNT_SCHEMA, "subscribe", slow_subscribe):
+            first, second = await asyncio.gather(
+                app.subscriptions.join(payload, None),
+                app.subscriptions.join(payload, None),
+            )
+        assert first is second
+        first.task.cancel()
+
+    _run(run())
+
+
+def test_shared_subscription_restarted():
+    """Test that a client joining an operation whose results are over gets a fresh
+    one, and that a queue of an ended operation is ended."""
+
+    async def run():
+        app = GraphQLWebSocketApplication(COUNT_SCHEMA)
+        payload = {"query": "subscription { count(until: 1) }"}
+        first = await app.subscriptions.join(payload, None)
+        queue = first.join()
+        assert json.loads(await queue.get()) == {"data": {"count": 0}}
+        assert await queue.get() is None
+        assert first.done
+        second = await app.subscriptions.join(payload, None)
+        assert second is not first
+        assert json.loads(await second.join().get()) == {"data": {"count": 0}}
+        assert await asyncio.wait_for(first.join().get(), 1) is None
+        # the ended operation leaving does not remove the fresh one.
+        app.subscriptions.leave(first, queue)
+        assert list(app.subscriptions.operations.values()) == [second]
+        await second.task
+
+    _run(run())
+
+
+def test_shared_subscription_drops_oldest():
+    """Test that a slow client only gets the latest results."""
+
+    async def run():
+        async def results():
+            await asyncio.sleep(3600)
+            yield  # pragma: no cover
+
+        operation = SharedSubscription(results(), queue_size=1)
+        queue = operation.join()
+        operation.put("1")
+        operation.put("2")
+        assert await queue.get() == "2"
+        assert operation.dropped == 1
+        assert operation.leave(queue)
+
+    _run(run())
+
+
+def test_subscription_failed():
+    """Test that the clients of a failed subscription get an error, not a hang."""
+
+    async def run():
+        app = GraphQLWebSocketApplication(COUNT_SCHEMA)
+        client = Client(app, subprotocols=(GRAPHQL_WS,))
+        await client.recv()
+        payload = {"query": "subscription { count(until: -1) }"}
+        client.send(type="start", id="1", payload=payload)
+        assert await client.recv() == {
+            "type": "error",
+            "id": "1",
+            "payload": [{"message": "source failed"}],
+        }
+        await client.disconnect()
+        return app
+
+    app = _run(run())
+    assert app.subscriptions.operations == {}
+
+
+def test_stop_operation():
+    """Test that an operation is stopped by the client, then its id reusable."""
+
+    async def run():
+        app = GraphQLWebSocketApplication(COUNT_SCHEMA)
+        client = Client(app, subprotocols=(GRAPHQL_WS,))
+        await client.recv()
+        payload = {"query": "subscription { count(until: 1000000) }"}
+        client.send(type="start", id="1", payload=payload)
+        await client.recv()
+        client.send(type="stop", id="1")
+        client.send(type="start", id="1", payload={"query": "{ hello }"})
+        while True:
+            message = await client.recv()
+            if "hello" in json.dumps(message):
+                break
+        client.send(type="start", id="2", payload=payload)
+        await client.recv()
+        client.send(type="stop", id="2")
+        client.send(type="connection_terminate")
+        while True:
+            message = await client.recv()
+            if message.get("type") == "websocket.close":
+                break
+        assert message["code"] == 1000
+        await client.task
+
+    _run(run())
+
+
+@pytest.mark.parametrize(
+    "subprotocols,received,code",
+    [
+        ((), None, 4406),
+        ((GRAPHQL_TRANSPORT_WS,), {"type": "websocket.receive", "text": "no"}, 4400),
+        ((GRAPHQL_TRANSPORT_WS,), {"type": "websocket.receive", "bytes": b"[]"}, 4400),
+    ],
+)
+def test_rejected(subprotocols, received, code):
+    """Test that unsupported protocols and messages close the connection."""
+
+    async def run():
+        client = Client(GraphQLWebSocketApplication(COUNT_SCHEMA), subprotocols)
+        if received:
+            await client.recv()
+            client.received.put_nowait(received)
+        assert (await client.recv()) == {"type": "websocket.close", "code": code}
+        await client.task
+
+    _run(run())
+
+
+@pytest.mark.parametrize(
+    "initialized,code", [(False, UNAUTHORIZED), (True, SUBSCRIBER_EXISTS)]
+)
+def test_rejected_subscribe(initialized, code):
+    """Test that graphql-transport-ws rejects a subscribe before connection_init,
+    and a second operation with the id of a running one."""
+
+    async def run():
+        client = Client(GraphQLWebSocketApplication(COUNT_SCHEMA))
+        await client.recv()
+        payload = {"query": "subscription { count(until: 1000000) }"}
+        if initialized:
+            client.send(type="connection_init")
+            await client.recv()
+            client.send(type="subscribe", id="1", payload=payload)
+            await client.recv()
+        client.send(type="subscribe", id="1", payload=payload)
+        while True:
+            message = await client.recv()
+            if message.get("type") == "websocket.close":
+                break
+        assert message["code"] == code
+        await client.task
+
+    _run(run())
+
+
+def test_not_a_connection():
+    async def run():
+        received = asyncio.Queue()
+        received.put_nowait({"type": "websocket.disconnect"})
+        await GraphQLWebSocketApplication(COUNT_SCHEMA)({}, received.get, None)
+
+    _run(run())
@@ -2,15 +2,31 @@
 ASGI config for backend project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Websocket connections to /graphql are served by the GraphQL websocket application
+(subscriptions), everything else by Django.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
 """
 
 import os
+from typing import Any
 
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# imported once Django is set up.
+from api.schema import schema  # noqa: E402
+from api.websocket import GraphQLWebSocketApplication  # noqa: E402
+
+graphql_ws_application = GraphQLWebSocketApplication(schema)
+
+
+async def application(scope: Any, receive: Any, send: Any) -> None:
+    if scope["type"] == "websocket" and scope["path"].rstrip("/") == "/graphql":
+        await graphql_ws_application(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
@@ -9,7 +9,7 @@ https://docs.djangoproject.com/en/4.0/topics/settings/
 For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.0/ref/settings/
 """
-from typing import List
+from typing import Any, Dict, List
 import environ
 from pathlib import Path
 
@@ -85,6 +85,36 @@ WSGI_APPLICATION = "backend.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/4.0/ref/settings/#databases
 
+# Connections are kept SQL_CONN_MAX_AGE seconds (0: closed at the end of each
+# request), and checked before being reused if SQL_CONN_HEALTH_CHECKS. Persistent
+# connections belong to a thread: under ASGI, where each request runs in its own
+# thread, keep SQL_CONN_MAX_AGE at 0 and enable the pool of each process instead
+# (PostgreSQL with psycopg 3 only), holding from SQL_POOL_MIN_SIZE to
+# SQL_POOL_MAX_SIZE connections (0 to disable), with a wait of at most
+# SQL_POOL_TIMEOUT seconds for a free one.
+# With psycopg 3, the statements executed SQL_PREPARE_THRESHOLD times on a
+# connection are prepared server-side (empty to disable), so that the hot queries
+# are planned once per connection. This binds the parameters server-side, which a
+# PgBouncer in transaction mode does not support.
+SQL_CONN_HEALTH_CHECKS = env.bool("SQL_CONN_HEALTH_CHECKS", default=True)
+SQL_POOL_MAX_SIZE = env.int("SQL_POOL_MAX_SIZE", default=0)
+SQL_PREPARE_THRESHOLD = env.int("SQL_PREPARE_THRESHOLD", default=None)
+
+DATABASE_OPTIONS: Dict[str, Any] = {}
+if SQL_POOL_MAX_SIZE:
+    from psycopg_pool import ConnectionPool
+
+    DATABASE_OPTIONS["pool"] = {
+        "min_size": env.int("SQL_POOL_MIN_SIZE", default=1),
+        "max_size": SQL_POOL_MAX_SIZE,
+        "timeout": env.float("SQL_POOL_TIMEOUT", default=10.0),
+    }
+    if SQL_CONN_HEALTH_CHECKS:
+        DATABASE_OPTIONS["pool"]["check"] = ConnectionPool.check_connection
+if SQL_PREPARE_THRESHOLD is not None:
+    DATABASE_OPTIONS["server_side_binding"] = True
+    DATABASE_OPTIONS["prepare_threshold"] = SQL_PREPARE_THRESHOLD
+
 DATABASES = {
     "default": {
         "ENGINE": env("SQL_ENGINE", default="django.db.backends.sqlite3"),
@@ -93,19 +123,146 @@ DATABASES = {
         "PASSWORD": env("SQL_PASSWORD", default="password"),
         "HOST": env("SQL_HOST", default="localhost"),
         "PORT": env("SQL_PORT", default="5432"),
+        "CONN_MAX_AGE": env.int("SQL_CONN_MAX_AGE", default=0),
+        "CONN_HEALTH_CHECKS": SQL_CONN_HEALTH_CHECKS,
+        "OPTIONS": DATABASE_OPTIONS,
     }
 }
 
 # Caching
 # In the real world, we would setup a true cache backend (Redis, Memcached)
 # But not LocMemCache (default) which is per-process, albeit we need cross-process caching.
+# When the API and the consumer run on the same host, FileBasedCache does the job
+# (see docker-compose.yml). Caching is disabled by default.
 CACHES = {
     "default": {
-        "BACKEND": "django.core.cache.backends.dummy.DummyCache",
+        "BACKEND": env(
+            "CACHE_BACKEND", default="django.core.cache.backends.dummy.DummyCache"
+        ),
+        "LOCATION": env("CACHE_LOCATION", default=""),
         "TIMEOUT": None,
-    }
+    },
+    # counters of the query budgets (see QUERY_COST_BUDGET), which need an atomic
+    # increment: LocMemCache counts per process, RedisCache or Memcached across the
+    # processes.
+    "budget": {
+        "BACKEND": env(
+            "QUERY_BUDGET_CACHE_BACKEND",
+            default="django.core.cache.backends.locmem.LocMemCache",
+        ),
+        "LOCATION": env("QUERY_BUDGET_CACHE_LOCATION", default="query-budget"),
+    },
 }
 
+# currentTemperature is served from the cache, where the consumer writes through
+# every reading it persists. A cached reading is kept at most
+# CURRENT_TEMPERATURE_CACHE_TIMEOUT seconds, after which it is read again from the
+# db: this bounds its staleness if the consumer stops.
+CURRENT_TEMPERATURE_CACHE_TIMEOUT = env.float(
+    "CURRENT_TEMPERATURE_CACHE_TIMEOUT", default=5.0
+)
+
+# Column type of the temperature values: "decimal" (numeric), "fixed" (bigint of
+# the value scaled by 10**15, exact and compact) or "float" (double precision).
+# The migrations create a numeric column: `python manage.py convert_value_storage`
+# converts it, after the migrations and after any change of the setting.
+TEMPERATURE_VALUE_STORAGE = env("TEMPERATURE_VALUE_STORAGE", default="decimal")
+
+# On PostgreSQL, the Temperature table can be partitioned by TEMPERATURE_PARTITIONING
+# ("day" or "month", empty to disable) by `python manage.py manage_partitions`, which
+# also creates the partitions of the next TEMPERATURE_PARTITIONS_AHEAD intervals.
+# Readings older than TEMPERATURE_RETENTION_DAYS (0 to keep them all) are dropped
+# by the same command, after being downsampled into the rollups unless
+# TEMPERATURE_RETENTION_DOWNSAMPLE is False. Without partitioning, they are deleted.
+TEMPERATURE_PARTITIONING = env("TEMPERATURE_PARTITIONING", default="")
+TEMPERATURE_PARTITIONS_AHEAD = env.int("TEMPERATURE_PARTITIONS_AHEAD", default=3)
+TEMPERATURE_RETENTION_DAYS = env.int("TEMPERATURE_RETENTION_DAYS", default=0)
+TEMPERATURE_RETENTION_DOWNSAMPLE = env.bool(
+    "TEMPERATURE_RETENTION_DOWNSAMPLE", default=True
+)
+
+# temperatureStatistics is computed from the per-minute/hour/day rollups maintained
+# along with the readings, and from the raw readings at the edges of the window.
+# Set to False to always aggregate the raw readings.
+STATISTICS_FROM_ROLLUPS = env.bool("STATISTICS_FROM_ROLLUPS", default=True)
+
+# temperatureSeries returns a point per minute, hour or day bucket, read from the
+# rollups as well (unless STATISTICS_FROM_ROLLUPS is False). Its window may span at
+# most TEMPERATURE_SERIES_MAX_BUCKETS buckets.
+TEMPERATURE_SERIES_MAX_BUCKETS = env.int(
+    "TEMPERATURE_SERIES_MAX_BUCKETS", default=10000
+)
+
+# Each API process keeps the readings of the last RECENT_READINGS_HORIZON seconds in
+# memory (0 to disable), indexed to answer temperatureStatistics on windows within
+# the horizon without querying the db. New readings are fetched at most every
+# RECENT_READINGS_SYNC_INTERVAL seconds, which bounds how stale these answers are.
+# Each sync fetches again the readings of the last RECENT_READINGS_SYNC_OVERLAP
+# seconds, to get those committed late or out of order by the feed consumer.
+RECENT_READINGS_HORIZON = env.float("RECENT_READINGS_HORIZON", default=86400.0)
+RECENT_READINGS_SYNC_INTERVAL = env.float("RECENT_READINGS_SYNC_INTERVAL", default=1.0)
+RECENT_READINGS_SYNC_OVERLAP = env.float("RECENT_READINGS_SYNC_OVERLAP", default=60.0)
+
+# Live readings: the consumer streams every reading it persists to the API processes
+# through a local TCP server on PUBSUB_HOST:PUBSUB_PORT (0 to disable), which drops
+# the API processes lagging by more than PUBSUB_BUFFER_LIMIT bytes. They reconnect
+# after PUBSUB_RETRY_DELAY seconds. Each subscription of an API process buffers at
+# most SUBSCRIPTION_QUEUE_SIZE readings, the oldest are dropped for slow clients.
+PUBSUB_HOST = env("PUBSUB_HOST", default="127.0.0.1")
+PUBSUB_PORT = env.int("PUBSUB_PORT", default=4100)
+PUBSUB_BUFFER_LIMIT = env.int("PUBSUB_BUFFER_LIMIT", default=1024 * 1024)
+PUBSUB_RETRY_DELAY = env.float("PUBSUB_RETRY_DELAY", default=1.0)
+SUBSCRIPTION_QUEUE_SIZE = env.int("SUBSCRIPTION_QUEUE_SIZE", default=16)
+
+# The temperatures history query returns pages of at most TEMPERATURES_MAX_PAGE_SIZE
+# readings, which is also the size of a page when none is requested.
+TEMPERATURES_MAX_PAGE_SIZE = env.int("TEMPERATURES_MAX_PAGE_SIZE", default=1000)
+
+# Each API process keeps the parsed and validated documents of the last
+# GRAPHQL_DOCUMENT_CACHE_SIZE distinct queries (0 to disable). Persisted queries are
+# kept by their hash, PERSISTED_QUERIES_CACHE_SIZE of them in each process, and
+# PERSISTED_QUERIES_TIMEOUT seconds in the shared cache (None: forever).
+GRAPHQL_DOCUMENT_CACHE_SIZE = env.int("GRAPHQL_DOCUMENT_CACHE_SIZE", default=256)
+PERSISTED_QUERIES_CACHE_SIZE = env.int("PERSISTED_QUERIES_CACHE_SIZE", default=1024)
+PERSISTED_QUERIES_TIMEOUT = env.float("PERSISTED_QUERIES_TIMEOUT", default=None)
+
+# Responses to GET queries are tagged with the version of the data (ETag), and not
+# executed again while it is unchanged (304). The responses to the queries of
+# windows ended more than IMMUTABLE_WINDOW_GRACE seconds ago (the delay after which
+# a reading is not expected anymore) are cacheable by the reverse proxy for
+# IMMUTABLE_RESPONSE_MAX_AGE seconds, which should stay below
+# TEMPERATURE_RETENTION_DAYS for the temperatures history.
+IMMUTABLE_WINDOW_GRACE = env.float("IMMUTABLE_WINDOW_GRACE", default=300.0)
+IMMUTABLE_RESPONSE_MAX_AGE = env.int("IMMUTABLE_RESPONSE_MAX_AGE", default=86400)
+
+# The cost of a query is estimated before its execution: currentTemperature and
+# feedGaps cost 1, temperatureStatistics and temperatureSeries QUERY_COST_PER_DAY
+# per day of their window (a window without start spans TEMPERATURE_RETENTION_DAYS,
+# or QUERY_COST_UNBOUNDED_DAYS when all readings are kept), temperatures
+# QUERY_COST_PER_READING per reading of its page. A document costing more than
+# QUERY_MAX_COST is rejected (0: no limit). A client spending more than
+# QUERY_COST_BUDGET per QUERY_COST_BUDGET_PERIOD seconds is answered with a 429
+# until the end of the period (0: no budget), counted in the "budget" cache, whose
+# backend must increment atomically. Clients are told apart by address:
+# behind QUERY_BUDGET_PROXIES reverse proxies, the one appended to X-Forwarded-For
+# by the farthest of them.
+
+QUERY_COST_PER_DAY = env.float("QUERY_COST_PER_DAY", default=1.0)
+QUERY_COST_PER_READING = env.float("QUERY_COST_PER_READING", default=0.01)
+QUERY_COST_UNBOUNDED_DAYS = env.float("QUERY_COST_UNBOUNDED_DAYS", default=3650.0)
+QUERY_MAX_COST = env.int("QUERY_MAX_COST", default=20000)
+QUERY_COST_BUDGET = env.int("QUERY_COST_BUDGET", default=200000)
+QUERY_COST_BUDGET_PERIOD = env.int("QUERY_COST_BUDGET_PERIOD", default=60)
+QUERY_BUDGET_PROXIES = env.int("QUERY_BUDGET_PROXIES", default=0)
+
+# Prometheus metrics: each API process serves its own at /metrics. Unless
+# GRAPHQL_METRICS is False, they include the latency of the root field resolvers,
+# and the number and duration of the SQL queries of each GraphQL request. The
+# consumer serves its ingestion metrics on port FEED_METRICS_PORT (0 to disable).
+
+GRAPHQL_METRICS = env.bool("GRAPHQL_METRICS", default=True)
+FEED_METRICS_PORT = env.int("FEED_METRICS_PORT", default=9101)
+
 # Internationalization
 # https://docs.djangoproject.com/en/4.0/topics/i18n/
 
@@ -133,3 +290,54 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 # URI of the temperature source feed
 
 FEED_URI = env("FEED_URI", default="ws://localhost:1000/graphql")
+
+# Feeds of several sensors, consumed concurrently by the same process, as
+# "sensor=uri,sensor=uri". When empty, FEED_URI is the feed of the default sensor.
+
+FEED_URIS = env.dict("FEED_URIS", default={})
+
+# Buffered ingestion of the feed: readings are kept in memory and written in bulk
+# as soon as either FEED_BATCH_SIZE readings are pending or the oldest pending
+# reading is FEED_FLUSH_INTERVAL seconds old.
+
+FEED_BATCH_SIZE = env.int("FEED_BATCH_SIZE", default=100)
+FEED_FLUSH_INTERVAL = env.float("FEED_FLUSH_INTERVAL", default=1.0)
+
+# Received readings are handed to FEED_WRITERS db writers through a queue holding
+# at most FEED_QUEUE_SIZE readings. When it is full, FEED_QUEUE_POLICY tells what
+# to do with a new reading:
+# - "block": wait for room, which stops reading the websocket meanwhile
+# - "drop-oldest": discard the oldest queued reading
+# - "spill": append the reading to FEED_SPILL_PATH, replayed when the queue drains
+# Queue metrics are written every FEED_STATS_INTERVAL seconds (0 to disable).
+
+FEED_WRITERS = env.int("FEED_WRITERS", default=1)
+FEED_QUEUE_SIZE = env.int("FEED_QUEUE_SIZE", default=10000)
+FEED_QUEUE_POLICY = env("FEED_QUEUE_POLICY", default="block")
+FEED_SPILL_PATH = env(
+    "FEED_SPILL_PATH", default=str(BASE_DIR / ".db_data" / "feed_spill.jsonl")
+)
+FEED_STATS_INTERVAL = env.float("FEED_STATS_INTERVAL", default=60.0)
+
+# The connection to a feed is pinged every FEED_PING_INTERVAL seconds, and deemed
+# lost without a pong within FEED_PING_TIMEOUT seconds. A lost feed is reconnected
+# after a jittered delay doubling from FEED_RECONNECT_MIN_DELAY seconds up to
+# FEED_RECONNECT_MAX_DELAY seconds, while the other feeds keep being consumed.
+# On shutdown, the writers get FEED_SHUTDOWN_TIMEOUT seconds to persist the queued
+# readings, which are spilled to FEED_SPILL_PATH past that delay.
+
+FEED_PING_INTERVAL = env.float("FEED_PING_INTERVAL", default=20.0)
+FEED_PING_TIMEOUT = env.float("FEED_PING_TIMEOUT", default=20.0)
+FEED_RECONNECT_MIN_DELAY = env.float("FEED_RECONNECT_MIN_DELAY", default=1.0)
+FEED_RECONNECT_MAX_DELAY = env.float("FEED_RECONNECT_MAX_DELAY", default=60.0)
+FEED_SHUTDOWN_TIMEOUT = env.float("FEED_SHUTDOWN_TIMEOUT", default=8.0)
+
+# `python manage.py load_readings` persists the readings it loads by chunks of
+# LOAD_CHUNK_SIZE, in a transaction each.
+
+LOAD_CHUNK_SIZE = env.int("LOAD_CHUNK_SIZE", default=20000)
+
+# The consumer keeps the feed status (on/off) in memory and refreshes it every
+# FEED_STATUS_POLL_INTERVAL seconds from the cache, or the db on a cache miss.
+
+FEED_STATUS_POLL_INTERVAL = env.float("FEED_STATUS_POLL_INTERVAL", default=1.0)
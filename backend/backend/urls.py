@@ -2,10 +2,13 @@
 from django.urls import path
 from django.views.decorators.csrf import csrf_exempt
 
-from graphene_django.views import GraphQLView
-
 from api.schema import schema
+from api.views import AsyncGraphQLView, metrics
 
 urlpatterns = [
-    path("graphql", csrf_exempt(GraphQLView.as_view(graphiql=True, schema=schema))),
+    path(
+        "graphql",
+        csrf_exempt(AsyncGraphQLView.as_view(graphiql=True, schema=schema)),
+    ),
+    path("metrics", metrics),
 ]
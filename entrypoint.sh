@@ -11,11 +11,28 @@ then
 fi
 
 python manage.py migrate
+# convert the temperature values to TEMPERATURE_VALUE_STORAGE, if needed
+python manage.py convert_value_storage
+# partition the readings if configured, before any write, then keep the
+# partitions and retention up to date in background
+python manage.py manage_partitions
+python manage.py manage_partitions --every 3600 &
+maintainer=$!
 python manage.py collectstatic --noinput --clear
 
 # start feed consumer in background
 echo "Start consume_feed"
 python manage.py consume_feed &
+consumer=$!
 echo "consume_feed started in background"
 
-exec "$@"
\ No newline at end of file
+# forward the stop signal to the consumer, for it to persist the readings it
+# already received, and to the partitions maintainer, then wait for them to exit.
+"$@" &
+server=$!
+trap 'kill -TERM $server $consumer $maintainer 2>/dev/null' TERM INT
+wait $server
+kill -TERM $consumer $maintainer 2>/dev/null
+wait $server
+wait $consumer
+wait $maintainer
\ No newline at end of file